@@ -128,6 +128,9 @@ widgetapp = None
 # pretty easily, but right now it only should be used in the frontend thread.
 connection_pools = None
 
+# AsyncQueryExecutor that ItemLists use to select ids without blocking the UI
+item_query_executor = None
+
 # handles the right-hand display
 display_manager = None
 
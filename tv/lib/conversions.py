@@ -27,6 +27,8 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import bisect
+import itertools
 import os
 import re
 import time
@@ -59,6 +61,17 @@ from miro.plat.popen import Popen
 
 NON_WORD_CHARS = re.compile(r"[^a-zA-Z0-9]+")
 
+def get_max_concurrent_conversions():
+    """Get the number of conversions we should run at once.
+
+    If MAX_CONCURRENT_CONVERSIONS is 0, we pick a number based on how many
+    CPUs there are, leaving one free for the rest of Miro.
+    """
+    count = int(app.config.get(prefs.MAX_CONCURRENT_CONVERSIONS))
+    if count <= 0:
+        count = max(1, utils.get_logical_cpu_count() - 1)
+    return count
+
 
 def get_conversions_folder():
     """Get the folder for video conversions.
@@ -351,7 +364,9 @@ class ConversionManager(signals.SignalEmitter):
         self.converters = ConverterManager()
         self.task_loop = None
         self.message_queue = Queue.Queue(-1)
+        # pending tasks are kept in the order that we will run them
         self.pending_tasks = list()
+        self.task_counter = itertools.count()
         self.running_tasks = list()
         self.finished_tasks = list()
         self.quit_flag = False
@@ -364,7 +379,9 @@ class ConversionManager(signals.SignalEmitter):
     def shutdown(self):
         if self.task_loop is not None:
             self.cancel_all()
+            self._enqueue_message("quit")
             self.task_loop.join()
+            self.task_loop = None
 
     def set_last_conversion(self, conversion_id):
         self.last_conversion_id = conversion_id
@@ -400,16 +417,22 @@ class ConversionManager(signals.SignalEmitter):
         return self.converters.lookup_converter(converter_id)
 
     def start_conversion(self, converter_id, item_info, target_folder=None,
-                         create_item=True):
+                         create_item=True, priority=0):
+        """Start converting an item.
+
+        Conversions run in the order they were started, except that ones
+        with a higher priority run first.
+        """
         task = self._make_conversion_task(
             converter_id, item_info, target_folder, create_item)
         if ((task is not None
              and task.get_executable() is not None
              and not self._has_running_task(task.key)
              and not self._has_finished_task(task.key))):
-            self._check_task_loop()
-            self.pending_tasks.append(task)
+            task.sort_key = (-priority, self.task_counter.next())
             self._notify_task_added(task)
+            self._enqueue_message("add_task", task=task)
+            self._check_task_loop()
 
         return task
 
@@ -428,6 +451,10 @@ class ConversionManager(signals.SignalEmitter):
                                         target_folder, create_item)
         return None
 
+    def _task_done(self, task):
+        """Called from a task's thread when it's done running."""
+        self._enqueue_message("task_done", task=task)
+
     def _check_task_loop(self):
         if self.task_loop is None:
             self.quit_flag = False
@@ -438,6 +465,8 @@ class ConversionManager(signals.SignalEmitter):
             self.task_loop.start()
 
     def _loop(self):
+        # The loop thread runs until shutdown().  It blocks on the message
+        # queue when there's nothing to do, so it's cheap to keep around.
         self.emit('thread-will-start')
         self.emit('thread-started', threading.currentThread())
         self.emit('thread-did-start')
@@ -445,44 +474,90 @@ class ConversionManager(signals.SignalEmitter):
             self.emit('begin-loop')
             self._run_loop_cycle()
             self.emit('end-loop')
-            time.sleep(0.5)
         logging.debug("Conversions manager thread loop finished.")
-        self.task_loop = None
 
     def _run_loop_cycle(self):
+        # wait until something happens: a new task, a task finishing, a
+        # message from the frontend, etc.
         self._process_message_queue()
 
         notify_count = False
-        max_concurrent_tasks = int(app.config.get(
-                prefs.MAX_CONCURRENT_CONVERSIONS))
-        if ((self.pending_tasks_count() > 0
-             and self.running_tasks_count() < max_concurrent_tasks)):
-            task = self.pending_tasks.pop()
+        while True:
+            started = self._start_pending_tasks()
+            reaped = self._reap_finished_tasks()
+            notify_count = notify_count or started or reaped
+            if not reaped:
+                break
+            # finished tasks leave slots open for pending ones.
+            # CopyConversionTasks finish as soon as they are started, so this
+            # can take a few times through the loop.
+
+        if notify_count:
+            self._notify_tasks_count()
+
+    def _start_pending_tasks(self):
+        """Start pending tasks until we run out of tasks or slots.
+
+        :returns: True if we started any tasks
+        """
+        started = False
+        max_concurrent_tasks = get_max_concurrent_conversions()
+        while (self.pending_tasks and
+               self.running_tasks_count() < max_concurrent_tasks):
+            task = self.pending_tasks.pop(0)
             if not self._has_running_task(task.key):
                 self.running_tasks.append(task)
                 task.run()
                 self._notify_task_changed(task)
-                notify_count = True
+                started = True
+        return started
 
+    def _reap_finished_tasks(self):
+        """Move tasks that are done running to finished_tasks.
+
+        :returns: True if we found any finished tasks
+        """
+        reaped = False
         for task in list(self.running_tasks):
             if task.done_running():
                 self._notify_task_changed(task)
                 self.running_tasks.remove(task)
                 self.finished_tasks.append(task)
-                notify_count = True
+                reaped = True
                 if task.is_finished():
                     self.schedule_staging(task.key)
+        return reaped
 
-        if notify_count:
-            self._notify_tasks_count()
+    def _add_pending_task(self, task):
+        sort_keys = [t.sort_key for t in self.pending_tasks]
+        index = bisect.bisect_right(sort_keys, task.sort_key)
+        self.pending_tasks.insert(index, task)
 
     def _process_message_queue(self):
-        try:
-            msg = self.message_queue.get_nowait()
-        except Queue.Empty:
-            return
+        """Wait for a message, then handle it and any others that are
+        queued.
+        """
+        msg = self.message_queue.get()
+        while True:
+            self._handle_message(msg)
+            try:
+                msg = self.message_queue.get_nowait()
+            except Queue.Empty:
+                return
+
+    def _handle_message(self, msg):
+        if msg['message'] == 'add_task':
+            self._add_pending_task(msg['task'])
+
+        elif msg['message'] == 'quit':
+            self.quit_flag = True
+
+        elif msg['message'] == 'task_done':
+            # the task sends this message right before its thread exits.
+            # Wait for that, so that done_running() returns True.
+            msg['task'].thread.join()
 
-        if msg['message'] == 'get_tasks_list':
+        elif msg['message'] == 'get_tasks_list':
             self._notify_tasks_list()
 
         elif msg['message'] == 'cancel':
@@ -660,7 +735,6 @@ class ConversionManager(signals.SignalEmitter):
                 task.interrupt()
         self._notify_all_tasks_removed()
         self._notify_tasks_count()
-        self.quit_flag = True
 
 
 def build_output_paths(item_info, target_folder, converter_info):
@@ -827,11 +901,17 @@ class ConversionTask(object):
 
         self.progress = 0
         self.thread = threading.Thread(target=utils.thread_body,
-                                       args=[self._loop],
+                                       args=[self._thread_main],
                                        name="Conversion Task")
         self.thread.setDaemon(True)
         self.thread.start()
 
+    def _thread_main(self):
+        try:
+            self._loop()
+        finally:
+            conversion_manager._task_done(self)
+
     def get_eta(self):
         """Calculates the eta for this conversion to be completed.
 
@@ -0,0 +1,152 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""miro.data.asyncquery -- Run database queries in a worker thread."""
+
+import logging
+import Queue
+import threading
+
+from miro.plat.utils import thread_body
+
+class QueryCanceled(StandardError):
+    """A query was canceled before it finished."""
+
+class QueryJob(object):
+    """A query submitted to an AsyncQueryExecutor.
+
+    :attribute connection: Connection the query runs on
+    :attribute canceled: has cancel() been called?
+    """
+    def __init__(self, connection, func, callback, errback):
+        self.connection = connection
+        self.func = func
+        self.callback = callback
+        self.errback = errback
+        self.canceled = False
+        self.running = False
+        self.lock = threading.Lock()
+
+    def cancel(self):
+        """Cancel this query.
+
+        If the query hasn't started yet, it won't be run.  If it's running,
+        we interrupt sqlite.  Either way, the errback will be called with a
+        QueryCanceled error.  Note that the query may have finished just
+        before we got here, in which case the callback gets called like
+        normal.
+        """
+        self.lock.acquire()
+        try:
+            self.canceled = True
+            if self.running:
+                self.connection.interrupt()
+        finally:
+            self.lock.release()
+
+class AsyncQueryExecutor(object):
+    """Runs database queries in a worker thread.
+
+    ItemTracker uses this to select its item ids without blocking the UI.
+    Queries run one at a time, in the order they were submitted, on a
+    connection that the caller checked out from a ConnectionPool.  The
+    connection is used only by the worker thread until the results get
+    passed back.
+
+    :param result_scheduler: function that schedules a function call on the
+    thread that submits the queries.  For the frontend, this is
+    call_on_ui_thread().
+    """
+    def __init__(self, result_scheduler):
+        self.result_scheduler = result_scheduler
+        self.queue = Queue.Queue()
+        self.thread = None
+
+    def run(self, connection, func, callback, errback):
+        """Run a query in the worker thread.
+
+        func will be called with connection as its only argument.  Once it
+        finishes, callback(result) or errback(error) will be called using
+        result_scheduler.
+
+        :returns: QueryJob that can be used to cancel the query
+        """
+        if self.thread is None:
+            self._start_thread()
+        job = QueryJob(connection, func, callback, errback)
+        self.queue.put(job)
+        return job
+
+    def _start_thread(self):
+        self.thread = threading.Thread(name='AsyncQueryExecutor',
+                                       target=thread_body,
+                                       args=[self._thread_loop])
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _thread_loop(self):
+        while True:
+            job = self.queue.get()
+            if job == "QUIT":
+                break
+            self._run_job(job)
+
+    def _run_job(self, job):
+        job.lock.acquire()
+        try:
+            if job.canceled:
+                self.result_scheduler(job.errback, QueryCanceled())
+                return
+            job.running = True
+        finally:
+            job.lock.release()
+        try:
+            try:
+                result = job.func(job.connection)
+            finally:
+                job.lock.acquire()
+                job.running = False
+                job.lock.release()
+        except Exception, e:
+            if job.canceled:
+                e = QueryCanceled()
+            else:
+                logging.debug("AsyncQueryExecutor: error running %s",
+                              job.func, exc_info=True)
+            self.result_scheduler(job.errback, e)
+        else:
+            self.result_scheduler(job.callback, result)
+
+    def shutdown(self):
+        """Stop the worker thread once the queries already submitted have
+        been run.
+        """
+        if self.thread is not None:
+            self.queue.put("QUIT")
+            self.thread = None
@@ -34,22 +34,52 @@ import logging
 import sqlite3
 
 from miro import messages
+from miro.clock import clock
 from miro.data import dbcollations
+from miro.data import sqlitetuning
 
 class ConnectionLimitError(StandardError):
     """We've hit our connection limits."""
 
 class Connection(object):
-    """Wraps the sqlite3.Connection object."""
+    """Wraps the sqlite3.Connection object.
+
+    Connections can be handed off between threads (see
+    miro.data.asyncquery), but only one thread should use a connection at a
+    time.
+
+    Each connection keeps a cache of prepared statements.  Callers that run
+    the same query many times should use the same SQL with different
+    parameters, rather than putting values in the SQL, so that the cache gets
+    hit.
+
+    :attribute query_count: number of times execute() has been called
+    :attribute query_time: total time spent in execute()
+    :attribute last_used: time when the connection was last released back to
+    its pool
+    """
+    # max number of prepared statements to cache for each connection
+    STATEMENT_CACHE_SIZE = 100
+
     def __init__(self, path):
         self._connection = sqlite3.connect(
-            path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES)
+            path, isolation_level=None, detect_types=sqlite3.PARSE_DECLTYPES,
+            check_same_thread=False,
+            cached_statements=self.STATEMENT_CACHE_SIZE)
+        self.query_count = 0
+        self.query_time = 0.0
+        self.last_used = clock()
 
     def execute(self, sql, values=()):
-        return self._connection.execute(sql, values)
+        start = clock()
+        try:
+            return self._connection.execute(sql, values)
+        finally:
+            self.query_count += 1
+            self.query_time += clock() - start
 
     def execute_many(self, sql, values):
-        self._connection.execute_many(sql, values)
+        self._connection.executemany(sql, values)
 
     def commit(self):
         self._connection.commit()
@@ -60,23 +90,55 @@ class Connection(object):
     def close(self):
         self._connection.close()
 
+    def interrupt(self):
+        """Abort any query running on this connection.
+
+        This is the one method that's safe to call from another thread while
+        a query is running.
+        """
+        self._connection.interrupt()
+
 class ConnectionPool(object):
     """Pool of SQLite database connections
 
+    Opening a connection means a new sqlite3.connect() call, registering our
+    collations and starting with a cold page cache.  To avoid that, we keep
+    connections that get released open, even if we have more than
+    min_connections.  Extra connections get closed once they've been idle for
+    IDLE_TIMEOUT seconds.
+
     :attribute wal_mode: Is the database using WAL mode for its journal?
     """
-    def __init__(self, db_path, min_connections=2, max_connections=7):
+    # seconds a connection can sit unused before we close it
+    IDLE_TIMEOUT = 300
+
+    def __init__(self, db_path, min_connections=2, max_connections=7,
+                 tuning_profile=None):
         """Create a new ConnectionPool
 
         :param db_path: path to the database to connect to
         :param min_connections: Minimum number of connections to maintain
         :param max_connections: Maximum number of connections to the database
+        :param tuning_profile: sqlitetuning.TuningProfile for new
+        connections.  Defaults to sqlitetuning.get_profile()
         """
+        if tuning_profile is None:
+            tuning_profile = sqlitetuning.get_profile()
         self.db_path = db_path
         self.min_connections = min_connections
         self.max_connections = max_connections
+        self.tuning_profile = tuning_profile
         self.all_connections = set()
+        # free connections, the most recently used connection is last
         self.free_connections = []
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.open_time = 0.0
+        # query stats for connections that we've closed
+        self._closed_query_count = 0
+        self._closed_query_time = 0.0
+        self.wal_mode = None
         self._check_wal_mode()
 
     def _check_wal_mode(self):
@@ -86,15 +148,28 @@ class ConnectionPool(object):
         cursor = connection.execute("PRAGMA journal_mode=wal");
         self.wal_mode = cursor.fetchone()[0] == u'wal'
         connection.commit()
+        # The connection was made before we knew wal_mode, so we need to
+        # apply the tuning profile now.
+        self.tuning_profile.apply(connection, self.wal_mode)
         self.release_connection(connection)
 
     def _make_new_connection(self):
         # TODO: should have error handling here, but what should we do?
+        start = clock()
         connection = Connection(self.db_path)
         dbcollations.setup_collations(connection)
+        if self.wal_mode is not None:
+            self.tuning_profile.apply(connection, self.wal_mode)
+        self.open_time += clock() - start
         self.free_connections.append(connection)
         self.all_connections.add(connection)
 
+    def _close_connection(self, connection):
+        self._closed_query_count += connection.query_count
+        self._closed_query_time += connection.query_time
+        connection.close()
+        self.all_connections.remove(connection)
+
     def destroy(self):
         """Forcably destroy all connections."""
         for connection in self.all_connections:
@@ -113,11 +188,16 @@ class ConnectionPool(object):
 
         :returns sqlite3.Connection object
         """
-        if not self.free_connections:
-            if len(self.all_connections) < self.max_connections:
-                self._make_new_connection()
-            else:
-                raise ConnectionLimitError()
+        self.evict_idle_connections()
+        if self.free_connections:
+            self.hits += 1
+        elif len(self.all_connections) < self.max_connections:
+            self.misses += 1
+            self._make_new_connection()
+        else:
+            raise ConnectionLimitError()
+        # pop the most recently used connection, it should have the warmest
+        # cache
         return self.free_connections.pop()
 
     def release_connection(self, connection):
@@ -126,11 +206,52 @@ class ConnectionPool(object):
         if connection not in self.all_connections:
             raise ValueError("%s not from this pool" % connection)
         connection.rollback()
-        if len(self.all_connections) > self.min_connections:
-            connection.close()
-            self.all_connections.remove(connection)
-        else:
-            self.free_connections.append(connection)
+        connection.last_used = clock()
+        self.free_connections.append(connection)
+        self.evict_idle_connections()
+
+    def evict_idle_connections(self):
+        """Close connections that have been idle for IDLE_TIMEOUT seconds.
+
+        We never go below min_connections.
+        """
+        cutoff = clock() - self.IDLE_TIMEOUT
+        # free_connections is ordered by last_used, so we only need to check
+        # the start of the list
+        while (self.free_connections and
+               len(self.all_connections) > self.min_connections and
+               self.free_connections[0].last_used <= cutoff):
+            self._close_connection(self.free_connections.pop(0))
+            self.evictions += 1
+
+    def get_stats(self):
+        """Get statistics for this pool.
+
+        :returns: dict with these keys:
+            - connections: number of open connections
+            - free: number of connections not checked out
+            - hits: get_connection() calls that got an open connection
+            - misses: get_connection() calls that opened a new connection
+            - evictions: connections closed for being idle
+            - open_latency: average time to open a connection
+            - queries: number of queries run
+            - query_latency: average time spent in execute()
+        """
+        query_count = self._closed_query_count
+        query_time = self._closed_query_time
+        for connection in self.all_connections:
+            query_count += connection.query_count
+            query_time += connection.query_time
+        return {
+            'connections': len(self.all_connections),
+            'free': len(self.free_connections),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'open_latency': self.open_time / max(self.misses, 1),
+            'queries': query_count,
+            'query_latency': query_time / max(query_count, 1),
+        }
 
     @contextlib.contextmanager
     def context(self):
@@ -149,6 +270,10 @@ class ConnectionPool(object):
 
 class DeviceConnectionPool(ConnectionPool):
     """ConnectionPool for a device."""
+    # Don't keep idle connections open, they would stop the device from being
+    # unmounted.
+    IDLE_TIMEOUT = 0
+
     def __init__(self, device_info):
         # min_connections is 0 since we should normally not have any
         # connections to the device database.  The max connections is 2 in
@@ -28,20 +28,45 @@
 # statement from all source files in the program, then also delete it here.
 
 """miro.data.fulltextsearch -- Set up full text search in our SQLite DB
+
+Keeping item_fts up to date is done with triggers on the item table.  There
+are 2 modes for handling updates:
+
+- REINDEX_IMMEDIATE -- re-index the row inside the UPDATE statement
+- REINDEX_DEFERRED -- remember the ids of changed rows in item_fts_pending
+  and re-index them all at once with flush_deferred_reindex().  LiveStorage
+  does this right before it commits a transaction.
+
+In both modes the update triggers only fire when one of the indexed columns
+actually changes.  Most of our UPDATE statements only touch columns like
+watched_time, resume_time or the download status, so this avoids rewriting
+item_fts for them.
 """
 from miro import app
 
+REINDEX_IMMEDIATE = 'immediate'
+REINDEX_DEFERRED = 'deferred'
+
+def fts_columns(path_column='filename', has_entry_description=True):
+    """Get the columns that we index in item_fts."""
+    columns = ['title', 'description', 'artist', 'album',
+               'genre', path_column, 'parent_title', ]
+    if has_entry_description:
+        columns.append('entry_description')
+    return columns
+
 def setup_fulltext_search(connection, table='item', path_column='filename',
                          has_entry_description=True):
-    """Set up fulltext search on a newly created database."""
+    """Set up fulltext search on a newly created database.
+
+    The update trigger starts out in REINDEX_IMMEDIATE mode.  Use
+    set_reindex_mode() to change that.
+    """
     if hasattr(app, 'in_unit_tests') and _no_item_table(connection, table):
         # handle unittests not defining the item table in their schemas
         return
 
-    columns = ['title', 'description', 'artist', 'album',
-               'genre', path_column, 'parent_title', ]
-    if has_entry_description:
-        columns.append('entry_description')
+    columns = fts_columns(path_column, has_entry_description)
     column_list = ', '.join(c for c in columns)
     column_list_for_new = ', '.join("new.%s" % c for c in columns)
     column_list_with_types = ', '.join('%s text' % c for c in columns)
@@ -51,21 +76,12 @@ def setup_fulltext_search(connection, table='item', path_column='filename',
                        "SELECT %s.id, %s FROM %s" %
                        (column_list, table, column_list, table))
     # make triggers to keep item_fts up to date
-    connection.execute("CREATE TRIGGER item_bu "
-                       "BEFORE UPDATE ON %s BEGIN "
-                       "DELETE FROM item_fts WHERE docid=old.id; "
-                       "END;" % (table,))
-
     connection.execute("CREATE TRIGGER item_bd "
                        "BEFORE DELETE ON %s BEGIN "
                        "DELETE FROM item_fts WHERE docid=old.id; "
                        "END;" % (table,))
 
-    connection.execute("CREATE TRIGGER item_au "
-                       "AFTER UPDATE ON %s BEGIN "
-                       "INSERT INTO item_fts(docid, %s) "
-                       "VALUES(new.id, %s); "
-                       "END;" % (table, column_list, column_list_for_new))
+    connection.execute(_update_trigger_sql(table, columns, REINDEX_IMMEDIATE))
 
     connection.execute("CREATE TRIGGER item_ai "
                        "AFTER INSERT ON %s BEGIN "
@@ -73,6 +89,100 @@ def setup_fulltext_search(connection, table='item', path_column='filename',
                        "VALUES(new.id, %s); "
                        "END;" % (table, column_list, column_list_for_new))
 
+def _update_trigger_sql(table, columns, mode):
+    column_list = ', '.join(c for c in columns)
+    column_list_for_new = ', '.join("new.%s" % c for c in columns)
+    changed_test = ' OR '.join("old.%s IS NOT new.%s" % (c, c)
+                               for c in columns)
+    if mode == REINDEX_IMMEDIATE:
+        body = ("DELETE FROM item_fts WHERE docid=old.id; "
+                "INSERT INTO item_fts(docid, %s) "
+                "VALUES(new.id, %s); " % (column_list, column_list_for_new))
+    elif mode == REINDEX_DEFERRED:
+        body = ("INSERT OR IGNORE INTO item_fts_pending(docid) "
+                "VALUES(new.id); ")
+    else:
+        raise ValueError("Unknown reindex mode: %r" % (mode,))
+    return ("CREATE TRIGGER item_au "
+            "AFTER UPDATE OF %s ON %s "
+            "WHEN %s BEGIN "
+            "%s"
+            "END;" % (column_list, table, changed_test, body))
+
+def get_indexed_columns(connection):
+    """Get the columns of the item_fts table for an existing database."""
+    cursor = connection.execute("PRAGMA table_info(item_fts)")
+    return [row[1] for row in cursor.fetchall()]
+
+def get_reindex_mode(connection):
+    """Get the current reindex mode of a database.
+
+    :returns: REINDEX_IMMEDIATE, REINDEX_DEFERRED, or None if the database
+    doesn't have an item_fts table.
+    """
+    if _no_item_table(connection, 'item_fts'):
+        return None
+    if _no_item_table(connection, 'item_fts_pending'):
+        return REINDEX_IMMEDIATE
+    else:
+        return REINDEX_DEFERRED
+
+def set_reindex_mode(connection, table, mode):
+    """Change how update triggers keep item_fts up to date.
+
+    This is a no-op if the database is already using mode.  When switching
+    away from REINDEX_DEFERRED, we flush any pending updates first.
+
+    :returns: the new reindex mode, or None if there's no item_fts table
+    """
+    current_mode = get_reindex_mode(connection)
+    if current_mode is None:
+        return None
+    columns = get_indexed_columns(connection)
+    if current_mode == REINDEX_DEFERRED:
+        # changes made before this point (for example by database upgrades)
+        # need to be indexed no matter what mode we're switching to.
+        for sql in flush_deferred_reindex_sql(table, columns):
+            connection.execute(sql)
+    if current_mode == mode and _update_trigger_matches(connection, table,
+                                                        columns, mode):
+        return mode
+    connection.execute("DROP TRIGGER IF EXISTS item_bu")
+    connection.execute("DROP TRIGGER IF EXISTS item_au")
+    if mode == REINDEX_DEFERRED:
+        connection.execute("CREATE TABLE IF NOT EXISTS item_fts_pending "
+                           "(docid integer PRIMARY KEY)")
+    else:
+        connection.execute("DROP TABLE IF EXISTS item_fts_pending")
+    connection.execute(_update_trigger_sql(table, columns, mode))
+    return mode
+
+def _update_trigger_matches(connection, table, columns, mode):
+    cursor = connection.execute("SELECT sql FROM sqlite_master "
+                                "WHERE type='trigger' AND name='item_au'")
+    row = cursor.fetchone()
+    if row is None:
+        return False
+    # sqlite_master stores the statement without the trailing semicolon
+    return row[0] + ';' == _update_trigger_sql(table, columns, mode)
+
+def flush_deferred_reindex_sql(table, columns):
+    """Get the statements that re-index rows in item_fts_pending.
+
+    Rows that were deleted since they were added to item_fts_pending are
+    handled by the delete trigger, so they simply won't get re-inserted.
+    """
+    column_list = ', '.join(c for c in columns)
+    return [
+        "DELETE FROM item_fts WHERE docid IN "
+        "(SELECT docid FROM item_fts_pending)",
+        "INSERT INTO item_fts(docid, %s) "
+        "SELECT %s.id, %s FROM %s "
+        "WHERE %s.id IN (SELECT docid FROM item_fts_pending)" %
+        (column_list, table, column_list, table, table),
+        "DELETE FROM item_fts_pending",
+    ]
+
 def _no_item_table(connection, table_name):
     cursor = connection.execute("SELECT COUNT(*) FROM sqlite_master "
                                 "WHERE type='table' and name=?",
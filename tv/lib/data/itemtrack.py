@@ -30,6 +30,7 @@
 """miro.data.itemtrack -- Track Items in the database
 """
 import collections
+import functools
 import logging
 import string
 import sqlite3
@@ -43,6 +44,7 @@ from miro import prefs
 from miro import schema
 from miro import signals
 from miro import util
+from miro.data import connectionpool
 from miro.data import item
 from miro.gtcache import gettext as _
 
@@ -95,6 +97,17 @@ class ItemTrackerQueryBase(object):
             return True
         return False
 
+    def can_update_incrementally(self, message):
+        """Given a ItemChanges message, can ItemTracker update its id list by
+        re-checking only the items in message?
+
+        This is only possible if the message lists all items whose position
+        in the list could have changed.  Also, we need a total ordering to
+        figure out where items go and can't handle a LIMIT clause, since items
+        could come in or fall out of the list at the end.
+        """
+        return self.order_by is not None and self.limit is None
+
     def _parse_column(self, column):
         """Parse a column specification.
 
@@ -243,9 +256,11 @@ class ItemTrackerQueryBase(object):
         other_tables.discard('item')
         return other_tables
 
-    def select_ids(self, connection):
+    def select_ids(self, connection, item_ids=None):
         """Run the select statement for this query
 
+        :param item_ids: if given, only check these ids.  The results are
+        sorted by id for items that our ORDER BY clause considers equal.
         :returns: list of item ids
         """
         sql_parts = []
@@ -253,8 +268,8 @@ class ItemTrackerQueryBase(object):
         sql_parts.append("SELECT %s.id FROM %s" %
                          (self.table_name(), self.table_name()))
         self._add_joins(sql_parts, arg_list)
-        self._add_conditions(sql_parts, arg_list)
-        self._add_order_by(sql_parts, arg_list)
+        self._add_conditions(sql_parts, arg_list, item_ids)
+        self._add_order_by(sql_parts, arg_list, item_ids is not None)
         self._add_limit(sql_parts, arg_list)
         sql = ' '.join(sql_parts)
         logging.debug("ItemTracker: running query %s (%s)", sql, arg_list)
@@ -321,8 +336,9 @@ class ItemTrackerQueryBase(object):
         if self.match_string:
             sql_parts.append(self.join_sql('item_fts'))
 
-    def _add_conditions(self, sql_parts, arg_list):
-        if not (self.conditions or self.match_string):
+    def _add_conditions(self, sql_parts, arg_list, item_ids=None):
+        if not (self.conditions or self.match_string or
+                item_ids is not None):
             return
         where_parts = []
         for c in self.conditions:
@@ -331,12 +347,20 @@ class ItemTrackerQueryBase(object):
         if self.match_string:
             where_parts.append("item_fts MATCH ?")
             arg_list.append(self.match_string)
+        if item_ids is not None:
+            where_parts.append("%s.id IN (%s)" % (self.table_name(),
+                ', '.join('?' for id_ in item_ids)))
+            arg_list.extend(item_ids)
         sql_parts.append("WHERE %s" % ' AND '.join(
             '(%s)' % part for part in where_parts))
 
-    def _add_order_by(self, sql_parts, arg_list):
+    def _add_order_by(self, sql_parts, arg_list, break_ties=False):
         if self.order_by:
-            sql_parts.append("ORDER BY %s" % self.order_by.sql)
+            if break_ties:
+                sql_parts.append("ORDER BY %s, %s.id" % (self.order_by.sql,
+                                                         self.table_name()))
+            else:
+                sql_parts.append("ORDER BY %s" % self.order_by.sql)
 
     def _add_limit(self, sql_parts, arg_list):
         if self.limit is not None:
@@ -362,6 +386,15 @@ class ItemTrackerQuery(ItemTrackerQueryBase):
             return True
         return ItemTrackerQueryBase.could_list_change(self, message)
 
+    def can_update_incrementally(self, message):
+        # changes to downloaders and playlists aren't listed by item id
+        other_tables = self.get_other_tables_to_track()
+        if message.dlstats_changed and 'remote_downloader' in other_tables:
+            return False
+        if message.playlists_changed and 'playlist_item_map' in other_tables:
+            return False
+        return ItemTrackerQueryBase.can_update_incrementally(self, message)
+
 class DeviceItemTrackerQuery(ItemTrackerQueryBase):
     """ItemTrackerQuery for DeviceItems."""
 
@@ -385,6 +418,13 @@ class SharingItemTrackerQuery(ItemTrackerQueryBase):
         else:
             return ItemTrackerQueryBase.could_list_change(self, message)
 
+    def can_update_incrementally(self, message):
+        if message.changed_playlists and self.tracking_playlist_map():
+            return False
+        else:
+            return ItemTrackerQueryBase.can_update_incrementally(self,
+                                                                 message)
+
 class ItemTracker(signals.SignalEmitter):
     """Track items in the database
 
@@ -404,12 +444,30 @@ class ItemTracker(signals.SignalEmitter):
     - "items-changed" (changed_id_list): some items have been changed, but the
     list is the same.
     - "list-changed": items have been added, removed, or reorded in the list.
+
+    When only a few items change, we update the list incrementally rather
+    than re-running the entire query.  In that case, we emit these signals
+    before "list-changed", to say exactly what happened:
+
+    - "items-removed" (removed_id_list): items have been removed
+    - "items-inserted" (inserted_id_list): items have been added
+    - "items-moved" (moved_id_list): items have changed position
+
+    If ItemTracker is created with a query_executor, then it selects its ids
+    in a worker thread when it's created and when change_query() is called.
+    Until the results come back, the tracker keeps its old list (which starts
+    out empty).  Once they do, we emit "will-change" and "list-changed".
     """
 
     # how many rows we fetch at one time in _ensure_row_loaded()
     FETCH_ROW_CHUNK_SIZE = 25
+    # Max number of added/changed/removed items that we will handle by
+    # updating the list incrementally.  For more changes, we just refetch the
+    # entire list.
+    INCREMENTAL_UPDATE_MAX = 50
 
-    def __init__(self, idle_scheduler, query, item_source):
+    def __init__(self, idle_scheduler, query, item_source,
+                 query_executor=None):
         """Create an ItemTracker
 
         :param idle_scheduler: function to schedule idle callback functions.
@@ -417,20 +475,38 @@ class ItemTracker(signals.SignalEmitter):
         idletime.
         :param query: ItemTrackerQuery to use
         :param item_source: ItemSource to use.
+        :param query_executor: AsyncQueryExecutor to select ids with.  If
+        None, we select ids synchronously.
         """
         signals.SignalEmitter.__init__(self)
         self.create_signal("will-change")
         self.create_signal("items-changed")
         self.create_signal("list-changed")
+        self.create_signal("items-removed")
+        self.create_signal("items-inserted")
+        self.create_signal("items-moved")
         self.idle_scheduler = idle_scheduler
         self.idle_work_scheduled = False
         self.item_fetcher = None
         self.item_source = item_source
         self._db_retry_callback_pending = False
+        self.query_executor = query_executor
+        # incremented each time we want a new id list.  Results from
+        # query_executor for older generations get dropped.
+        self.query_generation = 0
+        # QueryJob for the id list that query_executor is fetching
+        self._fetch_job = None
+        # should we start another fetch once _fetch_job finishes?
+        self._fetch_after_job = False
         self._set_query(query)
-        self._fetch_id_list()
-        if self.item_fetcher is not None:
-            self._schedule_idle_work()
+        if query_executor is None:
+            self._fetch_id_list()
+            if self.item_fetcher is not None:
+                self._schedule_idle_work()
+        else:
+            self.id_list = []
+            self._id_list_fetched()
+            self._fetch_id_list_async()
 
     def is_valid(self):
         """Is this item list valid?
@@ -446,6 +522,10 @@ class ItemTracker(signals.SignalEmitter):
         self to an empty list.
         """
         self._destroy_item_fetcher()
+        if self._fetch_job is not None:
+            # _on_fetch_job_done/_on_fetch_job_error will clean up after the
+            # job
+            self._fetch_job.cancel()
         self.id_list = self.id_to_index = self.row_data = None
 
     def make_item_fetcher(self, connection, id_list):
@@ -491,15 +571,91 @@ class ItemTracker(signals.SignalEmitter):
         self._destroy_item_fetcher()
         try:
             connection = self.item_source.get_connection()
-            connection.execute("BEGIN TRANSACTION")
-            self.id_list = self.query.select_ids(connection)
-            self.item_fetcher = self.make_item_fetcher(connection, self.id_list)
+            self.id_list, self.item_fetcher = self._select_id_list(
+                self.query, connection)
         except sqlite3.DatabaseError, e:
             logging.warn("%s while fetching items", e, exc_info=True)
             self._make_empty_list_after_db_error()
+        self._id_list_fetched()
+
+    def _select_id_list(self, query, connection):
+        """Select the ids for query.
+
+        When using query_executor, this runs in the worker thread.
+
+        :returns: (id_list, item_fetcher) tuple
+        """
+        connection.execute("BEGIN TRANSACTION")
+        id_list = query.select_ids(connection)
+        return id_list, self.make_item_fetcher(connection, id_list)
+
+    def _id_list_fetched(self):
+        """Called after we set id_list to a newly fetched list."""
         self.id_to_index = dict((id_, i) for i, id_ in enumerate(self.id_list))
         self.row_data = {}
 
+    def _fetch_id_list_async(self):
+        """Fetch the ids for this list using query_executor.
+
+        We only run 1 query at a time.  If one is already running, it's
+        been superseded, so we cancel it and start a new one once it
+        finishes.
+        """
+        self.query_generation += 1
+        if self._fetch_job is not None:
+            self._fetch_job.cancel()
+            self._fetch_after_job = True
+        else:
+            self._start_fetch_job()
+
+    def _start_fetch_job(self):
+        try:
+            connection = self.item_source.get_connection()
+        except connectionpool.ConnectionLimitError:
+            # our item_fetcher and other trackers are using all the
+            # connections.  Fetch synchronously instead, which releases the
+            # item_fetcher's connection before selecting the ids.
+            self._refetch_id_list()
+            return
+        self._fetch_job = self.query_executor.run(
+            connection,
+            functools.partial(self._select_id_list, self.query),
+            functools.partial(self._on_fetch_job_done, self.query_generation),
+            functools.partial(self._on_fetch_job_error, self.query_generation,
+                              connection))
+
+    def _on_fetch_job_done(self, generation, result):
+        self._fetch_job = None
+        id_list, item_fetcher = result
+        if self.id_list is None or generation != self.query_generation:
+            # we've been destroyed or the results are stale
+            item_fetcher.destroy()
+        else:
+            self.emit('will-change')
+            self._destroy_item_fetcher()
+            self.id_list, self.item_fetcher = id_list, item_fetcher
+            self._id_list_fetched()
+            self._schedule_idle_work()
+            self.emit('list-changed')
+        self._start_queued_fetch()
+
+    def _on_fetch_job_error(self, generation, connection, error):
+        self._fetch_job = None
+        self.item_source.release_connection(connection)
+        if self.id_list is not None and generation == self.query_generation:
+            logging.warn("%s while fetching items", error)
+            self.emit('will-change')
+            self._destroy_item_fetcher()
+            self._make_empty_list_after_db_error()
+            self._id_list_fetched()
+            self.emit('list-changed')
+        self._start_queued_fetch()
+
+    def _start_queued_fetch(self):
+        if self._fetch_after_job and self.id_list is not None:
+            self._fetch_after_job = False
+            self._start_fetch_job()
+
     def _make_empty_list_after_db_error(self):
         self.id_list = []
         self._run_db_error_dialog()
@@ -543,6 +699,101 @@ class ItemTracker(signals.SignalEmitter):
         if send_signals:
             self.emit("list-changed")
 
+    def _update_id_list_incrementally(self, message):
+        """Update our id list after an ItemChanges message without
+        refetching the entire list.
+
+        We re-run our query for only the added/changed items, then find the
+        new position of those items using a binary search.
+
+        :returns: (removed_ids, inserted_ids, moved_ids) or None if we need
+        to refetch the entire list instead.
+        """
+        removed_ids = set(message.removed)
+        check_ids = set(message.added).union(message.changed) - removed_ids
+        if (self.item_fetcher is None or
+            len(check_ids) + len(removed_ids) > self.INCREMENTAL_UPDATE_MAX or
+            not self.query.can_update_incrementally(message)):
+            return None
+        try:
+            need_refetch = self.item_fetcher.refresh_items(check_ids,
+                added_ids=message.added, removed_ids=removed_ids)
+            if need_refetch:
+                return None
+            connection = self.item_fetcher.connection
+            if check_ids:
+                new_ids = self.query.select_ids(connection, check_ids)
+            else:
+                new_ids = []
+            id_list = [id_ for id_ in self.id_list
+                       if id_ not in check_ids and id_ not in removed_ids]
+            # Insert the new ids in order.  They're already sorted relative
+            # to each other, so each one goes after the last.
+            start = 0
+            for id_ in new_ids:
+                pos = self._find_insert_position(connection, id_list, id_,
+                                                 start)
+                if pos is None:
+                    return None
+                id_list.insert(pos, id_)
+                start = pos + 1
+        except sqlite3.DatabaseError, e:
+            logging.warn("%s while updating id list", e, exc_info=True)
+            return None
+        return self._set_id_list(id_list, check_ids)
+
+    def _find_insert_position(self, connection, id_list, item_id, start):
+        """Find where item_id goes in id_list using a binary search.
+
+        :returns: index to insert item_id at or None if an item went missing
+        from the database.
+        """
+        low, high = start, len(id_list)
+        while low < high:
+            middle = (low + high) // 2
+            ordered = self.query.select_ids(connection,
+                                            (id_list[middle], item_id))
+            if len(ordered) != 2:
+                return None
+            if ordered[0] == item_id:
+                high = middle
+            else:
+                low = middle + 1
+        return low
+
+    def _set_id_list(self, id_list, check_ids):
+        """Replace our id list after an incremental update.
+
+        :returns: (removed_ids, inserted_ids, moved_ids)
+        """
+        old_id_to_index = self.id_to_index
+        id_to_index = dict((id_, i) for i, id_ in enumerate(id_list))
+        removed_ids = [id_ for id_ in self.id_list
+                       if id_ not in id_to_index]
+        inserted_ids = [id_ for id_ in id_list
+                        if id_ not in old_id_to_index]
+        # Items that we re-checked and stayed in the list have moved if the
+        # number of items before them, not counting other items that were
+        # added/removed, is different.
+        removed_before = inserted_before = 0
+        old_rank = {}
+        for i, id_ in enumerate(self.id_list):
+            if id_ not in id_to_index:
+                removed_before += 1
+            elif id_ in check_ids:
+                old_rank[id_] = i - removed_before
+        moved_ids = []
+        for i, id_ in enumerate(id_list):
+            if id_ not in old_id_to_index:
+                inserted_before += 1
+            elif id_ in old_rank and old_rank[id_] != i - inserted_before:
+                moved_ids.append(id_)
+        self._uncache_row_data(removed_ids)
+        self.id_list = id_list
+        self.id_to_index = id_to_index
+        self.item_fetcher.id_list = id_list
+        return removed_ids, inserted_ids, moved_ids
+
     def get_items(self):
         """Get a list of all items in sorted order."""
         return [self.get_row(i) for i in xrange(len(self.id_list))]
@@ -668,7 +919,10 @@ class ItemTracker(signals.SignalEmitter):
         :param new_query: ItemTrackerQuery object
         """
         self._set_query(new_query)
-        self._refetch_id_list()
+        if self.query_executor is None:
+            self._refetch_id_list()
+        else:
+            self._fetch_id_list_async()
 
     def on_item_changes(self, message):
         """Call this when items get changed and the list needs to be
@@ -679,12 +933,27 @@ class ItemTracker(signals.SignalEmitter):
 
         :param message: an ItemChanges message
         """
+        if self._fetch_job is not None:
+            # We're waiting on a new id list, which may not reflect these
+            # changes.  Fetch again once it comes in.
+            self._fetch_after_job = True
+            return
         self.emit('will-change')
         changed_ids = [item_id for item_id in message.changed
                        if self.item_in_list(item_id)]
         self._uncache_row_data(changed_ids)
         if self._could_list_change(message):
-            self._refetch_id_list(send_signals=False)
+            changes = self._update_id_list_incrementally(message)
+            if changes is None:
+                self._refetch_id_list(send_signals=False)
+            else:
+                removed_ids, inserted_ids, moved_ids = changes
+                if removed_ids:
+                    self.emit("items-removed", removed_ids)
+                if inserted_ids:
+                    self.emit("items-inserted", inserted_ids)
+                if moved_ids:
+                    self.emit("items-moved", moved_ids)
             self.emit("list-changed")
         else:
             if len(self.id_list) == 0:
@@ -710,6 +979,24 @@ class ItemTracker(signals.SignalEmitter):
         """Calculate if an ItemChanges means the list may have changed."""
         return self.query.could_list_change(message)
 
+def id_param_chunks(id_list, chunk_size):
+    """Split a list of ids into chunks to use with id_param_sql().
+
+    Each chunk has exactly chunk_size values.  The last one gets padded with
+    None, which never matches an id.  This way every query we run has the same
+    SQL and sqlite can reuse the prepared statement from its cache instead of
+    parsing a new statement each time.
+    """
+    id_list = list(id_list)
+    for start in xrange(0, len(id_list), chunk_size):
+        chunk = id_list[start:start+chunk_size]
+        chunk.extend([None] * (chunk_size - len(chunk)))
+        yield chunk
+
+def id_param_sql(column, chunk_size):
+    """Get a "column IN (?, ?, ...)" expression for id_param_chunks()."""
+    return "%s IN (%s)" % (column, ', '.join(['?'] * chunk_size))
+
 class ItemFetcher(object):
     """Create ItemInfo objects for ItemTracker
 
@@ -738,12 +1025,33 @@ class ItemFetcher(object):
     select_has_playables() which figure out which items in the list are
     playable using an SQL select.  This is needed because we want to calculate
     this without having to load all the ItemInfos in the list.
+
+    All the queries that take a list of ids use parameterized statements with
+    a fixed number of parameters (see id_param_chunks()), so sqlite only has
+    to prepare them once per connection.
     """
 
+    # number of ids we pass to a query to fetch rows.  This should be at
+    # least ItemTracker.FETCH_ROW_CHUNK_SIZE, so that we can load a chunk of
+    # rows with 1 query.
+    FETCH_PARAM_COUNT = 25
+    # number of ids we pass to queries that run over the entire list
+    LIST_PARAM_COUNT = 500
+
     def __init__(self, connection, item_source, id_list):
         self.connection = connection
         self.item_source = item_source
         self.id_list = id_list
+        self._prepare_playable_sql()
+
+    def _prepare_playable_sql(self):
+        where = ("%s IS NOT NULL AND file_type != 'other' AND %s" %
+                 (self.path_column(),
+                  id_param_sql('id', self.LIST_PARAM_COUNT)))
+        self._playable_ids_sql = ("SELECT id FROM %s WHERE %s" %
+                                  (self.table_name(), where))
+        self._has_playables_sql = ("SELECT EXISTS (SELECT 1 FROM %s "
+                                   "WHERE %s)" % (self.table_name(), where))
 
     def select_columns(self):
         return self.item_source.select_info.select_columns
@@ -786,13 +1094,16 @@ class ItemFetcher(object):
         """
         raise NotImplementedError()
 
-    def refresh_items(self, changed_ids):
+    def refresh_items(self, changed_ids, added_ids=(), removed_ids=()):
         """Refresh item data.
 
         Normally ItemFetcher uses data from the read transaction that the
         connection it was created with was in.  Use this method to force
         ItemFetcher to use new data for a list of items.
 
+        :param added_ids: ids for items that have been added to the database
+        :param removed_ids: ids for items that have been removed from the
+        database
         :returns True: if we can't refresh the items and we should refetch the
         entire list instead.  This is a hack to work around #19823
         """
@@ -803,14 +1114,32 @@ class ItemFetcher(object):
 
         :returns: list of item ids
         """
-        raise NotImplementedError()
+        playable_ids = []
+        for chunk in id_param_chunks(self.id_list, self.LIST_PARAM_COUNT):
+            cursor = self.connection.execute(self._playable_ids_sql, chunk)
+            playable_ids.extend(row[0] for row in cursor)
+        return playable_ids
 
     def select_has_playables(self):
         """Calculate if any items are playable using a select statement.
 
         :returns: True/False
         """
-        raise NotImplementedError()
+        for chunk in id_param_chunks(self.id_list, self.LIST_PARAM_COUNT):
+            cursor = self.connection.execute(self._has_playables_sql, chunk)
+            if cursor.fetchone()[0] == 1:
+                return True
+        return False
+
+    def _fetch_rows(self, sql, id_list):
+        """Run a query made with id_param_sql() for a list of ids.
+
+        :returns: list of rows
+        """
+        rows = []
+        for chunk in id_param_chunks(id_list, self.FETCH_PARAM_COUNT):
+            rows.extend(self.connection.execute(sql, chunk))
+        return rows
 
 class ItemFetcherWAL(ItemFetcher):
     def __init__(self, connection, item_source, id_list):
@@ -837,31 +1166,32 @@ class ItemFetcherWAL(ItemFetcher):
     def _prepare_sql(self):
         """Get an SQL statement ready to fire when fetch() is called.
 
-        The statement will be ready to go, except the WHERE clause will not be
-        present, since we can't know that in advance.
+        The ids to fetch get passed in as parameters, see id_param_chunks().
         """
         columns = ['%s.%s' % (c.table, c.column)
                    for c in self.select_columns()]
-        self._sql = ("SELECT %s FROM %s %s" %
-                     (', '.join(columns), self.table_name(), self.join_sql()))
+        id_column = '%s.id' % self.table_name()
+        self._sql = ("SELECT %s FROM %s %s WHERE %s" %
+                     (', '.join(columns), self.table_name(), self.join_sql(),
+                      id_param_sql(id_column, self.FETCH_PARAM_COUNT)))
 
     def fetch_items(self, id_list):
         """Create Item objects."""
-        where = ("WHERE %s.id in (%s)" %
-                 (self.table_name(), ', '.join(str(i) for i in id_list)))
-        sql = ' '.join((self._sql, where))
-        cursor = self.connection.execute(sql)
-        return [self.item_source.make_item_info(row) for row in cursor]
+        return [self.item_source.make_item_info(row)
+                for row in self._fetch_rows(self._sql, id_list)]
 
-    def refresh_items(self, changed_ids):
+    def refresh_items(self, changed_ids, added_ids=(), removed_ids=()):
         # We ignore changed_ids and just start a new transaction which will
         # refresh all the data.
         self.connection.commit()
         self.connection.execute("BEGIN TRANSACTION")
         # check if an item has been added/removed from the DB now that we have
-        # a new transaction.  This can happen if the backend changes some
-        # items sends an ItemsChanged message, then deletes them before we
-        # process the message (see #19823)
+        # a new transaction, other than the ones we were told about.  This
+        # can happen if the backend changes some items sends an ItemsChanged
+        # message, then deletes them before we process the message (see
+        # #19823)
+        self.max_item_id = max([self.max_item_id] + list(added_ids))
+        self.item_count += len(added_ids) - len(removed_ids)
 
         new_max_id = self.calc_max_item_id()
         new_item_count = self.calc_item_count()
@@ -879,28 +1209,11 @@ class ItemFetcherWAL(ItemFetcher):
         # nothing has changed, we can return false
         return False
 
-    def select_playable_ids(self):
-        sql = ("SELECT id FROM %s "
-               "WHERE %s IS NOT NULL AND "
-               "file_type != 'other' AND "
-               "id in (%s)" % 
-               (self.table_name(), self.path_column(),
-                ','.join(str(id_) for id_ in self.id_list)))
-        return [row[0] for row in self.connection.execute(sql)]
-
-    def select_has_playables(self):
-        sql = ("SELECT EXISTS (SELECT 1 FROM %s "
-               "WHERE %s IS NOT NULL AND "
-               "file_type != 'other' AND "
-               "id in (%s))" %
-               (self.table_name(), self.path_column(),
-                ','.join(str(id_) for id_ in self.id_list)))
-        return self.connection.execute(sql).fetchone()[0] == 1
-
 class ItemFetcherNoWAL(ItemFetcher):
     def __init__(self, connection, item_source, id_list):
         ItemFetcher.__init__(self, connection, item_source, id_list)
         self._make_temp_table()
+        self._prepare_sql()
         self._select_into_temp_table(id_list)
         self.connection.commit()
 
@@ -916,25 +1229,33 @@ class ItemFetcherNoWAL(ItemFetcher):
         self.connection.execute(create_sql)
         self.connection.execute(index_sql)
 
-    def _select_into_temp_table(self, id_list):
+    def _prepare_sql(self):
         template = string.Template("""\
 INSERT OR REPLACE INTO $temp_table_name($dest_columns)
 SELECT $source_columns
 FROM $table_name
 $join_sql
-WHERE $table_name.id in ($id_list)""")
+WHERE $id_param_sql""")
         d = {
             'temp_table_name': self.temp_table_name,
             'table_name': self.table_name(),
             'join_sql': self.join_sql(),
-            'id_list': ', '.join(str(id_) for id_ in id_list),
+            'id_param_sql': id_param_sql('%s.id' % self.table_name(),
+                                         self.LIST_PARAM_COUNT),
             'dest_columns': ','.join(ci.attr_name
                                      for ci in self.select_columns()),
             'source_columns': ','.join('%s.%s' % (ci.table, ci.column)
                                        for ci in self.select_columns()),
         }
-        sql = template.substitute(d)
-        self.connection.execute(sql)
+        self._insert_sql = template.substitute(d)
+        # We can use SELECT * here because we know that we defined the columns
+        # in the same order as select_columns() returned them.
+        self._select_sql = "SELECT * FROM %s WHERE %s" % (
+            self.temp_table_name, id_param_sql('id', self.FETCH_PARAM_COUNT))
+
+    def _select_into_temp_table(self, id_list):
+        self.connection.execute_many(
+            self._insert_sql, id_param_chunks(id_list, self.LIST_PARAM_COUNT))
 
     def destroy(self):
         if self.connection is not None:
@@ -945,36 +1266,14 @@ WHERE $table_name.id in ($id_list)""")
 
     def fetch_items(self, id_list):
         """Create Item objects."""
-        # We can use SELECT * here because we know that we defined the columns
-        # in the same order as select_columns() returned them.
-        id_list_str = ', '.join(str(i) for i in id_list)
-        sql = "SELECT * FROM %s WHERE id IN (%s)" % (self.temp_table_name,
-                                                     id_list_str)
         return [self.item_source.make_item_info(row)
-                for row in self.connection.execute(sql)]
+                for row in self._fetch_rows(self._select_sql, id_list)]
 
-    def refresh_items(self, changed_ids):
-        self._select_into_temp_table(changed_ids)
+    def refresh_items(self, changed_ids, added_ids=(), removed_ids=()):
+        if changed_ids:
+            self._select_into_temp_table(changed_ids)
         return False
 
-    def select_playable_ids(self):
-        sql = ("SELECT id FROM %s "
-               "WHERE %s IS NOT NULL AND "
-               "file_type != 'other' AND "
-               "id in (%s)" %
-               (self.table_name(), self.path_column(),
-                ','.join(str(id_) for id_ in self.id_list)))
-        return [row[0] for row in self.connection.execute(sql)]
-
-    def select_has_playables(self):
-        sql = ("SELECT EXISTS (SELECT 1 FROM %s "
-               "WHERE %s IS NOT NULL AND "
-               "file_type != 'other' AND "
-               "id in (%s))" %
-               (self.table_name(), self.path_column(),
-                ','.join(str(id_) for id_ in self.id_list)))
-        return self.connection.execute(sql).fetchone()[0] == 1
-
 class BackendItemTracker(signals.SignalEmitter):
     """Item tracker used by the backend
 
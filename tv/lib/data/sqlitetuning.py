@@ -0,0 +1,113 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2012
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""miro.data.sqlitetuning -- PRAGMA settings for sqlite connections.
+
+Both LiveStorage and the frontend ConnectionPools use the profile named by
+the SQLITE_TUNING_PROFILE pref to set up their connections.
+"""
+
+import logging
+
+from miro import app
+from miro import prefs
+
+class TuningProfile(object):
+    """PRAGMA settings to apply to new connections.
+
+    Any setting that's None is left at the sqlite default.
+
+    :attribute cache_size: page cache size in KiB
+    :attribute mmap_size: bytes of the database file to memory map for reads
+    :attribute temp_store: where to put temp tables and indexes ("MEMORY" or
+    "FILE")
+    :attribute wal_synchronous: synchronous setting to use when the database
+    is in WAL mode.  "NORMAL" is safe in WAL mode (a power loss can roll back
+    the last transactions, but can't corrupt the database) and doesn't fsync
+    on every commit.
+    """
+    def __init__(self, cache_size=None, mmap_size=None, temp_store=None,
+                 wal_synchronous=None):
+        self.cache_size = cache_size
+        self.mmap_size = mmap_size
+        self.temp_store = temp_store
+        self.wal_synchronous = wal_synchronous
+
+    def pragmas(self, wal_mode):
+        """Get the PRAGMA statements for this profile.
+
+        :param wal_mode: is the connection using the WAL journal mode?
+        """
+        pragmas = []
+        if self.cache_size is not None:
+            # negative values are in KiB rather than pages
+            pragmas.append("PRAGMA cache_size=%d" % -self.cache_size)
+        if self.mmap_size is not None:
+            pragmas.append("PRAGMA mmap_size=%d" % self.mmap_size)
+        if self.temp_store is not None:
+            pragmas.append("PRAGMA temp_store=%s" % self.temp_store)
+        if wal_mode and self.wal_synchronous is not None:
+            pragmas.append("PRAGMA synchronous=%s" % self.wal_synchronous)
+        return pragmas
+
+    def apply(self, connection, wal_mode):
+        """Run our PRAGMA statements on a connection.
+
+        :param connection: sqlite3.Connection or
+        miro.data.connectionpool.Connection
+        :param wal_mode: is the connection using the WAL journal mode?
+        """
+        for sql in self.pragmas(wal_mode):
+            # PRAGMA statements return rows for some settings (for example
+            # mmap_size), make sure we read them so the statement finishes.
+            connection.execute(sql).fetchall()
+
+PROFILES = {
+    # use the sqlite defaults
+    'none': TuningProfile(),
+    'standard': TuningProfile(cache_size=8192, mmap_size=64 * 1024 * 1024,
+                              temp_store='MEMORY', wal_synchronous='NORMAL'),
+    # for big libraries on machines with memory to spare
+    'large': TuningProfile(cache_size=32768, mmap_size=256 * 1024 * 1024,
+                           temp_store='MEMORY', wal_synchronous='NORMAL'),
+}
+
+def get_profile(name=None):
+    """Get a TuningProfile
+
+    :param name: name of the profile.  If None, we use the
+    SQLITE_TUNING_PROFILE pref.
+    """
+    if name is None:
+        name = app.config.get(prefs.SQLITE_TUNING_PROFILE)
+    try:
+        return PROFILES[name]
+    except KeyError:
+        logging.warn("Unknown sqlite tuning profile: %r", name)
+        return PROFILES['standard']
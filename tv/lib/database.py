@@ -35,6 +35,7 @@ import threading
 from miro import app
 from miro import signals
 from miro import threadcheck
+from miro import viewpredicate
 
 class DatabaseException(StandardError):
     """Superclass database errors."""
@@ -254,6 +255,7 @@ class ViewTracker(signals.SignalEmitter):
         self.joins = joins
         self.db_info = db_info
         self.bulk_mode = False
+        self.predicate = self._compile_predicate()
         self.current_ids = self._view_object_ids()
         vt_manager = self.db_info.view_tracker_manager
         vt_manager.trackers_for_table(self.table_name).add(self)
@@ -271,8 +273,27 @@ class ViewTracker(signals.SignalEmitter):
         """
         self.bulk_mode = bulk_mode
 
+    def _compile_predicate(self):
+        """Try to compile our WHERE clause into a python function.
+
+        This lets us check objects without running a query each time they
+        change.  If we can't compile the clause (for example if it uses
+        columns from joined tables), we return None and fall back to SQL.
+        """
+        try:
+            return self.db_info.db.compile_where(self.table_name, self.where,
+                                                 self.values)
+        except viewpredicate.UnsupportedWhereClause:
+            return None
+
     def _obj_in_view(self, obj):
         """Check if a single object is in our view."""
+        if self.predicate is not None:
+            return self.predicate(obj)
+        return self._obj_in_view_sql(obj)
+
+    def _obj_in_view_sql(self, obj):
+        """Check if a single object is in our view using a query."""
         where = '%s.id = ?' % (self.table_name,)
         if self.where:
             where += ' AND (%s)' % (self.where,)
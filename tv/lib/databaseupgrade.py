@@ -38,6 +38,7 @@
 
 from urlparse import urlparse
 import datetime
+import hashlib
 import itertools
 import os
 import re
@@ -4417,3 +4418,86 @@ def upgrade201(cursor):
             where_values.append((feed_id,))
     cursor.executemany("UPDATE feed SET expire_timedelta=NULL "
                        "WHERE id=?", where_values)
+
+@run_on_both
+def upgrade202(cursor):
+    """Only re-index item_fts when an indexed column changes."""
+    if is_device_db(cursor):
+        item_table = 'device_item'
+    else:
+        item_table = 'item'
+    columns = ['title', 'description', 'artist', 'album', 'genre', 'filename',
+               'parent_title', 'entry_description', ]
+    column_list = ', '.join(c for c in columns)
+    column_list_for_new = ', '.join("new.%s" % c for c in columns)
+    changed_test = ' OR '.join("old.%s IS NOT new.%s" % (c, c)
+                               for c in columns)
+    # replace the item_bu/item_au pair, which re-indexed the row for every
+    # UPDATE, with a single trigger that only fires when an indexed column
+    # changes.
+    cursor.execute("DROP TRIGGER item_bu")
+    cursor.execute("DROP TRIGGER item_au")
+    cursor.execute("CREATE TRIGGER item_au "
+                   "AFTER UPDATE OF %s ON %s "
+                   "WHEN %s BEGIN "
+                   "DELETE FROM item_fts WHERE docid=old.id; "
+                   "INSERT INTO item_fts(docid, %s) "
+                   "VALUES(new.id, %s); "
+                   "END;" % (column_list, item_table, changed_test,
+                             column_list, column_list_for_new))
+
+def upgrade203(cursor):
+    """Name icon cache files after their contents and share identical ones.
+    """
+    cursor.execute("CREATE INDEX icon_cache_url ON icon_cache (url)")
+    cursor.execute("CREATE INDEX icon_cache_filename ON icon_cache (filename)")
+
+    cache_dir = app.config.get(prefs.ICON_CACHE_DIRECTORY)
+    extension_re = re.compile(r'^\.[A-Za-z0-9]{1,5}$')
+    # map old paths to new paths.  None means the file couldn't be read
+    new_paths = {}
+    update_values = []
+    cursor.execute("SELECT id, filename FROM icon_cache "
+                   "WHERE filename IS NOT NULL")
+    for (icon_cache_id, path) in cursor.fetchall():
+        if path not in new_paths:
+            new_paths[path] = _upgrade203_move_file(path, cache_dir,
+                                                    extension_re)
+        update_values.append((new_paths[path], icon_cache_id))
+    # rows whose file is gone get a NULL filename, which makes the icon
+    # cache download them again.
+    cursor.executemany("UPDATE icon_cache SET filename=? WHERE id=?",
+                       update_values)
+
+def _upgrade203_move_file(path, cache_dir, extension_re):
+    if not os.path.exists(path):
+        # icon cache files get cleaned up all the time, this is normal
+        return None
+    try:
+        f = open(path, 'rb')
+        try:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        finally:
+            f.close()
+    except (IOError, OSError):
+        logging.warn("upgrade203: Error reading %s", path)
+        return None
+    ext = os.path.splitext(path)[1]
+    if not extension_re.match(ext):
+        ext = ''
+    dest_path = os.path.join(cache_dir, digest + ext.lower())
+    if dest_path == path:
+        return path
+    if os.path.exists(dest_path):
+        # another row already has a file with the same contents
+        try:
+            os.remove(path)
+        except StandardError:
+            logging.warn("upgrade203: Error deleting %s", path)
+        return dest_path
+    try:
+        shutil.move(path, dest_path)
+    except StandardError:
+        logging.warn("upgrade203: Error moving %s -> %s", path, dest_path)
+        return path
+    return dest_path
@@ -0,0 +1,309 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""devicecopy.py -- Copy files to devices in background threads.
+
+FileCopier handles the file copies for a device sync.  It copies files using
+a small pool of threads, so the copies don't compete with the backend
+eventloop, and so that we can keep slow devices busy.
+
+To make the copies fast:
+
+* We read and write using large buffers.  Using a multiple of the typical
+  flash erase block size means that most writes cover entire blocks.  Each
+  thread allocates its buffer once and uses it for all of its copies.
+* We don't open files with O_SYNC.  Instead we fsync() finished files in
+  batches, once FSYNC_BATCH_SIZE bytes or MAX_UNSYNCED_FILES files are
+  waiting, or we run out of files to copy.  Files are only reported as
+  finished after they've been synced.
+* Progress is reported back to the eventloop at most once every
+  PROGRESS_INTERVAL seconds.
+"""
+
+import collections
+import io
+import logging
+import os
+import threading
+import time
+
+from miro import eventloop
+from miro import fileutil
+from miro.plat.utils import thread_body
+
+# size of the buffers we use to copy files
+COPY_BLOCK_SIZE = 4 * 1024 * 1024
+# how many bytes we write before calling fsync()
+FSYNC_BATCH_SIZE = 64 * 1024 * 1024
+# how many files we keep open waiting for fsync().  This keeps us from
+# running out of file descriptors when copying lots of small files.
+MAX_UNSYNCED_FILES = 32
+# default number of threads to use for each device
+DEFAULT_THREAD_COUNT = 2
+# minimum time between progress updates
+PROGRESS_INTERVAL = 0.5
+
+class _CopyJob(object):
+    def __init__(self, source, dest, key):
+        self.source = source
+        self.dest = dest
+        self.key = key
+
+class FileCopier(object):
+    """Copies files to a device in background threads.
+
+    Callbacks are always called in the eventloop thread:
+
+    * progress_callback(progress) -- progress is a dict mapping keys to the
+      number of bytes copied since the last call.
+    * finished_callback(key, success) -- called once for each file.  success
+      is False if the copy failed or was canceled.  In that case, the
+      destination file has been deleted.
+    """
+    def __init__(self, name, progress_callback, finished_callback,
+                 thread_count=DEFAULT_THREAD_COUNT,
+                 block_size=COPY_BLOCK_SIZE,
+                 fsync_batch_size=FSYNC_BATCH_SIZE,
+                 max_unsynced_files=MAX_UNSYNCED_FILES):
+        self.name = name
+        self.progress_callback = progress_callback
+        self.finished_callback = finished_callback
+        self.thread_count = max(1, thread_count)
+        self.block_size = block_size
+        self.fsync_batch_size = fsync_batch_size
+        self.max_unsynced_files = max(1, max_unsynced_files)
+        self.lock = threading.Lock()
+        self.jobs = collections.deque()
+        self.threads = []
+        self.running_threads = 0
+        self.canceled = False
+        # files that we've written, but haven't synced yet
+        self.unsynced = []
+        self.unsynced_bytes = 0
+        # progress that we haven't reported yet
+        self.progress = collections.defaultdict(int)
+        self.progress_scheduled = False
+        self.last_progress_time = 0
+        # throughput accounting
+        self.bytes_copied = 0
+        self.files_copied = 0
+        self.start_time = None
+        self.end_time = None
+
+    def copy(self, source, dest, key):
+        """Copy a file.
+
+        :param source: path to copy from
+        :param dest: path to copy to
+        :param key: key to use for the callbacks
+        """
+        with self.lock:
+            if self.canceled:
+                raise ValueError("FileCopier canceled")
+            self.jobs.append(_CopyJob(source, dest, key))
+            if self.start_time is None:
+                self.start_time = time.time()
+            if self.running_threads < self.thread_count:
+                self.running_threads += 1
+                self._start_thread()
+
+    def _start_thread(self):
+        thread = threading.Thread(target=thread_body,
+                                  args=[self._thread_loop],
+                                  name='File Copier (%s) - %d' %
+                                  (self.name, len(self.threads)))
+        thread.setDaemon(True)
+        self.threads.append(thread)
+        thread.start()
+
+    def cancel(self):
+        """Stop copying files.
+
+        In-progress copies stop after their current block.  Files that
+        haven't been started are deleted and reported as failed.
+        """
+        with self.lock:
+            self.canceled = True
+            jobs = list(self.jobs)
+            self.jobs.clear()
+        for job in jobs:
+            self._job_failed(job)
+
+    def wait(self):
+        """Wait for all copies to finish.  Used by the unittests."""
+        for thread in list(self.threads):
+            thread.join()
+
+    def is_running(self):
+        with self.lock:
+            return self.running_threads > 0
+
+    def get_stats(self):
+        """Get throughput stats for our copies.
+
+        :returns: dict with the number of files and bytes we've copied, and
+            the rate in bytes per second.
+        """
+        with self.lock:
+            if self.start_time is None:
+                duration = 0.0
+            elif self.end_time is None or self.running_threads > 0:
+                duration = time.time() - self.start_time
+            else:
+                duration = self.end_time - self.start_time
+            bytes_copied = self.bytes_copied
+            files_copied = self.files_copied
+        if duration > 0:
+            rate = bytes_copied / duration
+        else:
+            rate = 0.0
+        return {
+            'files': files_copied,
+            'bytes': bytes_copied,
+            'seconds': duration,
+            'rate': rate,
+        }
+
+    def _next_job(self):
+        with self.lock:
+            if self.jobs and not self.canceled:
+                return self.jobs.popleft()
+            self.running_threads -= 1
+            self.end_time = time.time()
+            return None
+
+    def _thread_loop(self):
+        buf = bytearray(self.block_size)
+        while True:
+            job = self._next_job()
+            if job is None:
+                break
+            try:
+                output = self._copy_file(job, buf)
+            except EnvironmentError, e:
+                logging.warn("error copying %r to %r: %s", job.source,
+                             job.dest, e)
+                self._job_failed(job)
+                continue
+            if output is None:
+                # canceled
+                self._job_failed(job)
+                continue
+            with self.lock:
+                self.unsynced.append((output, job))
+                self.unsynced_bytes += output.tell()
+                if (self.unsynced_bytes < self.fsync_batch_size and
+                        len(self.unsynced) < self.max_unsynced_files and
+                        self.jobs and not self.canceled):
+                    continue
+                to_sync = self.unsynced
+                self.unsynced = []
+                self.unsynced_bytes = 0
+            self._sync_files(to_sync)
+        # Another thread may have added files after our last sync
+        with self.lock:
+            to_sync = self.unsynced
+            self.unsynced = []
+            self.unsynced_bytes = 0
+        self._sync_files(to_sync)
+
+    def _copy_file(self, job, buf):
+        """Copy the data for a job.
+
+        :param buf: bytearray to use as our read/write buffer
+        :returns: the output file, which still needs to be synced and closed,
+            or None if we were canceled
+        """
+        with io.open(job.source, 'rb', buffering=0) as source:
+            output = io.open(job.dest, 'wb', buffering=0)
+            finished = False
+            try:
+                while not self.canceled:
+                    count = source.readinto(buf)
+                    if not count:
+                        finished = True
+                        return output
+                    written = 0
+                    while written < count:
+                        written += output.write(buffer(buf, written,
+                                                       count - written))
+                    self._add_progress(job.key, count)
+                return None
+            finally:
+                if not finished:
+                    output.close()
+
+    def _sync_files(self, to_sync):
+        for output, job in to_sync:
+            try:
+                if self.canceled:
+                    success = False
+                else:
+                    output.flush()
+                    os.fsync(output.fileno())
+                    success = True
+            except EnvironmentError, e:
+                logging.warn("error syncing %r: %s", job.dest, e)
+                success = False
+            output.close()
+            if success:
+                with self.lock:
+                    self.files_copied += 1
+                eventloop.add_idle(self.finished_callback,
+                                   'file copy finished',
+                                   args=(job.key, True))
+            else:
+                self._job_failed(job)
+
+    def _job_failed(self, job):
+        # fileutil.delete() may schedule retries, so run it in the eventloop
+        eventloop.add_idle(fileutil.delete, 'deleting failed file copy',
+                           args=(job.dest,))
+        eventloop.add_idle(self.finished_callback, 'file copy failed',
+                           args=(job.key, False))
+
+    def _add_progress(self, key, count):
+        with self.lock:
+            self.bytes_copied += count
+            self.progress[key] += count
+            if self.progress_scheduled:
+                return
+            if time.time() - self.last_progress_time < PROGRESS_INTERVAL:
+                return
+            self.progress_scheduled = True
+        eventloop.add_idle(self._send_progress, 'file copy progress')
+
+    def _send_progress(self):
+        with self.lock:
+            progress = self.progress
+            self.progress = collections.defaultdict(int)
+            self.progress_scheduled = False
+            self.last_progress_time = time.time()
+        if progress:
+            self.progress_callback(dict(progress))
@@ -0,0 +1,306 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""devicejournal.py -- Store the JSON device database as a snapshot and a
+journal of changes.
+
+The device database lives in [MOUNT]/.miro.  There are two files:
+
+* json -- a snapshot of the entire database.  Older versions of Miro only
+  read this file.
+* json-journal -- changes made since the snapshot was written.  The first
+  line is a header that identifies the snapshot that the journal applies
+  to.  Each line after that is a JSON object that sets or deletes one path
+  in the database.
+
+Normally we only append the changed paths to the journal, which is much
+cheaper than rewriting the whole database on slow flash drives.  Once the
+journal gets bigger than the snapshot, we compact it by writing a new
+snapshot.
+
+Snapshots are written to a temporary file, synced, then renamed over the
+old one.  After that we replace the journal with one that only contains the
+header for the new snapshot.  If we crash in between, the header for the old
+journal won't match the new snapshot and we ignore it.  If we crash while
+appending to the journal, the last line will be incomplete.  We skip it
+when loading, and write a snapshot on the next save.
+
+JournalWriter does the actual file writes in a background thread, so they
+don't block the eventloop.
+"""
+
+import Queue
+import logging
+import os
+import threading
+import zlib
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from miro.plat.utils import thread_body
+
+SNAPSHOT_NAME = 'json'
+JOURNAL_NAME = 'json-journal'
+# compact the journal once it's bigger than both this and the snapshot
+COMPACT_MIN_SIZE = 256 * 1024
+
+def database_dir(mount):
+    return os.path.join(mount, '.miro')
+
+def _checksum(data):
+    return zlib.crc32(data) & 0xffffffff
+
+def encode_snapshot(db):
+    """Encode a database for write_snapshot()."""
+    return json.dumps(db)
+
+def _snapshot_base(snapshot_data):
+    if snapshot_data is None:
+        return None
+    return [len(snapshot_data), _checksum(snapshot_data)]
+
+def encode_header(snapshot_data):
+    """Encode the header line for a journal that follows a snapshot."""
+    return json.dumps({'base': _snapshot_base(snapshot_data)}) + '\n'
+
+def encode_change(path, db):
+    """Encode a journal line that stores the current value for a path.
+
+    :param path: tuple of keys to get to the value from the top of db
+    :param db: the database to read the value from
+    """
+    value = db
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return json.dumps({'p': path, 'd': True}) + '\n'
+        value = dict.__getitem__(value, key)
+    return json.dumps({'p': path, 'v': value}) + '\n'
+
+def coalesce_paths(paths):
+    """Remove paths that are inside other paths from a set of paths.
+
+    Writing the outer path stores the inner ones as well.
+    """
+    kept = set()
+    for path in sorted(paths, key=len):
+        for i in xrange(1, len(path)):
+            if path[:i] in kept:
+                break
+        else:
+            kept.add(path)
+    return sorted(kept, key=len)
+
+def apply_change(db, change):
+    """Apply a journal entry to a database."""
+    path = change['p']
+    if not path:
+        db.clear()
+        db.update(change['v'])
+        return
+    for key in path[:-1]:
+        child = db.get(key)
+        if not isinstance(child, dict):
+            child = db[key] = {}
+        db = child
+    if change.get('d'):
+        db.pop(path[-1], None)
+    else:
+        db[path[-1]] = change['v']
+
+def _sync_and_close(f):
+    f.flush()
+    os.fsync(f.fileno())
+    f.close()
+
+def _replace_file(path, data):
+    """Atomically replace the contents of a file."""
+    temp_path = path + '.tmp'
+    _sync_and_close(_write_file(temp_path, data))
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        # windows can't rename over an existing file.  load() will fall back
+        # to the temp file if we crash after removing the old one.
+        if not os.path.exists(path):
+            raise
+        os.remove(path)
+        os.rename(temp_path, path)
+
+def _write_file(path, data):
+    f = open(path, 'wb')
+    try:
+        f.write(data)
+    except:
+        f.close()
+        raise
+    return f
+
+def write_snapshot(directory, data):
+    """Write a new snapshot and start a new, empty, journal for it."""
+    _replace_file(os.path.join(directory, SNAPSHOT_NAME), data)
+    _replace_file(os.path.join(directory, JOURNAL_NAME), encode_header(data))
+
+def append_journal(directory, data):
+    f = open(os.path.join(directory, JOURNAL_NAME), 'ab')
+    try:
+        f.write(data)
+    except:
+        f.close()
+        raise
+    _sync_and_close(f)
+
+def _read_file(path):
+    if not os.path.exists(path):
+        return None
+    f = open(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def load(directory):
+    """Load a database from its snapshot and journal.
+
+    :raises ValueError: the snapshot can't be decoded
+    :raises EnvironmentError: error reading the files
+    :returns: (db, snapshot_size, journal_size) tuple.  journal_size is None
+        if the journal can't be appended to and the next write should be a
+        snapshot.
+    """
+    snapshot_path = os.path.join(directory, SNAPSHOT_NAME)
+    snapshot_data = _read_file(snapshot_path)
+    if snapshot_data is None:
+        snapshot_data = _read_file(snapshot_path + '.tmp')
+    if snapshot_data is None:
+        db = {}
+    else:
+        db = json.loads(snapshot_data.decode('utf-8'))
+        if not isinstance(db, dict):
+            raise ValueError("snapshot is not a JSON object")
+    snapshot_size = len(snapshot_data or '')
+    journal_data = _read_file(os.path.join(directory, JOURNAL_NAME))
+    if journal_data is None:
+        return db, snapshot_size, None
+    lines = journal_data.split('\n')
+    # lines[-1] is either empty or an incomplete line
+    complete = lines[-1] == ''
+    try:
+        header = json.loads(lines[0].decode('utf-8'))
+        base = header['base']
+    except (ValueError, KeyError, TypeError):
+        logging.warn("bad device journal header in %s", directory)
+        return db, snapshot_size, None
+    if base != _snapshot_base(snapshot_data):
+        # journal is for a different snapshot.  We must have crashed while
+        # compacting.
+        logging.info("ignoring stale device journal in %s", directory)
+        return db, snapshot_size, None
+    for line in lines[1:-1]:
+        try:
+            change = json.loads(line.decode('utf-8'))
+            apply_change(db, change)
+        except (ValueError, KeyError, TypeError):
+            logging.warn("bad device journal entry in %s", directory)
+            complete = False
+            break
+    if not complete:
+        return db, snapshot_size, None
+    return db, snapshot_size, len(journal_data)
+
+class JournalWriter(object):
+    """Writes snapshots and journal entries in a background thread.
+
+    Writes happen in the order they were queued.  If a write fails, the
+    failed attribute is set and the next write should be a snapshot.
+    """
+    def __init__(self, mount):
+        self.mount = mount
+        self.directory = database_dir(mount)
+        self.queue = Queue.Queue()
+        self.failed = False
+        self.thread = None
+
+    def snapshot(self, data):
+        self._queue_write(write_snapshot, data)
+
+    def append(self, data):
+        self._queue_write(append_journal, data)
+
+    def _queue_write(self, func, data):
+        if self.thread is None:
+            self.thread = threading.Thread(target=thread_body,
+                                           args=[self._thread_loop],
+                                           name='Device DB Writer (%s)' %
+                                           self.mount)
+            self.thread.setDaemon(True)
+            self.thread.start()
+        self.queue.put((func, data))
+
+    def wait(self):
+        """Wait until all queued writes are finished."""
+        self.queue.join()
+
+    def close(self):
+        """Finish all queued writes, then stop the thread."""
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def _thread_loop(self):
+        while True:
+            write = self.queue.get()
+            try:
+                if write is None:
+                    return
+                self._write(*write)
+            finally:
+                self.queue.task_done()
+
+    def _write(self, func, data):
+        if not os.path.exists(self.mount):
+            # device disappeared, so we can't write to it
+            self.failed = True
+            return
+        if func is append_journal and self.failed:
+            # the journal is missing entries, wait for the next snapshot
+            return
+        try:
+            if not os.path.exists(self.directory):
+                os.makedirs(self.directory)
+            func(self.directory, data)
+        except EnvironmentError, e:
+            logging.warn("error writing device database to %s: %s",
+                         self.directory, e)
+            self.failed = True
+        else:
+            if func is write_snapshot:
+                self.failed = False
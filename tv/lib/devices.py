@@ -33,7 +33,6 @@ try:
     import simplejson as json
 except ImportError:
     import json
-import codecs
 import logging
 import os, os.path
 import re
@@ -50,7 +49,9 @@ except ImportError:
 
 from miro import app
 from miro import database
+from miro import devicecopy
 from miro import devicedatabaseupgrade
+from miro import devicejournal
 from miro import eventloop
 from miro import item
 from miro import itemsource
@@ -79,7 +80,7 @@ from miro.plat.utils import (filename_to_unicode, unicode_to_filename,
 # how much slower converting a file is, compared to copying
 CONVERSION_SCALE = 500
 # schema version for device databases
-DB_VERSION = 198
+DB_VERSION = 202
 
 def unicode_to_path(path):
     """
@@ -589,10 +590,11 @@ class DeviceManager(object):
         info = self.connected[id_]
 
         if info.mount:
-            # turn off the autosaving on the old database
+            # turn off the autosaving on the old database and write it out
+            # now.  _set_connected() opens a new database and journal on the
+            # same files, so this can't wait.
             info.database.disconnect_all()
-            eventloop.add_idle(write_database, 'writing database on change',
-                               (info.database, info.mount))
+            write_database(info.database, info.mount)
 
         info = self._set_connected(id_, kwargs)
 
@@ -673,7 +675,7 @@ class DeviceSyncManager(object):
         self.auto_syncs = set()
         self.stopping = False
         self._change_timeout = None
-        self._copy_iter_running = False
+        self.copier = None
         self._info_to_conversion = {}
         self.started = False
 
@@ -1126,47 +1128,42 @@ class DeviceSyncManager(object):
                                       # will see it
         self.copying[final_path] = info
         self.total_size[info.id] = info.size
-        if not self._copy_iter_running:
-            self._copy_iter_running = True
-            eventloop.idle_iterate(self._copy_as_iter,
-                                   'copying files to device')
-
-    def _copy_as_iter(self):
-        while self.copying:
-            final_path, info = self.copying.popitem()
-            iterable = fileutil.copy_with_progress(info.filename, final_path,
-                                                   block_size=128 * 1024)
+        self._get_copier().copy(info.filename, final_path, final_path)
+
+    def _get_copier(self):
+        if self.copier is None:
+            thread_count = self.device_settings.get(
+                u'copy_threads', devicecopy.DEFAULT_THREAD_COUNT)
+            self.copier = devicecopy.FileCopier(self.device_info.name,
+                                                self._copy_progress_callback,
+                                                self._copy_finished_callback,
+                                                thread_count=thread_count)
+        return self.copier
+
+    def _copy_progress_callback(self, progress):
+        for final_path, count in progress.iteritems():
             try:
-                for count in iterable:
-                    self.progress_size[info.id] += count
-                    if self.stopping:
-                        iterable.close()
-                        eventloop.add_idle(fileutil.delete,
-                                           "deleting canceled sync",
-                                           args=(final_path,))
-                        final_path = None
-                        break
-                    # let other stuff run
-                    self._schedule_sync_changed()
-                    yield
-            except IOError:
-                final_path = None
-            if final_path:
-                self._add_item(final_path, info)
-            # don't throw off the progress bar; we're done so pretend we got
-            # all the bytes
-            self.progress_size[info.id] = self.total_size[info.id]
-            self.finished += 1
-            self._check_finished()
-            if self.stopping:
-                break # no more copies
-            yield
-        for final_path in self.copying:
-            # canceled the sync, so remove the non-synced files
-            eventloop.add_idle(fileutil.delete,
-                               "deleting canceled sync",
-                               args=(final_path,))
-        self._copy_iter_running = False
+                info = self.copying[final_path]
+            except KeyError:
+                continue # already finished
+            self.progress_size[info.id] += count
+        self._schedule_sync_changed()
+
+    def _copy_finished_callback(self, final_path, success):
+        info = self.copying.pop(final_path)
+        if success and not self.stopping:
+            self._add_item(final_path, info)
+        # don't throw off the progress bar; we're done so pretend we got
+        # all the bytes
+        self.progress_size[info.id] = self.total_size[info.id]
+        self.finished += 1
+        if not self.copying:
+            stats = self.copier.get_stats()
+            logging.info("copied %d files (%d bytes) to %s in %0.1fs "
+                         "(%0.1f MB/s)", stats['files'], stats['bytes'],
+                         self.device_info.name, stats['seconds'],
+                         stats['rate'] / (1024 * 1024))
+        self._check_finished()
 
     def _conversion_changed_callback(self, conversion_manager, task):
         total = self.total_size[task.key]
@@ -1288,12 +1285,14 @@ class DeviceSyncManager(object):
             return
         for key in self.waiting:
             conversions.conversion_manager.cancel(key)
-        self.stopping = True # kill in-progress copies
+        self.stopping = True
+        if self.copier is not None:
+            self.copier.cancel() # kill in-progress copies
         self._send_sync_changed()
         self._send_sync_finished()
 
 class DeviceDatabase(dict, signals.SignalEmitter):
-    def __init__(self, data=None, parent=None):
+    def __init__(self, data=None, parent=None, key_path=()):
         if data:
             dict.__init__(self, data)
             self.created_new = False
@@ -1303,11 +1302,15 @@ class DeviceDatabase(dict, signals.SignalEmitter):
         signals.SignalEmitter.__init__(self, 'changed', 'item-added',
                                        'item-changed', 'item-removed')
         self.parent = parent
+        self.key_path = key_path
         self.changing = False
         self.bulk_mode = False
         self.did_change = False
         self.check_old_key_usage = False
         self.write_manager = None
+        # paths that have changed since the last write.  None means that we
+        # don't know what changed and need to write everything.
+        self.changed_paths = set()
 
     def __getitem__(self, key):
         check_u(key)
@@ -1316,7 +1319,8 @@ class DeviceDatabase(dict, signals.SignalEmitter):
                 raise AssertionError()
         value = super(DeviceDatabase, self).__getitem__(key)
         if isinstance(value, dict) and not isinstance(value, DeviceDatabase):
-            value = DeviceDatabase(value, self.parent or self)
+            value = DeviceDatabase(value, self.parent or self,
+                                   self.key_path + (key,))
              # don't trip the changed signal
             super(DeviceDatabase, self).__setitem__(key, value)
         return value
@@ -1325,11 +1329,36 @@ class DeviceDatabase(dict, signals.SignalEmitter):
         check_u(key)
         super(DeviceDatabase, self).__setitem__(key, value)
         if self.parent:
-            self.parent.notify_changed()
+            self.parent.notify_changed(self.key_path + (key,))
         else:
-            self.notify_changed()
+            self.notify_changed((key,))
 
-    def notify_changed(self):
+    def __delitem__(self, key):
+        super(DeviceDatabase, self).__delitem__(key)
+        if self.parent:
+            self.parent.notify_changed(self.key_path + (key,))
+        else:
+            self.notify_changed((key,))
+
+    def setdefault(self, key, default=None):
+        # go through __getitem__ so that changes to dict values get tracked
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def notify_changed(self, path=None):
+        """Call when the database changes.
+
+        :param path: tuple of keys for the value that changed.  If None, the
+            entire database will be written out.
+        """
+        if path is None:
+            self.changed_paths = None
+        elif self.changed_paths is not None:
+            self.changed_paths.add(path)
+        self._send_changed()
+
+    def _send_changed(self):
         self.did_change = True
         if not self.bulk_mode and not self.changing:
             self.changing = True
@@ -1344,7 +1373,17 @@ class DeviceDatabase(dict, signals.SignalEmitter):
     def set_bulk_mode(self, bulk):
         self.bulk_mode = bulk
         if not bulk and self.did_change:
-            self.notify_changed()
+            self._send_changed()
+
+    def take_changed_paths(self):
+        """Get the paths that changed since the last call and reset them.
+
+        :returns: set of key path tuples or None if we need to write the
+            entire database
+        """
+        changed_paths = self.changed_paths
+        self.changed_paths = set()
+        return changed_paths
 
     def _find_item_data(self, path):
         """Find the data for an item in the database
@@ -1358,23 +1397,33 @@ class DeviceDatabase(dict, signals.SignalEmitter):
         raise KeyError(path)
 
     def shutdown(self):
-        if self.write_manager and self.write_manager.is_dirty():
-            self.write_manager.write()
+        if self.write_manager:
+            if self.write_manager.is_dirty():
+                self.write_manager.write()
+            self.write_manager.close()
 
 class DatabaseWriteManager(object):
     """
     Keeps track of writing a database periodically.
+
+    Normally we only append the changed parts of the database to the
+    journal.  See devicejournal for details.
     """
     SAVE_INTERVAL = 10 # seconds between writes
 
-    def __init__(self, mount):
+    def __init__(self, mount, snapshot_size=0, journal_size=None):
         self.mount = mount
         self.scheduled_write = None
         self.database = None
+        self.writer = devicejournal.JournalWriter(mount)
+        self.snapshot_size = snapshot_size
+        # None means that the next write should be a snapshot
+        self.journal_size = journal_size
+        self.closed = False
 
     def schedule_write(self, database):
         self.database = database
-        if self.is_dirty():
+        if self.is_dirty() or self.closed:
             return
         self.scheduled_write = eventloop.add_timeout(self.SAVE_INTERVAL,
                                                      self.write,
@@ -1385,35 +1434,75 @@ class DatabaseWriteManager(object):
 
     def write(self):
         if self.is_dirty():
-            write_database(self.database, self.mount)
+            self._write_changes(self.database)
             self.database = self.scheduled_write = None
 
+    def _write_changes(self, database):
+        changed_paths = database.take_changed_paths()
+        if (changed_paths is None or self._should_compact() or
+                self.writer.failed):
+            self._write_snapshot(database)
+            return
+        data = ''.join(devicejournal.encode_change(path, database)
+                       for path in devicejournal.coalesce_paths(changed_paths))
+        self.writer.append(data)
+        self.journal_size += len(data)
+
+    def _should_compact(self):
+        return (self.journal_size is None or
+                self.journal_size > max(self.snapshot_size,
+                                        devicejournal.COMPACT_MIN_SIZE))
+
+    def _write_snapshot(self, database):
+        # encoding the snapshot has to happen in the eventloop, but the slow
+        # part is writing it to the device.
+        data = devicejournal.encode_snapshot(database)
+        self.writer.snapshot(data)
+        self.snapshot_size = len(data)
+        self.journal_size = len(devicejournal.encode_header(data))
+
+    def wait(self):
+        """Wait for queued writes to finish."""
+        self.writer.wait()
+
+    def close(self):
+        """Stop writing the database.
+
+        Pending writes are finished, but any changes that haven't been
+        written yet are dropped.
+        """
+        if self.scheduled_write is not None:
+            self.scheduled_write.cancel()
+        self.database = self.scheduled_write = None
+        self.closed = True
+        self.writer.close()
+
 def load_database(mount, countdown=0):
     """
     Returns a dictionary of the JSON database that lives on the given device.
 
-    The database lives at [MOUNT]/.miro/json
+    The database lives at [MOUNT]/.miro/json, with recent changes in
+    [MOUNT]/.miro/json-journal
     """
-    file_name = os.path.join(mount, '.miro', 'json')
-    if not os.path.exists(file_name):
+    snapshot_size = 0
+    journal_size = None
+    try:
+        db, snapshot_size, journal_size = devicejournal.load(
+            devicejournal.database_dir(mount))
+    except ValueError:
+        logging.exception('JSON decode error on %s', mount)
         db = {}
-    else:
-        try:
-            fp = codecs.open(file_name, 'rb', 'utf8')
-            db = json.load(fp)
-        except ValueError:
-            logging.exception('JSON decode error on %s', mount)
+    except EnvironmentError:
+        if countdown == 5:
+            logging.exception('file error with JSON on %s', mount)
             db = {}
-        except EnvironmentError:
-            if countdown == 5:
-                logging.exception('file error with JSON on %s', mount)
-                db = {}
-            else:
-                # wait a little while; total time is ~1.5s
-                time.sleep(0.20 * 1.2 ** countdown)
-                return load_database(mount, countdown + 1)
+        else:
+            # wait a little while; total time is ~1.5s
+            time.sleep(0.20 * 1.2 ** countdown)
+            return load_database(mount, countdown + 1)
     ddb = DeviceDatabase(db)
-    ddb.write_manager = DatabaseWriteManager(mount)
+    ddb.write_manager = DatabaseWriteManager(mount, snapshot_size,
+                                             journal_size)
     return ddb
 
 def sqlite_database_path(mount):
@@ -1528,21 +1617,26 @@ def write_database(db, mount):
     """
     Writes the given dictionary to the device.
 
-    The database lives at [MOUNT]/.miro/json
+    The database lives at [MOUNT]/.miro/json.  This writes a complete
+    snapshot and waits for it to finish.  If db has a write manager, it gets
+    closed.
     """
     threadcheck.confirm_eventloop_thread()
+    write_manager = getattr(db, 'write_manager', None)
+    if write_manager is not None:
+        write_manager.close()
     if not os.path.exists(mount):
         # device disappeared, so we can't write to it
         return
+    directory = devicejournal.database_dir(mount)
     try:
-        fileutil.makedirs(os.path.join(mount, '.miro'))
+        fileutil.makedirs(directory)
     except OSError:
         pass
     try:
-        with file(os.path.join(mount, '.miro', 'json'), 'wb') as output:
-            iterable = json._default_encoder.iterencode(db)
-            output.writelines(iterable)
-    except IOError:
+        devicejournal.write_snapshot(directory,
+                                     devicejournal.encode_snapshot(db))
+    except EnvironmentError:
         # couldn't write to the device
         # XXX throw up an error?
         pass
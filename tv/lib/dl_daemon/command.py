@@ -116,8 +116,11 @@ class BatchUpdateDownloadStatus(Command):
         from miro.messages import DownloaderSyncCommandComplete
 
         cmd_done = self.args[1]
-        fresh = all(RemoteDownloader.update_status(status, cmd_done=cmd_done)
-                    for status in self.args[0])
+        # Use a list rather than a generator, so that we apply all the
+        # statuses even if one is stale.  Some of them may be deltas, which
+        # won't get sent again.
+        fresh = all([RemoteDownloader.update_status(status, cmd_done=cmd_done)
+                     for status in self.args[0]])
         if cmd_done and fresh:
             DownloaderSyncCommandComplete().send_to_frontend()
 
@@ -187,6 +190,7 @@ class DownloaderBatchCommand(Command):
     def action(self):
         from miro.dl_daemon import download
         mark_reply = True
+        reply_dlids = []
         for dlid, (cmd, args) in self.args[0].iteritems():
             if cmd == self.PAUSE:
                 upload = args['upload']
@@ -213,11 +217,13 @@ class DownloaderBatchCommand(Command):
                 download.restore_downloader(downloader)
             else:
                 raise ValueError('unknown downloader batch command %s' % cmd)
+            if cmd != self.RESTORE:
+                reply_dlids.append(dlid)
         # Mark this so that the next time we run through the periodic update
         # which will be after all the above have been processed because we
         # are in the same thread.
         if mark_reply:
-            download.DOWNLOAD_UPDATER.set_cmds_done()
+            download.DOWNLOAD_UPDATER.set_cmds_done(reply_dlids)
  
 class MigrateDownloadCommand(Command):
     def action(self):
@@ -37,6 +37,7 @@ import datetime
 import logging
 import tempfile
 import base64
+import weakref
 
 from miro.gtcache import gettext as _
 
@@ -392,12 +393,34 @@ class TorrentSession(object):
 
 TORRENT_SESSION = TorrentSession()
 
+def make_status_delta(old_status, new_status):
+    """Make a status dict that only has the fields that changed between
+    old_status and new_status.
+
+    Deltas always have the dlid and a 'delta' key set to True, so that the
+    frontend knows that missing fields are unchanged rather than unset.
+
+    :returns: the delta, None if nothing changed or new_status if the set of
+        fields changed.
+    """
+    if set(old_status.keys()) != set(new_status.keys()):
+        return new_status
+    delta = {}
+    for key, value in new_status.iteritems():
+        if old_status[key] != value:
+            delta[key] = value
+    if not delta:
+        return None
+    delta['dlid'] = new_status['dlid']
+    delta['delta'] = True
+    return delta
+
 class DownloadStatusUpdater(object):
     """Handles updating status for all in progress downloaders.
 
     On OS X and gtk if the user is on the downloads page and has a
     bunch of downloads going, this can be a fairly CPU intensive task.
-    DownloadStatusUpdaters mitigate this in 2 ways.
+    DownloadStatusUpdaters mitigate this in 3 ways.
 
     1. DownloadStatusUpdater objects batch all status updates into one
        big update which takes much less CPU.
@@ -405,6 +428,12 @@ class DownloadStatusUpdater(object):
     2. The update don't happen fairly infrequently (currently every 5
        seconds).
 
+    3. Only the fields that changed since the last update get sent (see
+       make_status_delta()).  We send the full status the first time we
+       see a downloader, when replying to commands from the frontend and
+       every FULL_STATUS_INTERVAL seconds, in case the frontend dropped
+       some of our deltas.
+
     Because updates happen infrequently, DownloadStatusUpdaters should
     only be used for progress updates, not events like downloads
     starting/finishing.  For those just call update_client() since
@@ -413,10 +442,16 @@ class DownloadStatusUpdater(object):
     """
 
     UPDATE_CLIENT_INTERVAL = 1
+    FULL_STATUS_INTERVAL = 30
 
     def __init__(self):
         self.to_update = set()
         self.cmds_done = False
+        # dlids that the frontend sent commands for
+        self.cmd_dlids = set()
+        # maps downloaders to (status, time) tuples, where status is the
+        # last status we sent and time is when we last sent a full status
+        self.last_statuses = weakref.WeakKeyDictionary()
 
     def start_updates(self):
         eventloop.add_timeout(self.UPDATE_CLIENT_INTERVAL, self.do_update,
@@ -425,26 +460,57 @@ class DownloadStatusUpdater(object):
     def flush_update(self):
         self.do_update(periodic=False)
 
+    def encode_status(self, downloader, full=False):
+        """Get the status to send to the frontend for a downloader.
+
+        :param full: always send the full status rather than a delta
+        :returns: status dict or None if there's nothing to send
+        """
+        status = downloader.get_status()
+        now = clock()
+        try:
+            last_status, last_full_time = self.last_statuses[downloader]
+        except KeyError:
+            full = True
+        else:
+            if now - last_full_time >= self.FULL_STATUS_INTERVAL:
+                full = True
+        if full or downloader.dlid in self.cmd_dlids:
+            self.last_statuses[downloader] = (status, now)
+            return status
+        self.last_statuses[downloader] = (status, last_full_time)
+        return make_status_delta(last_status, status)
+
     def do_update(self, periodic=True):
         try:
             TORRENT_SESSION.update_torrents()
+            if self.cmds_done:
+                # make sure the reply has statuses for everything the
+                # frontend sent commands for.
+                for dlid in self.cmd_dlids:
+                    if dlid in _downloads:
+                        self.to_update.add(_downloads[dlid])
             statuses = []
             for downloader in self.to_update:
-                statuses.append(downloader.get_status())
+                status = self.encode_status(downloader)
+                if status is not None:
+                    statuses.append(status)
             self.to_update = set()
             if statuses or self.cmds_done:
                 command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON,
                                                   statuses,
                                                   self.cmds_done).send()
                 self.cmds_done = False
+                self.cmd_dlids = set()
         finally:
             if periodic:
                 eventloop.add_timeout(self.UPDATE_CLIENT_INTERVAL,
                                       self.do_update,
                                       "Download status update")
 
-    def set_cmds_done(self):
+    def set_cmds_done(self, dlids=()):
         self.cmds_done = True
+        self.cmd_dlids.update(dlids)
 
     def queue_update(self, downloader):
         self.to_update.add(downloader)
@@ -504,8 +570,9 @@ class BGDownloader(object):
         if not now:
             DOWNLOAD_UPDATER.queue_update(self)
         else:
+            status = DOWNLOAD_UPDATER.encode_status(self, full=True)
             command.BatchUpdateDownloadStatus(daemon.LAST_DAEMON,
-                                              [self.get_status()]).send()
+                                              [status]).send()
 
     def pick_initial_filename(self, suffix=".part", torrent=False,
                               is_directory=False, exists=False):
@@ -737,6 +804,9 @@ class HTTPDownloader(BGDownloader):
             BGDownloader.__init__(self, url, dlid)
             self.restartOnError = False
         self.client = None
+        self.probe_client = None
+        # set to False if segmented downloading fails for this URL
+        self.try_segmented = True
         self.rate = None
         if self.state == u'downloading':
             self.start_download()
@@ -760,17 +830,89 @@ class HTTPDownloader(BGDownloader):
 
         logging.debug("start_download: %s", self.url)
 
+        if (self.try_segmented and
+                app.config.get(prefs.HTTP_DOWNLOAD_CONNECTIONS) > 1):
+            # check if the server supports range requests first
+            self.probe_client = httpclient.grab_headers(
+                self.url,
+                lambda info: self.on_probe_headers(info, resume),
+                lambda error: self.on_probe_error(error, resume))
+        else:
+            self._start_single_download(resume)
+
+    def _start_single_download(self, resume):
         self.client = httpclient.grab_url(
             self.url, self.on_download_finished, self.on_download_error,
             header_callback=self.on_headers, write_file=self.filename,
             resume=resume)
         self.update_stats()
 
+    def on_probe_headers(self, info, resume):
+        self.probe_client = None
+        if self.state != u'downloading':
+            # paused or stopped while we were waiting
+            return
+        if resume:
+            start = self.current_size
+        else:
+            start = 0
+        total_size = info.get('total-size')
+        min_size = httpclient.SegmentedClient.MIN_SEGMENT_SIZE * 2
+        if (info.get('accept-ranges', '').lower() != 'bytes' or
+                total_size is None or total_size - start < min_size):
+            self._start_single_download(resume)
+            return
+        self.on_headers(info)
+        if self.state != u'downloading':
+            # on_headers() found a problem
+            return
+        logging.debug("start_download: segmented download from %s", start)
+        self.current_size = start
+        self.client = httpclient.grab_url_segmented(
+            info['redirected-url'], self.filename, start, total_size,
+            app.config.get(prefs.HTTP_DOWNLOAD_CONNECTIONS),
+            self.on_download_finished, self.on_segmented_download_error,
+            info)
+        self.update_stats()
+
+    def on_probe_error(self, error, resume):
+        # let the normal download report the error, if there really is one
+        self.probe_client = None
+        if self.state == u'downloading':
+            self._start_single_download(resume)
+
+    def on_segmented_download_error(self, error):
+        if isinstance(error, (httpclient.UnexpectedStatusCode,
+                              httpclient.ResumeFailed)):
+            # The server doesn't handle range requests properly after all.
+            # Continue with a normal download from the data we've got.
+            logging.info("segmented download failed (%s), using a single "
+                         "connection.  url: %s", error, self.url)
+            self.destroy_client()
+            self.try_segmented = False
+            self.start_download()
+        else:
+            # destroy the client now, so that current_size doesn't include
+            # any data after a gap
+            self.destroy_client()
+            self.on_download_error(error)
+
     def _resume_sanity_check(self):
         """Do sanity checks to test if we should try HTTP Resume.
 
         :returns: If we should still try HTTP resume
         """
+        marker_path = httpclient.segmented_marker_path(self.filename)
+        if os.path.exists(marker_path):
+            # A segmented download was interrupted, so we don't know where
+            # the gaps in the file are.
+            logging.warn("Segmented download was interrupted, starting "
+                         "over.  url: %s, path: %s.", self.url, self.filename)
+            try:
+                fileutil.remove(marker_path)
+            except OSError:
+                pass
+            return False
         if not os.path.exists(self.filename):
             return False
         # sanity check that the file we're resuming from is the right
@@ -796,9 +938,17 @@ class HTTPDownloader(BGDownloader):
         """update the stats before we throw away the client.
         """
         self.update_stats()
+        if isinstance(self.client, httpclient.SegmentedClient):
+            # Resuming continues from the end of the file, so only count the
+            # data before the first gap.  _resume_sanity_check() will
+            # truncate the rest.
+            self.current_size = self.client.get_contiguous_size()
         self.client = None
 
     def cancel_request(self, remove_file=False):
+        if self.probe_client is not None:
+            self.probe_client.cancel()
+            self.probe_client = None
         if self.client is not None:
             self.client.cancel(remove_file=remove_file)
             self.destroy_client()
@@ -273,6 +273,12 @@ class RemoteDownloader(DDBObject):
         'current_size',
         'upload_size',
     ])
+    # status attributes that only track download progress.  If those are the
+    # only ones that change, we save to disk at most every
+    # PROGRESS_SAVE_INTERVAL seconds.
+    progress_status_attributes = status_attributes_to_defer.union(
+        temp_status_attributes)
+    PROGRESS_SAVE_INTERVAL = 10
 
     def setup_new(self, url, item, content_type=None, channel_name=None):
         check_u(url)
@@ -295,7 +301,8 @@ class RemoteDownloader(DDBObject):
         self.channel_name = channel_name
         self.manualUpload = False
         self.status_updates_frozen = False
-        self.last_update = time.time()
+        self.last_update = self.last_progress_save = time.time()
+        self.progress_save_pending = False
         self.reset_status_attributes()
         if content_type is None:
             self.content_type = u""
@@ -309,7 +316,8 @@ class RemoteDownloader(DDBObject):
 
     def setup_restored(self):
         self.status_updates_frozen = False
-        self.last_update = time.time()
+        self.last_update = self.last_progress_save = time.time()
+        self.progress_save_pending = False
         self.delete_files = True
         self.item_list = []
         if self.dlid == 'noid':
@@ -322,17 +330,27 @@ class RemoteDownloader(DDBObject):
             default = self.status_attribute_defaults.get(attr_name)
             setattr(self, attr_name, default)
 
-    def update_status_attributes(self, status_dict):
-        """Reset the attributes that track downloading info."""
+    def update_status_attributes(self, status_dict, delta=False):
+        """Update the attributes that track downloading info.
+
+        :param delta: status_dict only contains the attributes that changed,
+            leave the other ones alone rather than resetting them.
+        :returns: set of attribute names that changed
+        """
+        changed = set()
         for attr_name in self.status_attributes:
             if attr_name in status_dict:
                 value = status_dict[attr_name]
+            elif delta:
+                continue
             else:
                 value = self.status_attribute_defaults.get(attr_name)
             # only set attributes if something's changed.  This makes our
             # UPDATE statments contain less data
             if getattr(self, attr_name) != value:
                 setattr(self, attr_name, value)
+                changed.add(attr_name)
+        return changed
 
     def get_status_for_downloader(self):
         status = dict((name, getattr(self, name))
@@ -368,6 +386,9 @@ class RemoteDownloader(DDBObject):
         return cls.make_view('id NOT IN (SELECT downloader_id from item)')
 
     def signal_change(self, needs_save=True, needs_signal_item=True):
+        if needs_save:
+            self.last_progress_save = time.time()
+            self.progress_save_pending = False
         DDBObject.signal_change(self, needs_save=needs_save)
         if needs_signal_item:
             for item in self.item_list:
@@ -441,8 +462,24 @@ class RemoteDownloader(DDBObject):
         if rates[1] is not None:
             app.download_state_manager.total_up_rate += rates[1]
 
+    @classmethod
+    def save_deferred_progress(cls):
+        """Save progress changes that update_status() held off on saving."""
+        for downloader in cls.make_view():
+            if downloader.progress_save_pending:
+                downloader.signal_change(needs_signal_item=False)
+
     @classmethod
     def update_status(cls, data, cmd_done=False):
+        """Update a downloader using a status dict from the downloader
+        daemon.
+
+        data is either a full status or a delta that only has the fields
+        that changed (see make_status_delta() in dl_daemon/download.py).
+
+        :returns: False if the update was stale and got discarded
+        """
+        delta = data.pop('delta', False)
         for field in data:
             if field not in ['filename', 'short_filename', 'metainfo']:
                 data[field] = unicodify(data[field])
@@ -457,7 +494,10 @@ class RemoteDownloader(DDBObject):
             now = time.time()
             last_update = self.last_update
             state = self.get_state()
-            new_state = data.get('state', u'downloading')
+            if delta:
+                new_state = data.get('state', state)
+            else:
+                new_state = data.get('state', u'downloading')
 
             # If this item was marked as pending update, then any update
             # which comes in now which does not have cmd_done set is void.
@@ -514,8 +554,10 @@ class RemoteDownloader(DDBObject):
             old_filename = self.get_filename()
 
             self.before_changing_rates()
-            self.update_status_attributes(data)
+            changed = self.update_status_attributes(data, delta)
             self.after_changing_rates()
+            if not changed:
+                return True
 
             # Store the time the download finished
             finished = self.is_finished() and not was_finished
@@ -528,7 +570,15 @@ class RemoteDownloader(DDBObject):
                       and self.get_upload_ratio() > app.config.get(prefs.UPLOAD_RATIO)))):
                 self.stop_upload()
 
-            self.signal_change()
+            if (changed.issubset(self.progress_status_attributes) and
+                    now - self.last_progress_save <
+                    self.PROGRESS_SAVE_INTERVAL):
+                # Only the download progress changed.  Update the views,
+                # but hold off saving to disk for a bit.
+                self.progress_save_pending = True
+                self.signal_change(needs_save=False)
+            else:
+                self.signal_change()
 
             self.update_item_list(finished, file_migrated, old_filename)
         return True
@@ -1066,6 +1116,7 @@ class DownloadDaemonStarter(object):
                     callback=self._on_shutdown)
 
     def _on_shutdown(self):
+        RemoteDownloader.save_deferred_progress()
         self.shutdown_callback()
         del self.shutdown_callback
 
@@ -108,6 +108,95 @@ class _RateLimiter(object):
         # get ready for the next check() call
         self.last_time = time.time()
 
+class FeedItemDiff(object):
+    """Matches parsed feed entries against the items already in a feed.
+
+    We build hash indexes over the existing items once, then match each
+    entry with a couple of dict lookups.  Entries are matched by:
+
+        - rss_id (the entry's GUID)
+        - (url, entry_title)
+        - the enclosure values (url, size, type and format) of items that
+          don't have an rss_id
+
+    :attribute new_entries: list of (entry, fp_values) tuples for entries
+        that didn't match any item
+    :attribute updated: list of (item, fp_values) tuples for items whose
+        values changed
+    :attribute seen: set of items that matched an entry.  Items not in this
+        set aren't in the feed anymore.
+    """
+
+    ENCLOSURE_KEYS = ('url', 'enclosure_size', 'enclosure_type',
+                      'enclosure_format')
+
+    def __init__(self, items, rate_limiter=None):
+        self.new_entries = []
+        self.updated = []
+        self.seen = set()
+        # maps items to their index in self.updated
+        self._update_indexes = {}
+        self.items_by_rss_id = {}
+        self.items_by_url_title = {}
+        self.items_by_enclosure = {}
+        for item in items:
+            if rate_limiter is not None:
+                rate_limiter.check_for_sleep()
+            rss_id = item.get_rss_id()
+            if rss_id is not None:
+                self.items_by_rss_id[rss_id] = item
+            elif item.url is not None:
+                key = self._enclosure_key_for_item(item)
+                self.items_by_enclosure.setdefault(key, []).append(item)
+            by_url_title_key = (item.url, item.entry_title)
+            if by_url_title_key != (None, None):
+                self.items_by_url_title[by_url_title_key] = item
+
+    def _enclosure_key_for_item(self, item):
+        return tuple(getattr(item, key) for key in self.ENCLOSURE_KEYS)
+
+    def _enclosure_key_for_values(self, fp_values):
+        return tuple(fp_values.data[key] for key in self.ENCLOSURE_KEYS)
+
+    def add_entry(self, entry, fp_values):
+        """Match a parsed entry against our items."""
+        item = None
+        rss_id = fp_values.data['rss_id']
+        if rss_id is not None:
+            item = self.items_by_rss_id.get(rss_id)
+        if item is None:
+            by_url_title_key = (fp_values.data['url'],
+                                fp_values.data['entry_title'])
+            if by_url_title_key != (None, None):
+                item = self.items_by_url_title.get(by_url_title_key)
+        if item is not None:
+            self._match_item(item, fp_values)
+            return
+        key = self._enclosure_key_for_values(fp_values)
+        matches = None
+        if fp_values.data['url'] is not None:
+            matches = self.items_by_enclosure.get(key)
+        if matches:
+            for item in matches:
+                self._match_item(item, fp_values)
+        else:
+            self.new_entries.append((entry, fp_values))
+
+    def _match_item(self, item, fp_values):
+        self.seen.add(item)
+        if fp_values.compare_to_item(item):
+            return
+        # if several entries match an item, the last one wins
+        if item in self._update_indexes:
+            self.updated[self._update_indexes[item]] = (item, fp_values)
+        else:
+            self._update_indexes[item] = len(self.updated)
+            self.updated.append((item, fp_values))
+
+    def removed_items(self, items):
+        """Get the items in items that didn't match any entry."""
+        return set(i for i in items if i not in self.seen)
+
 # Notes on character set encoding of feeds:
 #
 # The parsing libraries built into Python mostly use byte strings
@@ -335,6 +424,11 @@ class FeedImpl(DDBObject):
         """
         return self.url
 
+    def get_update_host(self):
+        """Returns the host that update() fetches from, or None
+        """
+        return feedupdate.url_host(self.url)
+
     @returns_unicode
     def get_base_url(self):
         """Returns the URL of the feed
@@ -531,6 +625,8 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             if folder:
                 folder.signal_change(needs_save=False)
         DDBObject.signal_change(self, needs_save=needs_save)
+        if not self.in_db_init:
+            models.Item.feed_count_tracker.feed_changed(self)
 
     def on_signal_change(self):
         is_updating = bool(self.actualFeed.updating)
@@ -560,62 +656,43 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
         if self.actualFeed:
             return self.actualFeed.clean_old_items()
 
-    def invalidate_counts(self):
-        for cached_count_attr in ('_num_available', '_num_unwatched',
-                '_num_downloaded', '_num_downloading'):
-            if cached_count_attr in self.__dict__:
-                del self.__dict__[cached_count_attr]
-
     def recalc_counts(self):
-        self.invalidate_counts()
+        """Send out changes after our item counts change.
+
+        The counts themselves are kept up to date by Item's
+        feed_count_tracker.
+        """
         self.signal_change(needs_save=False)
         if self.in_folder():
             self.get_folder().signal_change(needs_save=False)
 
+    def _get_item_count(self, name):
+        return models.Item.feed_count_tracker.get_feed_count(self.id, name)
+
     def num_downloaded(self):
         """Returns the number of downloaded items in the feed.
         """
-        try:
-            return self._num_downloaded
-        except AttributeError:
-            self._num_downloaded = self.downloaded_items.count()
-            return self._num_downloaded
+        return self._get_item_count('downloaded')
 
     def num_downloading(self):
         """Returns the number of downloading items in the feed.
         """
-        try:
-            return self._num_downloading
-        except AttributeError:
-            self._num_downloading = self.downloading_items.count()
-            return self._num_downloading
+        return self._get_item_count('downloading')
 
     def num_unwatched(self):
         """Returns string with number of unwatched videos in feed
         """
-        try:
-            return self._num_unwatched
-        except AttributeError:
-            self._num_unwatched = self.unwatched_items.count()
-            return self._num_unwatched
+        return self._get_item_count('unwatched')
 
     def num_available(self):
         """Returns string with number of available videos in feed
         """
-        try:
-            return self._num_available
-        except AttributeError:
-            self._num_available = (self.available_items.count() -
-                    self.auto_pending_items.count())
-            return self._num_available
+        return (self._get_item_count('available') -
+                self._get_item_count('auto_pending'))
 
     def mark_as_viewed(self):
         """Sets the last time the feed was viewed to now
         """
-        try:
-            del self._num_available
-        except AttributeError:
-            pass
         for item in list(self.available_items):
             item.unset_new()
         if self.in_folder():
@@ -1070,7 +1147,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
 
     for name in ( 'set_update_frequency', 'schedule_update_events',
             'cancel_update_events',
-            'get_url', 'get_base_url',
+            'get_url', 'get_base_url', 'get_update_host',
             'get_base_href', 'get_link',
             'get_thumbnail_url', 'get_license', 'url', 'title', 'created',
             'thumbURL', 'dir', 'preserve_downloads', 'lookup', 'reset',
@@ -1156,6 +1233,7 @@ class Feed(DDBObject, iconcache.IconCacheOwnerMixin):
             app.bulk_sql_manager.finish()
         self.remove_icon_cache()
         DDBObject.remove(self)
+        models.Item.feed_count_tracker.feed_removed(self)
         self.actualFeed.remove()
         if self.in_folder():
             self.get_folder().signal_change()
@@ -1267,54 +1345,24 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                 self.thumbURL = image_url
                 self.ufeed.icon_cache.request_update(is_vital=True)
 
-        items_byid = {}
-        items_byURLTitle = {}
-        items_nokey = []
-        for item in self.items:
-            rate_limiter.check_for_sleep()
-            try:
-                items_byid[item.get_rss_id()] = item
-            except KeyError:
-                items_nokey.append(item)
-            by_url_title_key = (item.url, item.entry_title)
-            if by_url_title_key != (None, None):
-                items_byURLTitle[by_url_title_key] = item
+        diff = FeedItemDiff(self.items, rate_limiter)
         for entry in parsed.entries:
             rate_limiter.check_for_sleep()
             entry = self.add_scraped_thumbnail(entry)
-            fp_values = FeedParserValues(entry)
-            new = True
-            if fp_values.data['rss_id'] is not None:
-                id_ = fp_values.data['rss_id']
-                if items_byid.has_key(id_):
-                    item = items_byid[id_]
-                    if not fp_values.compare_to_item(item):
-                        item.update_from_feed_parser_values(fp_values)
-                    new = False
-                    self.old_items.discard(item)
-            if new:
-                by_url_title_key = (fp_values.data['url'],
-                        fp_values.data['entry_title'])
-                if by_url_title_key != (None, None):
-                    if items_byURLTitle.has_key(by_url_title_key):
-                        item = items_byURLTitle[by_url_title_key]
-                        if not fp_values.compare_to_item(item):
-                            item.update_from_feed_parser_values(fp_values)
-                        new = False
-                        self.old_items.discard(item)
-            if new:
-                for item in items_nokey:
-                    if fp_values.compare_to_item(item):
-                        new = False
-                    else:
-                        try:
-                            if fp_values.compare_to_item_enclosures(item):
-                                item.update_from_feed_parser_values(fp_values)
-                                new = False
-                                self.old_items.discard(item)
-                        except StandardError:
-                            pass
-            if new and fp_values.first_video_enclosure is not None:
+            diff.add_entry(entry, FeedParserValues(entry))
+        self._apply_item_diff(diff, channel_title)
+
+    def _apply_item_diff(self, diff, channel_title):
+        """Update our items using a FeedItemDiff.
+
+        create_items_for_parsed() calls this inside a bulk_sql_manager
+        batch, so all the inserts and updates get written out together.
+        """
+        for item, fp_values in diff.updated:
+            item.update_from_feed_parser_values(fp_values)
+        self.old_items = diff.removed_items(self.old_items)
+        for entry, fp_values in diff.new_entries:
+            if fp_values.first_video_enclosure is not None:
                 self._handle_new_entry(entry, fp_values, channel_title)
 
     def _allow_feed_to_override_title(self):
@@ -1483,9 +1531,10 @@ class RSSFeedImpl(RSSFeedImplBase):
             except AttributeError:
                 modified = None
             logging.debug("updating %s", self.url)
-            self.download = grab_url(self.url, self._update_callback,
-                    self._update_errback, etag=etag, modified=modified,
-                                    default_mime_type=u'application/rss+xml')
+            self.download = feedupdate.grab_url(self.ufeed, self.url,
+                    self._update_callback, self._update_errback, etag=etag,
+                    modified=modified,
+                    default_mime_type=u'application/rss+xml')
 
     def _update_errback(self, error):
         if not self.ufeed.id_exists():
@@ -1578,6 +1627,13 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         """
         raise NotImplementedError()
 
+    def get_update_host(self):
+        for url in self.urls:
+            host = feedupdate.url_host(url)
+            if host is not None:
+                return host
+        return None
+
     def check_update_finished(self):
         if self.updating == 0:
             self.update_finished()
@@ -1632,8 +1688,8 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         for url in self.urls:
             etag = self.etag.get(url)
             modified = self.modified.get(url)
-            self.download_dc[url] = grab_url(
-                url,
+            self.download_dc[url] = feedupdate.grab_url(
+                self.ufeed, url,
                 lambda x, url=url: self._update_callback(x, url),
                 lambda x, url=url: self._update_errback(x, url),
                 etag=etag, modified=modified,
@@ -30,27 +30,193 @@
 """feedupdate.py -- Handles updating feeds.
 
 Our basic strategy is to limit the number of feeds that are
-simultaniously updating at any given time.  Right now the limit is set
-to 3.
+simultaniously updating at any given time.  We limit both the total
+number of updates and the number of updates that fetch from the same
+host, so that a slow server doesn't hold up feeds on other servers.
+
+Feeds that want the same URL at the same time share a single HTTP request
+(see FeedUpdateQueue.grab_url()).
 """
 
 import collections
+import logging
+import random
+from urlparse import urlparse
 
 from miro import eventloop
+from miro import httpclient
+from miro.clock import clock
+
+MAX_UPDATES = 8
+MAX_UPDATES_PER_HOST = 2
+# Scheduled updates are moved up to this fraction of their delay earlier,
+# so that feeds with the same update frequency don't all fire at once.
+UPDATE_JITTER = 0.25
+
+def url_host(url):
+    """Get the host for a feed URL.
+
+    :returns: lowercase host name, or None for URLs without a host (file:
+        and dtv: URLs).
+    """
+    if not url:
+        return None
+    host = urlparse(url)[1].lower()
+    if not host:
+        return None
+    return host
+
+def jittered_delay(delay):
+    """Spread out a scheduled update.
+
+    Returns a random delay in the last UPDATE_JITTER part of the
+    range [0, delay].  Immediate updates (delay == 0) aren't changed.
+    """
+    if delay <= 0:
+        return delay
+    return delay * (1.0 - UPDATE_JITTER * random.random())
+
+class FetchStats(object):
+    """Statistics on the HTTP requests for a feed.
+
+    :attribute fetches: number of responses
+    :attribute not_modified: number of 304 responses
+    :attribute errors: number of failed requests
+    :attribute total_time: seconds spent waiting for responses
+    :attribute last_time: seconds taken by the last response
+    """
+    def __init__(self):
+        self.fetches = 0
+        self.not_modified = 0
+        self.errors = 0
+        self.total_time = 0.0
+        self.last_time = None
+
+    def record_response(self, status, elapsed):
+        self.fetches += 1
+        if status == 304:
+            self.not_modified += 1
+        self.total_time += elapsed
+        self.last_time = elapsed
+
+    def record_error(self, elapsed):
+        self.errors += 1
+        self.total_time += elapsed
+        self.last_time = elapsed
+
+    def not_modified_rate(self):
+        """Get the fraction of responses that were 304 Not Modified."""
+        if self.fetches == 0:
+            return 0.0
+        return float(self.not_modified) / self.fetches
+
+    def average_time(self):
+        """Get the average time for a request to complete."""
+        count = self.fetches + self.errors
+        if count == 0:
+            return None
+        return self.total_time / count
+
+    def __repr__(self):
+        return "<FetchStats fetches=%d 304s=%d errors=%d avg_time=%s>" % (
+            self.fetches, self.not_modified, self.errors,
+            self.average_time())
+
+class FetchRequest(object):
+    """A feed's request in a shared fetch.
+
+    Returned by FeedUpdateQueue.grab_url().  Call cancel() to stop waiting
+    for the response.
+    """
+    def __init__(self, fetch, feed, callback, errback):
+        self.fetch = fetch
+        self.feed = feed
+        self.callback = callback
+        self.errback = errback
+
+    def cancel(self):
+        self.fetch.cancel_request(self)
+
+class SharedFetch(object):
+    """HTTP request for a feed URL shared by all feeds that want it."""
+    def __init__(self, update_queue, key):
+        self.update_queue = update_queue
+        self.key = key
+        self.requests = []
+        self.client = None
+        self.start_time = clock()
+
+    def start(self, default_mime_type):
+        url, etag, modified = self.key
+        self.client = httpclient.grab_url(url, self.on_response,
+                                          self.on_error, etag=etag,
+                                          modified=modified,
+                                          default_mime_type=default_mime_type)
 
-MAX_UPDATES = 3
+    def add_request(self, feed, callback, errback):
+        request = FetchRequest(self, feed, callback, errback)
+        self.requests.append(request)
+        return request
+
+    def cancel_request(self, request):
+        try:
+            self.requests.remove(request)
+        except ValueError:
+            return # already finished
+        if not self.requests:
+            self.update_queue.fetch_finished(self)
+            if self.client is not None:
+                self.client.cancel()
+                self.client = None
+
+    def on_response(self, info):
+        elapsed = clock() - self.start_time
+        for request in self.finish():
+            self.update_queue.get_stats(request.feed).record_response(
+                info.get('status'), elapsed)
+            self.call_request(request.callback, info)
+
+    def on_error(self, error):
+        elapsed = clock() - self.start_time
+        for request in self.finish():
+            self.update_queue.get_stats(request.feed).record_error(elapsed)
+            self.call_request(request.errback, error)
+
+    def finish(self):
+        requests = self.requests
+        self.requests = []
+        self.client = None
+        self.update_queue.fetch_finished(self)
+        return requests
+
+    def call_request(self, func, arg):
+        # don't let an error updating one feed stop the other feeds from
+        # getting the response.
+        try:
+            func(arg)
+        except StandardError:
+            logging.exception("feedupdate: error handling response for %s",
+                              self.key[0])
 
 class FeedUpdateQueue(object):
     def __init__(self):
         self.update_queue = collections.deque()
+        self.queued = set()
         self.timeouts = {}
         self.callback_handles = {}
         self.currently_updating = set()
+        # maps feed ids to the host they're fetching from
+        self.updating_hosts = {}
+        self.host_counts = collections.defaultdict(int)
+        # maps (url, etag, modified) to the SharedFetch for it
+        self.fetches = {}
+        # maps feed ids to FetchStats objects
+        self.stats = {}
 
     def schedule_update(self, delay, feed, update_callback):
         name = "Feed update (%s)" % feed.get_title()
-        self.timeouts[feed.id] = eventloop.add_timeout(delay, self.do_update, 
-                name, args=(feed, update_callback))
+        self.timeouts[feed.id] = eventloop.add_timeout(jittered_delay(delay),
+                self.do_update, name, args=(feed, update_callback))
 
     def cancel_update(self, feed):
         try:
@@ -62,29 +228,88 @@ class FeedUpdateQueue(object):
 
     def do_update(self, feed, update_callback):
         del self.timeouts[feed.id]
-        self.update_queue.append((feed, update_callback))
+        if feed.id not in self.queued:
+            self.queued.add(feed.id)
+            self.update_queue.append((feed, update_callback))
         self.run_update_queue()
 
     def update_finished(self, feed):
         for callback_handle in self.callback_handles.pop(feed.id):
             feed.disconnect(callback_handle)
         self.currently_updating.remove(feed)
+        host = self.updating_hosts.pop(feed.id)
+        if host is not None:
+            self.host_counts[host] -= 1
+            if self.host_counts[host] == 0:
+                del self.host_counts[host]
         # call run_update_queue in an idle to avoid re-updating the feed that
         # just finished.  That could cause weird effects since we are in the
         # update-finished callback right now.  See #16277
         eventloop.add_idle(self.run_update_queue, 'run feed update queue')
 
+    def host_is_full(self, host):
+        return (host is not None and
+                self.host_counts[host] >= MAX_UPDATES_PER_HOST)
+
     def run_update_queue(self):
-        while (len(self.update_queue) > 0 and 
+        # feeds that we skip because their host is busy keep their place in
+        # the queue.
+        skipped = collections.deque()
+        while (len(self.update_queue) > 0 and
                len(self.currently_updating) < MAX_UPDATES):
             feed, update_callback = self.update_queue.popleft()
             if feed in self.currently_updating:
+                self.queued.discard(feed.id)
+                continue
+            host = feed.get_update_host()
+            if self.host_is_full(host):
+                skipped.append((feed, update_callback))
                 continue
+            self.queued.discard(feed.id)
             handle = feed.connect('update-finished', self.update_finished)
             handle2 = feed.connect('removed', self.update_finished)
             self.callback_handles[feed.id] = (handle, handle2)
             self.currently_updating.add(feed)
+            self.updating_hosts[feed.id] = host
+            if host is not None:
+                self.host_counts[host] += 1
             update_callback()
+        skipped.extend(self.update_queue)
+        self.update_queue = skipped
+
+    def grab_url(self, feed, url, callback, errback, etag=None,
+                 modified=None, default_mime_type=None):
+        """Fetch a URL for a feed update.
+
+        This works like httpclient.grab_url(), but requests for the same
+        URL with the same etag/modified values share a single HTTP request.
+        """
+        key = (url, etag, modified)
+        try:
+            fetch = self.fetches[key]
+        except KeyError:
+            fetch = self.fetches[key] = SharedFetch(self, key)
+            request = fetch.add_request(feed, callback, errback)
+            fetch.start(default_mime_type)
+        else:
+            request = fetch.add_request(feed, callback, errback)
+        return request
+
+    def fetch_finished(self, fetch):
+        if self.fetches.get(fetch.key) is fetch:
+            del self.fetches[fetch.key]
+
+    def get_stats(self, feed):
+        """Get the FetchStats for a feed."""
+        try:
+            return self.stats[feed.id]
+        except KeyError:
+            self.stats[feed.id] = FetchStats()
+            feed.connect('removed', self._forget_stats)
+            return self.stats[feed.id]
+
+    def _forget_stats(self, feed):
+        self.stats.pop(feed.id, None)
 
 global_update_queue = FeedUpdateQueue()
 
@@ -97,3 +322,17 @@ def schedule_update(delay, feed, update_callback):
     the future.
     """
     global_update_queue.schedule_update(delay, feed, update_callback)
+
+def grab_url(feed, url, callback, errback, etag=None, modified=None,
+             default_mime_type=None):
+    """Fetch a URL for a feed update.
+
+    See FeedUpdateQueue.grab_url().
+    """
+    return global_update_queue.grab_url(feed, url, callback, errback,
+                                        etag=etag, modified=modified,
+                                        default_mime_type=default_mime_type)
+
+def get_stats(feed):
+    """Get the FetchStats for a feed."""
+    return global_update_queue.get_stats(feed)
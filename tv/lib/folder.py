@@ -33,6 +33,7 @@
 import logging
 
 from miro import feed
+from miro import models
 from miro import playlist
 from miro.database import DDBObject, ObjectNotFoundError
 from miro.databasehelper import make_simple_get_set
@@ -149,18 +150,15 @@ class ChannelFolder(FolderBase):
     def num_unwatched(self):
         """Returns number of unwatched items in feed.
         """
-        unwatched = 0
-        for child in self.get_children_view():
-            unwatched += child.num_unwatched()
-        return unwatched
+        return models.Item.feed_count_tracker.get_folder_count(self.id,
+                                                               'unwatched')
 
     def num_available(self):
         """Returns number of available items in feed
         """
-        available = 0
-        for child in self.get_children_view():
-            available += child.num_available()
-        return available
+        tracker = models.Item.feed_count_tracker
+        return (tracker.get_folder_count(self.id, 'available') -
+                tracker.get_folder_count(self.id, 'auto_pending'))
 
     def mark_as_viewed(self):
         """Marks all children as viewed.
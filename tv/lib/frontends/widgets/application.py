@@ -48,6 +48,7 @@ from miro import app
 from miro import config
 from miro import crashreport
 from miro import data
+from miro.data import asyncquery
 from miro import prefs
 from miro import feed
 from miro import startup
@@ -106,6 +107,8 @@ class Application:
         messages.FrontendMessage.install_handler(self.message_handler)
         app.item_list_pool = itemlist.ItemListPool()
         app.item_tracker_updater = itemlist.ItemTrackerUpdater()
+        app.item_query_executor = asyncquery.AsyncQueryExecutor(
+            call_on_ui_thread)
         app.info_updater = infoupdater.InfoUpdater()
         app.saved_items = set()
         app.watched_folder_manager = watchedfolders.WatchedFolderManager()
@@ -1234,6 +1237,7 @@ class Application:
         width = self.get_left_width()
         if width:
             app.widget_state.set_tabs_width(width)
+        app.item_query_executor.shutdown()
         app.controller.shutdown()
         self.quit_ui()
 
@@ -93,7 +93,8 @@ class ItemList(itemtrack.ItemTracker):
         self.group_func = group_func
         itemtrack.ItemTracker.__init__(self, call_on_ui_thread,
                                        self._make_query(),
-                                       self._make_item_source())
+                                       self._make_item_source(),
+                                       app.item_query_executor)
 
     def is_for_device(self):
         return self.tab_type.startswith('device-')
@@ -113,8 +114,8 @@ class ItemList(itemtrack.ItemTracker):
         # This code should work for either
         return int(self.tab_id.split("-")[1])
 
-    def _fetch_id_list(self):
-        itemtrack.ItemTracker._fetch_id_list(self)
+    def _id_list_fetched(self):
+        itemtrack.ItemTracker._id_list_fetched(self)
         self._reset_group_info()
 
     def _uncache_row_data(self, id_list):
@@ -122,6 +123,11 @@ class ItemList(itemtrack.ItemTracker):
         # items have changed, so we need to reset all group info
         self._reset_group_info()
 
+    def _set_id_list(self, id_list, check_ids):
+        changes = itemtrack.ItemTracker._set_id_list(self, id_list, check_ids)
+        self._reset_group_info()
+        return changes
+
     def _make_base_query(self, tab_type, tab_id):
         if self.is_for_device():
             query = itemtrack.DeviceItemTrackerQuery()
@@ -1230,7 +1230,7 @@ class ConversionsPanel(PanelBuilder):
         grid = dialogwidgets.ControlGrid()
 
         count = get_logical_cpu_count()
-        max_concurrent = []
+        max_concurrent = [(0, _("Automatic"))]
         for i in range(0, count):
             max_concurrent.append((i+1, str(i+1)))
         max_concurrent_menu = widgetset.OptionMenu(
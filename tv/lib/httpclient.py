@@ -33,8 +33,10 @@ Implements a HTTP client using pylibcurl.
 
 The main ways this module used is grab_url() and grab_headers().  grab_url
 fetches a HTTP or HTTPS url, while grab_headers only fetches the headers.
+grab_url_segmented() downloads a file over several connections at once.
 """
 
+import copy
 import logging
 import os
 import stat
@@ -209,7 +211,7 @@ class TransferOptions(object):
 
     def __init__(self, url, etag=None, modified=None, resume=False,
             post_vars=None, post_files=None, write_file=None,
-                 extra_headers=None):
+                 extra_headers=None, byte_range=None):
         self.url = url
         self.etag = etag
         self.modified = modified
@@ -218,6 +220,9 @@ class TransferOptions(object):
         self.post_vars = post_vars
         self.post_files = post_files
         self.write_file = write_file
+        # (start, end) tuple.  If set, we only request those bytes and write
+        # them to write_file starting at start.  end is exclusive.
+        self.byte_range = byte_range
         self.requires_cookies = False
         self.head_request = False
         self.invalid_url = False
@@ -261,7 +266,7 @@ class TransferOptions(object):
         return handle
 
     def _init_handle(self):
-        handle = pycurl.Curl()
+        handle = curl_manager.get_handle()
         handle.setopt(pycurl.USERAGENT, user_agent())
         handle.setopt(pycurl.FOLLOWLOCATION, 1)
         handle.setopt(pycurl.MAXREDIRS, REDIRECTION_LIMIT)
@@ -371,6 +376,8 @@ class CurlTransfer(object):
         self.status_code = None
         self.trying_head_request = False
         self.saw_head_success = False
+        self.skipped_head_request = False
+        self.range_ignored = False
 
     def _send_new_request(self):
         self._reset_transfer_data()
@@ -472,8 +479,25 @@ class CurlTransfer(object):
         self._setup_proxy_auth()
         if self.options._cancel_on_body_data:
             self.handle.setopt(pycurl.WRITEFUNCTION, self._write_func_abort)
+        elif self.options.byte_range is not None:
+            # Range requests come from grab_url_segmented(), which has
+            # already checked the URL, so skip the HEAD request.  Error
+            # responses don't get written to the file since they won't have
+            # the 206 status code.
+            self._open_file()
+            self.handle.setopt(pycurl.WRITEFUNCTION, self._write_file)
         elif self.options.write_file is not None:
-            if not self.saw_head_success:
+            if (not self.saw_head_success and not self.options.resume and
+                    curl_manager.head_request_ok(self.options)):
+                # HEAD requests have worked for this host before, skip
+                # straight to the real request.  _write_file() won't write
+                # error responses to the file.  Resumed downloads still need
+                # the HEAD request, so that RESUME_FROM only gets applied to
+                # the URL we end up at after redirects.
+                self.skipped_head_request = True
+                self._open_file()
+                self.handle.setopt(pycurl.WRITEFUNCTION, self._write_file)
+            elif not self.saw_head_success:
                 # try a HEAD request first to see if the request will work.
                 # It avoids the issue of RESUME_FROM being applied to the 
                 # error response.
@@ -494,8 +518,19 @@ class CurlTransfer(object):
             self.handle.setopt(pycurl.DEBUGFUNCTION, self.debug_func)
 
     def _write_file(self, buf):
+        if self.canceled:
+            # Don't write after cancel() returns.  grab_url_segmented()
+            # callers may be truncating the file to resume it.
+            return
         if self.check_response_code(self.status_code):
             self._filehandle.write(buf)
+        elif (self.options.byte_range is not None and
+                self.status_code == 200 and not self.range_ignored):
+            # The server ignored our Range header and is sending us the
+            # whole file.  Stop now, rather than downloading it all just to
+            # report an error.
+            self.range_ignored = True
+            self._write_func_abort(buf)
 
     def _lookup_auth(self):
         """Lookup existing HTTP passwords to use.
@@ -542,6 +577,16 @@ class CurlTransfer(object):
             curl_manager.remove_transfer(self)
 
     def _open_file(self):
+        if self.options.byte_range is not None:
+            start, end = self.options.byte_range
+            self.handle.setopt(pycurl.RANGE, '%d-%d' % (start, end - 1))
+            try:
+                self._filehandle = fileutil.open_file(
+                    self.options.write_file, 'r+b')
+                self._filehandle.seek(start)
+            except IOError:
+                raise WriteError(self.options.write_file)
+            return
         if self.options.resume:
             mode = 'ab'
             try:
@@ -644,6 +689,8 @@ class CurlTransfer(object):
                     args=(self._make_callback_info(),))
 
     def check_response_code(self, code):
+        if self.options.byte_range is not None:
+            return code == 206
         expected_codes = set([200])
         if self.options.resume:
             expected_codes.add(206)
@@ -694,9 +741,14 @@ class CurlTransfer(object):
             else:
                 # we tried a HEAD request and it worked, now we can do the
                 # transfer for real
+                curl_manager.set_head_request_ok(self.options)
                 self._send_new_request()
                 self.saw_head_success = True
-        elif info['status'] == 401:
+            return
+        if self.skipped_head_request and info['status'] not in (401, 407):
+            # check the host with a HEAD request next time
+            curl_manager.forget_head_request_ok(self.options)
+        if info['status'] == 401:
             self.handle_http_auth()
         elif info['status'] == 407:
             self.handle_proxy_auth()
@@ -872,6 +924,19 @@ class TransferStats(object):
         self.initial_size = 0
         self.status_code = None
 
+class HostStats(object):
+    """Connection stats for a single host.
+
+    Attributes:
+        transfers -- number of transfers that finished
+        new_connections -- connections libcurl had to open for them
+        reused_connections -- transfers that used an already open connection
+        skipped_head_requests -- downloads where we skipped the HEAD request
+    """
+    def __init__(self):
+        self.transfers = self.new_connections = self.reused_connections = 0
+        self.skipped_head_requests = 0
+
 class LibCURLManager(eventloop.SimpleEventLoop):
     """Manage a set of CurlTransfers.
 
@@ -880,16 +945,126 @@ class LibCURLManager(eventloop.SimpleEventLoop):
       - Runs a thread for pycurl to use
       - Manages the libcurl multi object
       - Handles adding/removing CurlTransfers objects
+      - Keeps a pool of curl handles to reuse.  Reused handles keep their
+        connections open, and all handles share a DNS cache and TLS
+        sessions through a CurlShare object.
+      - Remembers which hosts handle HEAD requests properly, so that
+        downloads from them can skip the HEAD request
     """
 
+    # max number of idle curl handles to keep around
+    MAX_FREE_HANDLES = 10
+    # max number of hosts to remember HEAD request results for
+    MAX_HEAD_OK_HOSTS = 500
+
     def __init__(self):
         eventloop.SimpleEventLoop.__init__(self)
         self.multi = pycurl.CurlMulti()
+        self.share = self._make_share()
+        self.free_handles = []
+        self.head_ok_hosts = set()
+        self.host_stats = {}
+        self.host_stats_lock = threading.Lock()
         self.transfer_map = {}
         self.transfers_to_add = Queue.Queue()
         self.transfers_to_remove = Queue.Queue()
         self.after_perform_callbacks = []
 
+    def _make_share(self):
+        share = pycurl.CurlShare()
+        # Only share the DNS cache and TLS sessions.  Sharing cookies would
+        # leak them between unrelated transfers, and the multi handle
+        # already shares connections between its handles.  Older versions of
+        # libcurl/pycurl don't support sharing TLS sessions, so share what
+        # we can.
+        for name in ('LOCK_DATA_DNS', 'LOCK_DATA_SSL_SESSION'):
+            try:
+                share.setopt(pycurl.SH_SHARE, getattr(pycurl, name))
+            except (AttributeError, pycurl.error):
+                logging.debug("httpclient: can't share %s", name)
+        return share
+
+    def get_handle(self):
+        """Get a curl handle to use for a transfer.
+
+        This should only be called inside the LibCURLManager thread.
+        """
+        if self.free_handles:
+            # reset() keeps the share, and pycurl won't let us set it twice
+            return self.free_handles.pop()
+        handle = pycurl.Curl()
+        handle.setopt(pycurl.SHARE, self.share)
+        return handle
+
+    def release_handle(self, transfer, handle):
+        """Put a handle back in the pool once a transfer is done with it."""
+        if transfer.handle is handle:
+            transfer.handle = None
+        # Handles that have loaded cookies keep them after reset(), so don't
+        # reuse those for other transfers.
+        if (len(self.free_handles) < self.MAX_FREE_HANDLES and
+                not transfer.options.requires_cookies):
+            handle.reset()
+            self.free_handles.append(handle)
+        else:
+            handle.close()
+
+    def head_request_ok(self, options):
+        """Check if we can skip the HEAD request for a download."""
+        if (options.scheme, options.host) not in self.head_ok_hosts:
+            return False
+        self.host_stats_lock.acquire()
+        try:
+            self._get_host_stats(options.host).skipped_head_requests += 1
+        finally:
+            self.host_stats_lock.release()
+        return True
+
+    def set_head_request_ok(self, options):
+        if len(self.head_ok_hosts) >= self.MAX_HEAD_OK_HOSTS:
+            self.head_ok_hosts.pop()
+        self.head_ok_hosts.add((options.scheme, options.host))
+
+    def forget_head_request_ok(self, options):
+        self.head_ok_hosts.discard((options.scheme, options.host))
+
+    def _get_host_stats(self, host):
+        # should be called with host_stats_lock held
+        try:
+            return self.host_stats[host]
+        except KeyError:
+            self.host_stats[host] = HostStats()
+            return self.host_stats[host]
+
+    def _update_host_stats(self, transfer, handle):
+        try:
+            new_connections = handle.getinfo(pycurl.NUM_CONNECTS)
+        except (AttributeError, pycurl.error):
+            return
+        self.host_stats_lock.acquire()
+        try:
+            stats = self._get_host_stats(transfer.options.host)
+            stats.transfers += 1
+            stats.new_connections += new_connections
+            if new_connections == 0:
+                stats.reused_connections += 1
+        finally:
+            self.host_stats_lock.release()
+
+    def get_host_stats(self):
+        """Get connection reuse stats for each host.
+
+        This can be called from any thread.
+
+        :returns: dict mapping host names to HostStats objects
+        """
+        self.host_stats_lock.acquire()
+        try:
+            return dict((host, copy.copy(stats))
+                        for host, stats in self.host_stats.items())
+        finally:
+            self.host_stats_lock.release()
+
     def start(self):
         self.thread = threading.Thread(target=utils.thread_body,
                                        args=[self.loop],
@@ -906,7 +1081,11 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         for transfer in self.transfer_map.values():
             self.multi.remove_handle(transfer.handle)
             transfer.handle.close()
+        for handle in self.free_handles:
+            handle.close()
+        self.free_handles = []
         self.multi.close()
+        self.share.close()
 
     def add_transfer(self, transfer):
         self.transfers_to_add.put(transfer)
@@ -968,24 +1147,35 @@ class LibCURLManager(eventloop.SimpleEventLoop):
             except Queue.Empty:
                 break
             transfer.on_cancel(remove_file)
-            try:
-                del self.transfer_map[transfer.handle]
-            except KeyError:
+            handle = transfer.handle
+            if self.transfer_map.get(handle) is not transfer:
                 continue
-            self.multi.remove_handle(transfer.handle)
+            del self.transfer_map[handle]
+            self.multi.remove_handle(handle)
+            self.release_handle(transfer, handle)
 
     def check_finished(self):
         queued, finished, errors = self.multi.info_read()
         for handle in finished:
+            transfer = None
             try:
-                self.pop_transfer(handle).on_finished()
+                transfer = self.pop_transfer(handle)
+                self._update_host_stats(transfer, handle)
+                transfer.on_finished()
             except StandardError:
                 logging.warning("Error calling on_finished()", exc_info=True)
+            if transfer is not None:
+                self.release_handle(transfer, handle)
         for handle, code, message in errors:
+            transfer = None
             try:
-                self.pop_transfer(handle).on_error(code, handle)
+                transfer = self.pop_transfer(handle)
+                self._update_host_stats(transfer, handle)
+                transfer.on_error(code, handle)
             except StandardError:
                 logging.warning("Error calling on_error()", exc_info=True)
+            if transfer is not None:
+                self.release_handle(transfer, handle)
 
     def pop_transfer(self, handle):
         transfer = self.transfer_map.pop(handle)
@@ -1013,6 +1203,224 @@ class HTTPClient(object):
 
         return self.transfer.get_stats()
 
+def segmented_marker_path(write_file):
+    """Get the path of the file that marks an in-progress segmented transfer.
+
+    SegmentedClient creates it when it starts, and removes it when the
+    transfer stops.  If it's still there later, the transfer was
+    interrupted without a chance to work out which parts of write_file were
+    downloaded.
+    """
+    return write_file + '.segments'
+
+class _Segment(object):
+    """Byte range that a SegmentedClient downloads over one connection.
+
+    end is exclusive.  It can move backwards if another connection takes
+    over the second half of the range.
+    """
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.transfer = None
+        self.done = False
+        # bytes written by transfers that we've stopped
+        self.written = 0
+
+    def downloaded(self):
+        """Get the number of bytes of our range that we've written."""
+        if self.done:
+            return self.end - self.start
+        if self.transfer is None:
+            return self.written
+        stats = self.transfer.get_stats()
+        if stats.status_code != 206:
+            return 0
+        return min(stats.downloaded, self.end - self.start)
+
+    def position(self):
+        return self.start + self.downloaded()
+
+    def stop(self):
+        """Forget about our transfer, but remember what it wrote.
+
+        Call this after the transfer is canceled or fails.
+        """
+        self.written = self.downloaded()
+        self.transfer = None
+
+    def remaining(self):
+        return self.end - self.position()
+
+class SegmentedClient(object):
+    """HTTP client for a grab_url_segmented() call.
+
+    SegmentedClient splits the bytes from start to total_size into segments,
+    and downloads each one with a separate range request that writes
+    directly to its offset in write_file.  When a segment finishes early,
+    its connection takes over the second half of the segment that has the
+    most left to download.
+
+    It has the same interface as HTTPClient, and also get_contiguous_size().
+    All methods should be called in the eventloop.
+    """
+
+    CHECK_SEGMENTS_TIMEOUT = 1.0
+    # Don't make segments smaller than this.  Each one costs a new
+    # connection and request.
+    MIN_SEGMENT_SIZE = 1024 * 1024
+
+    def __init__(self, url, write_file, start, total_size, connections,
+                 callback, errback, info):
+        self.url = url
+        self.write_file = write_file
+        self.start = start
+        self.total_size = total_size
+        self.connections = connections
+        self.callback = callback
+        self.errback = errback
+        self.info = info
+        self.segments = []
+        self.check_dc = None
+        self.finished = False
+
+    def begin(self):
+        # preallocate the file, so that each segment can write to its offset
+        try:
+            f = fileutil.open_file(self.write_file, 'ab')
+            try:
+                f.truncate(self.total_size)
+            finally:
+                f.close()
+            fileutil.open_file(segmented_marker_path(self.write_file),
+                               'wb').close()
+        except IOError:
+            self._finish()
+            eventloop.add_idle(self.errback, 'segmented transfer errback',
+                               args=(WriteError(self.write_file),))
+            return
+        size = self.total_size - self.start
+        count = max(1, min(self.connections, size // self.MIN_SEGMENT_SIZE))
+        for i in xrange(count):
+            segment = _Segment(self.start + size * i // count,
+                               self.start + size * (i + 1) // count)
+            self.segments.append(segment)
+            self._start_segment(segment)
+        self._schedule_check()
+
+    def _make_transfer(self, segment):
+        options = TransferOptions(self.url, write_file=self.write_file,
+                                  byte_range=(segment.start, segment.end))
+        return CurlTransfer(options,
+                            lambda info: self._on_segment_finished(segment),
+                            lambda error: self._on_segment_error(segment,
+                                                                 error))
+
+    def _start_segment(self, segment):
+        segment.transfer = self._make_transfer(segment)
+        segment.transfer.start()
+
+    def _schedule_check(self):
+        self.check_dc = eventloop.add_timeout(self.CHECK_SEGMENTS_TIMEOUT,
+                                              self._check_segments,
+                                              'check segmented transfer')
+
+    def _check_segments(self):
+        self.check_dc = None
+        for segment in self.segments:
+            if (segment.transfer is not None and
+                    segment.start + segment.transfer.get_stats().downloaded >=
+                    segment.end):
+                # The segment was split and we've reached the start of the
+                # second half.  The transfer is still asking for the rest of
+                # its original range, so stop it.
+                segment.transfer.cancel(remove_file=False)
+                self._on_segment_finished(segment)
+                if self.finished:
+                    return
+        self._schedule_check()
+
+    def _on_segment_finished(self, segment):
+        if self.finished or segment.done:
+            return
+        segment.transfer = None
+        segment.done = True
+        self._rebalance()
+        if all(s.done for s in self.segments):
+            self._finish()
+            self.callback(self.info)
+
+    def _on_segment_error(self, segment, error):
+        if self.finished or segment.done:
+            return
+        segment.stop()
+        self._cancel_transfers(remove_file=False)
+        self._finish()
+        self.errback(error)
+
+    def _rebalance(self):
+        """Give idle connections work from the biggest active segments."""
+        active = [s for s in self.segments if s.transfer is not None]
+        while len(active) < self.connections and active:
+            biggest = max(active, key=lambda s: s.remaining())
+            remaining = biggest.remaining()
+            if remaining < self.MIN_SEGMENT_SIZE * 2:
+                break
+            split = biggest.position() + remaining // 2
+            segment = _Segment(split, biggest.end)
+            biggest.end = split
+            self.segments.append(segment)
+            self._start_segment(segment)
+            active.append(segment)
+
+    def _cancel_transfers(self, remove_file):
+        for segment in self.segments:
+            if segment.transfer is not None:
+                segment.transfer.cancel(remove_file)
+                segment.stop()
+
+    def _finish(self):
+        self.finished = True
+        if self.check_dc is not None:
+            self.check_dc.cancel()
+            self.check_dc = None
+        try:
+            fileutil.remove(segmented_marker_path(self.write_file))
+        except OSError:
+            pass
+
+    def cancel(self, remove_file=False):
+        self._cancel_transfers(remove_file)
+        self._finish()
+
+    def get_stats(self):
+        """Get the combined stats for all segments
+
+        :returns: a TransferStats object
+        """
+        stats = TransferStats()
+        stats.status_code = 206
+        stats.initial_size = self.start
+        stats.download_total = self.total_size - self.start
+        for segment in self.segments:
+            stats.downloaded += segment.downloaded()
+            if segment.transfer is not None:
+                stats.download_rate += segment.transfer.get_stats(
+                    ).download_rate
+        return stats
+
+    def get_contiguous_size(self):
+        """Get the size of the data at the start of the file with no gaps.
+
+        This is how much of the download can be kept when resuming it as a
+        normal transfer.
+        """
+        size = self.start
+        for segment in sorted(self.segments, key=lambda s: s.start):
+            if segment.start > size:
+                break
+            size = max(size, segment.position())
+        return size
 
 def sanitize_url(url):
     """Fix poorly constructed URLs.
@@ -1075,6 +1483,30 @@ def grab_url(url, callback, errback, header_callback=None,
         transfer.start()
         return HTTPClient(transfer)
 
+def grab_url_segmented(url, write_file, start, total_size, connections,
+                       callback, errback, info=None):
+    """Download a file over several connections
+
+    The server must support range requests.  grab_headers() can be used to
+    check that, by looking for "bytes" in the accept-ranges header.
+
+    :param url: URL to download
+    :param write_file: File path to write to
+    :param start: offset to start downloading from.  The data in write_file
+        before it is kept.
+    :param total_size: size of the file
+    :param connections: maximum number of connections to use
+    :param callback: function to call on success.  It's passed info.
+    :param errback: function to call on error
+    :param info: info dict from grab_headers(), to pass to callback
+
+    :returns SegmentedClient object
+    """
+    client = SegmentedClient(sanitize_url(url), write_file, start,
+                             total_size, connections, callback, errback, info)
+    client.begin()
+    return client
+
 def _grab_file_url(url, callback, errback, default_mime_type):
     path = download_utils.get_file_url_path(url)
     try:
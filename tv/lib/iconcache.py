@@ -28,21 +28,89 @@
 # statement from all source files in the program, then also delete it here.
 
 import os
+import re
 import logging
+import hashlib
+import tempfile
 import collections
 
 from miro import httpclient
 from miro import eventloop
 from miro.database import DDBObject, ObjectNotFoundError
-from miro.download_utils import next_free_filename, get_file_url_path
+from miro.download_utils import get_file_url_path
 from miro.util import unicodify
-from miro.plat.utils import unicode_to_filename
+from miro.plat.utils import unicode_to_filename, filename_to_unicode
 from miro import app
 from miro import prefs
 from miro import fileutil
 
 RUNNING_MAX = 3
 
+# extensions that we keep when naming a cache file after its contents
+ICON_EXTENSION_RE = re.compile(r'^\.[A-Za-z0-9]{1,5}$')
+
+def icon_file_extension(name):
+    """Get the extension to use for a cached icon.
+
+    :param name: filename suggested by the server for the icon, or None
+    :returns: the extension of name (including the dot) or an empty string
+        if name doesn't have a sane extension
+    """
+    if not name:
+        return ''
+    ext = os.path.splitext(name)[1]
+    if ICON_EXTENSION_RE.match(ext):
+        return ext.lower()
+    return ''
+
+def icon_cache_path(cachedir, data, name=None):
+    """Get the path to store icon data at.
+
+    Icon files are named after the SHA-1 hash of their contents, so two
+    downloads of the same image end up at the same path.
+    """
+    digest = hashlib.sha1(data).hexdigest()
+    filename = unicode(digest + icon_file_extension(name))
+    return os.path.join(cachedir, unicode_to_filename(filename, cachedir))
+
+def write_icon_file(cachedir, data, name=None):
+    """Store icon data in the icon cache directory.
+
+    If a file with the same contents is already there, we reuse it rather
+    than writing a new copy.  This does blocking IO, so it gets called with
+    eventloop.call_in_thread().
+
+    :returns: path to the cache file
+    """
+    path = icon_cache_path(cachedir, data, name)
+    if fileutil.exists(path):
+        return path
+    try:
+        fileutil.makedirs(cachedir)
+    except OSError:
+        pass
+    # write to a temp file, then rename it so that we never have a partial
+    # file at path.
+    fd, tmp_path = tempfile.mkstemp(suffix='.part',
+                                    dir=fileutil.expand_filename(cachedir))
+    try:
+        output = os.fdopen(fd, 'wb')
+        try:
+            output.write(data)
+        finally:
+            output.close()
+        fileutil.rename(tmp_path, path)
+    except (IOError, OSError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        # on windows, rename() fails if another thread stored the same
+        # icon before us.  That's fine, the file has the contents we want.
+        if not fileutil.exists(path):
+            raise
+    return path
+
 class IconCacheUpdater:
     def __init__(self):
         self.idle = collections.deque()
@@ -96,6 +164,78 @@ class IconCacheUpdater:
     def shutdown(self):
         self.in_shutdown = True
 
+class IconDownload(object):
+    """Download of a single icon URL.
+
+    Many IconCache objects can share a download.  Items from the same feed
+    often have the same thumbnail URL, so we only fetch each URL once at a
+    time and give the result to all the IconCaches that asked for it.
+
+    The IconCache that started the download holds the IconCacheUpdater slot;
+    we call update_finished() once when the download is done.
+    """
+
+    # maps URLs to the IconDownload currently fetching them
+    in_progress = {}
+
+    def __init__(self, url):
+        self.url = url
+        self.icon_caches = []
+
+    @classmethod
+    def start(cls, icon_cache, url):
+        """Get the icon at url for icon_cache.
+
+        :returns: True if we started a new download, False if icon_cache
+            joined a download that was already in progress.
+        """
+        if url in cls.in_progress:
+            cls.in_progress[url].icon_caches.append(icon_cache)
+            return False
+        download = cls.in_progress[url] = cls(url)
+        download.icon_caches.append(icon_cache)
+        httpclient.grab_url(url, download.on_response, download.on_error)
+        return True
+
+    def on_response(self, info):
+        if info is None or info['status'] not in (200, 304):
+            self.on_error("bad response")
+            return
+        # Our cache is good.  Hooray!
+        if info['status'] == 304:
+            self.finish(lambda icon_cache: icon_cache.update_finished())
+            return
+        cachedir = app.config.get(prefs.ICON_CACHE_DIRECTORY)
+        eventloop.call_in_thread(
+            lambda path: self.on_file_written(info, path),
+            self.on_write_error, write_icon_file, "Write Icon File",
+            cachedir, info['body'], info.get('filename'))
+
+    def on_file_written(self, info, path):
+        self.finish(lambda icon_cache: icon_cache.update_icon_cache(
+            self.url, info, path))
+
+    def on_write_error(self, error):
+        logging.warn("iconcache: error writing icon for %s: %s", self.url,
+                     error)
+        self.on_error(error)
+
+    def on_error(self, error):
+        self.finish(lambda icon_cache: icon_cache.error_callback(self.url,
+                                                                 error))
+
+    def finish(self, callback):
+        del self.in_progress[self.url]
+        try:
+            for icon_cache in self.icon_caches:
+                try:
+                    callback(icon_cache)
+                except StandardError:
+                    logging.exception("iconcache: error updating %s",
+                                      icon_cache)
+        finally:
+            app.icon_cache_updater.update_finished()
+
 class IconCache(DDBObject):
     def setup_new(self, dbItem):
         self.etag = None
@@ -147,16 +287,42 @@ class IconCache(DDBObject):
         self.icon_changed()
 
     def remove_file(self, filename):
+        """Remove a file that we were using.
+
+        Icon files are shared between IconCache objects with the same
+        image, so we only remove the file once nobody else refers to it.
+        """
+        if self.file_in_use(filename):
+            return
         try:
             fileutil.remove(filename)
         except OSError:
             pass
 
+    def file_in_use(self, filename):
+        """Check if an IconCache other than us refers to filename."""
+        view = IconCache.make_view('filename=? AND id != ?',
+                                   (filename_to_unicode(filename), self.id))
+        return view.count() > 0
+
+    @classmethod
+    def find_cached_file(cls, url):
+        """Look for an IconCache that already has the icon for url.
+
+        :returns: (filename, etag, modified) tuple, or None if no IconCache
+            has a valid file for url.
+        """
+        for filename, etag, modified in cls.select(
+                ['filename', 'etag', 'modified'],
+                'url=? AND filename IS NOT NULL', (url,)):
+            if fileutil.exists(filename):
+                return filename, etag, modified
+        return None
+
     def error_callback(self, url, error=None):
         self.dbItem.confirm_db_thread()
 
         if self.removed:
-            app.icon_cache_updater.update_finished()
             return
 
         # Don't clear the cache on an error.
@@ -165,109 +331,42 @@ class IconCache(DDBObject):
             self.etag = None
             self.modified = None
             self.icon_changed()
-        self.updating = False
-        if self.needsUpdate:
-            self.needsUpdate = False
-            self.request_update(True)
-        app.icon_cache_updater.update_finished()
+        self.update_finished()
+
+    def update_icon_cache(self, url, info, filename):
+        """Update our file after an icon download.
 
-    def update_icon_cache(self, url, info):
+        :param url: URL that we downloaded
+        :param info: response info from httpclient
+        :param filename: path to the cache file with the icon data
+        """
         self.dbItem.confirm_db_thread()
 
         if self.removed:
-            app.icon_cache_updater.update_finished()
             return
 
-        needs_save = False
-        needsChange = False
-
-        if info == None or (info['status'] != 304 and info['status'] != 200):
-            self.error_callback(url, "bad response")
-            return
         try:
-            # Our cache is good.  Hooray!
-            if info['status'] == 304:
-                return
-
-            needsChange = True
-
-            # We have to update it, and if we can't write to the file, we
-            # should pick a new filename.
-            if ((self.filename and
-                 not fileutil.access(self.filename, os.R_OK | os.W_OK))):
-                self.filename = None
-
-            cachedir = app.config.get(prefs.ICON_CACHE_DIRECTORY)
-            try:
-                fileutil.makedirs(cachedir)
-            except OSError:
-                pass
-
-            try:
-                # Write to a temp file.
-                if self.filename:
-                    tmp_filename = self.filename + ".part"
-                else:
-                    tmp_filename = os.path.join(cachedir, info["filename"]) + ".part"
-                tmp_filename, output = next_free_filename(tmp_filename)
-                output.write(info["body"])
-                output.close()
-            except IOError:
-                self.remove_file(tmp_filename)
-                return
-            except ValueError:
-                logging.warn('update_icon_cache: next_free_filename failed '
-                             '#1, candidate = %r', tmp_filename)
-                return
-
-            filename = unicode(info["filename"])
-            filename = unicode_to_filename(filename, cachedir)
-            filename = os.path.join(cachedir, filename)
-            needs_save = True
-            try:
-                filename, fp = next_free_filename(filename)
-            except ValueError:
-                logging.warn('update_icon_cache: next_free_filename failed '
-                             '#2, candidate = %r', filename)
-                return
-
-            if self.filename:
-                filename = self.filename
-                self.filename = None
-                self.remove_file(filename)
-
-            # we need to move the file here--so we close the file
-            # pointer and then move the file.
-            fp.close()
-            try:
-                self.remove_file(filename)
-                fileutil.rename(tmp_filename, filename)
-            except (IOError, OSError):
-                logging.exception("iconcache: fileutil.move failed")
-                filename = None
-
-            self.filename = filename
-
-            etag = unicodify(info.get("etag"))
-            modified = unicodify(info.get("modified"))
-
-            if self.etag != etag:
-                needs_save = True
-                self.etag = etag
-            if self.modified != modified:
-                needs_save = True
-                self.modified = modified
-            if self.url != url:
-                needs_save = True
-                self.url = url
+            self.set_file(url, filename, unicodify(info.get("etag")),
+                          unicodify(info.get("modified")))
         finally:
-            if needsChange:
-                self.icon_changed(needs_save=needs_save)
-            self.updating = False
-            if self.needsUpdate:
-                self.needsUpdate = False
-                self.request_update(True)
-            app.icon_cache_updater.update_finished()
+            self.update_finished()
+
+    def set_file(self, url, filename, etag, modified):
+        old_filename = self.filename
+        self.filename = filename
+        self.url = url
+        self.etag = etag
+        self.modified = modified
+        self.icon_changed()
+        if old_filename and old_filename != filename:
+            self.remove_file(old_filename)
+
+    def update_finished(self):
+        """Call when we're done with an update request."""
+        self.updating = False
+        if self.needsUpdate:
+            self.needsUpdate = False
+            self.request_update(True)
 
     def request_icon(self):
         if self.removed:
@@ -296,11 +395,25 @@ class IconCache(DDBObject):
         # No need to extract the icon again if we already have it.
         if url is None or url.startswith(u"/") or url.startswith(u"file://"):
             self.error_callback(url)
+            app.icon_cache_updater.update_finished()
+            return
+
+        # Another IconCache may already have downloaded this URL
+        cached = self.find_cached_file(url)
+        if cached is not None:
+            filename, etag, modified = cached
+            try:
+                self.set_file(url, filename, etag, modified)
+            finally:
+                self.update_finished()
+                app.icon_cache_updater.update_finished()
             return
 
         # Last try, get the icon from HTTP.
-        httpclient.grab_url(url, lambda info: self.update_icon_cache(url, info),
-                lambda error: self.error_callback(url, error))
+        if not IconDownload.start(self, url):
+            # we joined a download that's already running, so we don't need
+            # our updater slot.
+            app.icon_cache_updater.update_finished()
 
     def request_update(self, is_vital=False):
         if hasattr(self, "updating") and hasattr(self, "dbItem"):
@@ -345,12 +345,12 @@ class _ItemsForPathCountTracker(object):
         # Use a raw DB query for this one, since we want to be as fast as
         # possible
         counts = collections.defaultdict(int)
-        app.db.cursor.execute("SELECT filename, COUNT(*) "
+        rows = app.db.execute("SELECT filename, COUNT(*) "
                               "FROM item "
                               "WHERE filename IS NOT NULL "
                               "GROUP BY LOWER(filename)")
         counts.update((filename.lower(), count)
-                      for filename, count in app.db.cursor)
+                      for filename, count in rows)
         self.count_for_paths = counts
         return counts
 
@@ -381,6 +381,226 @@ class _ItemsForPathCountTracker(object):
         except AttributeError:
             return # counts not created yet we can just ignore
 
+# names of the per-feed item counts that _FeedCountTracker keeps.  The
+# order matches the flags returned by _FeedCountTracker.calc_flags()
+FEED_COUNT_NAMES = ('downloaded', 'downloading', 'unwatched', 'available',
+                    'auto_pending')
+_FEED_COUNT_INDEXES = dict((name, i) for i, name in
+                           enumerate(FEED_COUNT_NAMES))
+_FINISHED_STATES = (u'finished', u'uploading', u'uploading-paused')
+
+class _FeedCountTracker(object):
+    """Tracks the item counts that we display for feeds and folders.
+
+    We used to run a COUNT query for each count, for each feed, each time
+    something changed.  Instead, we load the counts for all feeds with one
+    query, then keep them up to date as items change.  For each item, we
+    remember which counts it contributes to, so when it changes we can
+    just apply the difference.
+
+    The flags that calc_flags() calculates should match the SQL for
+    Item.feed_downloaded_view(), feed_downloading_view(),
+    feed_unwatched_view(), feed_available_view() and
+    feed_auto_pending_view().  check_counts() can be used to verify that
+    against the database.
+    """
+
+    _FLAGS_SQL = ("SELECT item.id, item.feed_id, feed.folder_id, "
+                  # downloaded
+                  "(item.is_file_item OR rd.state in ('finished', "
+                  "'uploading', 'uploading-paused')), "
+                  # downloading
+                  "(rd.state in ('downloading', 'uploading') AND "
+                  "rd.main_item_id=item.id), "
+                  # unwatched
+                  "(item.watched_time IS NULL AND "
+                  "item.file_type in ('audio', 'video') AND "
+                  "(item.is_file_item OR rd.state in ('finished', "
+                  "'uploading', 'uploading-paused'))), "
+                  # available
+                  "item.new, "
+                  # auto_pending
+                  "(feed.autoDownloadable AND NOT item.was_downloaded AND "
+                  "(item.eligible_for_autodownload OR feed.getEverything)) "
+                  "FROM item "
+                  "LEFT JOIN remote_downloader AS rd "
+                  "ON item.downloader_id=rd.id "
+                  "LEFT JOIN feed ON item.feed_id=feed.id "
+                  "WHERE item.feed_id IS NOT NULL")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        # maps item id -> (feed_id, flags) for every item in a feed.  None
+        # until we load the counts.
+        self.item_flags = None
+        # maps feed/folder ids to lists of counts
+        self.feed_counts = {}
+        self.folder_counts = {}
+        # maps feed id -> folder id
+        self.feed_folders = {}
+
+    def calc_flags(self, item):
+        """Calculate which counts an item contributes to.
+
+        This needs to follow the SQL rules for NULL values, which is why
+        some of the checks look a bit strange.
+        """
+        dler = item.downloader
+        if dler is not None:
+            state = dler.state
+        else:
+            state = None
+        downloaded = bool(item.is_file_item) or state in _FINISHED_STATES
+        downloading = (state in (u'downloading', u'uploading') and
+                       dler.main_item_id == item.id)
+        unwatched = (item.watched_time is None and
+                     item.file_type in (u'audio', u'video') and downloaded)
+        try:
+            feed = item.get_feed()
+        except database.ObjectNotFoundError:
+            feed = None
+        auto_pending = bool(feed is not None and
+                            feed.autoDownloadable and
+                            item.was_downloaded is not None and
+                            not item.was_downloaded and
+                            (item.eligible_for_autodownload or
+                             feed.getEverything))
+        return (downloaded, downloading, unwatched, bool(item.new),
+                auto_pending)
+
+    def _load_from_db(self):
+        """Calculate counts using a query.
+
+        :returns: (item_flags, feed_counts, folder_counts, feed_folders)
+        """
+        item_flags = {}
+        feed_counts = {}
+        folder_counts = {}
+        feed_folders = dict(app.db.execute("SELECT id, folder_id FROM feed"))
+        for row in app.db.execute(self._FLAGS_SQL):
+            item_id, feed_id, folder_id = row[:3]
+            flags = tuple(bool(value) for value in row[3:])
+            item_flags[item_id] = (feed_id, flags)
+            self._add_to_counts(feed_counts, feed_id, flags, 1)
+            if folder_id is not None:
+                self._add_to_counts(folder_counts, folder_id, flags, 1)
+        return item_flags, feed_counts, folder_counts, feed_folders
+
+    def _add_to_counts(self, count_map, key, values, sign):
+        """Add a list of flags or counts to the counts for key."""
+        try:
+            counts = count_map[key]
+        except KeyError:
+            counts = count_map[key] = [0] * len(FEED_COUNT_NAMES)
+        for i, value in enumerate(values):
+            counts[i] += sign * value
+
+    def _ensure_loaded(self):
+        if self.item_flags is None:
+            (self.item_flags, self.feed_counts, self.folder_counts,
+             self.feed_folders) = self._load_from_db()
+
+    def rebuild(self):
+        """Throw away our counts and recalculate them from the database."""
+        self.item_flags = None
+        self._ensure_loaded()
+
+    def check_counts(self):
+        """Check our counts against the database.
+
+        If they don't match, we log a warning and use the counts from the
+        database.
+
+        :returns: True if the counts matched
+        """
+        if self.item_flags is None:
+            return True
+        db_state = self._load_from_db()
+        # ignore empty entries left behind by removed items
+        def non_zero(count_map):
+            return dict((key, counts) for key, counts in count_map.items()
+                        if counts != [0] * len(counts))
+        our_state = (self.item_flags, self.feed_counts, self.folder_counts)
+        if (db_state[0] == our_state[0] and
+                non_zero(db_state[1]) == non_zero(our_state[1]) and
+                non_zero(db_state[2]) == non_zero(our_state[2])):
+            return True
+        logging.warn("feed counts don't match the database, rebuilding")
+        (self.item_flags, self.feed_counts, self.folder_counts,
+         self.feed_folders) = db_state
+        return False
+
+    def get_feed_count(self, feed_id, name):
+        self._ensure_loaded()
+        try:
+            return self.feed_counts[feed_id][_FEED_COUNT_INDEXES[name]]
+        except KeyError:
+            return 0
+
+    def get_folder_count(self, folder_id, name):
+        self._ensure_loaded()
+        try:
+            return self.folder_counts[folder_id][_FEED_COUNT_INDEXES[name]]
+        except KeyError:
+            return 0
+
+    def _apply(self, feed_id, flags, delta):
+        self._add_to_counts(self.feed_counts, feed_id, flags, delta)
+        folder_id = self.feed_folders.get(feed_id)
+        if folder_id is not None:
+            self._add_to_counts(self.folder_counts, folder_id, flags, delta)
+
+    def item_changed(self, item):
+        if self.item_flags is None:
+            return # counts not loaded yet, we can just ignore
+        old = self.item_flags.get(item.id)
+        if item.feed_id is not None:
+            new = (item.feed_id, self.calc_flags(item))
+        else:
+            new = None
+        if old == new:
+            return
+        if old is not None:
+            self._apply(old[0], old[1], -1)
+        if new is not None:
+            self._apply(new[0], new[1], 1)
+            self.item_flags[item.id] = new
+        else:
+            del self.item_flags[item.id]
+
+    def item_removed(self, item):
+        if self.item_flags is None:
+            return
+        try:
+            feed_id, flags = self.item_flags.pop(item.id)
+        except KeyError:
+            return
+        self._apply(feed_id, flags, -1)
+
+    def feed_changed(self, feed):
+        """Call this when a feed changes, in case it moved folders."""
+        if self.item_flags is None:
+            return
+        old_folder_id = self.feed_folders.get(feed.id)
+        if old_folder_id == feed.folder_id:
+            return
+        counts = self.feed_counts.get(feed.id, [0] * len(FEED_COUNT_NAMES))
+        if old_folder_id is not None:
+            self._add_to_counts(self.folder_counts, old_folder_id,
+                                counts, -1)
+        if feed.folder_id is not None:
+            self._add_to_counts(self.folder_counts, feed.folder_id, counts, 1)
+        self.feed_folders[feed.id] = feed.folder_id
+
+    def feed_removed(self, feed):
+        if self.item_flags is None:
+            return
+        # the feed's items get removed first, so we just need to clean up
+        self.feed_counts.pop(feed.id, None)
+        self.feed_folders.pop(feed.id, None)
+
 class ItemChangeTracker(signals.SignalEmitter):
     """Tracks changes to items and send the ItemChanges message."""
     def __init__(self):
@@ -553,11 +773,16 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         self.playing = False
         Item._path_count_tracker.add_item(self)
 
+    def on_db_insert(self):
+        Item.feed_count_tracker.item_changed(self)
+
     def signal_change(self, needs_save=True, can_change_views=True):
         if ('torrent_title' in self.changed_attributes or
             'metadata_title' in self.changed_attributes):
             self.calc_title()
         ItemBase.signal_change(self, needs_save, can_change_views)
+        if not self.in_db_init:
+            Item.feed_count_tracker.item_changed(self)
 
     def playlists_changed(self, added=False):
         """Called when the item gets added/removed from playlists."""
@@ -939,6 +1164,8 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
         return cls.make_view("downloader_id=?", (dler_id,))
 
     _path_count_tracker = _ItemsForPathCountTracker()
+    # shared by Item and FileItem, like _path_count_tracker
+    feed_count_tracker = _FeedCountTracker()
 
     @classmethod
     def have_item_for_path(cls, path):
@@ -2095,6 +2322,7 @@ class Item(MetadataItemBase, iconcache.IconCacheOwnerMixin):
                 item.remove()
         self._remove_from_playlists()
         MetadataItemBase.remove(self)
+        Item.feed_count_tracker.item_removed(self)
 
     def setup_links(self):
         self.split_item()
@@ -41,9 +41,11 @@ import urlparse
 # XXX merged into http.server in Python 3.
 import BaseHTTPServer
 import SocketServer
+import Queue
 import threading
 import httplib
 import gzip
+from collections import deque
 try:
     from cStringIO import StringIO
 except ImportError:
@@ -62,9 +64,22 @@ from subr import (encode_response, decode_response, split_url_path, atoi,
 # Configurable options (or do via command line).
 DEFAULT_PORT = 3689
 DAAP_TIMEOUT = 1800    # timeout (in seconds)
+# Idle timeout for keep-alive connections that aren't a session's control
+# connection.  These hold on to a worker thread while they wait, so keep it
+# short.
+DAAP_KEEPALIVE_TIMEOUT = 15
+# Give up on a client that hasn't read any of a response for this long.
+DAAP_RESPONSE_TIMEOUT = 300
 
 DAAP_MAXCONN = 10      # Number of maximum connections we want to allow.
 
+# Each session typically holds open a control connection, a connection
+# waiting on /update and one or two for streaming.  We size the worker pool
+# to match.
+DAAP_WORKERS_PER_SESSION = 4
+DAAP_MAX_QUEUED = 32   # Connections waiting for a worker before we say 503
+DAAP_MAX_SESSION_REQUESTS = 6 # Concurrent requests allowed per session
+
 # !!! No user servicable parts below. !!!
 
 VERSION = '0.1'
@@ -106,28 +121,241 @@ class SessionObject(object):
     # on the requests which come in.
     pass
 
-class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+class ResponseCache(object):
+    """Cache of encoded replies for the current revision of the backend data.
+
+    Item and playlist listings only change when the backend revision
+    advances, so every client asking for the same listing at the same
+    revision can share one encoded (and possibly gzipped) StreamObj.  The
+    whole cache is thrown away as soon as we see a newer revision.
+
+    If several clients miss on the same key at once, only one of them
+    encodes the reply; the others wait for it and then use the cached copy.
+    """
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.revision = None
+        self.entries = dict()
+        # keys in the order they were added, used to evict the oldest
+        self.entry_order = deque()
+        self.key_locks = dict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, revision, key, create):
+        """Get the reply for key at revision, calling create() on a miss.
+
+        create() should return a StreamObj, or None if the reply shouldn't
+        be cached.
+        """
+        with self.lock:
+            if revision != self.revision:
+                if self.revision is not None and revision < self.revision:
+                    # Our data has already moved on, don't cache old replies.
+                    self.misses += 1
+                    return create()
+                self.revision = revision
+                self.entries.clear()
+                self.entry_order.clear()
+                self.key_locks.clear()
+            try:
+                blob = self.entries[key]
+            except KeyError:
+                key_lock = self.key_locks.setdefault(key, threading.Lock())
+            else:
+                self.hits += 1
+                return blob
+        with key_lock:
+            with self.lock:
+                if revision == self.revision and key in self.entries:
+                    self.hits += 1
+                    return self.entries[key]
+                self.misses += 1
+            blob = create()
+            with self.lock:
+                if revision == self.revision and blob is not None:
+                    if key not in self.entries:
+                        self.entry_order.append(key)
+                    self.entries[key] = blob
+                    while len(self.entries) > self.max_entries:
+                        del self.entries[self.entry_order.popleft()]
+                self.key_locks.pop(key, None)
+        return blob
+
+    def clear(self):
+        with self.lock:
+            self.revision = None
+            self.entries.clear()
+            self.entry_order.clear()
+            self.key_locks.clear()
+
+class ThreadPoolMixIn(object):
+    """Mix-in class to handle connections with a fixed pool of threads.
+
+    Like SocketServer.ThreadingMixIn, except that instead of starting a new
+    thread for every connection, accepted connections go on a queue which a
+    fixed number of worker threads service.  A worker keeps a connection
+    for as long as the client keeps it alive.  If too many connections are
+    already waiting for a worker, we tell the new one we are busy (503) and
+    close it rather than let the backlog grow without bound.
+    """
+    max_workers = DAAP_WORKERS_PER_SESSION * DAAP_MAXCONN
+    max_queued = DAAP_MAX_QUEUED
+
+    BUSY_RESPONSE = ('HTTP/1.1 503 Service Unavailable\r\n'
+                     'Content-Length: 0\r\n'
+                     'Connection: close\r\n'
+                     'Retry-After: 1\r\n\r\n')
+
+    def init_pool(self):
+        self.request_queue = Queue.Queue()
+        self.workers = []
+        self.pool_lock = threading.Lock()
+        self.pool_shutdown = False
+        self.active_connections = 0
+        self.total_connections = 0
+        self.rejected_connections = 0
+
+    def set_max_workers(self, max_workers):
+        self.max_workers = max_workers
+
+    def start_workers(self):
+        while len(self.workers) < self.max_workers:
+            t = threading.Thread(target=self.worker_thread,
+                                 name='DAAP Worker %d' % len(self.workers))
+            t.daemon = True
+            t.start()
+            self.workers.append(t)
+
+    def stop_workers(self):
+        self.pool_shutdown = True
+        # Close anything that never got to a worker.
+        while True:
+            try:
+                request, client_address = self.request_queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.close_connection(request)
+        # Wake up the idle workers so they can quit.  Busy ones quit once
+        # their connection closes.
+        for t in self.workers:
+            self.request_queue.put(None)
+        self.workers = []
+
+    def process_request(self, request, client_address):
+        # Only the thread accepting connections adds to the queue, so this
+        # check can't race with another put().
+        if self.request_queue.qsize() >= self.max_queued:
+            with self.pool_lock:
+                self.rejected_connections += 1
+            self.reject_request(request)
+            return
+        if not self.workers:
+            self.start_workers()
+        self.request_queue.put((request, client_address))
+
+    def reject_request(self, request):
+        try:
+            # Don't let a client that won't read hold up the accept loop.
+            request.setblocking(0)
+            request.send(self.BUSY_RESPONSE)
+        except socket.error:
+            pass
+        self.close_connection(request)
+
+    def close_connection(self, request):
+        # SocketServer only grew shutdown_request() in 2.7.
+        try:
+            request.shutdown(socket.SHUT_WR)
+        except socket.error:
+            pass
+        self.close_request(request)
+
+    def worker_thread(self):
+        while not self.pool_shutdown:
+            job = self.request_queue.get()
+            if job is None:
+                break
+            request, client_address = job
+            with self.pool_lock:
+                self.active_connections += 1
+                self.total_connections += 1
+            try:
+                self.finish_request(request, client_address)
+            except Exception:
+                self.handle_error(request, client_address)
+            finally:
+                self.close_connection(request)
+                with self.pool_lock:
+                    self.active_connections -= 1
+
+    def get_pool_stats(self):
+        with self.pool_lock:
+            return {
+                'workers': len(self.workers),
+                'active_connections': self.active_connections,
+                'queued_connections': self.request_queue.qsize(),
+                'total_connections': self.total_connections,
+                'rejected_connections': self.rejected_connections,
+            }
+
+class DaapTCPServer(ThreadPoolMixIn, SocketServer.TCPServer):
     # GRRR!  Stupid Windows!  When bind() is called twice on a socket
     # it should return EADDRINUSE on the second one - Windows doesn't!
     # Use robust=True (default) in make_daap_server() and it will pick 
     # a new port.
     # allow_reuse_address = True    # setsockopt(... SO_REUSEADDR, 1)
-    daemon_threads = True
+
+    # Close keep-alive connections that have been idle for this long.
+    keepalive_timeout = DAAP_KEEPALIVE_TIMEOUT
+    # Idle timeout for control connections (the ones that did the /login).
+    # This needs to be longer than the client heartbeat, because closing the
+    # control connection logs the session out.
+    control_timeout = DAAP_TIMEOUT
+    # How long a response can go without the client reading any of it.
+    # /update and streams can take as long as they need otherwise.
+    response_timeout = DAAP_RESPONSE_TIMEOUT
+    max_session_requests = DAAP_MAX_SESSION_REQUESTS
 
     def __init__(self, server_address, RequestHandlerClass,
                  bind_and_activate=True):
         SocketServer.TCPServer.__init__(self, server_address,
                                         RequestHandlerClass,
                                         bind_and_activate)
+        self.init_pool()
         self.finished_callback = None
         self.session_lock = threading.Lock()
+        self.session_requests = dict()
         self.debug = False
         self.log_message_callback = None
+        self.response_cache = ResponseCache()
+
+    def server_close(self):
+        self.stop_workers()
+        SocketServer.TCPServer.server_close(self)
+
+    def get_stats(self):
+        stats = self.get_pool_stats()
+        with self.session_lock:
+            stats['sessions'] = len(self.activeconn)
+            stats['active_requests'] = sum(self.session_requests.values())
+        return stats
 
     # New functions in subclass.  Note: we can separate some of these out
     # into separate libraries but not now.
     def set_backend(self, backend):
         self.backend = backend
+        self.response_cache.clear()
+
+    def get_backend_revision(self):
+        # Optional backend API: backends that can tell us their current
+        # revision get their item and playlist listings cached.
+        try:
+            get_current_revision = self.backend.get_current_revision
+        except AttributeError:
+            return None
+        return get_current_revision()
 
     def set_finished_callback(self, callback):
         self.finished_callback = callback
@@ -187,6 +415,30 @@ class DaapTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
             # OK, thank the caller for telling us the guy's alive
             return True
 
+    def begin_session_request(self, s):
+        """Count a request against session s.
+
+        :returns: False if the session already has too many requests going
+        """
+        if not s:
+            return True
+        with self.session_lock:
+            count = self.session_requests.get(s, 0)
+            if count >= self.max_session_requests:
+                return False
+            self.session_requests[s] = count + 1
+        return True
+
+    def end_session_request(self, s):
+        if not s:
+            return
+        with self.session_lock:
+            count = self.session_requests.get(s, 0) - 1
+            if count > 0:
+                self.session_requests[s] = count
+            else:
+                self.session_requests.pop(s, None)
+
     def handle_error(self, request, client_address):
         pass
 
@@ -215,6 +467,21 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if self.server.log_message_callback:
             self.server.log_message_callback(format, *args)
 
+    def handle_one_request(self):
+        # Don't let an idle keep-alive connection hold on to its worker
+        # forever.
+        if getattr(self, 'session', None):
+            self.connection.settimeout(self.server.control_timeout)
+        else:
+            self.connection.settimeout(self.server.keepalive_timeout)
+        BaseHTTPServer.BaseHTTPRequestHandler.handle_one_request(self)
+
+    def parse_request(self):
+        rv = BaseHTTPServer.BaseHTTPRequestHandler.parse_request(self)
+        # Got a request; the response only needs to keep making progress.
+        self.connection.settimeout(self.server.response_timeout)
+        return rv
+
     def finish(self):
         try:
             self.server.del_session(self.session)
@@ -234,7 +501,11 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     def do_send_reply(self, rcode, reply, content_type=DEFAULT_CONTENT_TYPE,
                       content_encoding=None, extra_headers=[]):
-        blob = encode_response(reply, content_encoding=content_encoding)
+        if isinstance(reply, StreamObj):
+            # already encoded, see cached_reply()
+            blob = reply
+        else:
+            blob = encode_response(reply, content_encoding=content_encoding)
         try:
             self.send_response(rcode)
             self.send_header('Content-type', content_type)
@@ -247,8 +518,14 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             for k, v in blob.get_headers():
                 self.send_header(k, v)
             self.end_headers()
-            for chunk in blob:
-                self.wfile.write(chunk)
+            if isinstance(blob, ChunkedStreamObj):
+                # Let the kernel copy file data straight to the socket if
+                # it can.
+                self.wfile.flush()
+                blob.send_to(self.connection, self.wfile.write)
+            else:
+                for chunk in blob:
+                    self.wfile.write(chunk)
         # Remote guy could be mean and cut us off.  If so, silence the broken
         # pipe error, and continue on our merry way
         except IOError:
@@ -259,6 +536,14 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
     # Convenience function: convenient that session-id must be non-zero so
     # you can use it for True/False testing too.
+    def requested_session(self):
+        # Like get_session(), but doesn't check or renew the session.
+        path, query = split_url_path(self.path)
+        try:
+            return int(query['session-id'])
+        except (KeyError, ValueError):
+            return 0
+
     def get_session(self):
         path, query = split_url_path(self.path)
         session = 0
@@ -459,6 +744,40 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             pass
         return revision, delta
     
+    def get_meta_list(self, query, default):
+        try:
+            meta = query['meta']
+        except KeyError:
+            meta = default
+        return tuple(m.strip() for m in meta.split(','))
+
+    def cached_reply(self, key, make_reply):
+        """Get an encoded reply from the server's response cache.
+
+        key identifies the request (everything except the backend revision
+        and content encoding, which we add here).  make_reply() is called to
+        build the (rcode, reply, extra_headers) tuple on a cache miss.
+        Returns an (rcode, reply, extra_headers) tuple where reply may be an
+        already encoded StreamObj.
+        """
+        revision = self.server.get_backend_revision()
+        if revision is None:
+            return make_reply()
+        content_encoding = self.reply_encoding()
+        results = []
+        def create():
+            rcode, reply, extra_headers = make_reply()
+            results.append((rcode, reply, extra_headers))
+            if rcode != DAAP_OK or extra_headers:
+                return None
+            return encode_response(reply, content_encoding=content_encoding)
+        blob = self.server.response_cache.get(revision,
+                                              key + (content_encoding,),
+                                              create)
+        if blob is None:
+            return results[0]
+        return (DAAP_OK, blob, [])
+
     # do_database_xxx(self, path, query): helper functions.  Session already
     # checked and we know we are in database/xxx.
     def do_database_containers(self, path, query):
@@ -466,64 +785,65 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         if not self._check_db_id(db_id):
             return (DAAP_FORBIDDEN, [], [])
         revision, delta = self.get_revision(query)
-        reply = []
         if len(path) == 3:
-            # There is a requirement to send a default playlist so we
-            # try to always send that one.
-            count = len(self.server.backend.get_items())
-            default_playlist = [('mlit', [
-                                          ('miid', 2),     # Item id
-                                          ('minm', 'Library'),
-                                          ('mper', 2),     # Persistent id
-                                          ('mimc', count), # count
-                                          ('mpco', 0),     # parent containerid
-                                          ('abpl', 1)      # Base playlist 
-                                         ]
-                               )]
-            playlists = self.server.backend.get_playlists()
-            playlist_list = []
-            deleted = []
-            try:
-                meta = query['meta']
-            except KeyError:
-                meta = DEFAULT_DAAP_PLAYLIST_META
-            meta_list = [m.strip() for m in meta.split(',')]
-            for k in playlists.keys():
-                playlistprop = playlists[k]
-                if playlistprop['revision'] <= delta:
-                    continue
-                if playlistprop['valid']:
-                    playlist = []
-                    for m in meta_list:
-                        if m in playlistprop.keys():
-                            try:
-                                code = dmap_consts_rmap[m]
-                            except KeyError:
-                                continue
-                            if playlistprop[m] is not None:
-                                attribute = (code, playlistprop[m])
-                                playlist.append(attribute)
-                    playlist_list.append(('mlit', playlist))
-                else:
-                    deleted.append(('miid', k))
-                                          
-            update = 1 if delta else 0
-            mlcl = default_playlist + playlist_list
-            npl = len(mlcl)
-            content = [                    # Database playlists
-                        ('mstt', DAAP_OK), # Status - OK
-                        ('muty', update),  # Update type
-                        ('mtco', npl),     # total count
-                        ('mrco', npl),     # returned count
-                        ('mlcl', mlcl)     # Playlist listing
-                       ]
-            if deleted:
-                content.append(('mudl', deleted))
-            reply.append(('aply', content))
+            meta_list = self.get_meta_list(query, DEFAULT_DAAP_PLAYLIST_META)
+            key = ('containers', delta, meta_list)
+            return self.cached_reply(key,
+                    lambda: self.make_playlist_list(delta, meta_list))
         else:
             # len(path) > 3
             playlist_id = int(path[3])
             return self.do_itemlist(path, query, playlist_id=playlist_id)
+
+    def make_playlist_list(self, delta, meta_list):
+        reply = []
+        # There is a requirement to send a default playlist so we
+        # try to always send that one.
+        count = len(self.server.backend.get_items())
+        default_playlist = [('mlit', [
+                                      ('miid', 2),     # Item id
+                                      ('minm', 'Library'),
+                                      ('mper', 2),     # Persistent id
+                                      ('mimc', count), # count
+                                      ('mpco', 0),     # parent containerid
+                                      ('abpl', 1)      # Base playlist 
+                                     ]
+                           )]
+        playlists = self.server.backend.get_playlists()
+        playlist_list = []
+        deleted = []
+        for k in playlists.keys():
+            playlistprop = playlists[k]
+            if playlistprop['revision'] <= delta:
+                continue
+            if playlistprop['valid']:
+                playlist = []
+                for m in meta_list:
+                    if m in playlistprop.keys():
+                        try:
+                            code = dmap_consts_rmap[m]
+                        except KeyError:
+                            continue
+                        if playlistprop[m] is not None:
+                            attribute = (code, playlistprop[m])
+                            playlist.append(attribute)
+                playlist_list.append(('mlit', playlist))
+            else:
+                deleted.append(('miid', k))
+                                      
+        update = 1 if delta else 0
+        mlcl = default_playlist + playlist_list
+        npl = len(mlcl)
+        content = [                    # Database playlists
+                    ('mstt', DAAP_OK), # Status - OK
+                    ('muty', update),  # Update type
+                    ('mtco', npl),     # total count
+                    ('mrco', npl),     # returned count
+                    ('mlcl', mlcl)     # Playlist listing
+                   ]
+        if deleted:
+            content.append(('mudl', deleted))
+        reply.append(('aply', content))
         return (DAAP_OK, reply, [])
 
     def do_database_browse(self, path, query):
@@ -538,6 +858,13 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     # type=xxx - not parsed yet.  I don't think it's actually used (?)
     # try to invoke any of this the server will go BOH BOH!!!! no support!!!
     def do_itemlist(self, path, query, playlist_id=None):
+        revision, delta = self.get_revision(query)
+        meta_list = self.get_meta_list(query, DEFAULT_DAAP_META)
+        key = ('items', playlist_id, delta, meta_list)
+        return self.cached_reply(key,
+                lambda: self.make_itemlist(playlist_id, delta, meta_list))
+
+    def make_itemlist(self, playlist_id, delta, meta_list):
         # Library playlist?
         # Save this variable, we use it to determine which code to send later
         # on.  playlist_id is Library default so it if asks for that as a 
@@ -548,12 +875,6 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         items = self.server.backend.get_items(playlist_id=backend_id)
         itemlist = []
         deleted = []
-        try:
-            meta = query['meta']
-        except KeyError:
-            meta = DEFAULT_DAAP_META
-        revision, delta = self.get_revision(query) 
-        meta_list = [m.strip() for m in meta.split(',')]
         # NB: mikd must be the first guy in the listing.
         # GRR stupid Rhythmbox!  The meta reply must appear in order otherwise
         # it doesn't work!
@@ -636,6 +957,7 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         # in urlparse (doesn't support daap but it's basically the same
         # as http).
         endconn = False
+        session = 0
         try:
             # You can do virtual host with this but we don't support for now
             # and actually strip it out.
@@ -647,7 +969,12 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     self.path = '?'.join([result.path, result.query])
                 else:
                     self.path = result.path
-            if self.path == '/server-info':
+            session = self.requested_session()
+            if not self.server.begin_session_request(session):
+                # This session already has its share of our workers.
+                session = 0
+                rcode, reply, extra_headers = (DAAP_UNAVAILABLE, [], [])
+            elif self.path == '/server-info':
                 rcode, reply, extra_headers = self.do_server_info()
             elif self.path == '/content-codes':
                 rcode, reply, extra_headers = self.do_content_codes()
@@ -691,6 +1018,8 @@ class DaapHttpRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             # Let's cut them off ... no reply for you!  Re-raising the
             # exception should make the caller do the right thing.
             raise e
+        finally:
+            self.server.end_session_request(session)
         if endconn:
             self.wfile.close()
 
@@ -795,7 +1124,7 @@ def runloop(daapserver):
     daapserver.serve_forever()
 
 def make_daap_server(backend, debug=False, name='pydaap', port=DEFAULT_PORT,
-                     max_conn=DAAP_MAXCONN, robust=True):
+                     max_conn=DAAP_MAXCONN, robust=True, max_workers=None):
     handler = DaapHttpRequestHandler
     failed = False
     while True:
@@ -815,6 +1144,9 @@ def make_daap_server(backend, debug=False, name='pydaap', port=DEFAULT_PORT,
     httpd.set_name(name)
     httpd.set_backend(backend)
     httpd.set_maxconn(max_conn)
+    if max_workers is None:
+        max_workers = DAAP_WORKERS_PER_SESSION * max_conn
+    httpd.set_max_workers(max_workers)
     return httpd
 
 ###############################################################################
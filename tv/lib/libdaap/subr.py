@@ -28,11 +28,14 @@
 
 # subr.py
 
+import errno
 import os
+import select
+import socket
 import stat
 import struct
 import urllib
-import gzip
+import zlib
 
 try:
     from cStringIO import StringIO
@@ -40,6 +43,22 @@ except ImportError:
     from StringIO import StringIO
 from const import *
 
+# Zero-copy file sending.  Python 2 doesn't have os.sendfile() so use the
+# pysendfile module if it is around, otherwise we fall back to read()/write().
+try:
+    from os import sendfile
+except ImportError:
+    try:
+        from sendfile import sendfile
+    except ImportError:
+        sendfile = None
+
+# sendfile() errors that mean we can't use it for this file/socket pair and
+# should copy the data ourselves.
+SENDFILE_UNSUPPORTED_ERRNOS = set([errno.EINVAL, errno.ENOSYS])
+if hasattr(errno, 'EOPNOTSUPP'):
+    SENDFILE_UNSUPPORTED_ERRNOS.add(errno.EOPNOTSUPP)
+
 # XXX calcsize()?  We need to do some overriding however.
 fmts = {
     DMAP_TYPE_LIST: ('0s', 0),
@@ -56,20 +75,46 @@ fmts = {
     DMAP_TYPE_VERSION: ('I', 4),
 }
 
+# Precompiled code (4 bytes) + length (4 bytes) header, and header + value
+# for the fixed size types, all in network byte order.
+header_struct = struct.Struct('!4sI')
+fixed_structs = dict((typ, struct.Struct('!4sI' + fmt))
+                     for typ, (fmt, size) in fmts.iteritems()
+                     if typ not in (DMAP_TYPE_LIST, DMAP_TYPE_STRING))
+
+# zlib wbits value that makes zlib write a gzip header and trailer.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+def gzip_chunks(chunks, level=6):
+    """
+       gzip_chunks(chunks) -> compressed chunks
+
+       Compress an iterable of strings into a gzip stream one chunk at a
+       time, without joining the input first.
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
 class StreamObj(object):
     """
-       Data object for encoding HTTP responses.  Use once then dispose.
+       Data object for encoding HTTP responses.  Unlike ChunkedStreamObj,
+       these can be sent any number of times, which lets the server cache
+       them.
+
+       data can be a string or a list of strings, as produced by
+       encode_chunks().
     """
     def __init__(self, data, content_encoding=None):
         self.content_encoding = content_encoding
+        if isinstance(data, str):
+            data = [data]
         if content_encoding == 'gzip':
-            gzdata = StringIO()
-            f = gzip.GzipFile(fileobj=gzdata, mode='wb')
-            f.write(data)
-            f.close()
-            self.data = gzdata.getvalue()
-        else:
-            self.data = data
+            data = gzip_chunks(data)
+        self.data = ''.join(data)
 
     def __str__(self):
         return self.data
@@ -100,8 +145,14 @@ class ChunkedStreamObj(object):
 
        for chunk in streamobj:
            write(chunk)
+
+       If the file is a regular file and the destination is a socket, you
+       can use send_to(sock) instead, which lets the kernel copy the data
+       with sendfile() where that is available.
     """
     DEFAULT_CHUNK_SIZE = 128 * 1024
+    # Max bytes to hand to each sendfile() call
+    SENDFILE_CHUNK_SIZE = 1024 * 1024
 
     def __init__(self, file_obj, hint, start=0, end=0,
                  chunksize=DEFAULT_CHUNK_SIZE):
@@ -153,6 +204,79 @@ class ChunkedStreamObj(object):
     def __len__(self):
         return self.streamsize
 
+    def can_sendfile(self, sock):
+        """Can we use sendfile() to send this object over sock?
+
+        We need a regular file.  Sockets with a timeout are fine, we wait
+        for them ourselves.
+        """
+        if sendfile is None:
+            return False
+        try:
+            mode = os.fstat(self.file_obj.fileno()).st_mode
+        except (AttributeError, EnvironmentError):
+            return False
+        return stat.S_ISREG(mode)
+
+    def send_to(self, sock, write=None):
+        """Send the rest of the stream to sock.
+
+        Uses sendfile() if we can, otherwise iterates over the object and
+        passes each chunk to write (sock.sendall by default).  If you have
+        written anything to a buffered file wrapping sock, flush it first.
+
+        :returns: number of bytes sent
+        """
+        if write is None:
+            write = sock.sendall
+        if self.can_sendfile(sock):
+            try:
+                return self._sendfile(sock)
+            except OSError, e:
+                if e.errno not in SENDFILE_UNSUPPORTED_ERRNOS:
+                    raise IOError(e.errno, e.strerror)
+                # Nothing was sent, copy the data ourselves.
+        sent = 0
+        for chunk in self:
+            write(chunk)
+            sent += len(chunk)
+        return sent
+
+    def _sendfile(self, sock):
+        out_fd = sock.fileno()
+        in_fd = self.file_obj.fileno()
+        # sendfile() doesn't use or update the file position, so pick up
+        # where the backend seeked to.
+        offset = start_offset = self.file_obj.tell()
+        # Sockets with a timeout are non-blocking underneath, so sendfile()
+        # gives us EAGAIN when the client isn't keeping up.
+        timeout = sock.gettimeout()
+        try:
+            while self.unread > 0:
+                count = min(self.unread, self.SENDFILE_CHUNK_SIZE)
+                try:
+                    sent = sendfile(out_fd, in_fd, offset, count)
+                except OSError, e:
+                    if e.errno == errno.EINTR:
+                        continue
+                    if e.errno == errno.EAGAIN and timeout is not None:
+                        if not select.select([], [out_fd], [], timeout)[1]:
+                            raise socket.timeout('timed out')
+                        continue
+                    if offset != start_offset:
+                        # too late to fall back
+                        raise IOError(e.errno, e.strerror)
+                    raise
+                # Maybe file got truncated
+                if sent == 0:
+                    self.unread = 0
+                    break
+                offset += sent
+                self.unread -= sent
+        finally:
+            self.file_obj.seek(offset)
+        return offset - start_offset
+
     def get_headers(self):
         headers = []
         if self.rangetext:
@@ -276,6 +400,58 @@ def decode_response(reply):
     except (struct.error, KeyError, ValueError), e:
         return [(-1, [])]
 
+def encode_chunks(reply, chunks):
+    """
+       encode_chunks(reply, chunks) -> size
+
+       Encode reply in a single pass, appending the encoded data to the
+       chunks list.  Returns the number of bytes appended.
+
+       Container headers are added as placeholders and filled in once we
+       know the size of their contents, so nested lists never get encoded
+       (or copied) more than once.  Joining the chunks gives the same data
+       as the old recursive encoder.
+    """
+    total = 0
+    for code, value in reply:
+        nam, typ = dmap_consts[code]
+        if typ == DMAP_TYPE_LIST:
+            # list container - reserve a slot for the header, encode the
+            # contents, then fill in the header now that we know the size.
+            index = len(chunks)
+            chunks.append('')
+            size = encode_chunks(value, chunks)
+            try:
+                chunks[index] = header_struct.pack(code, size)
+            except struct.error:
+                # This pack did not work.  Let's ignore the header but keep
+                # the contents, like we always have.
+                total += size
+                continue
+            total += header_struct.size + size
+        elif typ == DMAP_TYPE_STRING:
+            size = len(value)
+            # This ensures we always get a string type even if we are lame
+            # and passed a unicode in.
+            data = str(buffer(value))
+            if len(data) != size:
+                data = data[:size].ljust(size, '\0')
+            try:
+                chunks.append(header_struct.pack(code, size))
+            except struct.error:
+                continue
+            chunks.append(data)
+            total += header_struct.size + size
+        else:
+            fixed_struct = fixed_structs[typ]
+            try:
+                chunks.append(fixed_struct.pack(code, fmts[typ][1], value))
+            except struct.error:
+                # This pack did not work.  Let's ignore it
+                continue
+            total += fixed_struct.size
+    return total
+
 def encode_response(reply, content_encoding=None):
     """
        encode_response(reply) -> StreamObj/ChunkedStreamObj
@@ -290,42 +466,15 @@ def encode_response(reply, content_encoding=None):
        content_encoding: specify content encoding.  Right now we only support
        gzip.
     """
-    blob = ''
-    subblob = ''
+    chunks = []
     try:
-        for code, value in reply:
-            nam, typ = dmap_consts[code]
-            fmt, size = fmts[typ]
-            if typ == DMAP_TYPE_LIST:
-                # list container - override the value and the size.  Set
-                # value to '' to append nothingness but tack on the subblob at 
-                # the end. 
-                subblob = str(encode_response(value))
-                size = len(subblob)
-                value = ''
-            if typ == DMAP_TYPE_STRING:
-                fmt = str(len(value)) + fmt
-                size = len(value)
-                # This ensures we always get a string type even if we are lame
-                # and passed a unicode in.
-                value = str(buffer(value))
-            # code (4 bytes), length (4 bytes), data (variable), network byte
-            # order
-            fmt = '!4sI' + fmt
-            # XXX slow - should bunch up
-            try:
-                blob += struct.pack(fmt, code, size, value)
-            except struct.error:
-                # This pack did not work.  Let's ignore it
-                pass
-            blob += subblob
-        blob = StreamObj(blob, content_encoding=content_encoding)
+        encode_chunks(reply, chunks)
     except ValueError:
         # This is probably a file.  Just pass up to the
         # caller and let the caller deal with it.
         [(file_obj, hint, start, end)] = reply
-        blob = ChunkedStreamObj(file_obj, hint, start, end)
-    return blob
+        return ChunkedStreamObj(file_obj, hint, start, end)
+    return StreamObj(chunks, content_encoding=content_encoding)
 
 def split_url_path(urlpath):
     """
@@ -1200,11 +1200,10 @@ class MetadataManagerBase(signals.SignalEmitter):
         net_lookup_count tracks the number of paths in the system with
         net_lookup_enabled=True.
         """
-        cursor = self.db_info.db.cursor
-        cursor.execute("SELECT COUNT(1) "
-                       "FROM metadata_status "
-                       "WHERE net_lookup_enabled=1")
-        self.net_lookup_count = cursor.fetchone()[0]
+        rows = self.db_info.db.execute("SELECT COUNT(1) "
+                                       "FROM metadata_status "
+                                       "WHERE net_lookup_enabled=1")
+        self.net_lookup_count = rows[0][0]
 
     @contextlib.contextmanager
     def bulk_add(self):
@@ -87,6 +87,8 @@ EXPIRE_AFTER_X_DAYS         = Pref(key='expireAfterXDays',      default=6,     p
                                    possible_values=[1,3,6,10,30,-1], failsafe_value=-1)
 DOWNLOADS_TARGET            = Pref(key='DownloadsTarget',       default=4,     platformSpecific=False) # max auto downloads
 MAX_MANUAL_DOWNLOADS        = Pref(key='MaxManualDownloads',    default=5,    platformSpecific=False)
+# connections to use for each HTTP download.  1 turns off segmented downloads
+HTTP_DOWNLOAD_CONNECTIONS   = Pref(key='HTTPDownloadConnections', default=1, platformSpecific=False)
 VOLUME_LEVEL                = Pref(key='VolumeLevel',           default=1.0,   platformSpecific=False)
 BT_MIN_PORT                 = Pref(key='BitTorrentMinPort',     default=8500,  platformSpecific=False)
 BT_MAX_PORT                 = Pref(key='BitTorrentMaxPort',     default=8600,  platformSpecific=False)
@@ -117,7 +119,10 @@ SUBTITLE_ENCODING           = Pref(key='subtitleEncoding',      default=None,  p
 SUBTITLE_FONT               = Pref(key='subtitleFont',          default=None,  platformSpecific=False)
 # language setting: "system" uses system default; all other languages are overrides
 LANGUAGE                    = Pref(key='language',              default="system", platformSpecific=False)
-MAX_CONCURRENT_CONVERSIONS  = Pref(key='maxConcurrentConversions', default=1, platformSpecific=False)
+# 0 means pick a number based on the CPU count
+MAX_CONCURRENT_CONVERSIONS  = Pref(key='maxConcurrentConversions', default=0, platformSpecific=False)
+# PRAGMA settings for database connections, see miro.data.sqlitetuning
+SQLITE_TUNING_PROFILE       = Pref(key='sqliteTuningProfile',   default="standard", platformSpecific=False)
 SHOW_UNKNOWN_DEVICES        = Pref(key='showUnknownDevices',    default=False, platformSpecific=False)
 SHARE_MEDIA                 = Pref(key='ShareMedia',            default=False, platformSpecific=False)
 SHARE_DISCOVERABLE          = Pref(key='ShareDiscoverable',     default=True, platformSpecific=False)
@@ -401,6 +401,11 @@ class IconCacheSchema (DDBObjectSchema):
         ('url', SchemaURL(noneOk=True)),
         ]
 
+    indexes = (
+        ('icon_cache_url', ('url',)),
+        ('icon_cache_filename', ('filename',)),
+    )
+
 class ItemSchema(MultiClassObjectSchema):
     table_name = 'item'
 
@@ -998,7 +1003,7 @@ class MetadataEntrySchema(DDBObjectSchema):
         ('metadata_entry_status_and_source', ('status_id', 'source')),
     )
 
-VERSION = 201
+VERSION = 203
 
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
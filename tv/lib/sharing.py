@@ -1204,15 +1204,23 @@ class _SharedDataSet(object):
             self.condition.notify_all()
 
     def on_item_changes(self, tracker, message):
-        if 'feed_id' in message.changed_columns:
-            # items have changed feeds, regenerate the item lists
-            for feed in models.Feed.visible_view():
-                self.make_daap_playlist(feed)
-        if message.playlists_changed:
-            # items have been added/removed from playlists,
-            # regenerate the item lists
-            for playlist in models.SavedPlaylist.make_view():
-                self.make_daap_playlist(playlist)
+        feeds_changed = 'feed_id' in message.changed_columns
+        if not (feeds_changed or message.playlists_changed):
+            return
+        with self.lock:
+            # The item lists are part of the data we serve (and cache by
+            # revision), so changing them needs a new revision.
+            self.revision += 1
+            if feeds_changed:
+                # items have changed feeds, regenerate the item lists
+                for feed in models.Feed.visible_view():
+                    self.make_daap_playlist(feed)
+            if message.playlists_changed:
+                # items have been added/removed from playlists,
+                # regenerate the item lists
+                for playlist in models.SavedPlaylist.make_view():
+                    self.make_daap_playlist(playlist)
+            self.condition.notify_all()
 
     def _make_item_tracker_query(self):
         query = itemtrack.ItemTrackerQuery()
@@ -1429,6 +1437,10 @@ class _SharedDataSet(object):
         with self.lock:
             return self.daap_playlists.copy()
 
+    def get_current_revision(self):
+        with self.lock:
+            return self.revision
+
     def get_revision(self, old_revision, request_socket):
         with self.lock:
             while self.revision == old_revision:
@@ -1462,6 +1474,11 @@ class SharingManagerBackend(object):
         self.transcode_lock = threading.Lock()
         self.transcode = dict()
         self.in_shutdown = False
+        support_dir = app.config.get(prefs.SUPPORT_DIRECTORY)
+        self.probe_cache = transcode.ProbeCache(
+            os.path.join(support_dir, 'transcode-probe-cache'))
+        self.segment_cache = transcode.SegmentCache(
+            os.path.join(support_dir, 'transcode-segments'))
 
     # Reserved for future use: you can register new sharing protocols here.
     def register_protos(self, proto):
@@ -1488,6 +1505,15 @@ class SharingManagerBackend(object):
         """
         return self.data_set.get_revision(old_revision, request)
 
+    def get_current_revision(self):
+        """Get the current revision without blocking.
+
+        pydaap uses this to key its cache of encoded item and playlist
+        listings, so that clients asking for the same listing at the same
+        revision don't each pay to re-encode it.
+        """
+        return self.data_set.get_current_revision()
+
     def get_file(self, itemid, generation, ext, session, request_path_func,
                  offset=0, chunk=None):
         """Get a file to serve
@@ -1529,14 +1555,15 @@ class SharingManagerBackend(object):
                 except KeyError:
                     need_create = True
                 if need_create:
-                    yes, info = transcode.needs_transcode(path)
+                    yes, info = self.probe_cache.needs_transcode(path)
                     transcode_obj = transcode.TranscodeObject(
                                                           path,
                                                           itemid,
                                                           generation,
                                                           chunk,
                                                           info,
-                                                          request_path_func)
+                                                          request_path_func,
+                                                          self.segment_cache)
                 self.transcode[session] = transcode_obj
 
             # If there was an old object, shut it down.  Do it outside the
@@ -1735,6 +1762,18 @@ class SharingManager(object):
         else:
             return 0
 
+    def server_stats(self):
+        """Get connection counters for the sharing server.
+
+        :returns: dict with the number of workers, active, queued, total and
+        rejected connections, sessions and active requests.  Empty if we
+        aren't sharing.
+        """
+        if self.sharing:
+            return self.server.get_stats()
+        else:
+            return {}
+
     def on_config_changed(self, obj, key, value):
         listen_keys = [prefs.SHARE_MEDIA.key,
                        prefs.SHARE_DISCOVERABLE.key,
@@ -1863,6 +1902,7 @@ class SharingManager(object):
                         cmd = self.r.recv(4)
                         logging.debug('sharing: CMD %s' % cmd)
                         if cmd == SharingManager.CMD_QUIT:
+                            self.server.server_close()
                             del self.thread
                             del self.server
                             self.reload_done_event.set()
@@ -76,8 +76,10 @@ from miro import schema
 from miro import signals
 from miro import prefs
 from miro import util
+from miro import viewpredicate
 from miro.data import fulltextsearch
 from miro.data import item
+from miro.data import sqlitetuning
 from miro.gtcache import gettext as _
 from miro.plat.utils import PlatformFilenameType, filename_to_unicode
 
@@ -386,6 +388,15 @@ class LiveStorage(signals.SignalEmitter):
     - transaction-finished(success) -- We committed or rolled back a
     transaction
     """
+
+    # table that item_fts indexes and how we should keep it up to date (see
+    # miro.data.fulltextsearch)
+    fts_table = 'item'
+    fts_reindex_mode = fulltextsearch.REINDEX_DEFERRED
+    # Should we hold on to UPDATEs from update_obj() and write them in
+    # batches?  (see flush_pending_updates())
+    coalesce_updates = True
+
     def __init__(self, path=None, error_handler=None, preallocate=None,
                  object_schemas=None, schema_version=None,
                  start_in_temp_mode=False):
@@ -443,6 +454,10 @@ class LiveStorage(signals.SignalEmitter):
         self._object_map = {} # maps object id -> DDBObjects in memory
         self._ids_loaded = set()
         self._statements_in_transaction = []
+        # maps (table_name, id) -> {column name: SQL value} for updates that
+        # we haven't run yet
+        self._pending_updates = {}
+        self._fts_flush_sql = None
         eventloop.connect("event-finished", self.on_event_finished)
         for oschema in object_schemas:
             self._all_schemas.append(oschema)
@@ -462,6 +477,28 @@ class LiveStorage(signals.SignalEmitter):
         if self.preallocate:
             self._preallocate_space()
 
+    # Other code sometimes runs SQL directly on our connection or cursor.
+    # Make sure that it sees the changes update_obj() is holding on to.
+    def _get_connection(self):
+        if self._pending_updates:
+            self.flush_pending_updates()
+        return self._connection
+
+    def _set_connection(self, connection):
+        self._connection = connection
+
+    connection = property(_get_connection, _set_connection)
+
+    def _get_cursor(self):
+        if self._pending_updates:
+            self.flush_pending_updates()
+        return self._cursor
+
+    def _set_cursor(self, cursor):
+        self._cursor = cursor
+
+    cursor = property(_get_cursor, _set_cursor)
+
     def open_connection(self, path=None, start_in_temp_mode=False):
         if path is None:
             path = self.path
@@ -489,8 +526,10 @@ class LiveStorage(signals.SignalEmitter):
                     raise
 
         self.cursor = self.connection.cursor()
+        self.wal_mode = False
         if path != ':memory:' and not self.temp_mode:
             self._switch_to_wal_mode()
+        sqlitetuning.get_profile().apply(self.cursor, self.wal_mode)
 
     def _switch_to_wal_mode(self):
         """Switch to write-ahead logging mode for our connection
@@ -509,6 +548,7 @@ class LiveStorage(signals.SignalEmitter):
             self.cursor.execute("PRAGMA journal_mode=wal");
         # check that we actually succesfully switch to wal mode
         actual_mode = self.cursor.fetchall()[0][0]
+        self.wal_mode = (actual_mode == u'wal')
         if actual_mode != u'wal' and not hasattr(app, 'in_unit_tests'):
             logging.warn("PRAGMA journal_mode=wal didn't change the "
                          "mode.  journal_mode=%s", actual_mode)
@@ -789,6 +829,7 @@ class LiveStorage(signals.SignalEmitter):
             self.set_version()
             self._change_database_file_back()
         self.current_version = self._schema_version
+        self.setup_fts_reindex_mode()
 
     def _upgrade_20_database(self):
         self.cursor.execute("SELECT COUNT(*) FROM sqlite_master "
@@ -930,38 +971,93 @@ class LiveStorage(signals.SignalEmitter):
             obj.reset_changed_attributes()
 
     def update_obj(self, obj):
-        """Update a DDBObject on disk."""
+        """Update a DDBObject on disk.
+
+        If coalesce_updates is set, we don't run the UPDATE right away.
+        Instead we merge the changed values with any other pending changes
+        for the object and write them out in flush_pending_updates(), which
+        runs before any other SQL statement and before we commit.  If an
+        object gets changed several times in one event, that means we only
+        send one UPDATE for it.
+
+        Values are still validated here, so a ValidationError gets raised
+        from this call like before.  However, we can't tell that the row was
+        deleted out from under us until the UPDATE runs, so that KeyError
+        comes from flush_pending_updates() instead.
+        """
 
         obj_schema = self._schema_map[obj.__class__]
-        setters = []
-        values = []
+        values = {}
         for name, schema_item in obj_schema.fields:
             if (isinstance(schema_item, schema.SchemaSimpleItem) and
                     name not in obj.changed_attributes):
                 continue
-            setters.append('%s=?' % name)
             value = getattr(obj, name)
             try:
                 schema_item.validate(value)
             except schema.ValidationError:
                 logging.warn("error validating %s for %s", name, obj)
                 raise
-            values.append(self._converter.to_sql(obj_schema, name,
-                schema_item, value))
+            values[name] = self._converter.to_sql(obj_schema, name,
+                schema_item, value)
         obj.reset_changed_attributes()
         if values:
-            sql = "UPDATE %s SET %s WHERE id=%s" % (obj_schema.table_name,
-                    ', '.join(setters), obj.id)
-            self.execute(sql, values, is_update=True)
-            if (self.cursor.rowcount != 1 and not
+            key = (obj_schema.table_name, obj.id)
+            try:
+                self._pending_updates[key].update(values)
+            except KeyError:
+                self._pending_updates[key] = values
+            if not self.coalesce_updates:
+                self.flush_pending_updates()
+
+    def flush_pending_updates(self):
+        """Run the UPDATE statements that update_obj() held on to.
+
+        We send one UPDATE per object.  Objects from the same table that
+        changed the same set of columns get sent together using
+        executemany().
+        """
+        if not self._pending_updates:
+            return
+        pending = self._pending_updates
+        self._pending_updates = {}
+        # maps (table_name, column names) -> list of value lists
+        batches = {}
+        for (table_name, obj_id), values in pending.iteritems():
+            columns = tuple(sorted(values))
+            row = [values[name] for name in columns]
+            row.append(obj_id)
+            batches.setdefault((table_name, columns), []).append(row)
+        for (table_name, columns), rows in batches.iteritems():
+            sql = "UPDATE %s SET %s WHERE id=?" % (table_name,
+                    ', '.join('%s=?' % name for name in columns))
+            if len(rows) == 1:
+                self.execute(sql, rows[0], is_update=True)
+            else:
+                self.execute(sql, rows, is_update=True, many=True)
+            if (self.cursor.rowcount != len(rows) and not
                     self._quitting_from_operational_error):
-                if self.cursor.rowcount == 0:
-                    raise KeyError("Updating non-existent row (id: %s)" %
-                            obj.id)
-                else:
-                    raise ValueError("Update changed multiple rows "
-                            "(id: %s, count: %s)" %
-                            (obj.id, self.cursor.rowcount))
+                self._check_updated_rows(table_name, rows)
+
+    def _check_updated_rows(self, table_name, rows):
+        """Raise an error for an UPDATE that didn't change the rows we
+        expected it to.
+        """
+        ids = [row[-1] for row in rows]
+        found = set()
+        for ids_chunk in util.split_values_for_sqlite(ids):
+            sql = "SELECT id FROM %s WHERE id IN (%s)" % (table_name,
+                    ', '.join('?' for i in xrange(len(ids_chunk))))
+            found.update(r[0] for r in self.cursor.execute(sql, ids_chunk))
+        missing = [id_ for id_ in ids if id_ not in found]
+        if missing:
+            raise KeyError("Updating non-existent row (id: %s)" %
+                    ', '.join(str(id_) for id_ in missing))
+        else:
+            raise ValueError("Update changed multiple rows "
+                    "(ids: %s, count: %s)" %
+                    (', '.join(str(id_) for id_ in ids),
+                     self.cursor.rowcount))
 
     def remove_obj(self, obj):
         """Remove a DDBObject from disk."""
@@ -1030,6 +1126,23 @@ class LiveStorage(signals.SignalEmitter):
     def schema_fields(self, klass):
         return self._schema_map[klass].fields
 
+    def schema_for_table(self, table_name):
+        for oschema in self._all_schemas:
+            if oschema.table_name == table_name:
+                return oschema
+        raise KeyError(table_name)
+
+    def compile_where(self, table_name, where, values):
+        """Compile a WHERE clause for table_name into a python function.
+
+        See miro.viewpredicate for details.
+
+        :raises UnsupportedWhereClause: we can't compile the clause
+        """
+        return viewpredicate.compile_where(where, values, table_name,
+                                           self.schema_for_table(table_name),
+                                           self._converter)
+
     def object_from_class_table(self, obj, klass):
         return self._schema_map[klass] is self._schema_map[obj.__class__]
 
@@ -1171,16 +1284,46 @@ class LiveStorage(signals.SignalEmitter):
         self.finish_transaction(commit=success)
 
     def finish_transaction(self, commit=True):
+        if commit:
+            try:
+                self.flush_pending_updates()
+            except (KeyError, ValueError):
+                # All the UPDATEs ran, some just didn't match the rows we
+                # expected.  Commit the other changes, like we would have if
+                # update_obj() had raised the error.
+                self.finish_transaction()
+                raise
+            except StandardError:
+                self.finish_transaction(commit=False)
+                raise
+        else:
+            # We never sent these changes, so there's nothing to roll back
+            self._pending_updates = {}
         if len(self._statements_in_transaction) == 0:
             return
         if not self._quitting_from_operational_error:
             if commit:
+                self._flush_deferred_fts_reindex()
                 self.cursor.execute("COMMIT TRANSACTION")
             else:
                 self.cursor.execute("ROLLBACK TRANSACTION")
         self._statements_in_transaction = []
         self.emit("transaction-finished", commit)
 
+    def _flush_deferred_fts_reindex(self):
+        """Re-index item_fts rows changed during this transaction.
+
+        This only does something when we're using
+        fulltextsearch.REINDEX_DEFERRED.  We run the statements as part of the
+        transaction, so readers never see item_fts out of date.
+        """
+        if self._fts_flush_sql is None:
+            return
+        if not self.execute("SELECT 1 FROM item_fts_pending LIMIT 1"):
+            return
+        for sql in self._fts_flush_sql:
+            self.execute(sql, is_update=True)
+
     def execute(self, sql, values=None, is_update=False, many=False):
         """Execute an sql statement and return the results.
 
@@ -1196,6 +1339,11 @@ class LiveStorage(signals.SignalEmitter):
             # We want to avoid updating the database at this point.
             return
 
+        if self._pending_updates:
+            # run UPDATEs from update_obj() first, so that statements see the
+            # changes and run in the same order as the changes were made.
+            self.flush_pending_updates()
+
         if is_update and len(self._statements_in_transaction) == 0:
             self.cursor.execute("BEGIN TRANSACTION")
 
@@ -1359,10 +1507,24 @@ class LiveStorage(signals.SignalEmitter):
         self._create_variables_table()
         self.set_version()
         self.setup_fulltext_search()
+        self.setup_fts_reindex_mode()
 
     def setup_fulltext_search(self):
         fulltextsearch.setup_fulltext_search(self.connection)
 
+    def setup_fts_reindex_mode(self):
+        """Make the item_fts update triggers match fts_reindex_mode."""
+        self.flush_pending_updates()
+        mode = fulltextsearch.set_reindex_mode(self.connection,
+                                               self.fts_table,
+                                               self.fts_reindex_mode)
+        if mode == fulltextsearch.REINDEX_DEFERRED:
+            columns = fulltextsearch.get_indexed_columns(self.connection)
+            self._fts_flush_sql = fulltextsearch.flush_deferred_reindex_sql(
+                self.fts_table, columns)
+        else:
+            self._fts_flush_sql = None
+
     def _get_size_info(self):
         """Get info about the database size
 
@@ -1436,6 +1598,7 @@ class LiveStorage(signals.SignalEmitter):
 
         :param init_schema: should we create tables for our schema?
         """
+        self._pending_updates = {}
         self.connection.close()
         self.save_invalid_db()
         self.open_connection()
@@ -1469,6 +1632,11 @@ class LiveStorage(signals.SignalEmitter):
 
 class DeviceLiveStorage(LiveStorage):
     """Version of LiveStorage used for a device."""
+    fts_table = 'device_item'
+    # older versions of miro also open device databases and they don't know
+    # to flush item_fts_pending.
+    fts_reindex_mode = fulltextsearch.REINDEX_IMMEDIATE
+
     def setup_fulltext_search(self):
         fulltextsearch.setup_fulltext_search(self.connection, 'device_item')
 
@@ -1477,6 +1645,9 @@ class DeviceLiveStorage(LiveStorage):
 
 class SharingLiveStorage(LiveStorage):
     """Version of LiveStorage used for a device."""
+    fts_table = 'sharing_item'
+    # we write the items for a share once, then mostly read them
+    fts_reindex_mode = fulltextsearch.REINDEX_IMMEDIATE
 
     def __init__(self, path, share_name, object_schemas):
         error_handler = SharingLiveStorageErrorHandler(share_name)
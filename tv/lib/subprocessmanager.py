@@ -48,6 +48,7 @@ import sys
 import threading
 import trapcall
 import warnings
+import zlib
 import Queue
 
 from miro import app
@@ -72,8 +73,12 @@ def _on_windows():
 # ** Protocol between miro and subprocesses **
 #
 # We spawn a child process and communicate to it by sending messages through
-# it's stdin and stdout.  Each message contains a length (a unsigned long)
-# followed by a pickled object.
+# it's stdin and stdout.  Each message is a frame header (the data length as
+# an unsigned long long, then a flags byte) followed by an object pickled
+# with the highest protocol.  If COMPRESS_THRESHOLD is set, big pickles get
+# compressed with zlib, which is marked in the flags.  The main process
+# batches up the messages it sends during an event loop iteration and writes
+# them all at once.
 #
 # The communication goes like this:
 #
@@ -261,7 +266,19 @@ class SubprocessResponder(messagetools.MessageHandler):
 class LoadError(StandardError):
     """Exception for corrupt data when reading from a pipe."""
 
-SIZEOF_LONG = struct.calcsize("Q")
+FRAME_HEADER = struct.Struct("<QB")
+# flags for FRAME_HEADER
+FRAME_COMPRESSED = 1
+# Compress pickles at least this big, or None to never compress.  Local
+# pipes are fast enough that zlib costs far more time than it saves (see
+# performancetest.SubprocessIPCTest), so this is off by default.
+COMPRESS_THRESHOLD = None
+COMPRESS_LEVEL = 1
+# Chunks at least this big get written on their own, rather than copied
+# into a bigger string with the chunks around them.
+MAX_JOIN_SIZE = 64 * 1024
+# MessageWriter writes out its batch once it gets this big
+MAX_BATCH_SIZE = 256 * 1024
 
 def _read_bytes_from_pipe(pipe, length):
     """Read size bytes from a pipe.
@@ -292,15 +309,20 @@ def _load_obj(pipe):
 
     :returns: Python object send from the other side
     """
-    size_data = _read_bytes_from_pipe(pipe, SIZEOF_LONG)
-    if len(size_data) < SIZEOF_LONG:
-        raise LoadError("EOF reached while reading size field "
-                "(read %s bytes)" % len(size_data))
-    size = struct.unpack("Q", size_data)[0]
+    header = _read_bytes_from_pipe(pipe, FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        raise LoadError("EOF reached while reading frame header "
+                "(read %s bytes)" % len(header))
+    size, flags = FRAME_HEADER.unpack(header)
     pickle_data = _read_bytes_from_pipe(pipe, size)
     if len(pickle_data) < size:
         raise LoadError("EOF reached while reading pickle data "
                 "(read %s bytes)" % len(pickle_data))
+    if flags & FRAME_COMPRESSED:
+        try:
+            pickle_data = zlib.decompress(pickle_data)
+        except zlib.error:
+            raise LoadError("Compressed pickle data corrupt")
     try:
         return pickle.loads(pickle_data)
     except pickle.PickleError:
@@ -312,6 +334,39 @@ def _load_obj(pipe):
         send_subprocess_error_for_exception()
         raise LoadError("Unknown error in pickle.loads: %s" % e)
 
+def _encode_obj(obj):
+    """Pickle an object and make a frame header for it.
+
+    :raises pickle.PickleError: obj could not be pickled
+    :returns: (header, data) tuple
+    """
+    data = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+    flags = 0
+    if COMPRESS_THRESHOLD is not None and len(data) >= COMPRESS_THRESHOLD:
+        compressed = zlib.compress(data, COMPRESS_LEVEL)
+        if len(compressed) < len(data):
+            data = compressed
+            flags |= FRAME_COMPRESSED
+    return FRAME_HEADER.pack(len(data), flags), data
+
+def _write_chunks(pipe, chunks):
+    """Write a list of strings to a pipe with as few writes as we can.
+
+    Small chunks get joined together, big ones are written as-is to avoid
+    copying them.
+    """
+    pending = []
+    for chunk in chunks:
+        if len(chunk) >= MAX_JOIN_SIZE:
+            if pending:
+                pipe.write(''.join(pending))
+                pending = []
+            pipe.write(chunk)
+        else:
+            pending.append(chunk)
+    if pending:
+        pipe.write(''.join(pending))
+
 def _dump_obj(obj, pipe):
     """Dump an object to the other side of the pipe.
 
@@ -319,18 +374,62 @@ def _dump_obj(obj, pipe):
     :raises pickle.PickleError: obj could not be pickled
     """
 
-    pickle_data = pickle.dumps(obj)
-    size_data = struct.pack("Q", len(pickle_data))
     # NOTE: We do a blocking write here.  This should be fine, since on both
     # sides we have a thread dedicated to just reading from the pipe and
     # pushing the data into a Queue.  However, there's some chance that the
     # process on the other side has gone really haywire and the reader thread
     # is hung.  I (BDK) can't really see a way for this to realistically
     # happen, so we stick with blocking writes.
-    pipe.write(size_data)
-    pipe.write(pickle_data)
+    _write_chunks(pipe, _encode_obj(obj))
     pipe.flush()
 
+class MessageWriter(object):
+    """Writes objects to a pipe in batches.
+
+    add() pickles an object and saves it, flush() writes out everything
+    we've saved up.  If the batch gets bigger than max_batch_size, we write
+    it out right away.
+
+    MessageWriter is safe to use from multiple threads.
+    """
+    def __init__(self, pipe, max_batch_size=MAX_BATCH_SIZE):
+        self.pipe = pipe
+        self.max_batch_size = max_batch_size
+        self.lock = threading.Lock()
+        self.chunks = []
+        self.batch_size = 0
+
+    def add(self, obj):
+        """Add an object to the current batch.
+
+        :raises IOError: low-level error while writing to the pipe
+        :raises pickle.PickleError: obj could not be pickled
+        """
+        header, data = _encode_obj(obj)
+        with self.lock:
+            self.chunks.append(header)
+            self.chunks.append(data)
+            self.batch_size += len(header) + len(data)
+            if self.batch_size >= self.max_batch_size:
+                self._flush()
+
+    def flush(self):
+        """Write out the current batch.
+
+        :raises IOError: low-level error while writing to the pipe
+        """
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if not self.chunks:
+            return
+        chunks = self.chunks
+        self.chunks = []
+        self.batch_size = 0
+        _write_chunks(self.pipe, chunks)
+        self.pipe.flush()
+
 class SubprocessManager(object):
     """Manages a running subprocess
 
@@ -346,7 +445,9 @@ class SubprocessManager(object):
         up.
 
         We will install a MessageHandler for message_base_class that sends
-        them to the subprocess.
+        them to the subprocess.  If message_base_class is None, we don't
+        install a handler and messages must be sent with send_message().
+        This is useful when several processes handle the same messages.
 
         responder will receive callbacks when the subprocess sends messages.
 
@@ -358,7 +459,8 @@ class SubprocessManager(object):
         """
         if handler_args is None:
             handler_args = ()
-        message_base_class.install_handler(self)
+        if message_base_class is not None:
+            message_base_class.install_handler(self)
         self.responder = responder
         self.handler_class = handler_class
         self.handler_args = handler_args
@@ -366,6 +468,8 @@ class SubprocessManager(object):
         self.sent_quit = False
         self.process = None
         self.thread = None
+        self.writer = None
+        self.flush_scheduled = False
         self.start_time = 0
         self.restart_delay = restart_delay
 
@@ -382,6 +486,7 @@ class SubprocessManager(object):
         """Does the work to startup a new process/thread."""
         # create our child process.
         self.process = self._start_subprocess()
+        self.writer = MessageWriter(self.process.stdin)
         # create thread to handle the subprocess's output.  It would be nice
         # to eliminate this thread, but I don't see an easy way to integrate
         # it into the eventloop, since windows doesn't have support for
@@ -508,17 +613,22 @@ class SubprocessManager(object):
 
         self.thread = None
         self.process = None
+        self.writer = None
         self.is_running = False
 
     # Handle communication to our child process
 
     def send_message(self, msg):
-        """Send a message to our subprocess """
+        """Send a message to our subprocess
+
+        Messages get written out together in an idle callback, so that we
+        don't write to the pipe for each one.
+        """
 
         if not self.is_running:
             raise ValueError("subprocess not running")
         try:
-            _dump_obj(msg, self.process.stdin)
+            self.writer.add(msg)
         except IOError:
             logging.warn("Broken pipe in send_message()")
             # we could try to restart our subprocess here, but if the pipe is
@@ -526,10 +636,26 @@ class SubprocessManager(object):
             # cause a restart.
         except pickle.PickleError:
             logging.warn("Error pickling message in send_message() (%s)", msg)
+        else:
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                eventloop.add_idle(self.flush_messages,
+                                   'flush subprocess messages')
+
+    def flush_messages(self):
+        """Write out any messages that send_message() has saved up."""
+        self.flush_scheduled = False
+        if self.writer is None:
+            return
+        try:
+            self.writer.flush()
+        except IOError:
+            logging.warn("Broken pipe in flush_messages()")
 
     def send_quit(self):
         """Ask the subprocess to shutdown."""
         self.send_message(None)
+        self.flush_messages()
         self.sent_quit = True
 
     def _send_startup_info(self):
@@ -60,6 +60,7 @@ from miro.test.httpclienttest import *
 from miro.test.httpdownloadertest import *
 from miro.test.httpauthtoolstest import *
 from miro.test.feedtest import *
+from miro.test.feedupdatetest import *
 from miro.test.feedparsertest import *
 from miro.test.parseurltest import *
 from miro.test.utiltest import *
@@ -70,6 +71,7 @@ from miro.test.strippertest import *
 from miro.test.xhtmltest import *
 from miro.test.iconcachetest import *
 from miro.test.databasetest import *
+from miro.test.viewpredicatetest import *
 from miro.test.itemtest import *
 from miro.test.filetypestest import *
 from miro.test.cellpacktest import *
@@ -85,11 +87,13 @@ from miro.test.itemfiltertest import *
 from miro.test.extensiontest import *
 from miro.test.idleiteratetest import *
 from miro.test.itemtracktest import *
+from miro.test.connectionpooltest import *
 from miro.test.itemlisttest import *
 from miro.test.itemrenderertest import *
 from miro.test.sharingtest import *
 from miro.test.databaseerrortest import *
 from miro.test.playbacktest import *
+from miro.test.transcodetest import *
 
 # platform specific tests
 
@@ -0,0 +1,114 @@
+import os
+
+from miro import app
+from miro.data import connectionpool
+from miro.data import sqlitetuning
+from miro.test.framework import MiroTestCase
+
+class ConnectionPoolTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.db_path = os.path.join(self.tempdir, 'pool-test.db')
+        self.now = 0
+        self.patch_function('miro.data.connectionpool.clock',
+                            lambda: self.now)
+        self.pool = connectionpool.ConnectionPool(self.db_path,
+                                                  min_connections=1,
+                                                  max_connections=3)
+
+    def tearDown(self):
+        self.pool.destroy()
+        MiroTestCase.tearDown(self)
+
+    def test_reuse_connections(self):
+        connection = self.pool.get_connection()
+        connection2 = self.pool.get_connection()
+        self.pool.release_connection(connection)
+        self.pool.release_connection(connection2)
+        # we should keep both connections open, even though we're above
+        # min_connections
+        self.assertEquals(len(self.pool.all_connections), 2)
+        # we should get the most recently used connection back
+        self.assert_(self.pool.get_connection() is connection2)
+        stats = self.pool.get_stats()
+        self.assertEquals(stats['connections'], 2)
+        self.assertEquals(stats['free'], 1)
+        self.assertEquals(stats['hits'], 2)
+        self.assertEquals(stats['misses'], 2)
+
+    def test_connection_limit(self):
+        connections = [self.pool.get_connection() for i in xrange(3)]
+        self.assertRaises(connectionpool.ConnectionLimitError,
+                          self.pool.get_connection)
+        self.pool.release_connection(connections[0])
+        self.pool.get_connection()
+
+    def test_idle_eviction(self):
+        connections = [self.pool.get_connection() for i in xrange(3)]
+        for connection in connections:
+            self.pool.release_connection(connection)
+            self.now += 10
+        self.now = 5 + self.pool.IDLE_TIMEOUT
+        self.pool.evict_idle_connections()
+        # the first connection should be closed, since it's been idle for
+        # IDLE_TIMEOUT seconds.
+        self.assertEquals(self.pool.free_connections, connections[1:])
+        self.now += 1000
+        self.pool.evict_idle_connections()
+        # we shouldn't go below min_connections
+        self.assertEquals(self.pool.free_connections, connections[2:])
+        self.assertEquals(self.pool.get_stats()['evictions'], 2)
+
+    def test_query_stats(self):
+        connection = self.pool.get_connection()
+        start_count = self.pool.get_stats()['queries']
+        connection.execute("SELECT 1")
+        connection.execute("SELECT 2")
+        self.pool.release_connection(connection)
+        self.assertEquals(self.pool.get_stats()['queries'], start_count + 2)
+
+    def test_tuning_profile(self):
+        profile = sqlitetuning.PROFILES['standard']
+        pool = connectionpool.ConnectionPool(self.db_path,
+                                             tuning_profile=profile)
+        try:
+            for i in xrange(2):
+                # check both the connection made when checking wal_mode and a
+                # new one.
+                connection = pool.get_connection()
+                cursor = connection.execute("PRAGMA cache_size")
+                self.assertEquals(cursor.fetchone()[0], -profile.cache_size)
+                cursor = connection.execute("PRAGMA temp_store")
+                # 2 means MEMORY
+                self.assertEquals(cursor.fetchone()[0], 2)
+                if pool.wal_mode:
+                    cursor = connection.execute("PRAGMA synchronous")
+                    # 1 means NORMAL
+                    self.assertEquals(cursor.fetchone()[0], 1)
+        finally:
+            pool.destroy()
+
+class TuningProfileTest(MiroTestCase):
+    def test_pragmas(self):
+        profile = sqlitetuning.TuningProfile(cache_size=100,
+                                             wal_synchronous='NORMAL')
+        self.assertEquals(profile.pragmas(wal_mode=False),
+                          ["PRAGMA cache_size=-100"])
+        self.assertEquals(profile.pragmas(wal_mode=True),
+                          ["PRAGMA cache_size=-100",
+                           "PRAGMA synchronous=NORMAL"])
+        self.assertEquals(sqlitetuning.TuningProfile().pragmas(True), [])
+
+    def test_get_profile(self):
+        self.assert_(sqlitetuning.get_profile('large') is
+                     sqlitetuning.PROFILES['large'])
+        with self.allow_warnings():
+            profile = sqlitetuning.get_profile('bogus')
+        self.assert_(profile is sqlitetuning.PROFILES['standard'])
+
+    def test_live_storage(self):
+        # app.db should have the settings from our profile
+        profile = sqlitetuning.get_profile()
+        cursor = app.db.cursor
+        cursor.execute("PRAGMA cache_size")
+        self.assertEquals(cursor.fetchone()[0], -profile.cache_size)
@@ -1,7 +1,10 @@
 import os
 import glob
+import threading
+import time
 
 from miro.test.framework import MiroTestCase
+from miro.test import mock
 
 from miro import app
 from miro import prefs
@@ -86,6 +89,147 @@ class MockFFMpegConversionTask(conversions.FFMpegConversionTask):
     def _notify_progress(self):
         pass
 
+class FakeConversionTask(conversions.ConversionTask):
+    def __init__(self, key, output_dir, started):
+        # not calling superclass init, since we don't have an item to
+        # convert
+        self.key = key
+        self.item_info = None
+        self.create_item = False
+        self.final_output_path = os.path.join(output_dir, key)
+        self.temp_output_path = self.final_output_path + '.tmp'
+        self.thread = None
+        self.process_handle = None
+        self.error = None
+        self.progress = 0
+        self.started = started
+        self.can_finish = threading.Event()
+
+    def get_executable(self):
+        return 'fake'
+
+    def get_display_name(self):
+        return self.key
+
+    def _loop(self):
+        self.started.append(self.key)
+        self.can_finish.wait()
+        open(self.temp_output_path, 'w').close()
+        self.progress = 1.0
+
+class FakeConversionManager(conversions.ConversionManager):
+    def __init__(self, output_dir):
+        conversions.ConversionManager.__init__(self)
+        self.output_dir = output_dir
+        self.started = []
+        self.tasks = {}
+
+    def _make_conversion_task(self, converter_id, item_info, target_folder,
+                              create_item):
+        task = FakeConversionTask(item_info, self.output_dir, self.started)
+        self.tasks[item_info] = task
+        return task
+
+    # we don't have real items, so skip sending messages to the frontend
+    def _notify_task_added(self, task):
+        pass
+
+    def _notify_task_changed(self, task):
+        self.emit('task-changed', task)
+
+    def _notify_task_removed(self, task):
+        self.emit('task-removed', task)
+
+    def _notify_all_tasks_removed(self):
+        self.emit('all-tasks-removed')
+
+    def _notify_tasks_count(self):
+        pass
+
+class ConversionManagerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.manager = FakeConversionManager(self.tempdir)
+        # tasks send their completion notification to the global manager
+        patcher = mock.patch('miro.conversions.conversion_manager',
+                             self.manager)
+        patcher.start()
+        self.mock_patchers.append(patcher)
+        app.config.set(prefs.MAX_CONCURRENT_CONVERSIONS, 2)
+
+    def tearDown(self):
+        for task in self.manager.tasks.values():
+            task.can_finish.set()
+        self.manager.shutdown()
+        MiroTestCase.tearDown(self)
+
+    def start_conversions(self, *keys, **kwargs):
+        for key in keys:
+            self.manager.start_conversion('fake', key, **kwargs)
+
+    def wait_for(self, test):
+        end = time.time() + 5.0
+        while not test():
+            if time.time() > end:
+                raise AssertionError("timed out")
+            time.sleep(0.01)
+
+    def wait_for_started(self, *keys):
+        self.wait_for(lambda: self.manager.started == list(keys))
+        # make sure that nothing else starts
+        time.sleep(0.05)
+        self.assertEquals(self.manager.started, list(keys))
+
+    def finish(self, key):
+        self.manager.tasks[key].can_finish.set()
+
+    def test_fill_slots(self):
+        # all slots should be filled at once, in the order conversions were
+        # started
+        self.start_conversions('a', 'b', 'c', 'd')
+        self.wait_for_started('a', 'b')
+        # when a task finishes, the next one should start right away
+        self.finish('a')
+        self.wait_for_started('a', 'b', 'c')
+        self.finish('b')
+        self.finish('c')
+        self.wait_for_started('a', 'b', 'c', 'd')
+        self.finish('d')
+        self.wait_for(lambda: self.manager.finished_tasks_count() == 4)
+        self.assertEquals(self.manager.running_tasks_count(), 0)
+        # finished conversions should get staged
+        self.wait_for(lambda: os.path.exists(os.path.join(self.tempdir, 'd')))
+
+    def test_priority(self):
+        app.config.set(prefs.MAX_CONCURRENT_CONVERSIONS, 1)
+        self.start_conversions('a')
+        self.wait_for_started('a')
+        self.start_conversions('b', 'c')
+        self.start_conversions('d', priority=1)
+        self.finish('a')
+        self.wait_for_started('a', 'd')
+        self.finish('d')
+        self.wait_for_started('a', 'd', 'b')
+
+    def test_cancel_pending(self):
+        app.config.set(prefs.MAX_CONCURRENT_CONVERSIONS, 1)
+        self.start_conversions('a', 'b', 'c')
+        self.wait_for_started('a')
+        self.manager.cancel(self.manager.tasks['b'].key)
+        self.finish('a')
+        self.wait_for_started('a', 'c')
+
+    def test_auto_concurrency(self):
+        app.config.set(prefs.MAX_CONCURRENT_CONVERSIONS, 0)
+        self.patch_function('miro.plat.utils.get_logical_cpu_count',
+                            lambda: 4)
+        self.assertEquals(conversions.get_max_concurrent_conversions(), 3)
+        self.patch_function('miro.plat.utils.get_logical_cpu_count',
+                            lambda: 1)
+        self.assertEquals(conversions.get_max_concurrent_conversions(), 1)
+        app.config.set(prefs.MAX_CONCURRENT_CONVERSIONS, 2)
+        self.assertEquals(conversions.get_max_concurrent_conversions(), 2)
+
 class FFMpegConversionTaskTest(MiroTestCase):
     def test_ffmpeg_mp4_to_mp3(self):
         f = open(os.path.join(DATA, "ffmpeg.mp4.mp3.txt"), "r")
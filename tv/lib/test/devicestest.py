@@ -45,6 +45,7 @@ from miro.test import mock
 
 from miro import app
 from miro import database
+from miro import devicecopy
 from miro import devicedatabaseupgrade
 from miro import devices
 from miro import item
@@ -278,6 +279,123 @@ class DeviceHelperTest(MiroTestCase):
         with open(os.path.join(self.tempdir, '.miro', 'json')) as f:
             new_data = json.load(f)
         self.assertEqual(data, new_data)
+        # the journal should be reset for the new snapshot
+        ddb = devices.load_database(self.tempdir)
+        self.assertEqual(dict(ddb), data)
+        self.assertNotEqual(ddb.write_manager.journal_size, None)
+
+class DeviceDatabaseJournalTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.db_dir = os.path.join(self.tempdir, '.miro')
+        self.snapshot_path = os.path.join(self.db_dir, 'json')
+        self.journal_path = os.path.join(self.db_dir, 'json-journal')
+        devices.write_database({u'a': 1, u'b': {u'c': [5, 6]}}, self.tempdir)
+        self.ddb = devices.load_database(self.tempdir)
+
+    def tearDown(self):
+        self.ddb.write_manager.close()
+        EventLoopTest.tearDown(self)
+
+    def save(self, ddb=None):
+        if ddb is None:
+            ddb = self.ddb
+        ddb.write_manager.write()
+        ddb.write_manager.wait()
+
+    def reload(self):
+        self.ddb.write_manager.close()
+        self.ddb = devices.load_database(self.tempdir)
+        return dict(self.ddb)
+
+    def read_file(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def test_journal(self):
+        snapshot = self.read_file(self.snapshot_path)
+        self.ddb[u'a'] = 2
+        self.ddb[u'b'][u'd'] = {u'e': u'f'}
+        self.ddb.setdefault(u'settings', {})[u'name'] = u'My Device'
+        self.save()
+        # the changes should have gone to the journal, not the snapshot
+        self.assertEqual(self.read_file(self.snapshot_path), snapshot)
+        self.assertEqual(self.reload(), {
+            u'a': 2,
+            u'b': {u'c': [5, 6], u'd': {u'e': u'f'}},
+            u'settings': {u'name': u'My Device'},
+        })
+        # nested values changed after reloading should be tracked too
+        self.ddb[u'b'][u'd'][u'e'] = u'g'
+        del self.ddb[u'a']
+        self.save()
+        self.assertEqual(self.reload(), {
+            u'b': {u'c': [5, 6], u'd': {u'e': u'g'}},
+            u'settings': {u'name': u'My Device'},
+        })
+
+    def test_bulk_mode(self):
+        self.ddb.set_bulk_mode(True)
+        for i in xrange(10):
+            self.ddb[u'b'][u'%d' % i] = i
+        self.assert_(not self.ddb.write_manager.is_dirty())
+        self.ddb.set_bulk_mode(False)
+        self.assert_(self.ddb.write_manager.is_dirty())
+        self.save()
+        self.assertEqual(self.reload()[u'b'][u'9'], 9)
+
+    def test_compact(self):
+        patcher = mock.patch('miro.devicejournal.COMPACT_MIN_SIZE', 0)
+        patcher.start()
+        self.mock_patchers.append(patcher)
+        for i in xrange(10):
+            self.ddb[u'b'][u'c'] = range(i)
+            self.save()
+        # the journal should have been compacted into the snapshot at least
+        # once and it should never be bigger than the snapshot
+        snapshot_size = os.path.getsize(self.snapshot_path)
+        self.assert_(os.path.getsize(self.journal_path) <= snapshot_size * 2)
+        self.assertNotEqual(self.read_file(self.snapshot_path).find('[0, 1'),
+                            -1)
+        self.assertEqual(self.reload()[u'b'][u'c'], range(9))
+
+    def test_crash_while_appending(self):
+        self.ddb[u'a'] = 2
+        self.save()
+        with open(self.journal_path, 'ab') as f:
+            f.write('{"p": ["a"], "v"')
+        with self.allow_warnings():
+            self.assertEqual(self.reload()[u'a'], 2)
+        # since the journal is corrupt, the next write should be a snapshot
+        self.ddb[u'a'] = 3
+        self.save()
+        self.assertNotEqual(self.read_file(self.snapshot_path).find('3'), -1)
+        self.assertEqual(self.reload()[u'a'], 3)
+
+    def test_crash_while_compacting(self):
+        self.ddb[u'a'] = 2
+        self.save()
+        # simulate crashing after the new snapshot was renamed, but before
+        # the journal was reset.
+        with open(self.snapshot_path, 'wb') as f:
+            json.dump({u'a': 3}, f)
+        self.assertEqual(self.reload(), {u'a': 3})
+        self.assertEqual(self.ddb.write_manager.journal_size, None)
+
+    def test_crash_while_renaming(self):
+        # simulate crashing on windows, after removing the old snapshot but
+        # before renaming the new one.
+        os.rename(self.snapshot_path, self.snapshot_path + '.tmp')
+        self.assertEqual(self.reload(), {u'a': 1, u'b': {u'c': [5, 6]}})
+
+    def test_device_removed(self):
+        mount = self.make_temp_dir_path()
+        ddb = devices.load_database(mount)
+        shutil.rmtree(mount)
+        ddb[u'a'] = 2
+        self.save(ddb)
+        self.assert_(ddb.write_manager.writer.failed)
+        ddb.write_manager.close()
 
 class ScanDeviceForFilesTest(EventLoopTest):
     def setUp(self):
@@ -648,9 +766,16 @@ class DeviceSyncManagerTest(EventLoopTest):
         infos, expired = dsm.get_sync_items()
         dsm.start()
         dsm.add_items(infos)
-        self.runPendingIdles()
+        self.run_sync(dsm)
         return infos
 
+    def run_sync(self, dsm):
+        self.runPendingIdles()
+        # wait for the file copies, then run their callbacks
+        if dsm.copier is not None:
+            dsm.copier.wait()
+        self.runPendingIdles()
+
     def test_add_items(self):
         # Test add_items()
         self.check_device_items([])
@@ -767,7 +892,7 @@ class DeviceSyncManagerTest(EventLoopTest):
         dsm.start()
         dsm.add_items(playlist_items)
         dsm.add_items(auto_sync_items, auto_sync=True)
-        self.runPendingIdles()
+        self.run_sync(dsm)
         # check that the device items got created and that auto_sync is set
         # correctly
         db_info=self.device.db_info
@@ -788,6 +913,97 @@ class DeviceSyncManagerTest(EventLoopTest):
         # FIXME: Should write this one
         pass
 
+class FileCopierTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.progress = {}
+        self.finished = {}
+        self.sources = []
+        for i in xrange(5):
+            path = self.make_temp_path('.dat')
+            f = open(path, 'wb')
+            f.write(os.urandom(10000 + i))
+            f.close()
+            self.sources.append(path)
+        self.dests = [self.make_temp_path('.dat') for path in self.sources]
+
+    def make_copier(self, thread_count=2, max_unsynced_files=10):
+        # use small buffers so that we test copying files in multiple blocks
+        return devicecopy.FileCopier('test', self.on_progress,
+                                     self.on_finished,
+                                     thread_count=thread_count,
+                                     block_size=1024,
+                                     fsync_batch_size=15000,
+                                     max_unsynced_files=max_unsynced_files)
+
+    def on_progress(self, progress):
+        for key, count in progress.items():
+            self.progress[key] = self.progress.get(key, 0) + count
+
+    def on_finished(self, key, success):
+        self.assert_(key not in self.finished)
+        self.finished[key] = success
+
+    def start_copies(self, copier):
+        for source, dest in zip(self.sources, self.dests):
+            copier.copy(source, dest, dest)
+
+    def test_copy(self):
+        copier = self.make_copier()
+        self.start_copies(copier)
+        copier.wait()
+        self.runPendingIdles()
+        self.assertEquals(self.finished, dict((d, True) for d in self.dests))
+        for source, dest in zip(self.sources, self.dests):
+            self.assertEquals(open(source, 'rb').read(),
+                              open(dest, 'rb').read())
+        stats = copier.get_stats()
+        self.assertEquals(stats['files'], len(self.sources))
+        total_size = sum(os.path.getsize(p) for p in self.sources)
+        self.assertEquals(stats['bytes'], total_size)
+        self.assert_(sum(self.progress.values()) <= total_size)
+        self.assert_(not copier.is_running())
+
+    def test_max_unsynced_files(self):
+        copier = self.make_copier(max_unsynced_files=2)
+        # only the file count should make us sync
+        copier.fsync_batch_size = 1024 * 1024
+        batch_sizes = []
+        real_sync_files = copier._sync_files
+        def _sync_files(to_sync):
+            batch_sizes.append(len(to_sync))
+            real_sync_files(to_sync)
+        copier._sync_files = _sync_files
+        self.start_copies(copier)
+        copier.wait()
+        self.runPendingIdles()
+        self.assertEquals(self.finished, dict((d, True) for d in self.dests))
+        self.assertEquals(sum(batch_sizes), len(self.sources))
+        self.assert_(max(batch_sizes) <= 2, batch_sizes)
+
+    def test_copy_error(self):
+        copier = self.make_copier()
+        missing = os.path.join(self.tempdir, 'missing.dat')
+        with self.allow_warnings():
+            copier.copy(missing, self.dests[0], self.dests[0])
+            copier.wait()
+        self.runPendingIdles()
+        self.assertEquals(self.finished, {self.dests[0]: False})
+
+    def test_cancel(self):
+        copier = self.make_copier(thread_count=1)
+        self.start_copies(copier)
+        copier.cancel()
+        copier.wait()
+        self.runPendingIdles()
+        # every file should be reported once and only the ones that
+        # finished before the cancel should be left
+        self.assertSameSet(self.finished.keys(), self.dests)
+        for dest, success in self.finished.items():
+            self.assertEquals(os.path.exists(dest), success)
+        self.assertRaises(ValueError, copier.copy, self.sources[0],
+                          self.dests[0], self.dests[0])
+
 class DeviceItemTest(MiroTestCase):
     """Tests for the DeviceItem class."""
     def setUp(self):
@@ -6,7 +6,9 @@ from miro import eventloop
 from miro import models
 from miro import prefs
 from miro.dl_daemon import command
+from miro.dl_daemon import download
 from miro.plat import resources
+from miro.test import mock
 from miro.test import testobjects
 from miro.test.framework import MiroTestCase
 
@@ -133,6 +135,59 @@ class DownloaderTest(MiroTestCase):
         self.item.expire()
         self.assertEquals(self.feed.downloaded_items.count(), 0)
 
+    def send_delta(self, **fields):
+        fields['dlid'] = self.dlid
+        fields['delta'] = True
+        return downloader.RemoteDownloader.update_status(fields)
+
+    def saved_current_size(self):
+        rows = app.db.execute("SELECT current_size FROM remote_downloader "
+                              "WHERE id=?", (self.item.downloader.id,))
+        return rows[0][0]
+
+    def test_status_delta(self):
+        self.start_download()
+        self.update_status(0.3, 10)
+        self.assert_(self.send_delta(current_size=50000, rate=2500))
+        dler = self.item.downloader
+        self.assertEquals(dler.current_size, 50000)
+        self.assertEquals(dler.rate, 2500)
+        # fields that weren't in the delta should be unchanged
+        self.assertEquals(dler.get_state(), u'downloading')
+        self.assertEquals(dler.total_size, 100000)
+        self.assertEquals(dler.filename, self.downloading_path)
+        # a state change in a delta should be applied like normal
+        with open(self.final_path, 'w') as f:
+            f.write("bogus data")
+        self.send_delta(state=u'finished', current_size=100000,
+                        filename=self.final_path, end_time=1040)
+        self.check_download_finished()
+
+    def test_progress_save_throttled(self):
+        self.start_download()
+        self.update_status(0.3, 10)
+        dler = self.item.downloader
+        self.assertEquals(self.saved_current_size(), 30000)
+        # progress-only changes don't get saved right away
+        self.send_delta(current_size=50000, rate=2500)
+        self.assertEquals(dler.current_size, 50000)
+        self.assert_(dler.progress_save_pending)
+        self.assertEquals(self.saved_current_size(), 30000)
+        # ...but they do once PROGRESS_SAVE_INTERVAL has passed
+        dler.last_progress_save -= dler.PROGRESS_SAVE_INTERVAL
+        self.send_delta(current_size=60000)
+        self.assert_(not dler.progress_save_pending)
+        self.assertEquals(self.saved_current_size(), 60000)
+        # state changes get saved right away, along with any deferred
+        # progress
+        self.send_delta(current_size=70000)
+        self.send_delta(state=u'paused')
+        self.assertEquals(self.saved_current_size(), 70000)
+        # save_deferred_progress() saves anything left over
+        self.send_delta(current_size=80000)
+        downloader.RemoteDownloader.save_deferred_progress()
+        self.assertEquals(self.saved_current_size(), 80000)
+
     ## def test_resume(self):
     ##     # FIXME - implement this
     ##     pass
@@ -140,3 +195,92 @@ class DownloaderTest(MiroTestCase):
     ## def test_resume_fail(self):
     ##     # FIXME - implement this
     ##     pass
+
+class FakeDaemonDownloader(object):
+    def __init__(self, dlid):
+        self.dlid = dlid
+        self.status = {
+            'dlid': dlid,
+            'state': u'downloading',
+            'current_size': 0,
+            'rate': 0,
+        }
+
+    def get_status(self):
+        return self.status.copy()
+
+class DownloadStatusUpdaterTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.mock_send = self.patch_for_test(
+            'miro.dl_daemon.command.Command.send')
+        self.updater = download.DownloadStatusUpdater()
+        self.dler = FakeDaemonDownloader(u'download1')
+        patcher = mock.patch.dict('miro.dl_daemon.download._downloads',
+                                  {self.dler.dlid: self.dler})
+        patcher.start()
+        self.mock_patchers.append(patcher)
+
+    def sent_statuses(self):
+        if self.mock_send.call_count == 0:
+            return None
+        cmd = self.mock_send.call_args[0][0]
+        self.mock_send.reset_mock()
+        return cmd.args[0]
+
+    def do_update(self):
+        self.updater.queue_update(self.dler)
+        self.updater.do_update(periodic=False)
+        return self.sent_statuses()
+
+    def test_make_status_delta(self):
+        old = self.dler.get_status()
+        self.assertEquals(download.make_status_delta(old, old.copy()), None)
+        new = old.copy()
+        new['current_size'] = 100
+        self.assertEquals(download.make_status_delta(old, new), {
+            'dlid': u'download1',
+            'delta': True,
+            'current_size': 100,
+        })
+        # if the set of fields changes, we can't send a delta
+        new['eta'] = 10
+        self.assertEquals(download.make_status_delta(old, new), new)
+
+    def test_deltas(self):
+        # the first status for a downloader is the full one
+        self.assertEquals(self.do_update(), [self.dler.get_status()])
+        self.dler.status['current_size'] = 100
+        self.assertEquals(self.do_update(), [{
+            'dlid': u'download1',
+            'delta': True,
+            'current_size': 100,
+        }])
+        # nothing changed, so nothing should be sent
+        self.assertEquals(self.do_update(), None)
+
+    def test_full_status_interval(self):
+        self.do_update()
+        status, last_full_time = self.updater.last_statuses[self.dler]
+        self.updater.last_statuses[self.dler] = (
+            status, last_full_time - self.updater.FULL_STATUS_INTERVAL)
+        self.assertEquals(self.do_update(), [self.dler.get_status()])
+
+    def test_cmds_done(self):
+        self.do_update()
+        # When we reply to a command, we should send the full status, even
+        # if the downloader wasn't queued.  The frontend discards updates
+        # while it's waiting for the reply, so it may have missed deltas.
+        self.updater.set_cmds_done([self.dler.dlid])
+        self.updater.do_update(periodic=False)
+        self.assertEquals(self.mock_send.call_count, 1)
+        cmd = self.mock_send.call_args[0][0]
+        self.assertEquals(cmd.args, ([self.dler.get_status()], True))
+        self.mock_send.reset_mock()
+        # after that, we can go back to sending deltas
+        self.dler.status['rate'] = 10
+        self.assertEquals(self.do_update(), [{
+            'dlid': u'download1',
+            'delta': True,
+            'rate': 10,
+        }])
@@ -6,9 +6,12 @@ from miro import app
 from miro import prefs
 from miro import dialogs
 from miro import feedparserutil
+from miro import folder
 from miro.item import Item
-from miro.feed import validate_feed_url, normalize_feed_url, Feed
+from miro.feed import (validate_feed_url, normalize_feed_url, Feed,
+                       FeedItemDiff)
 
+from miro.test import testobjects
 from miro.test.framework import MiroTestCase, EventLoopTest
 
 class FakeDownloader(object):
@@ -461,5 +464,188 @@ by-nd/1.0</creativeCommons:license>
         self.save_then_restore_db()
         self.assertEquals(self.item.get_rss_id(), None)
 
+class FakeFeedItem(object):
+    def __init__(self, rss_id=None, url=None, entry_title=None,
+                 enclosure_size=None):
+        self.rss_id = rss_id
+        self.url = url
+        self.entry_title = entry_title
+        self.enclosure_size = enclosure_size
+        self.enclosure_type = None
+        self.enclosure_format = None
+
+    def get_rss_id(self):
+        return self.rss_id
+
+class FakeFeedParserValues(object):
+    def __init__(self, **data):
+        self.data = {
+            'rss_id': None,
+            'url': None,
+            'entry_title': None,
+            'enclosure_size': None,
+            'enclosure_type': None,
+            'enclosure_format': None,
+        }
+        self.data.update(data)
+
+    def compare_to_item(self, item):
+        for key, value in self.data.items():
+            if getattr(item, key) != value:
+                return False
+        return True
+
+class FeedItemDiffTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.guid_item = FakeFeedItem(rss_id=u'guid-1', url=u'http://a/1.mpg',
+                                      entry_title=u'one')
+        self.url_title_item = FakeFeedItem(rss_id=u'guid-2',
+                                           url=u'http://a/2.mpg',
+                                           entry_title=u'two')
+        self.no_guid_item = FakeFeedItem(url=u'http://a/3.mpg',
+                                         entry_title=u'three',
+                                         enclosure_size=100)
+        self.items = [self.guid_item, self.url_title_item, self.no_guid_item]
+        self.diff = FeedItemDiff(self.items)
+
+    def add_entry(self, **data):
+        values = FakeFeedParserValues(**data)
+        self.diff.add_entry(data, values)
+        return values
+
+    def test_match_by_rss_id(self):
+        unchanged = self.add_entry(rss_id=u'guid-1', url=u'http://a/1.mpg',
+                                   entry_title=u'one')
+        self.assertEquals(self.diff.seen, set([self.guid_item]))
+        self.assertEquals(self.diff.updated, [])
+        changed = self.add_entry(rss_id=u'guid-1', url=u'http://a/1b.mpg',
+                                 entry_title=u'one')
+        self.assertEquals(self.diff.updated, [(self.guid_item, changed)])
+        self.assertEquals(self.diff.new_entries, [])
+
+    def test_match_by_url_title(self):
+        values = self.add_entry(rss_id=u'new-guid', url=u'http://a/2.mpg',
+                                entry_title=u'two')
+        self.assertEquals(self.diff.seen, set([self.url_title_item]))
+        self.assertEquals(self.diff.updated, [(self.url_title_item, values)])
+        self.assertEquals(self.diff.new_entries, [])
+
+    def test_match_by_enclosure(self):
+        # items without an rss_id get matched by their enclosure when the
+        # title changes
+        values = self.add_entry(url=u'http://a/3.mpg', enclosure_size=100,
+                                entry_title=u'three, renamed')
+        self.assertEquals(self.diff.seen, set([self.no_guid_item]))
+        self.assertEquals(self.diff.updated, [(self.no_guid_item, values)])
+        # items with an rss_id don't get matched that way
+        self.add_entry(url=u'http://a/1.mpg', entry_title=u'one, renamed')
+        self.assertEquals(len(self.diff.new_entries), 1)
+
+    def test_new_entries(self):
+        entries = []
+        for i in range(3):
+            data = {'rss_id': u'new-%d' % i, 'url': u'http://b/%d.mpg' % i}
+            values = FakeFeedParserValues(**data)
+            self.diff.add_entry(data, values)
+            entries.append((data, values))
+        self.assertEquals(self.diff.new_entries, entries)
+        self.assertEquals(self.diff.seen, set())
+
+    def test_last_update_wins(self):
+        self.add_entry(rss_id=u'guid-1', entry_title=u'first')
+        last = self.add_entry(rss_id=u'guid-1', entry_title=u'second')
+        self.assertEquals(self.diff.updated, [(self.guid_item, last)])
+
+    def test_removed_items(self):
+        self.add_entry(rss_id=u'guid-1', url=u'http://a/1.mpg',
+                       entry_title=u'one')
+        self.assertEquals(self.diff.removed_items(self.items),
+                          set([self.url_title_item, self.no_guid_item]))
+
+class FeedCountTrackerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.tracker = Item.feed_count_tracker
+        self.feed, self.items = testobjects.make_feed_with_items(5)
+        self.file_feed, self.file_items = testobjects.make_feed_with_items(
+            4, file_items=True)
+        self.folder = folder.ChannelFolder(u'test folder')
+        # load the counts before we change anything
+        self.feed.num_available()
+
+    def check_counts(self, *feeds):
+        self.assert_(self.tracker.check_counts())
+        for feed in feeds:
+            self.assertEquals(feed.num_downloaded(),
+                              feed.downloaded_items.count())
+            self.assertEquals(feed.num_downloading(),
+                              feed.downloading_items.count())
+            self.assertEquals(feed.num_unwatched(),
+                              feed.unwatched_items.count())
+            self.assertEquals(feed.num_available(),
+                              feed.available_items.count() -
+                              feed.auto_pending_items.count())
+
+    def test_initial_counts(self):
+        self.check_counts(self.feed, self.file_feed)
+        self.assertEquals(self.feed.num_available(), 5)
+        self.assertEquals(self.file_feed.num_downloaded(), 4)
+
+    def test_item_changes(self):
+        self.items[0].unset_new()
+        self.file_items[0].mark_watched()
+        self.check_counts(self.feed, self.file_feed)
+        self.assertEquals(self.feed.num_available(), 4)
+
+    def test_new_and_removed_items(self):
+        new_items = testobjects.add_items_to_feed(self.feed, 2)
+        self.check_counts(self.feed)
+        self.assertEquals(self.feed.num_available(), 7)
+        new_items[0].remove()
+        self.items[0].remove()
+        self.check_counts(self.feed)
+        self.assertEquals(self.feed.num_available(), 5)
+
+    def test_move_item(self):
+        self.file_items[0].set_feed(self.feed.id)
+        self.check_counts(self.feed, self.file_feed)
+        self.assertEquals(self.feed.num_downloaded(), 1)
+
+    def test_auto_download_mode(self):
+        self.feed.set_auto_download_mode(u'all')
+        self.check_counts(self.feed)
+        self.assertEquals(self.feed.num_available(), 0)
+
+    def test_folder(self):
+        self.feed.set_folder(self.folder)
+        self.file_feed.set_folder(self.folder)
+        self.check_counts(self.feed, self.file_feed)
+        self.assertEquals(self.folder.num_available(),
+                          self.feed.num_available() +
+                          self.file_feed.num_available())
+        self.assertEquals(self.folder.num_unwatched(),
+                          self.file_feed.num_unwatched())
+        self.items[1].unset_new()
+        self.assertEquals(self.folder.num_available(),
+                          self.feed.num_available() +
+                          self.file_feed.num_available())
+        self.feed.set_folder(None)
+        self.assertEquals(self.folder.num_available(),
+                          self.file_feed.num_available())
+        self.check_counts(self.feed, self.file_feed)
+
+    def test_remove_feed(self):
+        self.feed.set_folder(self.folder)
+        self.feed.remove()
+        self.assertEquals(self.folder.num_available(), 0)
+        self.assert_(self.tracker.check_counts())
+
+    def test_check_counts_fixes_errors(self):
+        self.tracker.feed_counts[self.feed.id][0] += 10
+        with self.allow_warnings():
+            self.assert_(not self.tracker.check_counts())
+        self.check_counts(self.feed)
+
 if __name__ == "__main__":
     unittest.main()
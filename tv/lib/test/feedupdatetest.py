@@ -0,0 +1,178 @@
+from miro import feedupdate
+from miro import signals
+from miro.test.framework import EventLoopTest
+
+class FakeFeed(signals.SignalEmitter):
+    def __init__(self, id_, host):
+        signals.SignalEmitter.__init__(self, 'update-finished', 'removed')
+        self.id = id_
+        self.host = host
+
+    def get_title(self):
+        return u'feed %s' % self.id
+
+    def get_update_host(self):
+        return self.host
+
+class FakeClient(object):
+    def __init__(self, url, callback, errback):
+        self.url = url
+        self.callback = callback
+        self.errback = errback
+        self.canceled = False
+
+    def cancel(self):
+        self.canceled = True
+
+class FeedUpdateTestBase(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.queue = feedupdate.FeedUpdateQueue()
+        self.clients = []
+        self.patch_function('miro.httpclient.grab_url', self.fake_grab_url)
+
+    def fake_grab_url(self, url, callback, errback, **kwargs):
+        client = FakeClient(url, callback, errback)
+        self.clients.append(client)
+        return client
+
+class FeedUpdateQueueTest(FeedUpdateTestBase):
+    def setUp(self):
+        FeedUpdateTestBase.setUp(self)
+        self.updated = []
+
+    def queue_update(self, feed):
+        # do_update() is normally called by the timeout that
+        # schedule_update() creates
+        self.queue.timeouts[feed.id] = None
+        self.queue.do_update(feed, lambda: self.updated.append(feed))
+
+    def queue_updates(self, feeds):
+        for feed in feeds:
+            self.queue_update(feed)
+
+    def test_global_limit(self):
+        feeds = []
+        for i in range(feedupdate.MAX_UPDATES + 2):
+            feeds.append(FakeFeed(i, u'host%d.example.com' % i))
+        self.queue_updates(feeds)
+        self.assertEquals(self.updated, feeds[:feedupdate.MAX_UPDATES])
+        feeds[0].emit('update-finished')
+        self.run_idles_for_this_loop()
+        self.assertEquals(self.updated, feeds[:feedupdate.MAX_UPDATES+1])
+
+    def test_host_limit(self):
+        busy_feeds = [FakeFeed(i, u'busy.example.com') for i in range(4)]
+        other_feed = FakeFeed(4, u'other.example.com')
+        self.queue_updates(busy_feeds + [other_feed])
+        # feeds on the busy host shouldn't stop other feeds from updating
+        limit = feedupdate.MAX_UPDATES_PER_HOST
+        self.assertEquals(self.updated, busy_feeds[:limit] + [other_feed])
+        busy_feeds[0].emit('update-finished')
+        self.run_idles_for_this_loop()
+        self.assertEquals(self.updated[-1], busy_feeds[limit])
+
+    def test_no_host_limit(self):
+        # feeds without a host (file: URLs, etc) only count against the
+        # global limit
+        feeds = [FakeFeed(i, None) for i in range(4)]
+        self.queue_updates(feeds)
+        self.assertEquals(self.updated, feeds)
+
+    def test_removed_feed(self):
+        feeds = [FakeFeed(i, u'example.com') for i in range(3)]
+        self.queue_updates(feeds)
+        feeds[0].emit('removed')
+        self.run_idles_for_this_loop()
+        self.assertEquals(self.updated, feeds)
+        self.assertEquals(self.queue.host_counts[u'example.com'],
+                          feedupdate.MAX_UPDATES_PER_HOST)
+
+    def test_duplicate_updates(self):
+        feeds = [FakeFeed(i, u'example.com') for i in range(3)]
+        self.queue_updates(feeds)
+        self.queue_update(feeds[2])
+        self.assertEquals(len(self.queue.update_queue), 1)
+        feeds[0].emit('update-finished')
+        self.run_idles_for_this_loop()
+        self.assertEquals(self.updated, feeds)
+        self.assertEquals(len(self.queue.update_queue), 0)
+
+    def test_jitter(self):
+        for i in range(100):
+            delay = feedupdate.jittered_delay(100)
+            self.assert_(100 * (1 - feedupdate.UPDATE_JITTER) <= delay <= 100)
+        self.assertEquals(feedupdate.jittered_delay(0), 0)
+
+    def test_url_host(self):
+        self.assertEquals(feedupdate.url_host(u'http://Example.COM/feed'),
+                          u'example.com')
+        self.assertEquals(feedupdate.url_host(u'file:///tmp/feed.rss'), None)
+        self.assertEquals(feedupdate.url_host(u'dtv:savedsearch/foo?q=bar'),
+                          None)
+
+class SharedFetchTest(FeedUpdateTestBase):
+    def setUp(self):
+        FeedUpdateTestBase.setUp(self)
+        self.feeds = [FakeFeed(i, u'example.com') for i in range(3)]
+        self.responses = []
+        self.errors = []
+
+    def grab_url(self, feed, url=u'http://example.com/feed', etag=None):
+        return self.queue.grab_url(feed, url,
+                                   lambda info: self.responses.append(feed),
+                                   lambda error: self.errors.append(feed),
+                                   etag=etag)
+
+    def test_shared_request(self):
+        for feed in self.feeds:
+            self.grab_url(feed)
+        self.assertEquals(len(self.clients), 1)
+        self.clients[0].callback({'status': 200, 'body': 'feed'})
+        self.assertEquals(self.responses, self.feeds)
+        # after the response, the next request should make a new fetch
+        self.grab_url(self.feeds[0])
+        self.assertEquals(len(self.clients), 2)
+
+    def test_different_etags(self):
+        self.grab_url(self.feeds[0], etag=u'abc')
+        self.grab_url(self.feeds[1], etag=u'def')
+        self.grab_url(self.feeds[2], url=u'http://example.com/other')
+        self.assertEquals(len(self.clients), 3)
+
+    def test_error(self):
+        for feed in self.feeds:
+            self.grab_url(feed)
+        self.clients[0].errback(ValueError())
+        self.assertEquals(self.errors, self.feeds)
+        self.assertEquals(self.queue.get_stats(self.feeds[0]).errors, 1)
+
+    def test_cancel(self):
+        requests = [self.grab_url(feed) for feed in self.feeds]
+        requests[0].cancel()
+        requests[1].cancel()
+        self.assert_(not self.clients[0].canceled)
+        self.clients[0].callback({'status': 200, 'body': 'feed'})
+        self.assertEquals(self.responses, self.feeds[2:])
+
+    def test_cancel_all(self):
+        requests = [self.grab_url(feed) for feed in self.feeds]
+        for request in requests:
+            request.cancel()
+        self.assert_(self.clients[0].canceled)
+        self.assertEquals(self.queue.fetches, {})
+
+    def test_stats(self):
+        feed = self.feeds[0]
+        self.grab_url(feed)
+        self.clients[-1].callback({'status': 200, 'body': 'feed'})
+        for i in range(3):
+            self.grab_url(feed)
+            self.clients[-1].callback({'status': 304})
+        stats = self.queue.get_stats(feed)
+        self.assertEquals(stats.fetches, 4)
+        self.assertEquals(stats.not_modified, 3)
+        self.assertAlmostEquals(stats.not_modified_rate(), 0.75)
+        self.assert_(stats.average_time() >= 0.0)
+        feed.emit('removed')
+        self.assert_(feed.id not in self.queue.stats)
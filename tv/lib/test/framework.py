@@ -285,6 +285,7 @@ class MiroTestCase(unittest.TestCase):
         app.in_unit_tests = True
         app.device_manager = devices.DeviceManager()
         models.Item._path_count_tracker.reset()
+        models.Item.feed_count_tracker.reset()
         testobjects.test_started(self)
         # Tweak Item to allow us to make up fake paths for FileItems
         models.Item._allow_nonexistent_paths = True
@@ -390,6 +390,57 @@ class HTTPClientTest(HTTPClientTestBase):
         self.assert_('body' not in self.grab_url_info)
         self.assertEquals(open(filename).read(), self.test_response_data)
 
+    @uses_httpclient
+    def test_skip_head_request(self):
+        # once a HEAD request has worked for a host, downloads from it should
+        # skip the HEAD request
+        url = self.httpserver.build_url('test.txt')
+        for i in xrange(2):
+            filename = self.make_temp_path(".txt")
+            self.grab_url(url, write_file=filename)
+            self.assertEquals(open(filename).read(), self.test_response_data)
+            self.assertEquals(self.last_http_info('method'), 'GET')
+        host_stats = httpclient.curl_manager.get_host_stats().values()
+        self.assertEquals(len(host_stats), 1)
+        self.assertEquals(host_stats[0].skipped_head_requests, 1)
+        # HEAD + GET for the first download, then GET for the second
+        self.assertEquals(host_stats[0].transfers, 3)
+
+    @uses_httpclient
+    def test_skip_head_request_resume(self):
+        # resumed downloads shouldn't skip the HEAD request
+        url = self.httpserver.build_url('test.txt')
+        filename = self.make_temp_path(".txt")
+        self.grab_url(url, write_file=filename)
+        self._write_partial_file(filename, 5)
+        self.grab_url(url, write_file=filename, resume=True)
+        self.assertEquals(open(filename).read(), self.test_response_data)
+        host_stats = httpclient.curl_manager.get_host_stats().values()
+        self.assertEquals(host_stats[0].skipped_head_requests, 0)
+
+    @uses_httpclient
+    def test_skip_head_request_error(self):
+        filename = self.make_temp_path(".txt")
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                      write_file=filename)
+        self.expecting_errback = True
+        self.grab_url(self.httpserver.build_url('badfile.txt'),
+                      write_file=filename)
+        self.check_errback_called()
+        # after an error, we should go back to doing HEAD requests
+        self.assertEquals(httpclient.curl_manager.head_ok_hosts, set())
+
+    @uses_httpclient
+    def test_reuse_handle(self):
+        url = self.httpserver.build_url('test.txt')
+        self.grab_url(url)
+        free_handles = list(httpclient.curl_manager.free_handles)
+        self.assertEquals(len(free_handles), 1)
+        self.grab_url(url)
+        self.assertEquals(self.grab_url_info['body'], self.test_response_data)
+        # the second transfer should have used the pooled handle
+        self.assertEquals(httpclient.curl_manager.free_handles, free_handles)
+
     @uses_httpclient
     def test_write_file_resume(self):
         filename = self.make_temp_path(".txt")
@@ -483,6 +534,182 @@ class HTTPClientTest(HTTPClientTestBase):
         self.wait_for_libcurl_manager()
         self.assert_(not os.path.exists(filename))
 
+    def grab_url_segmented(self, url, filename, connections):
+        # the test server only handles one connection at a time, so don't
+        # let the segments keep theirs open
+        self.httpserver.close_connection()
+        self.grab_url_error = self.grab_url_info = None
+        self.client = SmallSegmentedClient(url, filename, 0,
+                len(self.test_response_data), connections,
+                self.grab_url_callback, self.grab_url_errback, {})
+        self.client.begin()
+        self.runEventLoop(timeout=self.event_loop_timeout)
+
+    @uses_httpclient
+    def test_segmented(self):
+        filename = self.make_temp_path(".txt")
+        self.grab_url_segmented(self.httpserver.build_url('test.txt'),
+                filename, 3)
+        self.assertEquals(self.grab_url_info, {})
+        self.assertEquals(open(filename).read(), self.test_response_data)
+        self.assertEquals(self.client.get_contiguous_size(),
+                len(self.test_response_data))
+
+    @uses_httpclient
+    def test_segmented_range_ignored(self):
+        self.httpserver.disable_resume()
+        self.expecting_errback = True
+        filename = self.make_temp_path(".txt")
+        self.grab_url_segmented(self.httpserver.build_url('test.txt'),
+                filename, 3)
+        self.assert_(isinstance(self.grab_url_error,
+                                httpclient.UnexpectedStatusCode))
+
+class SmallSegmentedClient(httpclient.SegmentedClient):
+    MIN_SEGMENT_SIZE = 100
+
+class FakeTransfer(object):
+    def __init__(self, client, segment):
+        self.client = client
+        self.segment = segment
+        self.byte_range = (segment.start, segment.end)
+        self.stats = httpclient.TransferStats()
+        self.stats.status_code = 206
+        self.canceled = False
+
+    def start(self):
+        pass
+
+    def cancel(self, remove_file):
+        self.canceled = True
+
+    def get_stats(self):
+        return self.stats
+
+    def set_downloaded(self, downloaded):
+        self.stats.downloaded = downloaded
+
+    def finish(self):
+        self.stats.downloaded = self.byte_range[1] - self.byte_range[0]
+        self.client._on_segment_finished(self.segment)
+
+    def fail(self, error):
+        self.client._on_segment_error(self.segment, error)
+
+class FakeSegmentedClient(SmallSegmentedClient):
+    def __init__(self, *args, **kwargs):
+        SmallSegmentedClient.__init__(self, *args, **kwargs)
+        self.transfers = []
+
+    def _make_transfer(self, segment):
+        transfer = FakeTransfer(self, segment)
+        self.transfers.append(transfer)
+        return transfer
+
+class SegmentedClientTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.filename = self.make_temp_path(".txt")
+        self.finished = []
+        self.errors = []
+
+    def make_client(self, start, total_size, connections):
+        client = FakeSegmentedClient('http://example.com/', self.filename,
+                start, total_size, connections, self.finished.append,
+                self.errors.append, {'status': 200})
+        client.begin()
+        return client
+
+    def check_ranges(self, client, ranges):
+        self.assertEquals([(s.start, s.end) for s in client.segments],
+                          ranges)
+
+    def test_split(self):
+        client = self.make_client(200, 1000, 4)
+        self.check_ranges(client, [(200, 400), (400, 600), (600, 800),
+                                   (800, 1000)])
+        self.assertEquals([t.byte_range for t in client.transfers],
+                          [(200, 400), (400, 600), (600, 800), (800, 1000)])
+        self.assertEquals(os.path.getsize(self.filename), 1000)
+        # don't make segments smaller than MIN_SEGMENT_SIZE
+        client = self.make_client(0, 250, 4)
+        self.check_ranges(client, [(0, 125), (125, 250)])
+
+    def test_rebalance(self):
+        client = self.make_client(0, 1000, 2)
+        client.transfers[1].set_downloaded(100)
+        client.transfers[0].finish()
+        # the first connection should take over the second half of what's
+        # left in the second segment
+        self.check_ranges(client, [(0, 500), (500, 800), (800, 1000)])
+        self.assertEquals(client.transfers[2].byte_range, (800, 1000))
+        # once the second segment's transfer passes its new end, we should
+        # stop it
+        client.transfers[1].set_downloaded(300)
+        client.transfers[2].set_downloaded(50)
+        client._check_segments()
+        self.assert_(client.transfers[1].canceled)
+        # the third segment has too little left to split
+        self.assertEquals(len(client.transfers), 3)
+        client.transfers[2].finish()
+        self.assertEquals(self.finished, [{'status': 200}])
+        self.assertEquals(client.check_dc, None)
+
+    def test_error(self):
+        client = self.make_client(0, 1000, 2)
+        error = httpclient.UnexpectedStatusCode(200)
+        client.transfers[0].fail(error)
+        self.assertEquals(self.errors, [error])
+        self.assert_(client.transfers[1].canceled)
+        # other segments finishing shouldn't call the callback
+        client.transfers[1].finish()
+        self.assertEquals(self.finished, [])
+        self.assertEquals(client.check_dc, None)
+
+    def test_stats(self):
+        client = self.make_client(100, 1100, 2)
+        client.transfers[0].set_downloaded(200)
+        client.transfers[1].set_downloaded(300)
+        stats = client.get_stats()
+        self.assertEquals(stats.initial_size, 100)
+        self.assertEquals(stats.downloaded, 500)
+        self.assertEquals(stats.download_total, 1000)
+        # only data up to the first gap can be kept for resuming
+        self.assertEquals(client.get_contiguous_size(), 300)
+        client.transfers[0].finish()
+        self.assertEquals(client.get_contiguous_size(), 900)
+
+    def test_cancel(self):
+        client = self.make_client(0, 1000, 2)
+        client.cancel()
+        self.assert_(client.transfers[0].canceled)
+        self.assert_(client.transfers[1].canceled)
+        self.assertEquals(client.check_dc, None)
+
+    def test_cancel_keeps_progress(self):
+        client = self.make_client(0, 1000, 2)
+        client.transfers[0].set_downloaded(200)
+        client.transfers[1].set_downloaded(300)
+        client.cancel()
+        # the data that the transfers wrote is still there for resuming
+        self.assertEquals(client.get_stats().downloaded, 500)
+        self.assertEquals(client.get_contiguous_size(), 200)
+
+    def test_error_keeps_progress(self):
+        client = self.make_client(0, 1000, 2)
+        client.transfers[0].set_downloaded(200)
+        client.transfers[1].set_downloaded(300)
+        client.transfers[1].fail(httpclient.UnexpectedStatusCode(200))
+        self.assertEquals(client.get_stats().downloaded, 500)
+        self.assertEquals(client.get_contiguous_size(), 200)
+
+    def test_marker_file(self):
+        marker_path = httpclient.segmented_marker_path(self.filename)
+        client = self.make_client(0, 1000, 1)
+        self.assert_(os.path.exists(marker_path))
+        client.transfers[0].finish()
+        self.assert_(not os.path.exists(marker_path))
+
 class HTTPAuthTest(HTTPClientTestBase):
     def setUp(self):
         HTTPClientTestBase.setUp(self)
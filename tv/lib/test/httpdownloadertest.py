@@ -1,11 +1,14 @@
 import os
 
+from miro import app
 from miro import download_utils
 from miro import httpclient
+from miro import prefs
 from miro.test.framework import (
     EventLoopTest, uses_httpclient, skip_for_platforms)
 from miro.plat import resources
 from miro.dl_daemon import download
+from miro.test import mock
 
 class TestingDownloader(download.HTTPDownloader):
     # update stats really often to make sure that we can do things like pause
@@ -165,3 +168,63 @@ class HTTPDownloaderTest(EventLoopTest):
         self.downloader2.statusCallback = status_callback
         self.runEventLoop()
         self.assert_(not self.restarted)
+
+    @uses_httpclient
+    def test_segmented_download(self):
+        app.config.set(prefs.HTTP_DOWNLOAD_CONNECTIONS, 3)
+        patcher = mock.patch.object(httpclient.SegmentedClient,
+                                    'MIN_SEGMENT_SIZE', 4096)
+        patcher.start()
+        self.mock_patchers.append(patcher)
+        # the test server only handles one connection at a time, so don't
+        # let the segments keep theirs open
+        self.httpserver.close_connection()
+        self.downloader = TestingDownloader(self, self.download_url, "ID1")
+        self.downloader.statusCallback = self.stopOnFinished
+        self.runEventLoop()
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path).read())
+        self.assertEquals(self.downloader.current_size, self.download_size)
+        self.assertEquals(self.downloader.total_size, self.download_size)
+
+    @uses_httpclient
+    def test_segmented_pause(self):
+        app.config.set(prefs.HTTP_DOWNLOAD_CONNECTIONS, 3)
+        patcher = mock.patch.object(httpclient.SegmentedClient,
+                                    'MIN_SEGMENT_SIZE', 4096)
+        patcher.start()
+        self.mock_patchers.append(patcher)
+        self.downloader = TestingDownloader(self, self.download_url, "ID1")
+        def pauseOnData():
+            if (self.downloader.state == 'downloading' and
+                    self.downloader.current_size == 10000):
+                self.downloader.pause()
+                self.stopEventLoop(False)
+        self.downloader.statusCallback = pauseOnData
+        self.httpserver.pause_after(10000)
+        self.runEventLoop()
+        self.assertEquals(self.downloader.state, 'paused')
+        # the first segment's data should be kept for resuming
+        self.assertEquals(self.downloader.current_size, 10000)
+        self.downloader.statusCallback = self.stopOnFinished
+        self.httpserver.pause_after(-1)
+        # the test server only handles one connection at a time, so don't
+        # let the segments keep theirs open
+        self.httpserver.close_connection()
+        self.add_timeout(0.1, self.downloader.start, 'restarter')
+        self.runEventLoop()
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path).read())
+        self.assertEquals(self.downloader.current_size, self.download_size)
+
+    @uses_httpclient
+    def test_segmented_download_no_ranges(self):
+        # if the server doesn't support ranges, we should fall back to a
+        # normal download
+        app.config.set(prefs.HTTP_DOWNLOAD_CONNECTIONS, 3)
+        self.httpserver.disable_resume()
+        self.downloader = TestingDownloader(self, self.download_url, "ID1")
+        self.downloader.statusCallback = self.stopOnFinished
+        self.runEventLoop()
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path).read())
@@ -1,4 +1,8 @@
+import os
+
+from miro import app
 from miro import database
+from miro import prefs
 
 from miro import iconcache
 from miro import item
@@ -52,3 +56,93 @@ class IconCacheTest(EventLoopTest):
                 iconcache.IconCache.get_by_id, item_icon_cache_id)
         self.assertRaises(database.ObjectNotFoundError,
                 iconcache.IconCache.get_by_id, guide_icon_cache_id)
+
+class SharedIconCacheTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.cachedir = os.path.join(self.tempdir, 'icon-cache')
+        app.config.set(prefs.ICON_CACHE_DIRECTORY, self.cachedir)
+        iconcache.IconDownload.in_progress.clear()
+        self.grab_url = self.patch_for_test('miro.httpclient.grab_url')
+        self.feed = feed.Feed(u'http://example.com/')
+        self.items = [self.make_item(u'http://example.com/thumb.png')
+                      for i in range(3)]
+
+    def make_item(self, thumbnail_url):
+        i = item.Item(item.FeedParserValues({}), feed_id=self.feed.id)
+        i.thumbnail_url = thumbnail_url
+        return i
+
+    def test_write_icon_file(self):
+        path = iconcache.write_icon_file(self.cachedir, 'abc', 'icon.PNG')
+        self.assertEquals(open(path).read(), 'abc')
+        self.assertEquals(os.path.splitext(path)[1], '.png')
+        # same contents should map to the same file
+        self.assertEquals(iconcache.write_icon_file(self.cachedir, 'abc',
+                                                    'icon.png'), path)
+        other_path = iconcache.write_icon_file(self.cachedir, 'def', None)
+        self.assertNotEquals(other_path, path)
+        self.assertEquals(os.path.splitext(other_path)[1], '')
+        self.assertEquals(sorted(os.listdir(self.cachedir)),
+                          sorted([os.path.basename(path),
+                                  os.path.basename(other_path)]))
+
+    def test_remove_shared_file(self):
+        path = iconcache.write_icon_file(self.cachedir, 'abc', 'icon.png')
+        for i in self.items[:2]:
+            i.icon_cache.set_file(i.thumbnail_url, path, None, None)
+        self.items[0].remove()
+        self.assert_(os.path.exists(path))
+        self.items[1].remove()
+        self.assert_(not os.path.exists(path))
+
+    def test_reset_shared_file(self):
+        path = iconcache.write_icon_file(self.cachedir, 'abc', 'icon.png')
+        for i in self.items[:2]:
+            i.icon_cache.set_file(i.thumbnail_url, path, None, None)
+        self.items[0].icon_cache.reset()
+        self.assert_(os.path.exists(path))
+        self.items[1].icon_cache.reset()
+        self.assert_(not os.path.exists(path))
+
+    def test_reuse_file_for_url(self):
+        path = iconcache.write_icon_file(self.cachedir, 'abc', 'icon.png')
+        first, second = self.items[:2]
+        first.icon_cache.set_file(first.thumbnail_url, path, u'etag', None)
+        second.icon_cache.request_icon()
+        self.assertEquals(self.grab_url.call_count, 0)
+        self.assertEquals(second.icon_cache.filename, path)
+        self.assertEquals(second.icon_cache.etag, u'etag')
+        self.assert_(not second.icon_cache.updating)
+
+    def test_shared_download(self):
+        for i in self.items:
+            i.icon_cache.request_icon()
+        self.assertEquals(self.grab_url.call_count, 1)
+        url, callback, errback = self.grab_url.call_args[0]
+        self.assertEquals(url, u'http://example.com/thumb.png')
+        callback({'status': 200, 'body': 'abc', 'filename': 'thumb.png',
+                  'etag': 'etag'})
+        self.processThreads()
+        self.run_idles_for_this_loop()
+        filenames = set(i.icon_cache.filename for i in self.items)
+        self.assertEquals(len(filenames), 1)
+        path = filenames.pop()
+        self.assertEquals(open(path).read(), 'abc')
+        self.assertEquals(os.listdir(self.cachedir),
+                          [os.path.basename(path)])
+        for i in self.items:
+            self.assertEquals(i.icon_cache.etag, u'etag')
+            self.assert_(not i.icon_cache.updating)
+        self.assertEquals(iconcache.IconDownload.in_progress, {})
+
+    def test_shared_download_error(self):
+        for i in self.items:
+            i.icon_cache.request_icon()
+        url, callback, errback = self.grab_url.call_args[0]
+        errback(ValueError())
+        for i in self.items:
+            self.assertEquals(i.icon_cache.filename, None)
+            self.assertEquals(i.icon_cache.url, url)
+            self.assert_(not i.icon_cache.updating)
+        self.assertEquals(iconcache.IconDownload.in_progress, {})
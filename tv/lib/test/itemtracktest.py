@@ -31,6 +31,7 @@
 
 import datetime
 import itertools
+import Queue
 
 from miro import app
 from miro import downloader
@@ -38,6 +39,7 @@ from miro import eventloop
 from miro import messages
 from miro import models
 from miro import sharing
+from miro.data import asyncquery
 from miro.data import item
 from miro.data import itemtrack
 from miro.test import mock
@@ -396,6 +398,78 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
         self.check_no_signals()
         self.check_tracker_items()
 
+    def connect_to_incremental_signals(self):
+        for signal in ("items-removed", "items-inserted", "items-moved"):
+            self.signal_handlers[signal] = mock.Mock()
+            self.tracker.connect(signal, self.signal_handlers[signal])
+
+    def check_incremental_signal(self, signal, correct_items):
+        handler = self.signal_handlers[signal]
+        if not correct_items:
+            self.assertEquals(handler.call_count, 0)
+            return
+        self.assertEquals(handler.call_count, 1)
+        self.assertSameSet(handler.call_args[0][1],
+                           [i.id for i in correct_items])
+        handler.reset_mock()
+
+    def patch_refetch_id_list(self):
+        self.mock_refetch = self.patch_function(
+            'miro.data.itemtrack.ItemTracker._refetch_id_list',
+            itemtrack.ItemTracker._refetch_id_list)
+
+    def check_incremental_update(self, removed=(), inserted=(), moved=()):
+        self.process_items_changed_messages()
+        self.assertEquals(self.mock_refetch.call_count, 0)
+        self.check_incremental_signal('items-removed', removed)
+        self.check_incremental_signal('items-inserted', inserted)
+        self.check_incremental_signal('items-moved', moved)
+        self.check_one_signal('list-changed')
+        self.check_tracker_items()
+
+    def test_incremental_update(self):
+        self.connect_to_incremental_signals()
+        self.patch_refetch_id_list()
+        # move an item to the end of the list.  Release dates are random, so
+        # pick the first item rather than relying on the creation order.
+        item1 = min(self.tracked_items, key=lambda i: i.release_date)
+        item1.release_date += datetime.timedelta(days=400)
+        item1.signal_change()
+        self.check_incremental_update(moved=[item1])
+        # changing the sort column without changing the order shouldn't move
+        # anything
+        item1.release_date += datetime.timedelta(days=1)
+        item1.signal_change()
+        self.check_incremental_update()
+        # add/remove items
+        new_item = testobjects.make_item(self.tracked_feed, u'new-item')
+        to_remove = self.tracked_items[1]
+        to_remove.remove()
+        self.check_incremental_update(removed=[to_remove],
+                                      inserted=[new_item])
+        # items moving to/from our list
+        item2 = self.tracked_items[2]
+        item2.feed_id = self.other_feed1.id
+        item2.signal_change()
+        item3 = self.other_items1[0]
+        item3.feed_id = self.tracked_feed.id
+        item3.signal_change()
+        self.check_incremental_update(removed=[item2], inserted=[item3])
+
+    def test_incremental_update_fallback(self):
+        self.connect_to_incremental_signals()
+        self.patch_refetch_id_list()
+        # if too many items change, we should refetch the entire list
+        self.tracker.INCREMENTAL_UPDATE_MAX = 1
+        for item_ in self.tracked_items[:2]:
+            item_.release_date += datetime.timedelta(days=400)
+            item_.signal_change()
+        self.process_items_changed_messages()
+        self.assertEquals(self.mock_refetch.call_count, 1)
+        self.check_incremental_signal('items-moved', [])
+        self.check_one_signal('list-changed')
+        self.check_tracker_items()
+
     def test_extra_conditions(self):
         # test adding more conditions
         titles = [i.title for i in self.tracked_items]
@@ -652,6 +726,37 @@ class ItemTrackTestWALMode(ItemTrackTestCase):
                           u'new title')
         self.assertRaises(KeyError, self.tracker.get_item, item2.id)
 
+    def test_playables(self):
+        # use small chunks so that we test splitting the id list up
+        self.patch_for_test('miro.data.itemtrack.ItemFetcher.LIST_PARAM_COUNT',
+                            autospec=False)
+        itemtrack.ItemFetcher.LIST_PARAM_COUNT = 3
+        # make a new ItemFetcher that uses the new value
+        self.tracker.change_query(self.tracker.query)
+        self.assertEquals(self.tracker.get_playable_ids(), [])
+        self.assert_(not self.tracker.has_playables())
+        playable_items = self.tracked_items[-2:]
+        for i in playable_items:
+            i.filename = self.make_temp_path('.avi')
+            i.file_type = u'video'
+            i.signal_change()
+        app.db.finish_transaction()
+        self.process_items_changed_messages()
+        self.assertSameSet(self.tracker.get_playable_ids(),
+                           [i.id for i in playable_items])
+        self.assert_(self.tracker.has_playables())
+
+    def test_fetch_param_chunks(self):
+        # fetching more rows than FETCH_PARAM_COUNT should still work
+        self.patch_for_test('miro.data.itemtrack.ItemFetcher.FETCH_PARAM_COUNT',
+                            autospec=False)
+        itemtrack.ItemFetcher.FETCH_PARAM_COUNT = 3
+        # make a new ItemFetcher that uses the new value
+        self.tracker.change_query(self.tracker.query)
+        id_list = [i.id for i in self.tracked_items]
+        items = self.tracker.item_fetcher.fetch_items(id_list)
+        self.assertSameSet([i.id for i in items], id_list)
+
     def test_19823(self):
         # Test the tricky case from bz19823.
         item = self.tracked_items[0]
@@ -753,6 +858,187 @@ class ItemTrackTestNonWALMode(ItemTrackTestWALMode):
     def force_wal_mode(self):
         self.connection_pool.wal_mode = False
 
+class AsyncItemTrackTest(ItemTrackTestCase):
+    def setUp(self):
+        ItemTrackTestCase.setUp(self)
+        self.signal_handlers = {}
+        for signal in ("will-change", "list-changed"):
+            self.signal_handlers[signal] = mock.Mock()
+            self.tracker.connect(signal, self.signal_handlers[signal])
+
+    def tearDown(self):
+        ItemTrackTestCase.tearDown(self)
+        self.executor.shutdown()
+
+    def setup_items(self):
+        self.tracked_feed, self.tracked_items = \
+                testobjects.make_feed_with_items(10)
+        self.other_feed, self.other_items = \
+                testobjects.make_feed_with_items(12)
+        app.db.finish_transaction()
+
+    def setup_connection_pool(self):
+        self.connection_pool = app.connection_pools.get_main_pool()
+
+    def setup_tracker(self):
+        # results from the worker thread go in this queue until
+        # run_query_results() is called
+        self.results = Queue.Queue()
+        self.executor = asyncquery.AsyncQueryExecutor(self.schedule_result)
+        self.tracker = itemtrack.ItemTracker(self.idle_scheduler,
+                                             self.make_query(),
+                                             item.ItemSource(),
+                                             self.executor)
+
+    def make_query(self, feed=None):
+        if feed is None:
+            feed = self.tracked_feed
+        query = itemtrack.ItemTrackerQuery()
+        query.add_condition('feed_id', '=', feed.id)
+        query.set_order_by(['release_date'])
+        return query
+
+    def schedule_result(self, func, *args):
+        self.results.put((func, args))
+
+    def run_query_results(self):
+        loop_check = itertools.count()
+        while self.tracker._fetch_job is not None:
+            if loop_check.next() > 100:
+                raise AssertionError("queries never finished")
+            func, args = self.results.get(timeout=5)
+            func(*args)
+
+    def check_signal_count(self, count):
+        for handler in self.signal_handlers.values():
+            self.assertEquals(handler.call_count, count)
+            handler.reset_mock()
+
+    def check_items(self, correct_items):
+        correct_items = sorted(correct_items, key=lambda i: i.release_date)
+        self.assertEquals([i.id for i in self.tracker.get_items()],
+                          [i.id for i in correct_items])
+
+    def test_initial_list(self):
+        # the list should start out empty, then get filled in when the query
+        # finishes
+        self.assertEquals(len(self.tracker), 0)
+        self.run_query_results()
+        self.check_signal_count(1)
+        self.check_items(self.tracked_items)
+
+    def test_change_query(self):
+        self.run_query_results()
+        self.check_signal_count(1)
+        self.tracker.change_query(self.make_query(self.other_feed))
+        # we should keep the old list until the query finishes
+        self.check_items(self.tracked_items)
+        self.run_query_results()
+        self.check_signal_count(1)
+        self.check_items(self.other_items)
+
+    def test_superseded_query(self):
+        self.run_query_results()
+        self.check_signal_count(1)
+        # change the query twice in a row.  The results from the first
+        # change should be dropped
+        self.tracker.change_query(self.make_query(self.other_feed))
+        self.tracker.change_query(self.make_query(self.tracked_feed))
+        self.run_query_results()
+        self.check_signal_count(1)
+        self.check_items(self.tracked_items)
+        # all the connections should be back in the pool
+        self.assertEquals(len(self.connection_pool.free_connections),
+                          len(self.connection_pool.all_connections) - 1)
+
+    def test_changes_while_fetching(self):
+        # change an item before the initial query is finished.  The results
+        # may not include the change, so we should run the query again
+        new_item = testobjects.make_item(self.tracked_feed, u'new-item')
+        self.tracker.on_item_changes(self.get_items_changed_message())
+        self.assertNotEquals(self.tracker._fetch_job, None)
+        self.run_query_results()
+        self.check_signal_count(2)
+        self.check_items(self.tracked_items + [new_item])
+
+    def test_pool_exhausted(self):
+        # if our item_fetcher is holding the last connection, we should
+        # fall back to fetching synchronously
+        self.run_query_results()
+        self.check_signal_count(1)
+        pool = self.connection_pool
+        pool.max_connections = len(pool.all_connections)
+        held = [pool.get_connection() for c in list(pool.free_connections)]
+        self.tracker.change_query(self.make_query(self.other_feed))
+        self.assertEquals(self.tracker._fetch_job, None)
+        self.check_signal_count(1)
+        self.check_items(self.other_items)
+        for connection in held:
+            pool.release_connection(connection)
+
+    def test_destroy_while_fetching(self):
+        self.tracker.destroy()
+        self.run_query_results()
+        self.assertEquals(len(self.connection_pool.free_connections),
+                          len(self.connection_pool.all_connections))
+        self.check_signal_count(0)
+        # make tearDown() happy
+        self.tracker.id_list = []
+
+class AsyncQueryExecutorTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.results = Queue.Queue()
+        self.executor = asyncquery.AsyncQueryExecutor(self.schedule_result)
+        self.connection = mock.Mock()
+
+    def tearDown(self):
+        self.executor.shutdown()
+        MiroTestCase.tearDown(self)
+
+    def schedule_result(self, func, *args):
+        self.results.put((func, args))
+
+    def get_result(self):
+        func, args = self.results.get(timeout=5)
+        return func, args[0]
+
+    def callback(self, result):
+        pass
+
+    def errback(self, error):
+        pass
+
+    def test_run(self):
+        self.executor.run(self.connection, lambda conn: conn, self.callback,
+                          self.errback)
+        func, result = self.get_result()
+        self.assertEquals(func, self.callback)
+        self.assertEquals(result, self.connection)
+
+    def test_error(self):
+        def raise_error(connection):
+            raise ValueError()
+        self.executor.run(self.connection, raise_error, self.callback,
+                          self.errback)
+        func, error = self.get_result()
+        self.assertEquals(func, self.errback)
+        self.assert_(isinstance(error, ValueError))
+
+    def test_cancel(self):
+        # block the worker thread until we've canceled the second job
+        blocker = Queue.Queue()
+        self.executor.run(self.connection, lambda conn: blocker.get(),
+                          self.callback, self.errback)
+        job = self.executor.run(self.connection, lambda conn: conn,
+                                self.callback, self.errback)
+        job.cancel()
+        blocker.put(None)
+        self.assertEquals(self.get_result()[0], self.callback)
+        func, error = self.get_result()
+        self.assertEquals(func, self.errback)
+        self.assert_(isinstance(error, asyncquery.QueryCanceled))
+
 class DeviceItemTrackTestWALMode(ItemTrackTestCase):
     def setup_items(self):
         self.device = testobjects.make_mock_device()
@@ -0,0 +1,600 @@
+"""Performance tests.
+
+These tests aren't run as part of the normal test suite.  To run them, list
+them explicitly on the command line, for example::
+
+    ./test.sh performancetest.FullTextSearchWriteTest
+
+Each test prints a short report comparing the old and new code paths.
+"""
+
+import cPickle as pickle
+import os
+import socket
+import struct
+import sys
+import threading
+import time
+
+import sqlite3
+
+from miro import app
+from miro import feedparserutil
+from miro import libdaap
+from miro import models
+from miro import subprocessmanager
+from miro import workerprocess
+from miro.data import fulltextsearch
+from miro.data import item
+from miro.data import itemtrack
+from miro.libdaap import subr
+from miro.plat import resources
+from miro.test import mock
+from miro.test import testobjects
+from miro.test.framework import MiroTestCase
+
+def report(title, rows):
+    """Print a table of results for a performance test.
+
+    :param title: title for the test
+    :param rows: list of (label, dict of stats) tuples
+    """
+    sys.stdout.write("\n%s\n" % title)
+    for label, stats in rows:
+        stat_text = ', '.join('%s: %s' % (key, _format_stat(stats[key]))
+                              for key in sorted(stats))
+        sys.stdout.write("    %-20s %s\n" % (label, stat_text))
+
+def _format_stat(value):
+    if isinstance(value, float):
+        return '%0.3f' % value
+    else:
+        return str(value)
+
+class FullTextSearchWriteTest(MiroTestCase):
+    """Measure item_fts write amplification for progress-style updates.
+
+    We simulate an event loop that mostly writes watched_time/resume_time and
+    only occasionally changes a title, which is what LiveStorage sees during
+    downloads and playback.
+    """
+    ITEM_COUNT = 10000
+    EVENT_COUNT = 200
+    UPDATES_PER_EVENT = 50
+    # every Nth update changes an indexed column
+    TITLE_CHANGE_INTERVAL = 25
+
+    def make_connection(self):
+        connection = sqlite3.connect(':memory:', isolation_level=None)
+        columns = fulltextsearch.fts_columns()
+        connection.execute("CREATE TABLE item (id integer PRIMARY KEY, %s, "
+                           "watched_time integer, resume_time integer)" %
+                           ', '.join('%s text' % c for c in columns))
+        connection.executemany(
+            "INSERT INTO item (id, title, description, filename) "
+            "VALUES (?, ?, ?, ?)",
+            ((i, u'title %d' % i, u'description of item %d' % i,
+              u'/videos/item-%d.mkv' % i)
+             for i in xrange(self.ITEM_COUNT)))
+        fulltextsearch.setup_fulltext_search(connection)
+        return connection
+
+    def install_legacy_triggers(self, connection):
+        # the triggers we used before column-aware reindexing
+        columns = fulltextsearch.fts_columns()
+        connection.execute("DROP TRIGGER item_au")
+        connection.execute("CREATE TRIGGER item_bu "
+                           "BEFORE UPDATE ON item BEGIN "
+                           "DELETE FROM item_fts WHERE docid=old.id; "
+                           "END;")
+        connection.execute("CREATE TRIGGER item_au "
+                           "AFTER UPDATE ON item BEGIN "
+                           "INSERT INTO item_fts(docid, %s) "
+                           "VALUES(new.id, %s); "
+                           "END;" % (', '.join(columns),
+                                     ', '.join('new.%s' % c
+                                               for c in columns)))
+
+    def run_workload(self, connection, flush_sql=None):
+        start_changes = connection.total_changes
+        start = time.time()
+        update_count = 0
+        for event in xrange(self.EVENT_COUNT):
+            connection.execute("BEGIN TRANSACTION")
+            for i in xrange(self.UPDATES_PER_EVENT):
+                item_id = (event * self.UPDATES_PER_EVENT + i) % self.ITEM_COUNT
+                update_count += 1
+                if update_count % self.TITLE_CHANGE_INTERVAL == 0:
+                    connection.execute("UPDATE item SET title=? WHERE id=?",
+                                       (u'new title %d' % event, item_id))
+                else:
+                    connection.execute("UPDATE item SET watched_time=?, "
+                                       "resume_time=? WHERE id=?",
+                                       (event, i, item_id))
+            if flush_sql is not None:
+                for sql in flush_sql:
+                    connection.execute(sql)
+            connection.execute("COMMIT TRANSACTION")
+        return {
+            'time': time.time() - start,
+            'row writes': connection.total_changes - start_changes,
+            'updates': update_count,
+        }
+
+    def test_write_amplification(self):
+        results = []
+
+        connection = self.make_connection()
+        self.install_legacy_triggers(connection)
+        results.append(('legacy', self.run_workload(connection)))
+
+        connection = self.make_connection()
+        results.append(('immediate', self.run_workload(connection)))
+
+        connection = self.make_connection()
+        fulltextsearch.set_reindex_mode(connection, 'item',
+                                        fulltextsearch.REINDEX_DEFERRED)
+        flush_sql = fulltextsearch.flush_deferred_reindex_sql(
+            'item', fulltextsearch.get_indexed_columns(connection))
+        results.append(('deferred', self.run_workload(connection, flush_sql)))
+
+        report("item_fts write amplification (%d items)" % self.ITEM_COUNT,
+               results)
+        legacy_writes = results[0][1]['row writes']
+        for label, stats in results[1:]:
+            self.assert_(stats['row writes'] < legacy_writes)
+
+class UpdateCoalescingTest(MiroTestCase):
+    """Measure how many UPDATEs LiveStorage sends while items download.
+
+    Each event changes every item a few times, like the downloader status
+    updates do, then commits.  We compare sending each update right away
+    with coalescing them until the commit.
+    """
+    DOWNLOAD_COUNT = 50
+    EVENT_COUNT = 200
+    CHANGES_PER_EVENT = 5
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        feed = testobjects.make_feed()
+        self.items = testobjects.add_items_to_feed(feed, self.DOWNLOAD_COUNT)
+        app.db.finish_transaction()
+        self.statement_count = 0
+        real_time_execute = app.db._time_execute
+        def _time_execute(sql, values, many):
+            self.statement_count += 1
+            return real_time_execute(sql, values, many)
+        app.db._time_execute = _time_execute
+
+    def run_workload(self, coalesce_updates):
+        app.db.coalesce_updates = coalesce_updates
+        start_count = self.statement_count
+        start = time.time()
+        commit_time = 0.0
+        for event in xrange(self.EVENT_COUNT):
+            for i in xrange(self.CHANGES_PER_EVENT):
+                for item in self.items:
+                    item.resume_time = event * self.CHANGES_PER_EVENT + i
+                    item.signal_change()
+            commit_start = time.time()
+            app.db.finish_transaction()
+            commit_time += time.time() - commit_start
+        return {
+            'time': time.time() - start,
+            'commit latency': commit_time / self.EVENT_COUNT,
+            'statements': self.statement_count - start_count,
+        }
+
+    def test_coalesce_updates(self):
+        results = [
+            ('immediate', self.run_workload(False)),
+            ('coalesced', self.run_workload(True)),
+        ]
+        report("item updates (%d downloads, %d changes per event)" %
+               (self.DOWNLOAD_COUNT, self.CHANGES_PER_EVENT), results)
+        self.assert_(results[1][1]['statements'] <
+                     results[0][1]['statements'])
+
+class SidebarCountsTest(MiroTestCase):
+    """Measure the cost of calculating the item counts for the sidebar.
+
+    Compares running COUNT queries for each feed, which is what we used to
+    do, with the counts from Item.feed_count_tracker.
+    """
+    FEED_COUNT = 800
+    ITEMS_PER_FEED = 5
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feeds = []
+        for i in xrange(self.FEED_COUNT):
+            feed = testobjects.make_feed()
+            testobjects.add_items_to_feed(feed, self.ITEMS_PER_FEED)
+            self.feeds.append(feed)
+        app.db.finish_transaction()
+        self.statement_count = 0
+        real_time_execute = app.db._time_execute
+        def _time_execute(sql, values, many):
+            self.statement_count += 1
+            return real_time_execute(sql, values, many)
+        app.db._time_execute = _time_execute
+
+    def query_counts(self, feed):
+        return (feed.downloaded_items.count(),
+                feed.downloading_items.count(),
+                feed.unwatched_items.count(),
+                feed.available_items.count() -
+                feed.auto_pending_items.count())
+
+    def tracker_counts(self, feed):
+        return (feed.num_downloaded(), feed.num_downloading(),
+                feed.num_unwatched(), feed.num_available())
+
+    def refresh_sidebar(self, get_counts):
+        start_count = self.statement_count
+        start = time.time()
+        for feed in self.feeds:
+            get_counts(feed)
+        return {
+            'time': time.time() - start,
+            'statements': self.statement_count - start_count,
+        }
+
+    def test_sidebar_counts(self):
+        models.Item.feed_count_tracker.reset()
+        results = [
+            ('queries', self.refresh_sidebar(self.query_counts)),
+            ('tracker (cold)', self.refresh_sidebar(self.tracker_counts)),
+            ('tracker (warm)', self.refresh_sidebar(self.tracker_counts)),
+        ]
+        report("sidebar counts (%d feeds)" % self.FEED_COUNT, results)
+        for feed in self.feeds[:10]:
+            self.assertEquals(self.query_counts(feed),
+                              self.tracker_counts(feed))
+        self.assert_(results[1][1]['statements'] <
+                     results[0][1]['statements'])
+
+def legacy_fetch_items(fetcher, id_list):
+    # the string-joined query that ItemFetcherWAL used before it switched to
+    # parameterized statements
+    columns = ['%s.%s' % (c.table, c.column)
+               for c in fetcher.select_columns()]
+    sql = ("SELECT %s FROM %s %s WHERE %s.id in (%s)" %
+           (', '.join(columns), fetcher.table_name(), fetcher.join_sql(),
+            fetcher.table_name(), ', '.join(str(i) for i in id_list)))
+    return [fetcher.item_source.make_item_info(row)
+            for row in fetcher.connection.execute(sql)]
+
+def legacy_select_playable_ids(fetcher):
+    sql = ("SELECT id FROM %s "
+           "WHERE %s IS NOT NULL AND "
+           "file_type != 'other' AND "
+           "id in (%s)" %
+           (fetcher.table_name(), fetcher.path_column(),
+            ','.join(str(id_) for id_ in fetcher.id_list)))
+    return [row[0] for row in fetcher.connection.execute(sql)]
+
+class ItemFetcherTest(MiroTestCase):
+    """Measure row-fetch latency for ItemFetcher.
+
+    Compares building SQL with the ids joined into the string, which is what
+    we used to do, with the fixed-shape parameterized statements.
+    """
+    LIST_SIZES = (1000, 10000, 100000)
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.init_data_package()
+        feed, items = testobjects.make_feed_with_items(1)
+        app.db.finish_transaction()
+        self.connection_pool = app.connection_pools.get_main_pool()
+        self.item_ids = self.copy_item(items[0].id, max(self.LIST_SIZES))
+
+    def copy_item(self, item_id, count):
+        """Insert count copies of an item directly into the database.
+
+        :returns: list of ids for the new rows
+        """
+        with self.connection_pool.context() as connection:
+            columns = [row[1] for row in
+                       connection.execute("PRAGMA table_info(item)")
+                       if row[1] != 'id']
+            sql = ("INSERT INTO item (%s) SELECT %s FROM item WHERE id=?" %
+                   (', '.join(columns), ', '.join(columns)))
+            connection.execute("BEGIN TRANSACTION")
+            connection.execute_many(sql, ((item_id,) for i in xrange(count)))
+            connection.commit()
+            return [row[0] for row in
+                    connection.execute("SELECT id FROM item WHERE id != ? "
+                                       "ORDER BY id", (item_id,))]
+
+    def make_fetcher(self, id_list):
+        connection = self.connection_pool.get_connection()
+        connection.execute("BEGIN TRANSACTION")
+        return itemtrack.ItemFetcherWAL(connection, item.ItemSource(),
+                                        id_list)
+
+    def time_fetch(self, id_list, fetch_items, select_playable_ids):
+        fetcher = self.make_fetcher(id_list)
+        try:
+            chunk_size = itemtrack.ItemTracker.FETCH_ROW_CHUNK_SIZE
+            chunk_count = 0
+            start = time.time()
+            for i in xrange(0, len(id_list), chunk_size):
+                fetch_items(fetcher, id_list[i:i+chunk_size])
+                chunk_count += 1
+            fetch_time = time.time() - start
+            start = time.time()
+            select_playable_ids(fetcher)
+            return {
+                'ms/chunk': fetch_time * 1000 / chunk_count,
+                'playable': time.time() - start,
+            }
+        finally:
+            fetcher.destroy()
+
+    def test_fetch_latency(self):
+        for size in self.LIST_SIZES:
+            id_list = self.item_ids[:size]
+            results = [
+                ('legacy', self.time_fetch(id_list, legacy_fetch_items,
+                                           legacy_select_playable_ids)),
+                ('parameterized', self.time_fetch(id_list,
+                    itemtrack.ItemFetcherWAL.fetch_items,
+                    itemtrack.ItemFetcherWAL.select_playable_ids)),
+            ]
+            report("ItemFetcher row fetch (%d items)" % size, results)
+
+class DAAPEncodeTest(MiroTestCase):
+    """Measure how long it takes to encode a large DAAP item listing."""
+    ITEM_COUNT = 50000
+
+    def make_reply(self):
+        itemlist = []
+        for i in xrange(self.ITEM_COUNT):
+            itemlist.append(('mlit', [
+                ('mikd', libdaap.DAAP_ITEMKIND_AUDIO),
+                ('miid', i),
+                ('minm', 'Item title number %d' % i),
+                ('asal', 'Album name'),
+                ('asar', 'Artist name'),
+                ('astm', 215000),
+                ('assz', 5000000),
+                ('asfm', 'mp3'),
+                ('aeMK', libdaap.DAAP_MEDIAKIND_AUDIO),
+            ]))
+        return [('adbs', [
+            ('mstt', libdaap.DAAP_OK),
+            ('muty', 0),
+            ('mtco', self.ITEM_COUNT),
+            ('mrco', self.ITEM_COUNT),
+            ('mlcl', itemlist),
+        ])]
+
+    def time_encode(self, reply, content_encoding):
+        start = time.time()
+        blob = subr.encode_response(reply, content_encoding=content_encoding)
+        elapsed = time.time() - start
+        return {
+            'time': elapsed,
+            'bytes': len(blob),
+            'items/sec': int(self.ITEM_COUNT / max(elapsed, 0.001)),
+        }
+
+    def test_encode_itemlist(self):
+        reply = self.make_reply()
+        results = [
+            ('identity', self.time_encode(reply, None)),
+            ('gzip', self.time_encode(reply, 'gzip')),
+        ]
+        report("DAAP item listing encode (%d items)" % self.ITEM_COUNT,
+               results)
+        data = str(subr.encode_response(reply))
+        code, size = subr.header_struct.unpack(data[:8])
+        self.assertEquals(size, len(data) - 8)
+
+class DAAPSendFileTest(MiroTestCase):
+    """Measure DAAP file download throughput over a loopback connection.
+
+    Compares the read()/write() loop with sendfile(), which is only
+    available if the pysendfile module is installed.
+    """
+    FILE_SIZE = 256 * 1024 * 1024
+    RANGE_START = 1024 * 1024
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = os.path.join(self.tempdir, 'big-file.mp4')
+        f = open(self.path, 'wb')
+        block = os.urandom(1024 * 1024)
+        for i in xrange(self.FILE_SIZE / len(block)):
+            f.write(block)
+        f.close()
+
+    def time_send(self, use_sendfile):
+        listen_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_sock.bind(('127.0.0.1', 0))
+        listen_sock.listen(1)
+        client = socket.create_connection(listen_sock.getsockname())
+        server, addr = listen_sock.accept()
+        listen_sock.close()
+        received = [0]
+        def read_client():
+            while True:
+                data = client.recv(256 * 1024)
+                if not data:
+                    break
+                received[0] += len(data)
+        reader = threading.Thread(target=read_client)
+        reader.start()
+
+        file_obj = open(self.path, 'rb')
+        file_obj.seek(self.RANGE_START)
+        stream = subr.ChunkedStreamObj(file_obj, self.path, self.RANGE_START)
+        old_sendfile = subr.sendfile
+        if not use_sendfile:
+            subr.sendfile = None
+        try:
+            start = time.time()
+            stream.send_to(server)
+            server.shutdown(socket.SHUT_WR)
+            reader.join()
+            elapsed = time.time() - start
+        finally:
+            subr.sendfile = old_sendfile
+            file_obj.close()
+            server.close()
+            client.close()
+        self.assertEquals(received[0], self.FILE_SIZE - self.RANGE_START)
+        return {
+            'time': elapsed,
+            'MB/sec': received[0] / (1024.0 * 1024.0) / max(elapsed, 0.001),
+        }
+
+    def test_throughput(self):
+        results = [('read/write', self.time_send(False))]
+        if subr.sendfile is not None:
+            results.append(('sendfile', self.time_send(True)))
+        report("DAAP file download (%d MB)" %
+               (self.FILE_SIZE / (1024 * 1024)), results)
+
+class CountingPipe(object):
+    """Wraps a pipe to count the bytes and write calls going through it."""
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.bytes_written = 0
+        self.write_count = 0
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        self.write_count += 1
+        self.pipe.write(data)
+
+    def flush(self):
+        self.pipe.flush()
+
+def legacy_dump_obj(obj, pipe):
+    # how subprocessmanager used to send messages
+    pickle_data = pickle.dumps(obj)
+    pipe.write(struct.pack("Q", len(pickle_data)))
+    pipe.write(pickle_data)
+    pipe.flush()
+
+def legacy_load_obj(pipe):
+    size_data = subprocessmanager._read_bytes_from_pipe(pipe,
+                                                        struct.calcsize("Q"))
+    size = struct.unpack("Q", size_data)[0]
+    return pickle.loads(subprocessmanager._read_bytes_from_pipe(pipe, size))
+
+class SubprocessIPCTest(MiroTestCase):
+    """Measure sending worker process messages over a pipe.
+
+    An echo thread reads each message and sends it straight back, so the
+    time covers pickling, writing, reading and unpickling on both sides.
+    """
+    ROUND_TRIPS = 200
+    BATCH_COUNT = 1000
+    COMPRESS_THRESHOLD = 16 * 1024
+
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        path = os.path.join(resources.path("testdata/feedparsertests/feeds"),
+                            "http___feeds_miroguide_com_miroguide_featured.xml")
+        html = open(path).read()
+        parsed_feed = feedparserutil.parse(html)
+        parsed_feed['bozo_exception'] = None
+        mutagen_result = {
+            'file_type': u'audio',
+            'duration': 215000,
+            'title': u'Invisible Walls',
+            'artist': u'Some Artist',
+            'album': u'Some Album',
+            'track': 3,
+            'year': 2011,
+            'genre': u'Rock',
+            'cover_art': u'/home/user/.miro/cover-art/invisible-walls.jpg',
+        }
+        self.messages = [
+            ('feed task', workerprocess.FeedparserTask(html)),
+            ('feed result', workerprocess.TaskResult(1, parsed_feed)),
+            ('mutagen task', workerprocess.MutagenTask(
+                u'/home/user/Music/invisible-walls.mp3',
+                u'/home/user/.miro/cover-art')),
+            ('mutagen result', workerprocess.TaskResult(2, mutagen_result)),
+        ]
+
+    def time_round_trips(self, msg, dump_obj, load_obj):
+        to_echo_r, to_echo_w = os.pipe()
+        from_echo_r, from_echo_w = os.pipe()
+        # unbuffered, like the pipes we get from Popen
+        to_echo = CountingPipe(os.fdopen(to_echo_w, 'wb', 0))
+        from_echo = os.fdopen(from_echo_r, 'rb', 0)
+        def echo_thread():
+            echo_in = os.fdopen(to_echo_r, 'rb', 0)
+            echo_out = os.fdopen(from_echo_w, 'wb', 0)
+            while True:
+                obj = load_obj(echo_in)
+                if obj is None:
+                    break
+                dump_obj(obj, echo_out)
+            echo_in.close()
+            echo_out.close()
+        thread = threading.Thread(target=echo_thread)
+        thread.start()
+        start = time.time()
+        for i in xrange(self.ROUND_TRIPS):
+            dump_obj(msg, to_echo)
+            load_obj(from_echo)
+        elapsed = time.time() - start
+        dump_obj(None, to_echo)
+        thread.join()
+        from_echo.close()
+        to_echo.pipe.close()
+        return {
+            'ms/round trip': elapsed * 1000.0 / self.ROUND_TRIPS,
+            'bytes': to_echo.bytes_written / self.ROUND_TRIPS,
+        }
+
+    def test_round_trips(self):
+        for label, msg in self.messages:
+            results = []
+            results.append(('legacy', self.time_round_trips(msg,
+                legacy_dump_obj, legacy_load_obj)))
+            with mock.patch.object(subprocessmanager, 'COMPRESS_THRESHOLD',
+                                   None):
+                results.append(('binary', self.time_round_trips(msg,
+                    subprocessmanager._dump_obj,
+                    subprocessmanager._load_obj)))
+            with mock.patch.object(subprocessmanager, 'COMPRESS_THRESHOLD',
+                                   self.COMPRESS_THRESHOLD):
+                results.append(('binary+compress', self.time_round_trips(msg,
+                    subprocessmanager._dump_obj,
+                    subprocessmanager._load_obj)))
+            report("IPC round trip: %s" % label, results)
+
+    def test_batching(self):
+        msg = self.messages[2][1]
+        results = []
+        pipe = CountingPipe(open(os.devnull, 'wb', 0))
+        start = time.time()
+        for i in xrange(self.BATCH_COUNT):
+            legacy_dump_obj(msg, pipe)
+        results.append(('legacy', {
+            'time': time.time() - start,
+            'writes': pipe.write_count,
+            'bytes': pipe.bytes_written,
+        }))
+        pipe = CountingPipe(open(os.devnull, 'wb', 0))
+        writer = subprocessmanager.MessageWriter(pipe)
+        start = time.time()
+        for i in xrange(self.BATCH_COUNT):
+            writer.add(msg)
+        writer.flush()
+        results.append(('batched', {
+            'time': time.time() - start,
+            'writes': pipe.write_count,
+            'bytes': pipe.bytes_written,
+        }))
+        report("Sending %d mutagen tasks" % self.BATCH_COUNT, results)
+        self.assert_(results[1][1]['writes'] < results[0][1]['writes'])
@@ -28,7 +28,14 @@
 # statement from all source files in the program, then also delete it here.
 
 from miro import sharing
+import errno
+import gzip
+import httplib
 import os
+import socket
+import threading
+import time
+from StringIO import StringIO
 
 import sqlite3
 
@@ -39,9 +46,12 @@ from miro import models
 from miro import prefs
 from miro import startup
 from miro.data import mappings
+from miro.libdaap import libdaap
+from miro.libdaap import subr
 from miro.test import mock
 from miro.test import testobjects
-from miro.test.framework import MiroTestCase, EventLoopTest
+from miro.test.framework import (MiroTestCase, EventLoopTest,
+                                 skip_for_platforms)
 
 class ShareTest(MiroTestCase):
     # Test the backend Share object
@@ -121,6 +131,261 @@ class ShareTest(MiroTestCase):
         # second call shouldn't cause an error
         share.stop_tracking()
 
+class DMAPEncodeTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.reply = [('adbs', [
+            ('mstt', 200),
+            ('muty', 0),
+            ('mtco', 2),
+            ('mrco', 2),
+            ('mlcl', [
+                ('mlit', [('mikd', 2), ('miid', 1), ('minm', 'foo')]),
+                ('mlit', [('mikd', 2), ('miid', 2), ('minm', 'bar baz')]),
+            ]),
+            ('mudl', [('miid', 3)]),
+        ])]
+
+    def test_round_trip(self):
+        data = str(subr.encode_response(self.reply))
+        self.assertEquals(subr.decode_response(data), self.reply)
+
+    def test_container_sizes(self):
+        data = str(subr.encode_response(self.reply))
+        # the outer container size should cover everything after its header
+        code, size = subr.header_struct.unpack(data[:8])
+        self.assertEquals(code, 'adbs')
+        self.assertEquals(size, len(data) - 8)
+
+    def test_bad_value_skipped(self):
+        # values that can't be packed get left out, like they always have
+        reply = [('mlit', [('miid', 'not-an-int'), ('minm', 'foo')])]
+        expected = [('mlit', [('minm', 'foo')])]
+        data = str(subr.encode_response(reply))
+        self.assertEquals(subr.decode_response(data), expected)
+
+    def test_gzip(self):
+        plain = str(subr.encode_response(self.reply))
+        blob = subr.encode_response(self.reply, content_encoding='gzip')
+        self.assertEquals(blob.get_headers(),
+                          [('Content-encoding', 'gzip')])
+        f = gzip.GzipFile(fileobj=StringIO(str(blob)))
+        self.assertEquals(f.read(), plain)
+
+class DAAPResponseCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache = libdaap.ResponseCache(max_entries=2)
+        self.create_count = 0
+
+    def create(self):
+        self.create_count += 1
+        return subr.StreamObj('reply-%d' % self.create_count)
+
+    def get(self, revision, key):
+        return str(self.cache.get(revision, key, self.create))
+
+    def test_hit(self):
+        self.assertEquals(self.get(1, 'items'), 'reply-1')
+        self.assertEquals(self.get(1, 'items'), 'reply-1')
+        self.assertEquals(self.create_count, 1)
+        self.assertEquals(self.cache.hits, 1)
+        self.assertEquals(self.cache.misses, 1)
+
+    def test_different_keys(self):
+        self.assertEquals(self.get(1, 'items'), 'reply-1')
+        self.assertEquals(self.get(1, 'containers'), 'reply-2')
+        self.assertEquals(self.get(1, 'items'), 'reply-1')
+
+    def test_new_revision(self):
+        self.assertEquals(self.get(1, 'items'), 'reply-1')
+        self.assertEquals(self.get(2, 'items'), 'reply-2')
+        self.assertEquals(self.get(2, 'items'), 'reply-2')
+
+    def test_old_revision_not_cached(self):
+        self.get(2, 'items')
+        self.assertEquals(self.get(1, 'items'), 'reply-2')
+        self.assertEquals(self.get(1, 'items'), 'reply-3')
+        self.assertEquals(self.get(2, 'items'), 'reply-1')
+
+    def test_max_entries(self):
+        self.get(1, 'a')
+        self.get(1, 'b')
+        self.get(1, 'c')
+        self.assertEquals(len(self.cache.entries), 2)
+        # 'a' was the oldest, so it should have been dropped
+        self.assertEquals(self.get(1, 'a'), 'reply-4')
+
+    def test_none_not_cached(self):
+        self.cache.get(1, 'items', lambda: None)
+        self.assertEquals(self.get(1, 'items'), 'reply-1')
+
+@skip_for_platforms('win32')
+class ChunkedStreamTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.data = ''.join(chr(i % 256) for i in xrange(300 * 1024))
+        path = os.path.join(self.tempdir, 'song.mp3')
+        f = open(path, 'wb')
+        f.write(self.data)
+        f.close()
+        self.file_obj = open(path, 'rb')
+        self.sock, self.peer = socket.socketpair()
+        self.received = []
+        self.reader = threading.Thread(target=self.read_peer)
+        self.reader.start()
+
+    def tearDown(self):
+        self.file_obj.close()
+        self.sock.close()
+        self.peer.close()
+        MiroTestCase.tearDown(self)
+
+    def read_peer(self):
+        while True:
+            data = self.peer.recv(65536)
+            if not data:
+                break
+            self.received.append(data)
+
+    def send(self, start=0, end=0):
+        # the backend seeks to the start of the range before we get the file
+        self.file_obj.seek(start)
+        stream = subr.ChunkedStreamObj(self.file_obj, 'song.mp3', start, end)
+        sent = stream.send_to(self.sock)
+        self.sock.shutdown(socket.SHUT_WR)
+        self.reader.join()
+        self.assertEquals(sent, len(stream))
+        return ''.join(self.received)
+
+    def test_whole_file(self):
+        self.assertEquals(self.send(), self.data)
+
+    def test_range(self):
+        self.assertEquals(self.send(1000, 200 * 1024),
+                          self.data[1000:200 * 1024 + 1])
+
+    def test_open_range(self):
+        self.assertEquals(self.send(5000), self.data[5000:])
+
+    def test_fallback(self):
+        # if sendfile() doesn't work for this file, we should copy the data
+        # ourselves
+        def bad_sendfile(out_fd, in_fd, offset, count):
+            raise OSError(errno.EINVAL, 'Invalid argument')
+        old_sendfile = subr.sendfile
+        subr.sendfile = bad_sendfile
+        try:
+            self.assertEquals(self.send(1000), self.data[1000:])
+        finally:
+            subr.sendfile = old_sendfile
+
+    def test_timeout_socket(self):
+        # sockets with a timeout are non-blocking, so sendfile() can give us
+        # EAGAIN.  We should wait for the socket and carry on.
+        calls = []
+        def eagain_sendfile(out_fd, in_fd, offset, count):
+            calls.append(offset)
+            if len(calls) == 1:
+                raise OSError(errno.EAGAIN, 'Resource temporarily unavailable')
+            data = self.data[offset:offset+min(count, 4096)]
+            return os.write(out_fd, data)
+        old_sendfile = subr.sendfile
+        subr.sendfile = eagain_sendfile
+        self.sock.settimeout(10)
+        try:
+            self.assertEquals(self.send(), self.data)
+        finally:
+            subr.sendfile = old_sendfile
+        self.assertEquals(calls[:2], [0, 0])
+
+class DAAPServerPoolTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.server = libdaap.make_daap_server(None, port=0, max_conn=2,
+                                               max_workers=1)
+        self.server.max_queued = 1
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.server.server_close()
+        MiroTestCase.tearDown(self)
+
+    def connect(self):
+        client = socket.create_connection(self.server.server_address)
+        self.clients.append(client)
+        # accept the connection and hand it to the pool
+        self.server.handle_request()
+        return client
+
+    def wait_for_stats(self, **expected):
+        for i in xrange(100):
+            stats = self.server.get_stats()
+            if all(stats[k] == v for k, v in expected.items()):
+                return
+            time.sleep(0.05)
+        raise AssertionError("%s doesn't match %s" % (stats, expected))
+
+    def read_status(self, client):
+        response = httplib.HTTPResponse(client)
+        response.begin()
+        response.read()
+        return response.status
+
+    def get_status(self, client, path):
+        client.sendall('GET %s HTTP/1.1\r\n\r\n' % path)
+        return self.read_status(client)
+
+    def test_keep_alive(self):
+        client = self.connect()
+        self.assertEquals(self.get_status(client, '/server-info'), 200)
+        # the same worker should handle the next request
+        self.assertEquals(self.get_status(client, '/server-info'), 200)
+        self.wait_for_stats(workers=1, active_connections=1,
+                            total_connections=1)
+
+    def test_idle_timeout(self):
+        self.server.keepalive_timeout = 0.1
+        client = self.connect()
+        self.assertEquals(self.get_status(client, '/server-info'), 200)
+        # the connection is idle, so the server should close it and free up
+        # the worker
+        self.wait_for_stats(active_connections=0, total_connections=1)
+        self.assertEquals(client.recv(1), '')
+
+    def test_queue(self):
+        first = self.connect()
+        self.wait_for_stats(active_connections=1)
+        # our only worker is busy with the first connection, so the second
+        # should wait for it.
+        second = self.connect()
+        self.wait_for_stats(queued_connections=1)
+        # the queue is full, so the third gets turned away
+        third = self.connect()
+        self.assertEquals(self.read_status(third), 503)
+        self.wait_for_stats(rejected_connections=1)
+        # once the first connection closes, the second should get served
+        first.close()
+        self.assertEquals(self.get_status(second, '/server-info'), 200)
+        self.wait_for_stats(queued_connections=0, total_connections=2)
+
+    def test_session_requests(self):
+        self.server.max_session_requests = 2
+        self.assert_(self.server.begin_session_request(123))
+        self.assert_(self.server.begin_session_request(123))
+        self.assert_(not self.server.begin_session_request(123))
+        # other sessions and requests without a session aren't affected
+        self.assert_(self.server.begin_session_request(456))
+        self.assert_(self.server.begin_session_request(0))
+        self.assertEquals(self.server.get_stats()['active_requests'], 3)
+        self.server.end_session_request(123)
+        self.assert_(self.server.begin_session_request(123))
+        for s in (123, 123, 456):
+            self.server.end_session_request(s)
+        self.assertEquals(self.server.session_requests, {})
+
 class SharingTest(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
@@ -549,6 +814,22 @@ class SharingServerTest(EventLoopTest):
         self.check_daap_list(self.backend.get_items(new_playlist.id),
                              self.video_items[:4])
 
+    def test_current_revision(self):
+        self.setup_sharing_manager_backend()
+        initial_revision = self.backend.get_current_revision()
+        self.assertEquals(initial_revision, self.backend.data_set.revision)
+        # moving items between feeds changes the feed item lists, so it
+        # should get a new revision.
+        new_feed = testobjects.make_feed()
+        self.send_changes_from_trackers()
+        second_revision = self.backend.get_current_revision()
+        for item in self.video_items:
+            item.set_feed(new_feed.id)
+        app.db.finish_transaction()
+        models.Item.change_tracker.send_changes()
+        self.assertNotEquals(self.backend.get_current_revision(),
+                             second_revision)
+
     def test_change_share_feed(self):
         self.setup_sharing_manager_backend()
         initial_revision = self.backend.data_set.revision
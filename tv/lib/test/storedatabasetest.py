@@ -25,10 +25,12 @@ from miro import theme
 from miro.fileobject import FilenameType
 import shutil
 from miro import storedatabase
+from miro.data import fulltextsearch
 from miro.plat import resources
 from miro.plat.utils import PlatformFilenameType
 
 from miro.test import mock
+from miro.test import testobjects
 from miro.test.framework import (MiroTestCase, EventLoopTest,
                                  skip_for_platforms, MatchAny)
 from miro.schema import (SchemaString, SchemaInt, SchemaFloat,
@@ -548,6 +550,198 @@ class DiskTest(FakeSchemaTest):
         lee_view = Human.make_view("id=?", values=(lee.id,))
         self.assertEquals(lee_view.count(), 0)
 
+class CoalesceUpdatesTest(FakeSchemaTest):
+    def setUp(self):
+        FakeSchemaTest.setUp(self)
+        app.db.finish_transaction()
+        self.statements = []
+        real_time_execute = app.db._time_execute
+        def _time_execute(sql, values, many):
+            self.statements.append(sql)
+            return real_time_execute(sql, values, many)
+        app.db._time_execute = _time_execute
+
+    def update_statements(self):
+        return [sql for sql in self.statements if sql.startswith('UPDATE')]
+
+    def get_age(self, obj):
+        sql = "SELECT age FROM %s WHERE id=?" % app.db.table_name(
+            obj.__class__)
+        return app.db.execute(sql, (obj.id,))[0][0]
+
+    def check_age(self, obj, age):
+        self.assertEquals(self.get_age(obj), age)
+
+    def change_age(self, obj, age):
+        obj.age = age
+        obj.signal_change()
+
+    def test_coalesce(self):
+        for i in range(5):
+            self.change_age(self.lee, i)
+            self.lee.name = u'lee %d' % i
+            self.lee.signal_change()
+        self.assertEquals(self.update_statements(), [])
+        app.db.finish_transaction()
+        self.assertEquals(len(self.update_statements()), 1)
+        self.reload_test_database()
+        self.check_age(self.lee, 4)
+
+    def test_executemany(self):
+        humans = [Human(u"human %d" % i, 20, 1.5, [], {}) for i in range(3)]
+        app.db.finish_transaction()
+        del self.statements[:]
+        for obj in humans:
+            self.change_age(obj, 50)
+        self.joe.age = 50
+        self.joe.signal_change()
+        app.db.finish_transaction()
+        # the humans changed the same column, so they get written together.
+        # joe is stored in a different table.
+        self.assertEquals(len(self.update_statements()), 2)
+        for obj in humans:
+            self.check_age(obj, 50)
+
+    def test_read_sees_pending_updates(self):
+        self.change_age(self.lee, 30)
+        self.check_age(self.lee, 30)
+        self.change_age(self.joe, 31)
+        cursor = app.db.cursor
+        cursor.execute("SELECT age FROM restorable_human WHERE id=?",
+                       (self.joe.id,))
+        self.assertEquals(cursor.fetchone()[0], 31)
+
+    def test_rollback(self):
+        self.change_age(self.lee, 30)
+        app.db.finish_transaction(commit=False)
+        self.assertEquals(self.update_statements(), [])
+        self.check_age(self.lee, 25)
+
+    def test_update_then_remove(self):
+        self.change_age(self.lee, 30)
+        self.lee.remove()
+        app.db.finish_transaction()
+        # lee was the only object in the human table
+        self.assertEquals(Human.make_view().count(), 0)
+        self.check_age(self.joe, 14)
+
+    def test_missing_row(self):
+        self.change_age(self.lee, 30)
+        app.db.cursor.execute("DELETE FROM human WHERE id=?", (self.lee.id,))
+        self.change_age(self.lee, 31)
+        self.change_age(self.joe, 32)
+        self.assertRaises(KeyError, app.db.finish_transaction)
+        self.assertEquals(app.db._pending_updates, {})
+        # the other changes still get committed
+        self.reload_test_database()
+        self.check_age(self.joe, 32)
+
+    def test_validation_error(self):
+        # bad values get caught when the object changes, not at commit time
+        self.lee.age = u'old'
+        with self.allow_warnings():
+            self.assertRaises(schema.ValidationError, self.lee.signal_change)
+        self.assertEquals(app.db._pending_updates, {})
+        self.change_age(self.joe, 32)
+        app.db.finish_transaction()
+        self.check_age(self.joe, 32)
+
+    def test_no_coalesce(self):
+        app.db.coalesce_updates = False
+        self.change_age(self.lee, 30)
+        self.change_age(self.lee, 31)
+        self.assertEquals(len(self.update_statements()), 2)
+        app.db.finish_transaction()
+        self.check_age(self.lee, 31)
+
+class FullTextReindexTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = testobjects.make_feed()
+        self.items = testobjects.add_items_to_feed(self.feed, 5)
+        app.db.finish_transaction()
+
+    def count_changes(self, sql, values):
+        start = app.db.connection.total_changes
+        app.db.cursor.execute(sql, values)
+        return app.db.connection.total_changes - start
+
+    def search(self, term):
+        rows = app.db.execute("SELECT docid FROM item_fts "
+                              "WHERE item_fts MATCH ?", (term,))
+        return set(row[0] for row in rows)
+
+    def pending_count(self):
+        return app.db.execute("SELECT COUNT(*) FROM item_fts_pending")[0][0]
+
+    def change_title(self, obj, title):
+        obj.title = title
+        obj.signal_change()
+
+    def set_reindex_mode(self, mode):
+        app.db.fts_reindex_mode = mode
+        app.db.setup_fts_reindex_mode()
+
+    def test_mode(self):
+        self.assertEquals(fulltextsearch.get_reindex_mode(app.db.connection),
+                          fulltextsearch.REINDEX_DEFERRED)
+
+    def test_unindexed_column_update(self):
+        # changing a column that's not indexed should only change the item
+        # row
+        changes = self.count_changes(
+            "UPDATE item SET resume_time=100 WHERE id=?", (self.items[0].id,))
+        self.assertEquals(changes, 1)
+        self.assertEquals(self.pending_count(), 0)
+
+    def test_same_value_update(self):
+        # setting an indexed column to its current value shouldn't re-index
+        # the row
+        changes = self.count_changes("UPDATE item SET title=title WHERE id=?",
+                                     (self.items[0].id,))
+        self.assertEquals(changes, 1)
+        self.assertEquals(self.pending_count(), 0)
+
+    def test_deferred_reindex(self):
+        self.change_title(self.items[0], u'foo')
+        self.change_title(self.items[0], u'foo bar')
+        self.change_title(self.items[1], u'bar')
+        # item_fts doesn't get updated until the end of the transaction
+        self.assertEquals(self.search('bar'), set())
+        app.db.finish_transaction()
+        self.assertEquals(self.search('bar'),
+                          set([self.items[0].id, self.items[1].id]))
+        self.assertEquals(self.search('foo'), set([self.items[0].id]))
+        self.assertEquals(self.pending_count(), 0)
+
+    def test_deferred_reindex_rollback(self):
+        self.change_title(self.items[0], u'foo')
+        app.db.finish_transaction(commit=False)
+        self.assertEquals(self.search('foo'), set())
+        self.assertEquals(self.pending_count(), 0)
+
+    def test_update_then_remove(self):
+        self.change_title(self.items[0], u'foo')
+        self.items[0].remove()
+        app.db.finish_transaction()
+        self.assertEquals(self.search('foo'), set())
+
+    def test_immediate_reindex(self):
+        self.set_reindex_mode(fulltextsearch.REINDEX_IMMEDIATE)
+        self.change_title(self.items[0], u'foo')
+        self.assertEquals(self.search('foo'), set([self.items[0].id]))
+        changes = self.count_changes(
+            "UPDATE item SET resume_time=100 WHERE id=?", (self.items[0].id,))
+        self.assertEquals(changes, 1)
+        app.db.finish_transaction()
+
+    def test_switch_modes_flushes(self):
+        # switching from deferred mode should index any pending changes
+        self.change_title(self.items[0], u'foo')
+        self.set_reindex_mode(fulltextsearch.REINDEX_IMMEDIATE)
+        self.assertEquals(self.search('foo'), set([self.items[0].id]))
+        app.db.finish_transaction()
+
 class ObjectMemoryTest(FakeSchemaTest):
     def test_remove_remove_object_map(self):
         self.reload_test_database()
@@ -1,6 +1,7 @@
 import os
 import time
 import Queue
+from StringIO import StringIO
 
 from miro import app
 from miro import moviedata
@@ -8,7 +9,8 @@ from miro import subprocessmanager
 from miro import workerprocess
 from miro.plat import resources
 from miro.test import mock
-from miro.test.framework import EventLoopTest, only_on_platforms
+from miro.test.framework import (EventLoopTest, MiroTestCase,
+                                 only_on_platforms)
 
 # setup some test messages/handlers
 class TestSubprocessHandler(subprocessmanager.SubprocessHandler):
@@ -80,8 +82,101 @@ class SlowRunningTask(workerprocess.TaskMessage):
     """
     priority = -10
 
+class RecordingPipe(object):
+    """File-like object that records writes and flushes."""
+    def __init__(self):
+        self.writes = []
+        self.flush_count = 0
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def flush(self):
+        self.flush_count += 1
+
+    def make_read_pipe(self):
+        return StringIO(''.join(self.writes))
+
 # Actual tests go below here
 
+class PipeFramingTest(MiroTestCase):
+    def round_trip(self, obj):
+        pipe = StringIO()
+        subprocessmanager._dump_obj(obj, pipe)
+        pipe.seek(0)
+        return subprocessmanager._load_obj(pipe), pipe.getvalue()
+
+    def get_flags(self, data):
+        return subprocessmanager.FRAME_HEADER.unpack(
+            data[:subprocessmanager.FRAME_HEADER.size])[1]
+
+    def test_round_trip(self):
+        obj = {'title': u'Caf\xe9', 'duration': 1234, 'data': '\0\xff' * 10}
+        loaded, data = self.round_trip(obj)
+        self.assertEquals(loaded, obj)
+        self.assertEquals(self.get_flags(data), 0)
+
+    def test_compression(self):
+        html = '<item><title>Title</title></item>' * 20000
+        with mock.patch.object(subprocessmanager, 'COMPRESS_THRESHOLD',
+                               64 * 1024):
+            loaded, data = self.round_trip(html)
+        self.assertEquals(loaded, html)
+        self.assertEquals(self.get_flags(data),
+                          subprocessmanager.FRAME_COMPRESSED)
+        self.assert_(len(data) < len(html) / 10)
+
+    def test_compression_disabled(self):
+        html = '<item><title>Title</title></item>' * 20000
+        with mock.patch.object(subprocessmanager, 'COMPRESS_THRESHOLD', None):
+            loaded, data = self.round_trip(html)
+        self.assertEquals(loaded, html)
+        self.assertEquals(self.get_flags(data), 0)
+
+    def test_corrupt_compressed_data(self):
+        data = 'not zlib data'
+        header = subprocessmanager.FRAME_HEADER.pack(len(data),
+                subprocessmanager.FRAME_COMPRESSED)
+        self.assertRaises(subprocessmanager.LoadError,
+                          subprocessmanager._load_obj,
+                          StringIO(header + data))
+
+    def test_truncated_frame(self):
+        loaded, data = self.round_trip('some data')
+        self.assertRaises(subprocessmanager.LoadError,
+                          subprocessmanager._load_obj,
+                          StringIO(data[:-1]))
+
+    def test_batching(self):
+        pipe = RecordingPipe()
+        writer = subprocessmanager.MessageWriter(pipe)
+        for i in xrange(3):
+            writer.add(i)
+        # nothing should be written until we flush
+        self.assertEquals(pipe.writes, [])
+        writer.flush()
+        self.assertEquals(len(pipe.writes), 1)
+        self.assertEquals(pipe.flush_count, 1)
+        # flushing again shouldn't write anything
+        writer.flush()
+        self.assertEquals(pipe.flush_count, 1)
+        read_pipe = pipe.make_read_pipe()
+        self.assertEquals([subprocessmanager._load_obj(read_pipe)
+                           for i in xrange(3)], [0, 1, 2])
+
+    def test_batch_size(self):
+        pipe = RecordingPipe()
+        writer = subprocessmanager.MessageWriter(pipe, max_batch_size=100)
+        writer.add('a' * 50)
+        self.assertEquals(pipe.flush_count, 0)
+        # once the batch gets big enough, we should write it out
+        writer.add('b' * 50)
+        self.assertEquals(pipe.flush_count, 1)
+        read_pipe = pipe.make_read_pipe()
+        self.assertEquals(subprocessmanager._load_obj(read_pipe), 'a' * 50)
+        self.assertEquals(subprocessmanager._load_obj(read_pipe), 'b' * 50)
+
+
 class SubprocessManagerTest(EventLoopTest):
     # FIXME: we should have a better way of waiting for the subprocess to do
     # things, than calling runEventLoop() with an arbitrary timeout.
@@ -298,17 +393,19 @@ class FeedParserTest(WorkerProcessTest):
         self.assert_(isinstance(self.error, ValueError))
 
     def test_crash(self):
-        # force a crash of our subprocess right after we send the task
+        # force a crash of our subprocesses right after we send the task
         workerprocess.startup()
-        original_pid = workerprocess._subprocess_manager.process.pid
+        processes = workerprocess._subprocess_manager.processes
+        original_pids = [p.process.pid for p in processes]
         self.send_feedparser_task()
-        workerprocess._subprocess_manager.process.terminate()
+        for p in processes:
+            p.process.terminate()
         with self.allow_warnings():
             self.runEventLoop(4.0)
-        # check that we really restarted the subprocess
-        self.assertNotEqual(original_pid,
-                workerprocess._subprocess_manager.process.pid)
+        # check that we really restarted the subprocess that had our task
         self.check_successful_result()
+        self.assertNotEqual(original_pids, [p.process.pid for p in processes
+                                            if p.process is not None])
 
     def test_queue_before_start(self):
         # test sending tasks before we start the worker process
@@ -320,6 +417,141 @@ class FeedParserTest(WorkerProcessTest):
         self.runEventLoop(4.0)
         self.check_successful_result()
 
+class WorkerPoolTest(WorkerProcessTest):
+    def setUp(self):
+        WorkerProcessTest.setUp(self)
+        self.results = []
+        self.task_count = 10
+
+    def callback(self, msg, result):
+        self.results.append(result)
+        if len(self.results) == self.task_count:
+            self.stopEventLoop(abnormal=False)
+
+    def test_many_tasks(self):
+        # send more tasks than any one process will take and check that they
+        # all get done.
+        workerprocess.startup(thread_count=1, process_count=2)
+        processes = workerprocess._subprocess_manager.processes
+        self.assertEquals(len(processes), 2)
+        path = os.path.join(resources.path("testdata/feedparsertests/feeds"),
+            "http___feeds_miroguide_com_miroguide_featured.xml")
+        html = open(path).read()
+        for i in xrange(self.task_count):
+            workerprocess.send(workerprocess.FeedparserTask(html),
+                               self.callback, self.errback)
+        # each process should have gotten its share
+        for process in processes:
+            self.assertEquals(len(process.tasks_in_flight), 2)
+        self.runEventLoop(10.0)
+        if self.error is not None:
+            raise self.error
+        self.assertEquals(len(self.results), self.task_count)
+        for process in processes:
+            self.assertEquals(len(process.tasks_in_flight), 0)
+        self.assertEquals(workerprocess._miro_task_queue.tasks_in_progress,
+                          {})
+
+class FakeWorkerProcess(object):
+    """Stands in for WorkerProcess in MiroTaskQueueTest."""
+    def __init__(self, max_tasks):
+        self.is_running = True
+        self.max_tasks = max_tasks
+        self.tasks_in_flight = set()
+        self.sent = []
+
+    def has_room(self):
+        return self.is_running and len(self.tasks_in_flight) < self.max_tasks
+
+    def send_task(self, msg):
+        self.tasks_in_flight.add(msg.task_id)
+        self.sent.append(msg)
+
+    def send_message(self, msg):
+        self.sent.append(msg)
+
+    def task_finished(self, task_id):
+        self.tasks_in_flight.discard(task_id)
+
+    def shutdown(self):
+        self.is_running = False
+
+class MiroTaskQueueTest(MiroTestCase):
+    """Test handing out tasks to worker processes."""
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.processes = [FakeWorkerProcess(2), FakeWorkerProcess(2)]
+        workerprocess._subprocess_manager.processes = self.processes
+        self.queue = workerprocess._miro_task_queue
+        self.results = []
+
+    def callback(self, msg, result):
+        self.results.append((msg, result))
+
+    def send_mutagen_task(self, path):
+        msg = workerprocess.MutagenTask(path, self.tempdir)
+        workerprocess.send(msg, self.callback, self.callback)
+        return msg
+
+    def finish(self, process, msg):
+        self.queue.process_result(process,
+                                  workerprocess.TaskResult(msg.task_id, {}))
+
+    def test_spread_over_processes(self):
+        tasks = [self.send_mutagen_task('/music/%d.mp3' % i)
+                 for i in xrange(5)]
+        # tasks should go to the process with the most room, and wait once
+        # every process is full.
+        self.assertEquals(self.processes[0].sent, [tasks[0], tasks[2]])
+        self.assertEquals(self.processes[1].sent, [tasks[1], tasks[3]])
+        self.finish(self.processes[1], tasks[1])
+        self.assertEquals(self.processes[1].sent[-1], tasks[4])
+        self.assertEquals(self.results, [(tasks[1], {})])
+
+    def test_priority(self):
+        for process in self.processes:
+            process.is_running = False
+        mutagen_task = self.send_mutagen_task('/music/song.mp3')
+        feedparser_task = workerprocess.FeedparserTask('<rss />')
+        workerprocess.send(feedparser_task, self.callback, self.callback)
+        # once a process has room, higher priority tasks should go first,
+        # even though they were sent later
+        self.processes[0].is_running = True
+        self.processes[0].max_tasks = 1
+        self.queue.process_started(self.processes[0])
+        self.assertEquals(self.processes[0].sent, [feedparser_task])
+        self.finish(self.processes[0], feedparser_task)
+        self.assertEquals(self.processes[0].sent,
+                          [feedparser_task, mutagen_task])
+
+    def test_cancel(self):
+        tasks = [self.send_mutagen_task('/music/%d.mp3' % i)
+                 for i in xrange(6)]
+        workerprocess.cancel_tasks_for_files(['/music/1.mp3',
+                                              '/music/5.mp3'])
+        # the cancel message should go to every process
+        for process in self.processes:
+            self.assert_(isinstance(process.sent[-1],
+                                    workerprocess.CancelFileOperations))
+        # the pending task should be dropped right away
+        self.assert_(tasks[5].task_id not in self.queue.tasks_in_progress)
+        # the task that was sent gets dropped when the process tells us
+        self.queue.process_canceled(self.processes[1], [tasks[1].task_id])
+        self.assert_(tasks[1].task_id not in self.queue.tasks_in_progress)
+        # and the next task goes out in its place
+        self.assertEquals(self.processes[1].sent[-1], tasks[4])
+
+    def test_requeue_after_restart(self):
+        task = self.send_mutagen_task('/music/song.mp3')
+        # when the process restarts, the task should get sent again
+        self.queue.process_started(self.processes[0])
+        self.assertEquals(self.processes[0].sent, [task, task])
+        # if the process finished the task just before restarting, we
+        # should still only call the callback once
+        self.finish(self.processes[0], task)
+        self.finish(self.processes[0], task)
+        self.assertEquals(self.results, [(task, {})])
+
 class MovieDataTest(WorkerProcessTest):
 
     def setUp(self):
@@ -55,7 +55,8 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 if self.start_pos > 0:
                     f.seek(self.start_pos, os.SEEK_CUR)
                 if self.end_pos > 0:
-                    count = self.end_pos - self.start_pos
+                    # the end of a HTTP range is inclusive
+                    count = self.end_pos - max(self.start_pos, 0) + 1
                 else:
                     count = -1
                 data = f.read(count)
@@ -240,12 +241,14 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         fs = os.fstat(f.fileno())
         length = fs[6]
         if self.end_pos > 0:
-            length = min(self.end_pos, length)
+            length = min(self.end_pos + 1, length)
         if self.start_pos > 0:
             length -= self.start_pos
         if 'content-length' not in self.server.headers_to_send:
             self.send_header("Content-Length", str(length))
         self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        if self.server.allow_resume:
+            self.send_header("Accept-Ranges", "bytes")
         for key, value in self.server.headers_to_send:
             self.send_header(key, value)
         for key, value in headers_to_send:
@@ -0,0 +1,207 @@
+import os
+from StringIO import StringIO
+
+from miro import transcode
+from miro.test.framework import MiroTestCase
+
+class LRUDictTest(MiroTestCase):
+    def test_order(self):
+        lru = transcode._LRUDict([('a', 1), ('b', 2), ('c', 3)])
+        lru.touch('a')
+        lru['b'] = 4
+        self.assertEquals(lru.items(), [('c', 3), ('a', 1), ('b', 4)])
+        self.assertEquals(lru.pop_oldest(), ('c', 3))
+        self.assertEquals(lru.pop('a'), 1)
+        self.assertEquals(lru.pop('a', None), None)
+        self.assertEquals(lru.pop_oldest(), ('b', 4))
+        self.assertRaises(KeyError, lru.pop_oldest)
+        self.assertEquals(len(lru), 0)
+
+    def test_compact(self):
+        lru = transcode._LRUDict([('a', 1), ('b', 2)])
+        for i in xrange(1000):
+            lru.touch('a')
+        self.assert_(len(lru.order) < 200)
+        self.assertEquals(lru.keys(), ['b', 'a'])
+
+class ProbeCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache_path = os.path.join(self.tempdir, 'probe-cache')
+        self.probed = []
+        self.patch_function('miro.transcode.needs_transcode',
+                            self.fake_needs_transcode)
+        self.media_path = self.make_media_file('video.mp4', 'abc')
+
+    def fake_needs_transcode(self, media_file):
+        self.probed.append(media_file)
+        return (True, (60, True, 'aac', 44100, True, 'h264', '640x480'))
+
+    def make_media_file(self, name, contents):
+        path = os.path.join(self.tempdir, name)
+        f = open(path, 'wb')
+        f.write(contents)
+        f.close()
+        return path
+
+    def test_cache(self):
+        cache = transcode.ProbeCache(self.cache_path)
+        result = cache.needs_transcode(self.media_path)
+        self.assertEquals(cache.needs_transcode(self.media_path), result)
+        self.assertEquals(self.probed, [self.media_path])
+
+    def test_file_changed(self):
+        cache = transcode.ProbeCache(self.cache_path)
+        cache.needs_transcode(self.media_path)
+        self.make_media_file('video.mp4', 'abcdef')
+        cache.needs_transcode(self.media_path)
+        self.assertEquals(len(self.probed), 2)
+
+    def test_saved(self):
+        cache = transcode.ProbeCache(self.cache_path)
+        result = cache.needs_transcode(self.media_path)
+        cache2 = transcode.ProbeCache(self.cache_path)
+        self.assertEquals(cache2.needs_transcode(self.media_path), result)
+        self.assertEquals(self.probed, [self.media_path])
+
+    def test_corrupt_cache_file(self):
+        self.make_media_file('probe-cache', 'not a pickle')
+        with self.allow_warnings():
+            cache = transcode.ProbeCache(self.cache_path)
+        cache.needs_transcode(self.media_path)
+        self.assertEquals(self.probed, [self.media_path])
+
+    def test_max_entries(self):
+        cache = transcode.ProbeCache(self.cache_path)
+        cache.MAX_ENTRIES = 2
+        paths = [self.make_media_file('video%d.mp4' % i, 'abc')
+                 for i in range(3)]
+        cache.needs_transcode(paths[0])
+        cache.needs_transcode(paths[1])
+        # use paths[0] again so that paths[1] is the least recently used
+        cache.needs_transcode(paths[0])
+        cache.needs_transcode(paths[2])
+        self.assertEquals(set(cache.entries.keys()),
+                          set([paths[0], paths[2]]))
+        cache.needs_transcode(paths[1])
+        self.assertEquals(self.probed, [paths[0], paths[1], paths[2],
+                                        paths[1]])
+
+class SegmentCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache_dir = os.path.join(self.tempdir, 'segments')
+        self.cache = transcode.SegmentCache(self.cache_dir, max_size=10)
+
+    def add_segment(self, cache, chunk, data):
+        cache.add_segment('key', chunk, StringIO(data))
+
+    def check_segment(self, cache, chunk, data):
+        f = cache.get_segment('key', chunk)
+        self.assertNotEquals(f, None)
+        try:
+            self.assertEquals(f.read(), data)
+        finally:
+            f.close()
+
+    def test_cache(self):
+        self.add_segment(self.cache, 0, 'abc')
+        self.check_segment(self.cache, 0, 'abc')
+        self.assert_(self.cache.has_segment('key', 0))
+        self.assert_(not self.cache.has_segment('key', 1))
+        self.assert_(not self.cache.has_segment('other-key', 0))
+        self.assertEquals(self.cache.get_segment('key', 1), None)
+
+    def test_evict(self):
+        self.add_segment(self.cache, 0, 'aaaa')
+        self.add_segment(self.cache, 1, 'bbbb')
+        # use chunk 0 again so that chunk 1 is the least recently used
+        self.check_segment(self.cache, 0, 'aaaa')
+        self.add_segment(self.cache, 2, 'cccc')
+        self.assert_(self.cache.has_segment('key', 0))
+        self.assert_(not self.cache.has_segment('key', 1))
+        self.assert_(self.cache.has_segment('key', 2))
+        self.assertEquals(len(os.listdir(self.cache_dir)), 2)
+        # a segment bigger than the cache is kept until the next one comes
+        # in
+        self.add_segment(self.cache, 3, 'd' * 20)
+        self.assertEquals(self.cache.entries.values(), [20])
+        self.check_segment(self.cache, 3, 'd' * 20)
+
+    def test_rescan(self):
+        self.add_segment(self.cache, 0, 'aaaa')
+        self.add_segment(self.cache, 1, 'bbbb')
+        open(os.path.join(self.cache_dir, 'partial.ts.tmp'), 'wb').close()
+        cache2 = transcode.SegmentCache(self.cache_dir, max_size=10)
+        self.check_segment(cache2, 0, 'aaaa')
+        self.check_segment(cache2, 1, 'bbbb')
+        self.assertEquals(cache2.total_size, 8)
+        self.assertEquals(len(os.listdir(self.cache_dir)), 2)
+
+class TranscodeObjectCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.media_path = os.path.join(self.tempdir, 'video.avi')
+        open(self.media_path, 'wb').close()
+        self.cache = transcode.SegmentCache(
+            os.path.join(self.tempdir, 'segments'))
+        self.transcode_objs = []
+
+    def tearDown(self):
+        for obj in self.transcode_objs:
+            # shutdown() waits for transcode() to be called, but some of the
+            # tests don't call it.
+            obj.transcode_gate.set()
+            obj.shutdown()
+        MiroTestCase.tearDown(self)
+
+    def make_transcode_obj(self, chunk):
+        # 25 seconds long, so 3 chunks
+        media_info = (25, True, 'aac', 44100, True, 'h264', '640x480')
+        obj = transcode.TranscodeObject(self.media_path, 1, 0, chunk,
+                                        media_info, self.request_path,
+                                        self.cache)
+        self.transcode_objs.append(obj)
+        return obj
+
+    def request_path(self, itemid, ext):
+        return 'daap://127.0.0.1:3689/item/%d.%s?session=1' % (itemid, ext)
+
+    def add_segments(self, obj, chunks):
+        key = obj.get_cache_key(obj.get_transcode_args())
+        for chunk in chunks:
+            self.cache.add_segment(key, chunk, StringIO('chunk %d' % chunk))
+
+    def test_all_cached(self):
+        obj = self.make_transcode_obj(None)
+        self.add_segments(obj, [0, 1, 2])
+        self.patch_function('miro.transcode.Popen', self.fail_popen)
+        self.assert_(obj.transcode())
+        for i in range(3):
+            self.assertEquals(obj.get_chunk().read(), 'chunk %d' % i)
+        # past the end of the file we should get an empty chunk
+        self.assertEquals(obj.get_chunk().read(), '')
+
+    def fail_popen(self, *args, **kwargs):
+        raise AssertionError("transcode job started")
+
+    def test_skip_cached_chunks(self):
+        obj = self.make_transcode_obj(1)
+        self.add_segments(obj, [0, 1])
+        args = obj.get_transcode_args()
+        self.assert_(not obj.skip_cached_chunks(args))
+        self.assertEquals(obj.job_start_chunk, 2)
+        self.assertEquals(obj.time_offset, 2 * obj.segment_duration)
+        # chunk 1 is cached, so it shouldn't need a new transcode job
+        self.assert_(not obj.isseek(1))
+        self.assertEquals(obj.get_chunk().read(), 'chunk 1')
+        self.assertEquals(obj.current_chunk, 2)
+
+    def test_evicted_chunk(self):
+        obj = self.make_transcode_obj(0)
+        self.add_segments(obj, [0])
+        obj.skip_cached_chunks(obj.get_transcode_args())
+        self.cache.max_size = 0
+        self.add_segments(obj, [2])
+        # chunk 0 was evicted, so we need a new transcode job for it
+        self.assert_(obj.isseek(0))
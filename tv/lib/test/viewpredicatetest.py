@@ -0,0 +1,173 @@
+from datetime import datetime, timedelta
+
+from miro import app
+from miro import models
+from miro import schema
+from miro import viewpredicate
+from miro.test import testobjects
+from miro.test.framework import MiroTestCase
+
+class FakeObject(object):
+    def __init__(self, **attrs):
+        self.__dict__.update(attrs)
+
+class CompileWhereTest(MiroTestCase):
+    def compile(self, where, values=()):
+        return viewpredicate.compile_where(where, values, 'item',
+                                           schema.ItemSchema,
+                                           app.db._converter)
+
+    def check_unsupported(self, where, values=()):
+        self.assertRaises(viewpredicate.UnsupportedWhereClause,
+                          self.compile, where, values)
+
+    def test_null_handling(self):
+        predicate = self.compile('NOT (feed_id = 1)')
+        self.assert_(predicate(FakeObject(feed_id=2)))
+        # NOT NULL is still NULL, which doesn't match
+        self.assert_(not predicate(FakeObject(feed_id=None)))
+        predicate = self.compile('feed_id NOT IN (1, NULL)')
+        self.assert_(not predicate(FakeObject(feed_id=2)))
+        predicate = self.compile('feed_id IS NULL OR feed_id > ?', (5,))
+        self.assert_(predicate(FakeObject(feed_id=None)))
+        self.assert_(predicate(FakeObject(feed_id=6)))
+        self.assert_(not predicate(FakeObject(feed_id=5)))
+
+    def test_like(self):
+        predicate = self.compile("title LIKE 'dtv:s_arch%'")
+        self.assert_(predicate(FakeObject(title=u'DTV:Search foo')))
+        self.assert_(predicate(FakeObject(title=u'dtv:sEarch')))
+        self.assert_(not predicate(FakeObject(title=u'dtv:searc')))
+        self.assert_(not predicate(FakeObject(title=None)))
+
+    def test_columns(self):
+        predicate = self.compile('item.feed_id=? AND (deleted IS NULL OR '
+                                 'NOT deleted)', (1,))
+        self.assertEquals(predicate.columns, set(['feed_id', 'deleted']))
+
+    def test_unsupported(self):
+        self.check_unsupported('LOWER(filename)=LOWER(?)', (u'foo',))
+        self.check_unsupported('feed_id NOT IN (SELECT id from feed)')
+        self.check_unsupported("rd.state='downloading'")
+        self.check_unsupported('folder_id=?', (1,))
+        # comparing different kinds of values would mean copying SQLite's
+        # type affinity rules
+        self.check_unsupported('feed_id=?', (u'1',))
+        self.check_unsupported('title')
+        self.check_unsupported('feed_id=? AND parent_id=?', (1,))
+
+class ViewPredicateTest(MiroTestCase):
+    """Check that compiled predicates give the same results as SQL for the
+    views that we actually use.
+    """
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed, self.items = testobjects.make_feed_with_items(6)
+        self.manual_feed = testobjects.make_manual_feed()
+        self.file_items = [testobjects.make_file_item(self.manual_feed,
+                                                      u'file %d' % i)
+                           for i in xrange(3)]
+        self.items[0].watched_time = datetime.now()
+        self.items[0].last_watched = datetime.now()
+        self.items[1].keep = True
+        self.items[1].watched_time = datetime.now() - timedelta(days=10)
+        self.items[2].file_type = u'audio'
+        self.items[3].pending_manual_download = True
+        self.items[4].downloader_id = 123
+        self.file_items[0].deleted = True
+        self.file_items[1].file_type = u'other'
+        self.file_items[2].is_container_item = True
+        for obj in self.items + self.file_items:
+            obj.signal_change()
+        # child items get a parent_id instead of a feed_id
+        child_path = self.make_temp_path('.avi')
+        testobjects.ensure_file_exists(child_path)
+        child = models.FileItem(child_path, parent_id=self.file_items[2].id)
+        self.file_items.append(child)
+
+    def check_view(self, view):
+        """Cross-check a view's predicate with SQL.
+
+        :returns: True if the view's where clause was compiled
+        """
+        tracker = view.make_tracker()
+        try:
+            if tracker.predicate is None:
+                return False
+            for obj in view.fetcher.klass.make_view():
+                self.assertEquals(tracker.predicate(obj),
+                                  tracker._obj_in_view_sql(obj),
+                                  "%s: %s" % (view.where, obj))
+            return True
+        finally:
+            tracker.unlink()
+
+    def test_item_views(self):
+        Item = models.Item
+        feed_id = self.feed.id
+        parent_id = self.file_items[2].id
+        compiled_views = [
+            Item.manual_pending_view(),
+            Item.feed_view(feed_id),
+            Item.visible_feed_view(feed_id),
+            Item.visible_feed_view(self.manual_feed.id),
+            Item.folder_contents_view(parent_id),
+            Item.feed_available_view(feed_id),
+            Item.children_view(parent_id),
+            Item.feed_expiring_view(feed_id, datetime.now()),
+            Item.media_children_view(parent_id),
+            Item.containers_view(),
+            Item.file_items_view(),
+            Item.recently_watched_view(),
+            Item.downloader_view(123),
+        ]
+        sql_views = [
+            Item.auto_pending_view(),
+            Item.auto_downloads_view(),
+            Item.manual_downloads_view(),
+            Item.download_tab_view(),
+            Item.downloading_view(),
+            Item.only_downloading_view(),
+            Item.paused_view(),
+            Item.newly_downloaded_view(),
+            Item.downloaded_view(),
+            Item.unique_others_view(),
+            Item.unique_new_video_view(),
+            Item.unique_new_audio_view(),
+            Item.toplevel_view(),
+            Item.visible_folder_view(feed_id),
+            Item.feed_downloaded_view(feed_id),
+            Item.feed_downloading_view(feed_id),
+            Item.feed_auto_pending_view(feed_id),
+            Item.feed_unwatched_view(feed_id),
+            Item.search_item_view(),
+            Item.watchable_video_view(),
+            Item.watchable_view(),
+            Item.watchable_audio_view(),
+            Item.watchable_other_view(),
+            Item.orphaned_from_feed_view(),
+            Item.orphaned_from_parent_view(),
+            Item.recently_downloaded_view(),
+            Item.items_with_path_view(self.file_items[0].filename),
+        ]
+        for view in compiled_views:
+            self.assert_(self.check_view(view), view.where)
+        for view in sql_views:
+            self.assert_(not self.check_view(view), view.where)
+
+    def test_feed_views(self):
+        Feed = models.Feed
+        self.assert_(self.check_view(Feed.folder_view(self.feed.id)))
+        self.assert_(self.check_view(Feed.visible_view()))
+        self.assert_(self.check_view(Feed.watched_folder_view()))
+
+    def test_tracker_skips_sql(self):
+        tracker = models.Item.feed_view(self.feed.id).make_tracker()
+        removed = []
+        tracker.connect('removed', lambda tracker, obj: removed.append(obj))
+        def obj_in_view_sql(obj):
+            raise AssertionError("_obj_in_view_sql() called")
+        tracker._obj_in_view_sql = obj_in_view_sql
+        self.items[0].feed_id = self.manual_feed.id
+        self.items[0].signal_change()
+        self.assertEquals(removed, [self.items[0]])
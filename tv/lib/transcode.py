@@ -27,13 +27,17 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import collections
+import cPickle
 import errno
+import hashlib
 import logging
 import subprocess
 import tempfile
 import re
 import os
 import select
+import shutil
 import socket
 import subprocess
 import sys
@@ -207,8 +211,292 @@ def needs_transcode(media_file):
         acopy = audio_can_copy(acodec, sample_rate)
         if not acopy:
             transcode = False
-    return (transcode, (seconds, has_audio, acodec, sample_rate,
-                        has_video, vcodec, size))
+    # return booleans rather than match objects, so that ProbeCache can
+    # pickle the result
+    return (transcode, (seconds, bool(has_audio), acodec, sample_rate,
+                        bool(has_video), vcodec, size))
+
+class _LRUDict(object):
+    """Maps keys to values and keeps track of which was used least recently.
+
+    We can't use collections.OrderedDict, since we still support python 2.6.
+    Each key gets a stamp from a counter when it's set or touched, and
+    self.order holds (stamp, key) pairs, oldest first.  We don't remove old
+    pairs from self.order when a key gets a new stamp, instead pop_oldest()
+    skips pairs that don't match the current stamp.  This makes all
+    operations O(1), except for the occasional compaction.
+    """
+    def __init__(self, items=()):
+        self.data = {}
+        self.stamps = {}
+        self.order = collections.deque()
+        self.counter = 0
+        for key, value in items:
+            self[key] = value
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        self.data[key] = value
+        self.touch(key)
+
+    def get(self, key, default=None):
+        """Get a value without changing the order."""
+        return self.data.get(key, default)
+
+    def touch(self, key):
+        """Mark key as the most recently used one."""
+        self.counter += 1
+        self.stamps[key] = self.counter
+        self.order.append((self.counter, key))
+        if len(self.order) > 2 * len(self.data) + 100:
+            self._compact()
+
+    def pop(self, key, *default):
+        if key not in self.data:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        del self.stamps[key]
+        return self.data.pop(key)
+
+    def pop_oldest(self):
+        """Remove the least recently used key.
+
+        :returns: (key, value) tuple
+        """
+        while self.order:
+            stamp, key = self.order.popleft()
+            if self.stamps.get(key) == stamp:
+                del self.stamps[key]
+                return key, self.data.pop(key)
+        raise KeyError("pop_oldest(): dictionary is empty")
+
+    def keys(self):
+        """Get our keys, least recently used first."""
+        return [key for stamp, key in self.order
+                if self.stamps.get(key) == stamp]
+
+    def values(self):
+        return [self.data[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self.data[key]) for key in self.keys()]
+
+    def _compact(self):
+        self.order = collections.deque(
+            (stamp, key) for stamp, key in self.order
+            if self.stamps.get(key) == stamp)
+
+class ProbeCache(object):
+    """Caches the results of needs_transcode().
+
+    needs_transcode() runs ffmpeg, which is slow, and the sharing code calls
+    it each time a client starts playing or seeks in a file that needs
+    transcoding.  ProbeCache remembers the results for each file, using the
+    file's size and modification time to tell if it has changed.
+
+    The results are saved to disk as a list of (path, entry) tuples, least
+    recently used first, so they survive restarts.  This can be used from
+    multiple threads.
+    """
+    MAX_ENTRIES = 1000
+
+    def __init__(self, cache_path):
+        self.cache_path = cache_path
+        self.lock = threading.Lock()
+        # maps paths to (size, mtime, result) tuples
+        self.entries = _LRUDict(self._load())
+
+    def _load(self):
+        try:
+            f = open(self.cache_path, 'rb')
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                logging.warn("error opening transcode probe cache: %s", e)
+            return []
+        try:
+            try:
+                entries = cPickle.load(f)
+            finally:
+                f.close()
+        except Exception, e:
+            logging.warn("error loading transcode probe cache: %s", e)
+            return []
+        if not isinstance(entries, list):
+            return []
+        return entries
+
+    def _save(self):
+        temp_path = self.cache_path + '.tmp'
+        try:
+            f = open(temp_path, 'wb')
+            try:
+                cPickle.dump(self.entries.items(), f,
+                             cPickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            try:
+                os.rename(temp_path, self.cache_path)
+            except OSError:
+                # windows can't rename over an existing file
+                os.remove(self.cache_path)
+                os.rename(temp_path, self.cache_path)
+        except EnvironmentError, e:
+            logging.warn("error saving transcode probe cache: %s", e)
+
+    def needs_transcode(self, media_file):
+        """Cached version of needs_transcode()."""
+        try:
+            stat = os.stat(media_file)
+        except OSError:
+            # let needs_transcode() handle the error
+            return needs_transcode(media_file)
+        file_key = (stat.st_size, stat.st_mtime)
+        with self.lock:
+            entry = self.entries.get(media_file)
+            if entry is not None and entry[:2] == file_key:
+                self.entries.touch(media_file)
+                return entry[2]
+        result = needs_transcode(media_file)
+        with self.lock:
+            self.entries[media_file] = file_key + (result,)
+            while len(self.entries) > self.MAX_ENTRIES:
+                self.entries.pop_oldest()
+            self._save()
+        return result
+
+class SegmentCache(object):
+    """Keeps transcoded mpegts segments on disk so they can be reused.
+
+    Segments are keyed by a cache key, which identifies the media file and
+    the transcode parameters, and the chunk index.  Each segment is stored in
+    its own file, named after a hash of the key and index, so the cache can
+    be rebuilt by scanning the directory after a restart.
+
+    When the total size goes over max_size, the least recently used segments
+    are removed.  This can be used from multiple threads.
+    """
+    DEFAULT_MAX_SIZE = 512 * 1024 * 1024
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # maps segment filenames to their sizes
+        self.entries = _LRUDict()
+        self.total_size = 0
+        self._scan()
+
+    def _scan(self):
+        if not os.path.exists(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError, e:
+                logging.warn("error creating segment cache directory: %s", e)
+            return
+        files = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith('.ts'):
+                # leftover from a write that didn't finish
+                self._remove_file(path)
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, name, stat.st_size))
+        files.sort()
+        for mtime, name, size in files:
+            self.entries[name] = size
+            self.total_size += size
+        self._evict()
+
+    def _segment_name(self, cache_key, chunk):
+        return hashlib.sha1(repr((cache_key, chunk))).hexdigest() + '.ts'
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError, e:
+            logging.debug("segment cache: error removing %s: %s", path, e)
+
+    def _evict(self, keep_newest=False):
+        if keep_newest:
+            min_entries = 1
+        else:
+            min_entries = 0
+        while (self.total_size > self.max_size and
+               len(self.entries) > min_entries):
+            name, size = self.entries.pop_oldest()
+            self.total_size -= size
+            self._remove_file(os.path.join(self.directory, name))
+
+    def has_segment(self, cache_key, chunk):
+        with self.lock:
+            return self._segment_name(cache_key, chunk) in self.entries
+
+    def get_segment(self, cache_key, chunk):
+        """Get a cached segment.
+
+        :returns: file object for the segment or None if it's not cached
+        """
+        name = self._segment_name(cache_key, chunk)
+        with self.lock:
+            size = self.entries.get(name)
+            if size is None:
+                return None
+            try:
+                fileobj = open(os.path.join(self.directory, name), 'rb')
+            except IOError, e:
+                logging.warn("segment cache: error opening segment: %s", e)
+                self.entries.pop(name)
+                self.total_size -= size
+                return None
+            self.entries.touch(name)
+            return fileobj
+
+    def add_segment(self, cache_key, chunk, fileobj):
+        """Store a segment.
+
+        The contents of fileobj are copied from its current position to the
+        end.
+        """
+        name = self._segment_name(cache_key, chunk)
+        path = os.path.join(self.directory, name)
+        temp_path = path + '.tmp'
+        try:
+            f = open(temp_path, 'wb')
+            try:
+                shutil.copyfileobj(fileobj, f)
+            finally:
+                f.close()
+            size = os.path.getsize(temp_path)
+        except EnvironmentError, e:
+            logging.warn("segment cache: error writing segment: %s", e)
+            self._remove_file(temp_path)
+            return
+        with self.lock:
+            try:
+                if name in self.entries:
+                    os.remove(path)
+                    self.total_size -= self.entries.pop(name)
+                os.rename(temp_path, path)
+            except OSError, e:
+                logging.warn("segment cache: error storing segment: %s", e)
+                self._remove_file(temp_path)
+                return
+            self.entries[name] = size
+            self.total_size += size
+            self._evict(keep_newest=True)
 
 class TranscodeSinkServer(SocketServer.TCPServer):
     pass
@@ -266,6 +554,12 @@ class TranscodeRequestHandler(SocketServer.BaseRequestHandler):
 # the chunk from the server.  In this case, the current transcode operation
 # stops, and a new transcode operation begins at the requested time offset
 # calculated based on which chunk was requested.
+#
+# If a SegmentCache is passed in, each segment is also copied into it.
+# Chunks that are already in the cache, for example because another client
+# watched the same file or because the client seeked backwards, are served
+# from there.  The transcode job only starts at the first chunk that isn't
+# cached.
 class TranscodeObject(object):
     """TranscodeObject
 
@@ -292,8 +586,10 @@ class TranscodeObject(object):
     buffer_high_watermark = 6
 
     def __init__(self, media_file, itemid, generation, chunk, media_info,
-                 request_path_func):
+                 request_path_func, segment_cache=None):
         self.media_file = media_file
+        self.segment_cache = segment_cache
+        self.cache_key = None
         self.in_shutdown = False
         if chunk is not None:
             self.time_offset = chunk * TranscodeObject.segment_duration
@@ -336,6 +632,11 @@ class TranscodeObject(object):
             self.current_chunk = self.start_chunk = chunk
         else:
             self.current_chunk = self.start_chunk = 0
+        # chunk index of the first segment that the transcode job makes and
+        # of the next one it will make.  These get moved forward if there are
+        # cached chunks.
+        self.job_start_chunk = self.next_job_chunk = self.start_chunk
+        # list of (chunk index, file) tuples
         self.chunk_buffer = []
         self.chunk_throttle = threading.Event()
         self.chunk_throttle.set()
@@ -386,13 +687,70 @@ class TranscodeObject(object):
 
     def isseek(self, chunk):
         # Is it requesting the next available chunk in the sequence?
-        if self.current_chunk == chunk:
+        if self.current_chunk != chunk:
+            return True
+        # If we skipped over the chunk because it was cached, but it's been
+        # evicted since, then we need to start a new transcode job for it.
+        return (chunk < self.job_start_chunk and
+                not self.segment_cache.has_segment(self.cache_key, chunk))
+
+    def get_cache_key(self, transcode_args):
+        stat = os.stat(self.media_file)
+        return (self.media_file, stat.st_size, stat.st_mtime,
+                tuple(transcode_args), TranscodeObject.segment_duration)
+
+    def skip_cached_chunks(self, transcode_args):
+        """Move the start of the transcode job past any cached chunks.
+
+        :returns: True if there's nothing left to transcode
+        """
+        self.cache_key = self.get_cache_key(transcode_args)
+        chunk = self.start_chunk
+        while self.segment_cache.has_segment(self.cache_key, chunk):
+            chunk += 1
+        if chunk == self.start_chunk:
             return False
-        return True
+        logging.debug('transcode: chunks %d-%d are cached', self.start_chunk,
+                      chunk - 1)
+        self.job_start_chunk = self.next_job_chunk = chunk
+        self.time_offset = chunk * TranscodeObject.segment_duration
+        # nchunks is only an estimate, but if we've cached everything up to
+        # it, then we must have seen the end of the file.
+        return chunk >= self.nchunks
+
+    def get_transcode_args(self):
+        """Get the ffmpeg arguments that pick the output codecs."""
+        args = []
+        if self.has_video:
+            logging.debug('Video codec: %s', self.video_codec)
+            logging.debug('Video size: %s', self.video_size)
+            if video_can_copy(self.video_codec, self.video_size):
+                args += get_transcode_video_copy_options()
+            else:
+                args += get_transcode_video_options()
+        if self.has_audio:
+            logging.debug('Audio codec: %s', self.audio_codec)
+            logging.debug('Audio sample rate: %s', self.audio_sample_rate)
+            if (valid_av_combo(self.video_codec, self.audio_codec) and
+              audio_can_copy(self.audio_codec, self.audio_sample_rate)):
+                args += get_transcode_audio_copy_options()
+            else:
+                args += get_transcode_audio_options()
+        else:
+           raise ValueError('no video or audio stream present')
+        return args
 
     def transcode(self):
         rc = True
         try:
+            transcode_args = self.get_transcode_args()
+            if (self.segment_cache is not None and
+              self.skip_cached_chunks(transcode_args)):
+                with self.chunk_lock:
+                    self.finished = True
+                self.transcode_gate.set()
+                return rc
+
             ffmpeg_exe = get_ffmpeg_executable_path()
             kwargs = {"stdin": open(os.devnull, 'rb'),
                       "stdout": subprocess.PIPE,
@@ -403,26 +761,7 @@ class TranscodeObject(object):
                 logging.debug('transcode: start job @ %d' % self.time_offset)
                 args += TranscodeObject.time_offset_args + [
                     str(self.time_offset)]
-            video_needs_trancode = False
-            if self.has_video:
-                logging.debug('Video codec: %s', self.video_codec)
-                logging.debug('Video size: %s', self.video_size)
-                if video_can_copy(self.video_codec, self.video_size):
-                    args += get_transcode_video_copy_options()
-                else:
-                    args += get_transcode_video_options()
-                    video_needs_transcode = True
-            if self.has_audio:
-                logging.debug('Audio codec: %s', self.audio_codec)
-                logging.debug('Audio sample rate: %s', self.audio_sample_rate)
-                if (valid_av_combo(self.video_codec, self.audio_codec) and
-                  audio_can_copy(self.audio_codec, self.audio_sample_rate)):
-                    args += get_transcode_audio_copy_options()
-                else:
-                    args += get_transcode_audio_options()
-            else:
-               raise ValueError('no video or audio stream present')
-
+            args += transcode_args
             args += TranscodeObject.output_args
             logging.debug('Running command %s' % ' '.join(args))
             self.ffmpeg_handle = Popen(args, **kwargs)
@@ -464,8 +803,14 @@ class TranscodeObject(object):
                     logging.debug('Transcode: end-of-transcode marker')
                     self.finished = True
                 else:
+                    chunk = self.next_job_chunk
+                    self.next_job_chunk += 1
+                    if self.segment_cache is not None:
+                        self.tmp_file.seek(0, os.SEEK_SET)
+                        self.segment_cache.add_segment(self.cache_key, chunk,
+                                                       self.tmp_file)
                     self.tmp_file.seek(0, os.SEEK_SET)
-                    self.chunk_buffer.append(self.tmp_file)
+                    self.chunk_buffer.append((chunk, self.tmp_file))
                     chunk_buffer_size = len(self.chunk_buffer)
                     if (chunk_buffer_size >= 
                       TranscodeObject.buffer_high_watermark):
@@ -503,28 +848,50 @@ class TranscodeObject(object):
             except StandardError:
                 raise
 
+    def discard_old_chunks(self):
+        # Drop segments that we've already served from the cache.  Call this
+        # with chunk_lock held.
+        while (self.chunk_buffer and
+               self.chunk_buffer[0][0] < self.current_chunk):
+            self.chunk_buffer.pop(0)[1].close()
+            self.chunk_throttle.set()
+
     def get_chunk(self):
+        if self.segment_cache is not None and self.cache_key is not None:
+            tmpf = self.segment_cache.get_segment(self.cache_key,
+                                                  self.current_chunk)
+            if tmpf is not None:
+                with self.chunk_lock:
+                    self.current_chunk += 1
+                    self.discard_old_chunks()
+                return tmpf
+
         # End of transcode check: if the transcode returned not enough
-        # chunks, then send an empty file.
+        # chunks, then send an empty file.  Also send one if the chunk got
+        # evicted from the cache after we skipped over it.
         with self.chunk_lock:
-            if self.finished and not self.chunk_buffer:
+            if ((self.finished and not self.chunk_buffer) or
+              self.current_chunk < self.job_start_chunk):
                 return tempfile.TemporaryFile()
 
-        # Consume an item
-        self.chunk_sem.acquire()
-        with self.chunk_lock:
-            # If we got woken up, and there is nothing there, maybe it's
-            # because the job has been aborted?  If this is the case,
-            # ensure we return a sensible empty file. (or maybe alternatively
-            # an error).
-            if self.chunk_buffer:
-                tmpf = self.chunk_buffer[0]
-                self.current_chunk += 1
-                self.chunk_buffer = self.chunk_buffer[1:]
-                self.chunk_throttle.set()
-            else:
-                tmpf = tempfile.TemporaryFile()
-        return tmpf
+        # Consume an item.  chunk_sem gets released once for each segment,
+        # so if discard_old_chunks() threw some away, we may need to wait
+        # again.
+        while True:
+            self.chunk_sem.acquire()
+            with self.chunk_lock:
+                self.discard_old_chunks()
+                if self.chunk_buffer:
+                    tmpf = self.chunk_buffer.pop(0)[1]
+                    self.current_chunk += 1
+                    self.chunk_throttle.set()
+                    return tmpf
+                # If we got woken up, and there is nothing there, maybe it's
+                # because the job has been aborted?  If this is the case,
+                # ensure we return a sensible empty file. (or maybe
+                # alternatively an error).
+                if self.finished or self.in_shutdown:
+                    return tempfile.TemporaryFile()
 
     # Shutdown the transcode job.  If we quitting, make sure you call this
     # so the segmenter et al have a chance to clean up.
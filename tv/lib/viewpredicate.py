@@ -0,0 +1,484 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005, 2006, 2007, 2008, 2009, 2010, 2011
+# Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""viewpredicate.py -- Check if objects match a view without using SQL.
+
+ViewTracker needs to know if an object is in its view every time that object
+changes.  Running a SELECT for each tracker on each change adds up quickly, so
+for simple WHERE clauses we compile a python function that evaluates the
+clause against the object's attributes instead.
+
+We only handle a small subset of SQL: AND, OR, NOT, comparisons, IS [NOT]
+NULL, [NOT] IN with a list of values, [NOT] LIKE and parentheses.  Every
+column has to be from the object's own table.  compile_where() raises
+UnsupportedWhereClause for anything else and callers should fall back to
+running the query.
+
+We follow SQLite's rules for NULL values, so each sub-expression evaluates to
+True, False or None (NULL).  To avoid having to copy SQLite's type affinity
+rules, we only allow comparisons between values of the same kind (numbers,
+text or dates).
+"""
+
+import datetime
+import operator
+import re
+
+class UnsupportedWhereClause(ValueError):
+    """Raised when we can't compile a WHERE clause."""
+    pass
+
+# kinds of values that we know how to compare
+NUMERIC = 'numeric'
+TEXT = 'text'
+DATETIME = 'datetime'
+NULL = 'null'
+OTHER = 'other'
+
+_column_kinds = None
+
+def _column_kind(schema_item):
+    global _column_kinds
+    if _column_kinds is None:
+        # import here because schema imports database, which imports us
+        from miro import schema
+        _column_kinds = {
+            schema.SchemaBool: NUMERIC,
+            schema.SchemaInt: NUMERIC,
+            schema.SchemaFloat: NUMERIC,
+            schema.SchemaString: TEXT,
+            schema.SchemaURL: TEXT,
+            schema.SchemaFilename: TEXT,
+            schema.SchemaDateTime: DATETIME,
+        }
+    return _column_kinds.get(schema_item.__class__, OTHER)
+
+_comparisons = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<>': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+_token_re = re.compile(r"""
+    \s*(?:
+        (?P<string>'(?:[^']|'')*') |
+        (?P<number>\d+(?:\.\d+)?) |
+        (?P<param>\?) |
+        (?P<op>==|!=|<>|<=|>=|=|<|>) |
+        (?P<punct>[(),]) |
+        (?P<name>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)?)
+    )""", re.VERBOSE)
+
+_keywords = frozenset(['and', 'or', 'not', 'is', 'null', 'in', 'like'])
+
+def _tokenize(where):
+    tokens = []
+    pos = 0
+    end = len(where.rstrip())
+    while pos < end:
+        m = _token_re.match(where, pos)
+        if m is None:
+            raise UnsupportedWhereClause("can't parse %r" % where[pos:])
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'name' and value.lower() in _keywords:
+            kind = 'keyword'
+            value = value.lower()
+        tokens.append((kind, value))
+        pos = m.end()
+    return tokens
+
+def value_kind(value):
+    """Get the kind of a python value that we're comparing against."""
+    if value is None:
+        return NULL
+    elif isinstance(value, (bool, int, long, float)):
+        return NUMERIC
+    elif isinstance(value, basestring):
+        return TEXT
+    elif isinstance(value, datetime.datetime):
+        return DATETIME
+    else:
+        return OTHER
+
+def _check_comparable(kind1, kind2):
+    if NULL in (kind1, kind2):
+        return
+    if kind1 != kind2 or kind1 == OTHER:
+        raise UnsupportedWhereClause("can't compare %s to %s" %
+                                     (kind1, kind2))
+
+def _constant(value):
+    return lambda obj: value
+
+def _truth_value(kind, func):
+    """Convert an expression to True/False/None like SQLite does when it's
+    used as a condition.
+    """
+    if kind == NUMERIC:
+        def truth(obj):
+            value = func(obj)
+            if value is None:
+                return None
+            return value != 0
+        return truth
+    elif kind == DATETIME:
+        # SQLite converts the date string to a number, which gives us the
+        # year
+        def truth(obj):
+            if func(obj) is None:
+                return None
+            return True
+        return truth
+    elif kind == NULL:
+        return _constant(None)
+    else:
+        raise UnsupportedWhereClause("can't use %s value as a condition" %
+                                     kind)
+
+def _and(left, right):
+    def evaluate(obj):
+        left_value = left(obj)
+        if left_value is False:
+            return False
+        right_value = right(obj)
+        if right_value is False:
+            return False
+        if left_value is None or right_value is None:
+            return None
+        return True
+    return evaluate
+
+def _or(left, right):
+    def evaluate(obj):
+        left_value = left(obj)
+        if left_value is True:
+            return True
+        right_value = right(obj)
+        if right_value is True:
+            return True
+        if left_value is None or right_value is None:
+            return None
+        return False
+    return evaluate
+
+def _not(func):
+    def evaluate(obj):
+        value = func(obj)
+        if value is None:
+            return None
+        return not value
+    return evaluate
+
+def _compare(op, left, right):
+    def evaluate(obj):
+        left_value = left(obj)
+        if left_value is None:
+            return None
+        right_value = right(obj)
+        if right_value is None:
+            return None
+        return op(left_value, right_value)
+    return evaluate
+
+def _is_null(func):
+    return lambda obj: func(obj) is None
+
+def _in(func, values):
+    has_null = None in values
+    values = frozenset(v for v in values if v is not None)
+    def evaluate(obj):
+        value = func(obj)
+        if value is None:
+            return None
+        if value in values:
+            return True
+        if has_null:
+            return None
+        return False
+    return evaluate
+
+def like_pattern_to_regex(pattern):
+    """Convert a LIKE pattern to a regular expression.
+
+    SQLite's LIKE is case insensitive for ASCII characters only, so we can't
+    just use re.IGNORECASE.
+    """
+    parts = []
+    for c in pattern:
+        if c == '%':
+            parts.append('.*')
+        elif c == '_':
+            parts.append('.')
+        elif ('a' <= c <= 'z') or ('A' <= c <= 'Z'):
+            parts.append('[%s%s]' % (c.lower(), c.upper()))
+        else:
+            parts.append(re.escape(c))
+    return re.compile(''.join(parts) + r'\Z', re.DOTALL)
+
+def _like(func, pattern):
+    regex = like_pattern_to_regex(pattern)
+    def evaluate(obj):
+        value = func(obj)
+        if value is None:
+            return None
+        return regex.match(value) is not None
+    return evaluate
+
+class _WhereCompiler(object):
+    def __init__(self, where, values, table_name, obj_schema, converter):
+        self.tokens = _tokenize(where)
+        self.pos = 0
+        self.values = values
+        self.value_pos = 0
+        self.table_name = table_name.lower()
+        self.obj_schema = obj_schema
+        self.converter = converter
+        self.columns = {}
+        for name, schema_item in obj_schema.fields:
+            self.columns[name.lower()] = (name, schema_item)
+        self.referenced_columns = set()
+
+    def compile(self):
+        func = self.parse_or()
+        if self.pos != len(self.tokens):
+            raise UnsupportedWhereClause("unexpected token: %r" %
+                                         (self.peek(),))
+        if self.value_pos != len(self.values):
+            raise UnsupportedWhereClause("too many values")
+        return func
+
+    def peek(self, offset=0):
+        try:
+            return self.tokens[self.pos + offset]
+        except IndexError:
+            return (None, None)
+
+    def next(self):
+        token = self.peek()
+        if token[0] is None:
+            raise UnsupportedWhereClause("unexpected end of WHERE clause")
+        self.pos += 1
+        return token
+
+    def accept_keyword(self, keyword):
+        if self.peek() == ('keyword', keyword):
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, kind, value):
+        if self.next() != (kind, value):
+            raise UnsupportedWhereClause("expected %r" % value)
+
+    def parse_or(self):
+        func = self.parse_and()
+        while self.accept_keyword('or'):
+            func = _or(func, self.parse_and())
+        return func
+
+    def parse_and(self):
+        func = self.parse_not()
+        while self.accept_keyword('and'):
+            func = _and(func, self.parse_not())
+        return func
+
+    def parse_not(self):
+        if self.accept_keyword('not'):
+            return _not(self.parse_not())
+        kind, func = self.parse_predicate()
+        return _truth_value(kind, func)
+
+    def parse_predicate(self):
+        """Parse a predicate.
+
+        :returns: (kind, function) tuple
+        """
+        kind, func = self.parse_operand()
+        token = self.peek()
+        if token[0] == 'op':
+            self.next()
+            right_kind, right_func = self.parse_operand()
+            _check_comparable(kind, right_kind)
+            return NUMERIC, _compare(_comparisons[token[1]], func, right_func)
+        elif self.accept_keyword('is'):
+            negate = self.accept_keyword('not')
+            self.expect('keyword', 'null')
+            if negate:
+                return NUMERIC, _not(_is_null(func))
+            else:
+                return NUMERIC, _is_null(func)
+        negate = False
+        if (token == ('keyword', 'not') and
+                self.peek(1) in (('keyword', 'in'), ('keyword', 'like'))):
+            self.next()
+            negate = True
+        if self.accept_keyword('in'):
+            result = self.parse_in(kind, func)
+        elif self.accept_keyword('like'):
+            result = self.parse_like(kind, func)
+        else:
+            return kind, func
+        if negate:
+            result = _not(result)
+        return NUMERIC, result
+
+    def parse_in(self, kind, func):
+        self.expect('punct', '(')
+        values = []
+        while True:
+            value_kind, value = self.parse_constant()
+            _check_comparable(kind, value_kind)
+            values.append(value)
+            if self.peek() == ('punct', ')'):
+                self.next()
+                return _in(func, values)
+            self.expect('punct', ',')
+
+    def parse_like(self, kind, func):
+        pattern_kind, pattern = self.parse_constant()
+        if kind != TEXT or pattern_kind != TEXT:
+            raise UnsupportedWhereClause("LIKE only supported for text")
+        return _like(func, pattern)
+
+    def parse_constant(self):
+        """Parse a literal value or a parameter.
+
+        :returns: (kind, value) tuple
+        """
+        token_kind, token_value = self.next()
+        if token_kind == 'string':
+            value = token_value[1:-1].replace("''", "'")
+            if isinstance(value, str):
+                value = value.decode('utf-8')
+        elif token_kind == 'number':
+            if '.' in token_value:
+                value = float(token_value)
+            else:
+                value = int(token_value)
+        elif token_kind == 'param':
+            try:
+                value = self.values[self.value_pos]
+            except IndexError:
+                raise UnsupportedWhereClause("not enough values")
+            self.value_pos += 1
+        elif (token_kind, token_value) == ('keyword', 'null'):
+            value = None
+        else:
+            raise UnsupportedWhereClause("expected a value, not %r" %
+                                         token_value)
+        return value_kind(value), value
+
+    def parse_operand(self):
+        """Parse a value, column or parenthesized expression.
+
+        :returns: (kind, function) tuple
+        """
+        token_kind, token_value = self.peek()
+        if token_kind in ('string', 'number', 'param'):
+            kind, value = self.parse_constant()
+            return kind, _constant(value)
+        elif (token_kind, token_value) == ('keyword', 'null'):
+            self.next()
+            return NULL, _constant(None)
+        elif (token_kind, token_value) == ('punct', '('):
+            self.next()
+            func = self.parse_or()
+            self.expect('punct', ')')
+            return NUMERIC, func
+        elif token_kind == 'name':
+            self.next()
+            if self.peek() == ('punct', '('):
+                raise UnsupportedWhereClause("functions not supported: %s" %
+                                             token_value)
+            return self.column_reader(token_value)
+        else:
+            raise UnsupportedWhereClause("unexpected token: %r" %
+                                         token_value)
+
+    def column_reader(self, column):
+        if '.' in column:
+            table, column_name = column.split('.')
+            if table.lower() != self.table_name:
+                raise UnsupportedWhereClause("column from another table: %s"
+                                             % column)
+            column = column_name
+        try:
+            name, schema_item = self.columns[column.lower()]
+        except KeyError:
+            # Must be a column from a joined table
+            raise UnsupportedWhereClause("unknown column: %s" % column)
+        self.referenced_columns.add(name)
+        kind = _column_kind(schema_item)
+        obj_schema = self.obj_schema
+        to_sql = self.converter.to_sql
+        def read_column(obj):
+            return to_sql(obj_schema, name, schema_item, getattr(obj, name))
+        return kind, read_column
+
+class WherePredicate(object):
+    """Compiled version of a WHERE clause.
+
+    Call it with a DDBObject to check if the object matches the clause.
+
+    Attributes:
+    - where -- the WHERE clause we compiled
+    - columns -- set of column names that the clause uses
+    """
+    def __init__(self, where, func, columns):
+        self.where = where
+        self.func = func
+        self.columns = columns
+
+    def __call__(self, obj):
+        # WHERE only matches rows where the clause is true, not NULL
+        return self.func(obj) is True
+
+def compile_where(where, values, table_name, obj_schema, converter):
+    """Compile a WHERE clause into a WherePredicate.
+
+    :param where: WHERE clause, or None to match all objects
+    :param values: values for the ? placeholders in where
+    :param table_name: table that the objects are stored in
+    :param obj_schema: ObjectSchema for the table
+    :param converter: SQLiteConverter used to convert attributes to the
+        values that get stored in the database
+    :raises UnsupportedWhereClause: we can't compile where
+    """
+    if where is None:
+        return WherePredicate(where, _constant(True), set())
+    compiler = _WhereCompiler(where, values, table_name, obj_schema,
+                              converter)
+    func = compiler.compile()
+    return WherePredicate(where, func, compiler.referenced_columns)
@@ -27,11 +27,16 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
-"""```workerprocess.py``` -- Miro worker subprocess
+"""```workerprocess.py``` -- Miro worker subprocesses
 
 To avoid UI freezing due to the GIL, we farm out all CPU-intensive backend
-tasks to this process.  See #17328 for more details.  Right now this just
-includes feedparser, but we could pretty easily extend this to other tasks.
+tasks to these processes.  See #17328 for more details.  Right now this
+includes feedparser, mutagen and movie data.
+
+We run a pool of worker processes so that big jobs, like importing a large
+music library, can use more than one core.  Tasks wait in the main process
+until a worker has room for them, so the highest priority tasks always go
+out first no matter how many processes we have.
 """
 
 from collections import deque, namedtuple
@@ -111,6 +116,14 @@ class TaskResult(subprocessmanager.SubprocessResponse):
         self.task_id = task_id
         self.result = result
 
+class TasksCanceled(subprocessmanager.SubprocessResponse):
+    """Report tasks that we dropped because of a CancelFileOperations.
+
+    We won't send a TaskResult for these.
+    """
+    def __init__(self, task_ids):
+        self.task_ids = task_ids
+
 class MovieDataTaskStatus(subprocessmanager.SubprocessResponse):
     """Report when we are handling movie data tasks.
 
@@ -189,12 +202,18 @@ class WorkerProcessHandler(subprocessmanager.SubprocessHandler):
 
     def handle_cancel_file_operations(self, msg):
         path_set = set(msg.paths)
-        self.task_queue.cancel_file_operations(path_set)
+        canceled = self.task_queue.cancel_file_operations(path_set)
         # we need to handle main_thread_tasks, since those skip the task
         # queue
-        filtered_tasks = deque(t for t in self.main_thread_tasks
-                               if t.source_path not in path_set)
+        filtered_tasks = deque()
+        for method, task in self.main_thread_tasks:
+            if task.source_path in path_set:
+                canceled.append(task)
+            else:
+                filtered_tasks.append((method, task))
         self.main_thread_tasks = filtered_tasks
+        if canceled:
+            TasksCanceled([t.task_id for t in canceled]).send_to_main_process()
         return None
 
     # handle_movie_data_program_task gets called in the main thread, unlike
@@ -258,12 +277,19 @@ class _SinglePriorityQueue(object):
 
         :param filterfunc: function to determine if messages should stay
         :param message_class: type of messages to filter
+        :returns: list of messages removed
         """
         fifo = self.fifo_map[message_class]
-        new_items = tuple((method, msg) for (method, msg) in fifo
-                         if filterfunc(msg))
+        new_items = []
+        removed = []
+        for method, msg in fifo:
+            if filterfunc(msg):
+                new_items.append((method, msg))
+            else:
+                removed.append(msg)
         fifo.clear()
         fifo.extend(new_items)
+        return removed
 
 class WorkerTaskQueue(object):
     """Store the pending tasks for the worker process.
@@ -273,6 +299,9 @@ class WorkerTaskQueue(object):
 
     It's shared between the main subprocess thread, and all worker threads, so
     all methods need to be thread-safe.
+
+    The main process also uses one to hold tasks until a worker process has
+    room for them.
     """
     def __init__(self):
         self.should_quit = False
@@ -322,6 +351,15 @@ class WorkerTaskQueue(object):
                 return None
             return self._get_next_task()
 
+    def get_next_task_nowait(self):
+        """Get the next task to be processed without blocking.
+
+        :returns: (handler_method, message) tuple, or None if there are no
+        tasks in the queue
+        """
+        with self.condition:
+            return self._get_next_task()
+
     def _get_next_task(self):
         for queue in self.queues_by_priority:
             next_for_queue = queue.get_next_task()
@@ -331,15 +369,20 @@ class WorkerTaskQueue(object):
         return None
 
     def cancel_file_operations(self, path_set):
-        """Cancels all mutagen/movie data tasks for a list of paths."""
+        """Cancels all mutagen/movie data tasks for a list of paths.
+
+        :returns: list of canceled messages
+        """
         # Acquire our lock as soon as possible.  We want to prevent other
         # tasks from getting tasks, since they may be about to deleted.
         with self.condition:
             def filter_func(msg):
                 return msg.source_path not in path_set
+            canceled = []
             for cls in (MutagenTask, MovieDataProgramTask):
                 queue = self.queue_map[cls.priority]
-                queue.filter_messages(filter_func, cls)
+                canceled.extend(queue.filter_messages(filter_func, cls))
+            return canceled
 
     def shutdown(self):
         # should be save to set this without the lock, since it's a boolean
@@ -385,15 +428,15 @@ MovieDataTaskStatusInfo = namedtuple('MovieDataTaskStatusInfo',
                                      'task_id start_time')
 
 class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
-    def __init__(self):
+    def __init__(self, worker_process):
         subprocessmanager.SubprocessResponder.__init__(self)
+        self.worker_process = worker_process
         self.worker_ready = False
-        self.startup_message = None
         self.movie_data_task_status = None
 
     def on_startup(self):
-        self.startup_message.send_to_process()
-        _miro_task_queue.run_pending_tasks()
+        self.worker_process.send_message(self.worker_process.startup_message)
+        _miro_task_queue.process_started(self.worker_process)
 
     def on_shutdown(self):
         # do the tasks that we've already gotten
@@ -404,7 +447,10 @@ class WorkerProcessResponder(subprocessmanager.SubprocessResponder):
         self.worker_ready = False
 
     def handle_task_result(self, msg):
-        _miro_task_queue.process_result(msg)
+        _miro_task_queue.process_result(self.worker_process, msg)
+
+    def handle_tasks_canceled(self, msg):
+        _miro_task_queue.process_canceled(self.worker_process, msg.task_ids)
 
     def handle_worker_process_ready(self, msg):
         self.worker_ready = True
@@ -421,43 +467,143 @@ class MiroTaskQueue(object):
 
     Responsible for:
         - Storing callbacks/errbacks for each pending task
+        - Sending tasks to the worker processes in priority order, as they
+          have room for them
         - Calling the callback/errback for a finished task
     """
     def __init__(self):
-        # maps task_ids to (msg, callback, errback) tuples
-        self.tasks_in_progress = {}
+        self.reset()
 
     def reset(self):
+        # maps task_ids to (msg, callback, errback) tuples
         self.tasks_in_progress = {}
+        # tasks that we haven't sent to a worker process yet
+        self.pending_tasks = WorkerTaskQueue()
 
     def add_task(self, msg, callback, errback):
         """Add a new task to the queue."""
+        if isinstance(msg, CancelFileOperations):
+            self.cancel_file_operations(msg)
+            return
         self.tasks_in_progress[msg.task_id] = (msg, callback, errback)
-        if _subprocess_manager.is_running:
-            msg.send_to_process()
+        self.pending_tasks.add_task(None, msg)
+        self.send_pending_tasks()
+
+    def send_pending_tasks(self):
+        """Send tasks to our worker processes while they have room."""
+        while True:
+            process = _subprocess_manager.least_busy_process()
+            if process is None:
+                return
+            next_task = self.pending_tasks.get_next_task_nowait()
+            if next_task is None:
+                return
+            method, msg = next_task
+            if msg.task_id in self.tasks_in_progress:
+                process.send_task(msg)
+            # else the task finished or was canceled while it was waiting to
+            # be resent after a restart.
+
+    def cancel_file_operations(self, msg):
+        path_set = set(msg.paths)
+        for canceled in self.pending_tasks.cancel_file_operations(path_set):
+            del self.tasks_in_progress[canceled.task_id]
+        # The worker processes will tell us what they canceled with a
+        # TasksCanceled message.
+        for process in _subprocess_manager.processes:
+            if process.is_running:
+                process.send_message(msg)
+            else:
+                self._cancel_in_flight_tasks(process, path_set)
 
-    def process_result(self, reply):
-        """Process a TaskResult from our subprocess."""
-        msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+    def _cancel_in_flight_tasks(self, process, path_set):
+        for task_id in list(process.tasks_in_flight):
+            try:
+                task_msg = self.tasks_in_progress[task_id][0]
+            except KeyError:
+                continue
+            if getattr(task_msg, 'source_path', None) in path_set:
+                process.task_finished(task_id)
+                del self.tasks_in_progress[task_id]
+
+    def process_result(self, process, reply):
+        """Process a TaskResult from one of our subprocesses."""
+        process.task_finished(reply.task_id)
+        self.send_pending_tasks()
+        try:
+            msg, callback, errback = self.tasks_in_progress.pop(reply.task_id)
+        except KeyError:
+            # Either this is the reply to a CancelFileOperations, which we
+            # don't track, or we already got a result for this task.  That
+            # happens when a process finishes a task just before it gets
+            # restarted and we send the task out again.
+            return
         if isinstance(reply.result, Exception):
             errback(msg, reply.result)
         else:
             callback(msg, reply.result)
 
-    def run_pending_tasks(self):
-        """Rerun all tasks in the queue."""
-        for msg, callback, errback in self.tasks_in_progress.values():
-            msg.send_to_process()
+    def process_canceled(self, process, task_ids):
+        """Process a TasksCanceled message from one of our subprocesses."""
+        for task_id in task_ids:
+            process.task_finished(task_id)
+            self.tasks_in_progress.pop(task_id, None)
+        self.send_pending_tasks()
+
+    def process_started(self, process):
+        """Call when a worker process starts up or restarts."""
+        self.requeue_tasks(process)
+        self.send_pending_tasks()
+
+    def requeue_tasks(self, process):
+        """Put the tasks we sent to a process back in the queue.
+
+        Call this when the process quits before finishing them.
+        """
+        for task_id in process.tasks_in_flight:
+            try:
+                msg = self.tasks_in_progress[task_id][0]
+            except KeyError:
+                continue
+            self.pending_tasks.add_task(None, msg)
+        process.tasks_in_flight.clear()
 
 _miro_task_queue = MiroTaskQueue()
 
-# Manage subprocess
-class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
-    def __init__(self):
-        subprocessmanager.SubprocessManager.__init__(self, WorkerMessage,
-                WorkerProcessResponder(), WorkerProcessHandler)
+# Manage subprocesses
+class WorkerProcess(subprocessmanager.SubprocessManager):
+    """Manages one worker subprocess.
+
+    We keep track of the tasks that we've sent to the process, so that we
+    only send it as many as it can work on, and so we can send them again
+    if the process needs to be restarted.
+    """
+    # How long a movie data task can run before we decide the process hung
+    HUNG_TIMEOUT = 90
+
+    def __init__(self, name, handler_class, startup_message, restart_delay):
+        subprocessmanager.SubprocessManager.__init__(self, None,
+                WorkerProcessResponder(self), handler_class,
+                restart_delay=restart_delay)
+        self.name = name
+        self.startup_message = startup_message
+        # task ids we've sent to the process, but haven't heard back about
+        self.tasks_in_flight = set()
+        # The worker threads handle most tasks, but movie data tasks run
+        # in the subprocess's main thread, so allow for one extra.
+        self.max_tasks = startup_message.thread_count + 1
         self.check_hung_timeout = None
 
+    def has_room(self):
+        return self.is_running and len(self.tasks_in_flight) < self.max_tasks
+
+    def send_task(self, msg):
+        self.tasks_in_flight.add(msg.task_id)
+        self.send_message(msg)
+
+    def task_finished(self, task_id):
+        self.tasks_in_flight.discard(task_id)
+
     def _start(self):
         subprocessmanager.SubprocessManager._start(self)
         self.schedule_check_subprocess_hung()
@@ -472,7 +618,7 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
         subprocessmanager.SubprocessManager.restart(self, clean)
 
     def schedule_check_subprocess_hung(self):
-        self.check_hung_timeout = eventloop.add_timeout(90,
+        self.check_hung_timeout = eventloop.add_timeout(self.HUNG_TIMEOUT,
                 self.check_subprocess_hung, 'check workerprocess hung')
 
     def cancel_check_subprocess_hung(self):
@@ -484,8 +630,8 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
         task_status = self.responder.movie_data_task_status
 
         if (task_status is not None and
-                clock.clock() - task_status.start_time > 90):
-            logging.warn("Worker process is hanging on a movie data task.")
+                clock.clock() - task_status.start_time > self.HUNG_TIMEOUT):
+            logging.warn("%s is hanging on a movie data task.", self.name)
             error_result = TaskResult(task_status.task_id,
                     SubprocessTimeoutError())
             self.responder.handle_task_result(error_result)
@@ -493,17 +639,88 @@ class WorkerSubprocessManager(subprocessmanager.SubprocessManager):
         else:
             self.schedule_check_subprocess_hung()
 
+class WorkerSubprocessManager(object):
+    """Manages our pool of worker subprocesses.
+
+    Each process gets started, checked for hangs and restarted on its own.
+    WorkerMessages that aren't tasks get sent to every process.
+    """
+    def __init__(self):
+        self.handler_class = WorkerProcessHandler
+        self.restart_delay = 60
+        self.processes = []
+        WorkerMessage.install_handler(self)
+
+    @property
+    def is_running(self):
+        return any(process.is_running for process in self.processes)
+
+    def start(self, thread_count=3, process_count=1):
+        if self.is_running:
+            return
+        self.processes = []
+        for i in xrange(process_count):
+            self.processes.append(WorkerProcess('Worker process %d' % i,
+                self.handler_class, WorkerStartupInfo(thread_count),
+                self.restart_delay))
+        for process in self.processes:
+            process.start()
+
+    def shutdown(self):
+        for process in self.processes:
+            process.shutdown()
+            # send anything it didn't finish to the next process we start
+            _miro_task_queue.requeue_tasks(process)
+
+    def restart(self, clean=False):
+        for process in self.processes:
+            if process.is_running:
+                process.restart(clean)
+
+    def least_busy_process(self):
+        """Get the process that should get the next task.
+
+        :returns: WorkerProcess or None if none of them have room
+        """
+        candidates = [p for p in self.processes if p.has_room()]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda p: len(p.tasks_in_flight))
+
+    # implement the MessageHandler interface
+
+    def handle(self, msg):
+        for process in self.processes:
+            if process.is_running:
+                process.send_message(msg)
+
 _subprocess_manager = WorkerSubprocessManager()
 
-def startup(thread_count=3):
-    """Startup the worker process."""
+# Don't start more than this many processes unless we're asked to.  Each one
+# has its own copy of feedparser, mutagen, etc. in memory.
+MAX_DEFAULT_PROCESS_COUNT = 4
+
+def default_process_count():
+    """Pick how many worker processes to run.
+
+    We leave one core for the main process.
+    """
+    cpu_count = utils.get_logical_cpu_count()
+    return max(1, min(cpu_count - 1, MAX_DEFAULT_PROCESS_COUNT))
+
+def startup(thread_count=3, process_count=None):
+    """Startup the worker processes.
 
-    startup_msg = WorkerStartupInfo(thread_count)
-    _subprocess_manager.responder.startup_message = startup_msg
-    _subprocess_manager.start()
+    :param thread_count: number of worker threads in each process
+    :param process_count: number of processes to run.  By default, this
+    depends on how many cores we have.
+    """
+    if process_count is None:
+        process_count = default_process_count()
+    _subprocess_manager.start(thread_count, process_count)
 
 def shutdown():
-    """Shutdown the worker process."""
+    """Shutdown the worker processes."""
     _subprocess_manager.shutdown()
 
 # API for sending tasks
@@ -519,8 +736,8 @@ def send(msg, callback, errback):
 def cancel_tasks_for_files(paths):
     """Cancel mutagen and movie data tasks for a list of paths."""
     msg = CancelFileOperations(paths)
-    # we don't care about the return value, but we still want to use the task
-    # queue to queue up this message.
+    # we don't care about the return value, but we still send this through
+    # the task queue, which passes it on to all of the worker processes.
     def null_callback(msg, result):
         pass
     send(msg, null_callback, null_callback)